@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+AN-017 - Check of energy_accounting.py against the trace headers written by QIS and QPS
+
+QIS writes the time column of a stream as "Time uS" (or "Time nS" for some modules), and traces exported or merged in
+QPS can use "Time mS".  This script writes a short trace with each of these headers, sampled every mS at 2W up to
+499mS and 4W from 500mS, and checks the energy phase_energy() gives for the two halves of each one: 1.001J up to 500mS
+(the power rises from 2W to 4W over the last mS) and 2J after.  No module is required.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, it prints the result for each header and exits with an error if any check fails:
+    python EnergyAccountingCheck.py
+
+####################################
+'''
+import os
+import sys
+import tempfile
+
+from energy_accounting import phase_energy
+
+# Header of each trace checked, and the number of time units per second of its time column
+HEADERS = [
+    ("Time uS,5V Voltage mV,5V Current uA,5V Power uW,12V Voltage mV,12V Current uA,12V Power uW,Tot Power uW", 1e6),
+    ("Time nS,5V Voltage mV,5V Current uA,5V Power uW,Tot Power uW", 1e9),
+    ("Time mS,3v3 Voltage mV,3v3 Current mA,3v3 Power mW", 1e3),
+    ("Time us,Tot uW", 1e6),
+]
+
+# The two halves of each trace, in mS, and their expected energy in joules
+PHASES = [("2W", 0, 500), ("4W", 500, 1000)]
+EXPECTED_JOULES = [1.001, 2.0]
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for header, units_per_second in HEADERS:
+            path = os.path.join(directory, "trace.csv")
+            write_trace(path, header, units_per_second)
+            try:
+                energies = phase_energy(path, PHASES, phase_unit="ms")
+            except ValueError as error:
+                print("FAIL  " + header.split(",")[0] + ": " + str(error))
+                failures += 1
+                continue
+            joules = [energy.joules for energy in energies]
+            passed = all(abs(value - expected) < 1e-9 for value, expected in zip(joules, EXPECTED_JOULES))
+            failures += 0 if passed else 1
+            print(("PASS  " if passed else "FAIL  ") + header.split(",")[0] + ": " +
+                  ", ".join("{} {:.6f} J".format(energy.label, energy.joules) for energy in energies))
+    return 1 if failures else 0
+
+
+# Writes one second of a trace at 1000 samples per second, 2W up to 499mS and 4W from 500mS.  The columns between the
+# time and the last one (the power column that is integrated) are written as 0
+def write_trace(path, header, units_per_second):
+    names = header.split(",")
+    power_scale = {"uW": 1e6, "mW": 1e3}[names[-1].split()[-1]]
+    with open(path, "w") as file:
+        file.write(header + "\n")
+        for sample in range(1001):
+            watts = 2.0 if sample < 500 else 4.0
+            time = int(round(sample * units_per_second / 1000))
+            values = [0] * (len(names) - 2) + [int(round(watts * power_scale))]
+            file.write(",".join(str(value) for value in [time] + values) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
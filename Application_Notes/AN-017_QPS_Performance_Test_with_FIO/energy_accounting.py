@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Energy accounting of the test phases in a QPS / QIS CSV trace, from the raw power samples.
+
+calculate_results() in performanceTestFIO.py divides the mean throughput of each FIO job by the mean power QPS
+calculated for it.  This module calculates the energy of each test phase from the exported trace instead, in one pass
+over the file however many phases there are:
+
+1- A phase is a label and a time range, such as the start and end of an FIO job.  annotation_phases() makes the phases
+   between a list of annotations, where each phase runs from one annotation to the next
+2- The power is integrated over time with the trapezoidal rule.  A phase boundary that falls between two samples
+   splits the interval between them, with the power at the boundary interpolated, so each phase gets exactly the
+   energy of its own time range
+3- The joules, average power (joules / time covered by the trace) and peak power of each phase are returned as a
+   PhaseEnergy, and job_efficiency() combines them with the throughput of the job (MB/s and IOPS) into efficiency
+   metrics such as (MB/s)/W and MB per joule
+
+The integral is kept as a running cumulative sum over the blocks of the trace, and the value at every phase boundary
+is found with a binary search on the time column, so the energy of each phase is the difference of two values.
+
+Example:
+    phases = [("4kRead", 2000000, 22000000), ("16kRead", 27000000, 47000000)]
+    for energy in phase_energy("RawData.csv", phases):
+        print(energy.label, energy.joules, energy.average_power)
+"""
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import BLOCK_ROWS, TraceReader, unit_scale
+
+# Test phase, from 'start_time' up to (not including) 'end_time', in the units of the trace time column.  Either time
+# may be None for the start or end of the trace
+TestPhase = namedtuple("TestPhase", ("label", "start_time", "end_time"))
+
+# Energy of one test phase.  'duration' is the time (in seconds) of the phase covered by the trace, 'joules' the energy
+# over that time, and 'average_power' and 'peak_power' are in watts (None if the trace does not cover the phase).
+# 'samples' is the number of power samples in the phase
+PhaseEnergy = namedtuple("PhaseEnergy", ("label", "start_time", "end_time", "duration", "joules", "average_power",
+                                         "peak_power", "samples"))
+
+# Efficiency of one job: its throughput, and the throughput per watt and work per joule.  Values that cannot be
+# calculated (such as IOPS per watt without the IOPS) are None
+JobEfficiency = namedtuple("JobEfficiency", ("label", "mb_per_second", "iops", "joules", "average_power",
+                                             "mb_per_second_per_watt", "iops_per_watt", "mb_per_joule",
+                                             "joules_per_io"))
+
+
+'''
+Calculates the energy of each test phase of a trace, in one pass over the trace.  Returns a list of PhaseEnergy, in
+the order of 'phases'.
+
+data_path               = The path of the CSV file to read.
+phases                  = List of (label, start_time, end_time) phases, or TestPhase, with times in 'phase_unit'.
+col_name                = The name of the power column, the last power column (units ending in W) if None.
+csv_delimiter           = The delimiter character used in the CSV file.
+phase_offset            = Value added to the phase times first, such as minus the Unix time the trace started at.
+phase_unit              = Units of the phase times (such as "ms"), the units of the trace time column if None.
+block_rows              = Number of lines processed at once.
+'''
+def phase_energy (data_path, phases, col_name=None, csv_delimiter=",", phase_offset=0, phase_unit=None,
+                  block_rows=BLOCK_ROWS):
+    phases = [TestPhase(*phase) for phase in phases]
+    with TraceReader(data_path, delimiter=csv_delimiter) as header:
+        if len(header.names) == 0:
+            raise ValueError ("File does not contain any named columns")
+        time_column = header.names[0]
+        if col_name is None:
+            power_columns = [name for name in header.names[1:] if unit_scale(header.units.get(name), "W") is not None]
+            if len(power_columns) == 0:
+                raise ValueError ("File does not contain any power columns")
+            col_name = power_columns[-1]
+        time_scale = unit_scale(header.units.get(time_column), "s")
+        if time_scale is None:
+            raise ValueError ("Time column does not have units of time: " + time_column)
+
+    with TraceReader(data_path, columns=[time_column, col_name], delimiter=csv_delimiter,
+                     block_rows=block_rows) as reader:
+        col_name = reader.columns[1]
+        power_scale = unit_scale(reader.units.get(col_name), "W")
+        if power_scale is None:
+            raise ValueError ("Column does not have units of power: " + col_name)
+        # Phase times in the units of the time column
+        phase_scale = 1.0
+        if phase_unit is not None:
+            if unit_scale(phase_unit, "s") is None:
+                raise ValueError ("Phase unit is not a unit of time: " + phase_unit)
+            phase_scale = unit_scale(phase_unit, "s") / time_scale
+        bounds = [[None if time is None else (time + phase_offset) * phase_scale for time in phase[1:]]
+                  for phase in phases]
+        engine = _PhaseIntegrals(bounds)
+        for block in reader:
+            times = block.columns[time_column]
+            if block.missing[time_column] is not None:
+                raise ValueError ("Time column has an empty value on data row " +
+                                  str(block.first_row + int(np.flatnonzero(block.missing[time_column])[0])))
+            values = block.columns[col_name]
+            if block.missing[col_name] is not None:
+                times = times[~block.missing[col_name]]
+                values = values[~block.missing[col_name]]
+            engine.add(times, values)
+
+    results = []
+    for phase, (start, end, integral, peak, samples) in zip(phases, engine.finish()):
+        duration = float(end - start) * time_scale
+        joules = float(integral) * time_scale * power_scale
+        results.append(PhaseEnergy(phase.label, phase.start_time, phase.end_time, duration, joules,
+                                   joules / duration if duration > 0 else None,
+                                   None if peak is None else float(peak) * power_scale, samples))
+    return results
+
+
+'''
+Returns the test phases between a list of annotations, each phase running from one annotation to the next.
+Annotations with a label in 'end_labels' (such as the "END" annotation added after each FIO job) end the phase
+before them without starting a new one.
+
+annotations             = List of (time, label) pairs.
+end_time                = End time of the last phase, or None for the end of the trace.
+end_labels              = Labels of the annotations that only end a phase.
+'''
+def annotation_phases (annotations, end_time=None, end_labels=("END",)):
+    annotations = sorted(annotations, key=lambda annotation: annotation[0])
+    phases = []
+    for position, (time, label) in enumerate(annotations):
+        if label in end_labels:
+            continue
+        phase_end = annotations[position + 1][0] if position + 1 < len(annotations) else end_time
+        phases.append(TestPhase(label, time, phase_end))
+    return phases
+
+
+'''
+Returns the JobEfficiency of a job, from the PhaseEnergy of its test phase and its throughput.
+
+energy                  = PhaseEnergy of the job.
+mb_per_second           = Average throughput of the job in MB/s, or None.
+iops                    = Average IO operations per second of the job, or None.
+'''
+def job_efficiency (energy, mb_per_second=None, iops=None):
+    power = energy.average_power
+    joules = energy.joules if energy.duration > 0 else None
+    return JobEfficiency(energy.label, mb_per_second, iops, joules, power,
+                         _ratio(mb_per_second, power), _ratio(iops, power),
+                         _ratio(None if mb_per_second is None else mb_per_second * energy.duration, joules),
+                         _ratio(joules, None if iops is None else iops * energy.duration))
+
+
+class _PhaseIntegrals:
+    '''
+    Running trapezoidal integral of a trace, sampled at the start and end of each phase, with the largest sample and
+    the number of samples in each phase.
+
+    phases          = List of (start, end) times of the phases, in the units of the time column (None for the start
+                      or end of the trace)
+    '''
+    def __init__(self, phases):
+        self.phases = phases
+        # Every start and end time, and the integral and power at each of them once the trace reaches it
+        starts = np.array([-np.inf if start is None else start for start, end in phases], dtype=np.float64)
+        ends = np.array([np.inf if end is None else end for start, end in phases], dtype=np.float64)
+        self.__bounds = np.concatenate((starts, np.maximum(ends, starts)))
+        self.__integrals = np.full(len(self.__bounds), np.nan)
+        self.__powers = np.full(len(self.__bounds), np.nan)
+        self.__peaks = np.full(len(phases), -np.inf)
+        self.__samples = np.zeros(len(phases), dtype=np.int64)
+        # Integral up to the last sample, and the last sample as (time, value)
+        self.__total = 0.0
+        self.__last = None
+        self.__first_time = None
+
+    # Adds the next block of samples (times must not decrease)
+    def add(self, times, values):
+        if len(times) == 0:
+            return
+        times = times.astype(np.float64)
+        values = values.astype(np.float64)
+        if self.__first_time is None:
+            self.__first_time = times[0]
+        else:
+            if times[0] < self.__last[0]:
+                raise ValueError ("Time column must not decrease")
+
+        # Largest sample and number of samples in each phase, from the samples of this block
+        lows = np.searchsorted(times, self.__bounds[:len(self.phases)], side="left")
+        highs = np.searchsorted(times, self.__bounds[len(self.phases):], side="left")
+        used = np.flatnonzero(highs > lows)
+        if len(used) > 0:
+            pairs = np.column_stack((lows[used], highs[used])).ravel()
+            peaks = np.maximum.reduceat(np.append(values, -np.inf), pairs)[::2]
+            self.__peaks[used] = np.maximum(self.__peaks[used], peaks)
+            self.__samples[used] += highs[used] - lows[used]
+
+        # Cumulative integral at each sample, carrying on from the last sample of the block before
+        if self.__last is not None:
+            times = np.concatenate(([self.__last[0]], times))
+            values = np.concatenate(([self.__last[1]], values))
+        intervals = np.diff(times)
+        cumulative = np.concatenate(([0.0], np.cumsum((values[1:] + values[:-1]) * intervals) / 2))
+
+        # Integral and interpolated power at each bound in the time span of this block, that is not known yet
+        bounds = np.flatnonzero(np.isnan(self.__integrals) & (self.__bounds >= times[0]) &
+                                (self.__bounds <= times[-1]))
+        if len(bounds) > 0:
+            at = self.__bounds[bounds]
+            sample = np.clip(np.searchsorted(times, at, side="right") - 1, 0, max(len(times) - 2, 0))
+            after = np.minimum(sample + 1, len(times) - 1)
+            interval = times[after] - times[sample]
+            fraction = np.divide(at - times[sample], interval, out=np.zeros(len(at)), where=interval > 0)
+            power = values[sample] + (values[after] - values[sample]) * fraction
+            self.__integrals[bounds] = self.__total + cumulative[sample] + (at - times[sample]) * \
+                                       (values[sample] + power) / 2
+            self.__powers[bounds] = power
+
+        self.__total += cumulative[-1]
+        self.__last = (times[-1], values[-1])
+
+    # Returns (start, end, integral, peak, samples) of each phase, with the start and end clipped to the trace.  The
+    # peak is None if the trace does not cover the phase
+    def finish(self):
+        results = []
+        if self.__last is None:
+            return [(0.0, 0.0, 0.0, None, 0) for _ in self.phases]
+        first_time, last_time = self.__first_time, self.__last[0]
+        # Bounds before the trace are at its start, and bounds after it at its end
+        clipped = np.clip(self.__bounds, first_time, last_time)
+        integrals = np.where(self.__bounds < first_time, 0.0, np.where(self.__bounds > last_time, self.__total,
+                                                                       self.__integrals))
+        count = len(self.phases)
+        for phase in range(count):
+            start, end = clipped[phase], clipped[count + phase]
+            peak = None
+            if end > start or self.__samples[phase] > 0:
+                # The power at a bound inside the trace is part of the phase, as the samples either side are
+                candidates = [self.__peaks[phase]] + [self.__powers[bound] for bound in (phase, count + phase)
+                                                      if first_time <= self.__bounds[bound] <= last_time]
+                peak = max(candidates)
+            results.append((start, end, integrals[count + phase] - integrals[phase], peak,
+                            int(self.__samples[phase])))
+        return results
+
+
+# Returns numerator / denominator, or None if either is None or the denominator is 0
+def _ratio (numerator, denominator):
+    if numerator is None or denominator is None or denominator == 0:
+        return None
+    return numerator / denominator
@@ -23,6 +23,8 @@ AN-017 - Application note demonstrating FIO and QPS running traffic tests to a d
     https://quarch.com/support/faqs/usb/
 5- Install FIO (Go to releases and look for msi installer for windows or install CMD for linux version. )
     https://github.com/axboe/fio
+6- NumPy python package (used by energy_accounting.py)
+    pip install numpy
 
 ########### INSTRUCTIONS ###########
 1- Install the required items above
@@ -51,6 +53,8 @@ from quarchpy.qis import closeQis, checkAndCloseQis
 from quarchpy.fio import *
 from quarchpy.user_interface.user_interface import visual_sleep
 
+from energy_accounting import job_efficiency, phase_energy
+
 # We use TK for the directory selection box, this code avoids additional TK GUI items being shown
 try:
     # python 3.7
@@ -64,6 +68,10 @@ root.withdraw()
 # Path where stream will be saved to (defaults to current script path)
 streamPath = os.path.dirname(os.path.realpath(__file__))
 
+# Each FIO job run, recorded by the callbacks as [name, start time, end time, IOPS points, MB/s points], with the
+# times in mS (Unix time) as given by FIO
+testPhases = []
+
 '''
 Main function, containing the example code to execute FIO and display the results
 '''
@@ -136,7 +144,13 @@ def main():
     # Start a stream, using the local folder of the script and a time-stamp file name in this example
     fileName = time.strftime("%Y-%m-%d-%H-%M-%S", time.gmtime())
     streamLocation = os.path.join(streamPath, fileName)
+    # Time 0 of the exported trace is when QPS starts the stream, at some point during startStream(), so the Unix
+    # time in mS of the start is estimated as the middle of the call, and may be out by up to half its length
+    startBefore = time.time() * 1000
     myStream = myQpsDevice.startStream(streamLocation)
+    startAfter = time.time() * 1000
+    streamStartTime = (startBefore + startAfter) / 2
+    streamStartUncertainty = (startAfter - startBefore) / 2
 
     # Create new custom channels to plot IOPS results
     myStream.createChannel('read_iops', 'Read', 'IOPS', "Yes")
@@ -224,6 +238,14 @@ def main():
     '''
     calculate_results(myStream)
 
+    '''
+    The power can also be integrated over each FIO job from the raw trace, giving the energy, average and peak power
+    of each job without QPS statistics.  The stream is exported to CSV and read in one pass by energy_accounting.py.
+    '''
+    rawOutputPath = os.path.join(streamPath, fileName + "_RawData.csv")
+    myStream.saveCSV(rawOutputPath, pollTillComplete=True)
+    calculate_energy_results(rawOutputPath, streamStartTime, streamStartUncertainty)
+
     #This simply pauses the script to allow you to look at the output data in console and the QPS trace in QPS.
     userInput("You have reach the end of the application note.\nPress enter to close QPS and exit the script:")
 
@@ -265,10 +287,47 @@ def calculate_results(myStream):
     print("##############\n")
 
 
+def calculate_energy_results(rawOutputPath, streamStartTime, streamStartUncertainty=0):
+    '''
+    This function integrates the total power of the exported trace over each FIO job recorded in testPhases, and
+    combines the energy with the throughput FIO reported for the job.  The job times are Unix times in mS, so the
+    estimated start time of the stream is taken from them to give the time in the trace.
+    QPS places the annotations on its chart itself, but they are not returned to the script, so each job boundary in
+    the trace can be out by up to streamStartUncertainty (mS).  The energy of a job can then be out by up to about
+    the peak power over twice that time, which is printed with each job.  Increase the job runtimes if this is
+    significant.
+    '''
+    jobs = [job for job in testPhases if job[2] is not None]
+    phases = [(name, startTime, endTime) for name, startTime, endTime, iops, mbps in jobs]
+    energies = phase_energy(rawOutputPath, phases, phase_offset=-streamStartTime, phase_unit="ms")
+
+    print("\n\n####Energy Results####")
+    print("Job bounds estimated to +/- {:.1f} mS from the stream start time".format(streamStartUncertainty))
+    for energy, (name, startTime, endTime, iops, mbps) in zip(energies, jobs):
+        if energy.average_power is None:
+            print("Job \"" + name + "\"   Not found in the trace")
+            continue
+        # The mean of the FIO status points gives the average throughput of the job
+        efficiency = job_efficiency(energy, sum(mbps) / len(mbps) if mbps else None,
+                                    sum(iops) / len(iops) if iops else None)
+        print("Job \"" + name + "\"   Time s:{:.2f}  Energy J:{:.3f} (+/- {:.3f})  Ave Power W:{:.3f}  "
+              "Peak Power W:{:.3f}".format(energy.duration, energy.joules,
+                                           energy.peak_power * 2 * streamStartUncertainty / 1000,
+                                           energy.average_power, energy.peak_power))
+        if efficiency.mb_per_second_per_watt is not None:
+            print("    Ave MB/s:{:.2f}  Ave (MB/s)/Watt:{:.2f}  MB/Joule:{:.2f}".format(
+                efficiency.mb_per_second, efficiency.mb_per_second_per_watt, efficiency.mb_per_joule))
+        if efficiency.iops_per_watt is not None:
+            print("    Ave IOPS:{:.0f}  IOPS/Watt:{:.1f}  uJ/IO:{:.3f}".format(
+                efficiency.iops, efficiency.iops_per_watt, efficiency.joules_per_io * 1000000))
+    print("######################\n")
+
+
 def notifyTestStart(myStream, timeStamp, title, testDescription):
     '''
     Callback: Run to add the start point of a test run.  Adds an annotation to the chart
     '''
+    testPhases.append([title, int(timeStamp), None, [], []])
     # adding an annotation using xml format
     print(myStream.addAnnotation(title=title, extraText=testDescription, annotationTime=timeStamp))
 
@@ -279,6 +338,8 @@ def notifyTestEnd(myStream, timeStamp, testName="END"):
     ends the current block of performance data
     '''
     print("adding Data at time:" + str(timeStamp) + "  values:endSeq")
+    if testPhases and testPhases[-1][2] is None:
+        testPhases[-1][2] = int(timeStamp)
     # breaking data input to graph between tests
     myStream.addDataPoint('read_iops', 'Read', "endSeq", str(int(timeStamp) + 1))
     myStream.addDataPoint('write_iops', 'Write', "endSeq", str(int(timeStamp) + 1))
@@ -297,6 +358,9 @@ def notifyTestPoint(myStream, timeStamp, dataValues):
 
     read_mb_s = get_mb_s(bs, read_iops)
     write_mb_s = get_mb_s(bs, write_iops)
+    if testPhases and testPhases[-1][2] is None:
+        testPhases[-1][3].append(float(read_iops) + float(write_iops))
+        testPhases[-1][4].append(read_mb_s + write_mb_s)
     print("adding Data at time:" + str(timeStamp) + "  values:" + str(read_iops) + ", " + str(write_iops) + ", " + str(
         write_mb_s) + ", " + str(read_mb_s))
     myStream.addDataPoint('read_iops', 'Read', read_iops, timeStamp)
@@ -14,9 +14,11 @@ We will record at a high rate and post process down to a lower rate, ending with
     https://www.python.org/downloads/
 2- Quarchpy python package
     https://quarch.com/products/quarchpy-python-package/
-3- Quarch USB driver (Required for USB connected devices on Windows only)
+3- NumPy python package
+    pip install numpy
+4- Quarch USB driver (Required for USB connected devices on Windows only)
     https://quarch.com/downloads/driver/
-4- Check USB permissions if using Linux:
+5- Check USB permissions if using Linux:
     https://quarch.com/support/faqs/usb/
 
 ########### INSTRUCTIONS ###########
@@ -29,12 +31,19 @@ We will record at a high rate and post process down to a lower rate, ending with
 '''
 
 import os
+import sys
 import time
 
+import numpy as np
 import quarchpy
 from quarchpy.device import *
 from quarchpy.qps import *
 
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_pyramid import PyramidBuilder
+from trace_reader import TraceReader
+
 # Path where stream will be saved to (defaults to current script path)
 streamPath = os.path.dirname(os.path.realpath(__file__))
 
@@ -111,88 +120,136 @@ def main():
     if (msg != "OK"):
         print ("Failed export CSV data: " + msg)
 
-    # Run the post process step.  The first one is purely for the stats calculations, as we alredy have it in the correct sample rate
-    print ("-Post processing step 1")
-    post_process_resample (rawOutputPath, 1, streamPath + "\\PostData100us.csv")
-    print ("-Post processing step 2")
-    post_process_resample (rawOutputPath, 5, streamPath + "\\PostData500us.csv")
-    print ("-Post processing step 3")
-    post_process_resample (rawOutputPath, 10, streamPath + "\\PostData1ms.csv")
+    # Run the post process steps, all on one read of the raw data.  The first output is purely for the stats
+    # calculations, as we alredy have it in the correct sample rate.  A pyramid of min/max/mean summaries is built in
+    # the same pass, for fast zoomed-out views of the whole trace
+    print ("-Post processing: resample to 100uS, 500uS and 1mS, and build a min/max/mean pyramid")
+    pyramid = post_process_resample_outputs (rawOutputPath, [(1, streamPath + "\\PostData100us.csv"),
+                                                             (5, streamPath + "\\PostData500us.csv"),
+                                                             (10, streamPath + "\\PostData1ms.csv")],
+                                             PyramidBuilder (streamPath + "\\RawData_pyramid", factor=10,
+                                                             source="RawData100us.csv"))
+    print_pyramid_overview (pyramid)
 
     
-# Post process and resample the CSV file (for now assuming all data is in one file, QPS v1.09 maxes out at 100k lines right now in a single file, this limit will be removed in the next version)    
-# Assumes first column is time and next (max 8) columns are data or empty, this could be automated by parsing the stream header to see the record channels and setting up dynamically
-def post_process_resample (raw_file_path, resample_count, output_file_path):    
+# Post process and resample the CSV file, by averaging each group of 'resample_count' lines into one.  To write several
+# sample rates, use post_process_resample_outputs() so the trace is only read once
+def post_process_resample (raw_file_path, resample_count, output_file_path):
+    post_process_resample_outputs (raw_file_path, [(resample_count, output_file_path)])
+
+
+# Post process and resample the CSV file, by averaging each group of 'resample_count' lines into one, for each
+# (resample_count, output_file_path) in 'outputs'.  The trace is read once, in blocks with TraceReader
+# (trace_reader.py), and each block is passed to every output, so files of any size are processed in bounded memory
+# and in one pass however many outputs there are.  The first column is time and the other columns are found from the
+# header, empty cells (unused columns) count as 0.  If a PyramidBuilder (trace_pyramid.py) is given, the pyramid is
+# built in the same pass and returned
+def post_process_resample_outputs (raw_file_path, outputs, pyramid=None):
     # Init variables
-    firstLine = True
-    stripeCount = 0
     dilimiter = ","
-    number_of_columns = 9
-    averaged_stripe_count = 0
-    # Storage for the accumulating data (9 columns of data)
-    procData = [0,0,0,0,0,0,0,0,0]
-    # Storage for the summary data (8 columns as time is note processed)
-    maxData = [0,0,0,0,0,0,0,0]
-    minData = [999999,999999,999999,999999,999999,999999,999999,999999]
-    aveData = [0,0,0,0,0,0,0,0]
-    # Open both the input and output files in appropriate access modes
-    with open(raw_file_path, 'r') as rawFile:
-        with open (output_file_path, 'w') as postFile:
-            # Iterate through all input files
-            for fileLine in rawFile:
-                # headerline is unique, copy it directly
-                if (firstLine == True):
-                    postFile.write (fileLine + "\n")
-                    firstLine = False
-                    continue
-
-                # Accumulate the required number of lines                
-                lineSections = fileLine.split(dilimiter)
-                # Update to the latest time point
-                procData[0] = lineSections[0]
-                # Sum the values for all other columns
-                for i in range (1, number_of_columns):     
-                    # Avoid crash on blank cells (happens with unused columns)
-                    if (lineSections[i] != ''):
-                        procData[i] += int(lineSections[i])
-                stripeCount += 1
-
-                # When we have enough data to complete one output line we can process it
-                if (stripeCount == resample_count):
-                    # Track the number of output stripes
-                    averaged_stripe_count += 1
-
-                    # Divide down the averaged colums to get the final result
-                    for i in range (1, number_of_columns):                                    
-                        procData[i] /= resample_count
-                    # Generate the single line for the output file
-                    outStr = dilimiter.join (str(x) for x in procData)
-                    postFile.write (outStr + "\n")
-                    # Track maximums
-                    for i in range (1, number_of_columns):       
-                        if (procData[i] > maxData[i-1]):
-                            maxData[i-1] = procData[i]
-                    # Track minimums
-                    for i in range (1, number_of_columns):
-                        if (procData[i] < minData[i-1]):
-                            minData[i-1] = procData[i]
-                    # Track averages (Note: large datasets may overflow this simple averaging mechanism)
-                    for i in range (1, number_of_columns):                       
-                        aveData[i-1] += procData[i]
-
-                    # Reset the accumulating data buffer
-                    procData = [0,0,0,0,0,0,0,0,0]    
-                    stripeCount = 0
+    with TraceReader(raw_file_path, delimiter=dilimiter) as rawFile:
+        timeName = rawFile.names[0]
+        dataNames = rawFile.names[1:]
+        resamplers = []
+        try:
+            # Open each output file, writing its header line from the column names found
+            for resample_count, output_file_path in outputs:
+                resamplers.append(Resampler(resample_count, output_file_path, rawFile.names, dilimiter))
+            if pyramid is not None:
+                pyramid.start(rawFile, timeName)
+
+            for block in rawFile:
+                # Data columns as one array of (lines, columns), with empty cells as 0
+                times = block.columns[timeName]
+                data = np.column_stack([block.columns[name] if block.missing[name] is None else
+                                        np.where(block.missing[name], 0, block.columns[name]) for name in dataNames])
+                for resampler in resamplers:
+                    resampler.add(times, data)
+                if pyramid is not None:
+                    pyramid.add(block, times)
+        finally:
+            for resampler in resamplers:
+                resampler.finish()
+    return None if pyramid is None else pyramid.finish()
+
+'''
+Averages each group of 'resample_count' lines of a trace into one line of a new CSV file, writing the MAX, MIN and
+AVE of the output to the bottom of the file.  Lines are added a block at a time, and a last group of fewer lines is
+not output.
+'''
+class Resampler:
+    def __init__(self, resample_count, output_file_path, names, dilimiter=","):
+        self.resample_count = resample_count
+        self.dilimiter = dilimiter
+        self.averaged_stripe_count = 0
+        # Lines left over from the last block, that did not complete a group
+        self.leftTimes = None
+        self.leftData = None
+        # Storage for the summary data (all columns except time)
+        self.maxData = None
+        self.minData = None
+        self.aveData = None
+        self.postFile = open (output_file_path, 'w')
+        self.postFile.write (dilimiter.join(names) + "\n\n")
+
+    # Adds the times and (lines, columns) data of a block of lines
+    def add(self, times, data):
+        resample_count = self.resample_count
+        if self.leftTimes is not None:
+            times = np.concatenate((self.leftTimes, times))
+            data = np.concatenate((self.leftData, data))
+
+        # Average each complete group of lines, keeping the time of the last line in the group
+        groups = len(times) // resample_count
+        used = groups * resample_count
+        procTimes = times[resample_count - 1:used:resample_count]
+        procData = data[:used].reshape(groups, resample_count, data.shape[1]).sum(axis=1) / resample_count
+        self.leftTimes = times[used:]
+        self.leftData = data[used:]
+        if groups == 0:
+            return
+
+        # Generate the lines for the output file
+        for timePoint, values in zip(procTimes.tolist(), procData.tolist()):
+            self.postFile.write (str(timePoint) + self.dilimiter + self.dilimiter.join(str(x) for x in values) + "\n")
+        self.averaged_stripe_count += groups
+
+        # Track maximums, minimums and averages
+        blockMax = procData.max(axis=0)
+        blockMin = procData.min(axis=0)
+        self.maxData = blockMax if self.maxData is None else np.maximum(self.maxData, blockMax)
+        self.minData = blockMin if self.minData is None else np.minimum(self.minData, blockMin)
+        self.aveData = procData.sum(axis=0) if self.aveData is None else self.aveData + procData.sum(axis=0)
+
+    # Adds the stats data to the bottom of the output file, and closes it
+    def finish(self):
+        try:
+            if self.averaged_stripe_count == 0:
+                print ("No complete groups of " + str(self.resample_count) + " lines to process")
+                return
 
             # Complete the calculation of the average values
-            for i in range (1, number_of_columns):                       
-                aveData[i-1] /= averaged_stripe_count
-
-            # Add the stats data to the bottom of the output file
-            postFile.write ("\n\nSTATISTICS\n")
-            postFile.write ("MAX," + dilimiter.join(str(x) for x in maxData) + "\n")
-            postFile.write ("MIN," + dilimiter.join(str(x) for x in minData) + "\n")
-            postFile.write ("AVE," + dilimiter.join(str(x) for x in aveData) + "\n")
+            aveData = self.aveData / self.averaged_stripe_count
+
+            self.postFile.write ("\n\nSTATISTICS\n")
+            self.postFile.write ("MAX," + self.dilimiter.join(str(x) for x in self.maxData.tolist()) + "\n")
+            self.postFile.write ("MIN," + self.dilimiter.join(str(x) for x in self.minData.tolist()) + "\n")
+            self.postFile.write ("AVE," + self.dilimiter.join(str(x) for x in aveData.tolist()) + "\n")
+        finally:
+            self.postFile.close()
+
+# Prints an overview of the whole trace from the pyramid, using about 20 bins
+def print_pyramid_overview (pyramid):
+    if pyramid.levels == 0:
+        print ("No data in the trace")
+        return
+    top = pyramid.query (-float("inf"), float("inf"), level=pyramid.levels)
+    overview = pyramid.query (top.time_start[0], top.time_end[-1], points=20)
+    channel = pyramid.channels[-1]
+    print ("Pyramid levels: " + str(pyramid.levels) + ", overview from level " + str(overview.level) + " (" +
+           str(overview.bin_samples) + " samples per bin)")
+    for timePoint, minValue, maxValue in zip (overview.time_start, overview.min[channel], overview.max[channel]):
+        print ("\t" + str(timePoint) + ": " + channel + " " + str(minValue) + " to " + str(maxValue))
 
 '''
 Function to check the output state of the module and prompt to select an output mode if not set already
@@ -3,8 +3,9 @@
 This example demonstrates basic automation with QIS and post-processing of raw data after recording.
 We will record at a high rate and post-process down to a lower rate, ending with 100uS and 500uS sample rates
 
-The resampling implementation is basic and currently coded for a PPM Plus which has a fixed number of
-columns in the CSV file.  It could be expanded for a PAM with a higher number of channels.
+The resampling finds the columns from the header of the CSV file, so works for a PPM Plus or a PAM with a
+higher number of channels.  Stripes can be combined by count or by time period, and the file is read in blocks
+with trace_reader.py, so files of any size can be processed.
 
 ########### REQUIREMENTS ###########
 
@@ -12,9 +13,11 @@ columns in the CSV file.  It could be expanded for a PAM with a higher number of
     https://www.python.org/downloads/
 2- Quarchpy python package
     https://quarch.com/products/quarchpy-python-package/
-3- Quarch USB driver (Required for USB connected devices on windows only)
+3- NumPy python package
+    pip install numpy
+4- Quarch USB driver (Required for USB connected devices on windows only)
     https://quarch.com/downloads/driver/
-4- Check USB permissions if using Linux:
+5- Check USB permissions if using Linux:
     https://quarch.com/support/faqs/usb/
 
 ########### INSTRUCTIONS ###########
@@ -27,13 +30,20 @@ columns in the CSV file.  It could be expanded for a PAM with a higher number of
 """
 
 
-import os, time
+import os, sys, time
 import logging
 import quarchpy
 from quarchpy.device import *
 from quarchpy.qis import *
 from quarchpy.user_interface import visual_sleep
 
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_pipeline import (EnergyStage, ResampleResult, ResampleStage, StatisticsStage, ThresholdStage,
+                            TracePipeline, WindowStage)
+from trace_pyramid import PyramidBuilder, TracePyramid
+from trace_reader import TraceReader
+
 # Path where stream will be saved to (defaults to the current script path)
 stream_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -141,27 +151,49 @@ def main() -> None:
     # Request raw CSV data from the stream, into the local folder
     raw_output_path = stream_path + "\\RawData100us.csv"
 
-    # Run the post-process step.  The first one is purely for the stats calculations, as we already have it in the correct sample rate
-    print ("-Post processing step 1 - Calc Stats")
-    post_process_resample (raw_output_path, 1, stream_path + "\\PostData100us.csv")
-    print ("-Post processing step 2 - Resample to 500uS")
-    post_process_resample (raw_output_path, 5, stream_path + "\\PostData500us.csv")
-    print ("-Post processing step 3 - Resample to 1mS")
-    post_process_resample (raw_output_path, 10, stream_path + "\\PostData1ms.csv")
+    # Run the post-process steps, all on one read of the raw data.  Each stage of the pipeline is passed every block as
+    # it is read, so this costs one pass however many stages are added.  The first output is purely for the stats
+    # calculations, as we already have it in the correct sample rate.  Resampling can also be by time (in the units of
+    # the time column), which works for any ratio of sample rates.  A pyramid of min/max/mean summaries is built in the
+    # same pass, for fast zoomed-out views of the whole trace
+    print ("-Post processing - Resample to 100uS (Calc Stats), 500uS, 1mS and 250uS, build a min/max/mean pyramid and "
+           "report on the trace, in a single pass")
+    pipeline = TracePipeline (raw_output_path)
+    pipeline.add (ResampleStage (stream_path + "\\PostData100us.csv", resample_count=1, name="resample_100us"))
+    pipeline.add (ResampleStage (stream_path + "\\PostData500us.csv", resample_count=5, name="resample_500us"))
+    pipeline.add (ResampleStage (stream_path + "\\PostData1ms.csv", resample_count=10, name="resample_1ms"))
+    pipeline.add (ResampleStage (stream_path + "\\PostData250us.csv", resample_time=250, name="resample_250us"))
+    pipeline.add (PyramidBuilder (stream_path + "\\RawData100us_pyramid", factor=10, source=file_name))
+    pipeline.add (StatisticsStage ())
+    pipeline.add (WindowStage ([1000, 100000]))
+    pipeline.add (EnergyStage ())
+    # Set the threshold to the power level of interest, in the units of the last power column (uW)
+    pipeline.add (ThresholdStage (1000000, hysteresis=10000))
+    results = pipeline.run ()
+    print_pyramid_overview (results["pyramid"])
+    print_pipeline_report (results)
 
     print ("\nAll processing complete!\n\n")
 
     if close_qis_at_end_of_test:
         closeQis()
 
-def post_process_resample (raw_file_path: str, resample_count: int, output_file_path: str) -> None:
+def post_process_resample (raw_file_path: str, resample_count: float, output_file_path: str,
+                           resample_time: float = None) -> None:
     """
-    Post process and resamples a CSV file output by combining multiple stripes of data into one
-    Assumes standard PPM channels are enabled for this quick example.  The resample process uses
-    averaging to ensure that
+    Post process and resamples a CSV file output by combining multiple stripes of data into one.
+    The trace is read in blocks with TraceReader (trace_reader.py) and each block is resampled with
+    array operations by ResampleStage (trace_pipeline.py), so files of any size are processed in bounded memory and one pass.  The first
+    column is time, and the other columns are found from the header.  Empty cells count as 0.
+
+    Stripes are combined either in groups of 'resample_count' stripes, or by time: every stripe in
+    each 'resample_time' period (from the time of the first stripe) is combined into one.  A
+    'resample_count' that is not a whole number is converted to a time period, from the sample time
+    of the first 2 stripes.  Each output stripe has the time of the last stripe combined into it.
 
-    We also calculate the maximum, minimum and average values for each channel and write them
-    to the bottom of the output file
+    Integer columns are summed exactly (as int64), and the averages for the statistics are summed with
+    compensated (Neumaier) summation, so large datasets do not lose precision.  We also calculate the
+    maximum, minimum and average values for each channel and write them to the bottom of the output file
 
     Args:
         raw_file_path:
@@ -170,77 +202,94 @@ def post_process_resample (raw_file_path: str, resample_count: int, output_file_
             Number of stripes to combine into one
         output_file_path:
             New output file path to create
+        resample_time:
+            Optional time period to combine stripes over, in the units of the time column, instead of
+            a number of stripes
     Returns:
 
     """
-    # Init variables
-    header_lines = 0
-    stripe_count = 0
-    delimiter = ","
-    number_of_columns = 9
-    averaged_stripe_count = 0
-    # Storage for the accumulating data (9 columns of data)
-    proc_data = [0,0,0,0,0,0,0,0,0]
-    # Storage for the summary data (8 columns as time is note processed)
-    max_data = [0,0,0,0,0,0,0,0]
-    min_data = [999999,999999,999999,999999,999999,999999,999999,999999]
-    ave_data = [0,0,0,0,0,0,0,0]
-    # Open both the input and output files in appropriate access modes
-    with open(raw_file_path, 'r') as rawFile:
-        with open (output_file_path, 'w') as postFile:
-            # Iterate through all input files
-            for fileLine in rawFile:
-                # The header line is unique, copy it directly
-                if header_lines < 2:
-                    postFile.write (fileLine + "\n")
-                    header_lines = header_lines + 1
-                    continue
-
-                # Accumulate the required number of lines                
-                line_sections = fileLine.split(delimiter)
-                # Update to the latest time point
-                proc_data[0] = line_sections[0]
-                # Sum the values for all other columns
-                for i in range (1, number_of_columns):                                    
-                    proc_data[i] += int(line_sections[i])
-                stripe_count += 1
-
-                # When we have enough data to complete one output line we can process it
-                if stripe_count == resample_count:
-                    # Track the number of output stripes
-                    averaged_stripe_count += 1
-
-                    # Divide down the averaged columns to get the final result
-                    for i in range (1, number_of_columns):                                    
-                        proc_data[i] /= resample_count
-                    # Generate the single line for the output file
-                    out_str = delimiter.join (str(x) for x in proc_data)
-                    postFile.write (out_str + "\n")
-                    # Track maximums
-                    for i in range (1, number_of_columns):       
-                        if proc_data[i] > max_data[i - 1]:
-                            max_data[i-1] = proc_data[i]
-                    # Track minimums
-                    for i in range (1, number_of_columns):
-                        if proc_data[i] < min_data[i - 1]:
-                            min_data[i-1] = proc_data[i]
-                    # Track averages (Note: large datasets may overflow this simple averaging mechanism)
-                    for i in range (1, number_of_columns):                       
-                        ave_data[i-1] += proc_data[i]
-
-                    # Reset the accumulating data buffer
-                    proc_data = [0,0,0,0,0,0,0,0,0]
-                    stripe_count = 0
-
-            # Complete the calculation of the average values
-            for i in range (1, number_of_columns):                       
-                ave_data[i-1] /= averaged_stripe_count
-
-            # Add the stats data to the bottom of the output file
-            postFile.write ("\n\nSTATISTICS\n")
-            postFile.write ("MAX," + delimiter.join(str(x) for x in max_data) + "\n")
-            postFile.write ("MIN," + delimiter.join(str(x) for x in min_data) + "\n")
-            postFile.write ("AVE," + delimiter.join(str(x) for x in ave_data) + "\n")
+    if resample_time is None and resample_count != int(resample_count):
+        resample_time = _sample_time(raw_file_path) * resample_count
+    if resample_time is not None and resample_time <= 0:
+        raise ValueError ("Resample time must be greater than 0")
+    if resample_time is None and resample_count < 1:
+        raise ValueError ("Resample count must be at least 1")
+
+    # The resampling is a stage of a single pass pipeline, run here on its own
+    pipeline = TracePipeline (raw_file_path)
+    pipeline.add (ResampleStage (output_file_path, None if resample_time is not None else resample_count,
+                                 resample_time))
+    if pipeline.run()["resample"].stripes == 0:
+        print ("No complete groups of stripes to process")
+
+
+def print_pyramid_overview (pyramid: TracePyramid) -> None:
+    """
+    Prints an overview of the whole trace from a pyramid, using about 20 bins from the level that
+    gives them, so only a few bins are read however long the trace is
+
+    Args:
+        pyramid:
+            Pyramid built from the trace
+    Returns:
+
+    """
+    if pyramid.levels == 0:
+        print ("No data in the trace")
+        return
+    top = pyramid.query (-float("inf"), float("inf"), level=pyramid.levels)
+    overview = pyramid.query (top.time_start[0], top.time_end[-1], points=20)
+    channel = pyramid.channels[-1]
+    print ("Pyramid levels: " + str(pyramid.levels) + ", overview from level " + str(overview.level) + " (" +
+           str(overview.bin_samples) + " samples per bin)")
+    for time_point, min_value, max_value in zip (overview.time_start, overview.min[channel], overview.max[channel]):
+        print ("\t" + str(time_point) + ": " + channel + " " + str(min_value) + " to " + str(max_value))
+
+
+def print_pipeline_report (results: dict) -> None:
+    """
+    Prints the results of the single pass pipeline run in main()
+
+    Args:
+        results:
+            Dict of stage name to result, from TracePipeline.run()
+    Returns:
+
+    """
+    for name, result in results.items():
+        if isinstance(result, ResampleResult):
+            print ("Resampled (" + name + ") to " + str(result.stripes) + " stripes")
+    for name, stats in results["statistics"].items():
+        if stats.count > 0:
+            print ("\t" + name + ": min " + str(stats.min) + ", max " + str(stats.max) + ", mean " +
+                   str(round(stats.mean, 3)) + ", RMS " + str(round(stats.rms, 3)))
+    for window in results["windows"]:
+        print ("Worst case over " + str(window.window) + ": " + str(window.worst_case) + ", best case " +
+               str(window.best_case))
+    for name, energy in results["energy"].items():
+        print ("Energy of " + name + ": " + str(energy.joules) + " J")
+    crossings = results["threshold"]
+    print ("Threshold of " + str(crossings.threshold) + " crossed " + str(len(crossings.rising_times)) +
+           " times, above it for " + str(crossings.time_above) + " (units of the time column)")
+
+
+def _sample_time (raw_file_path: str) -> float:
+    """
+    Measures the sample time of a CSV file from the times of its first 2 stripes
+
+    Args:
+        raw_file_path:
+            Input file path to read
+    Returns:
+        Sample time in the units of the time column
+    """
+    with TraceReader(raw_file_path, block_rows=2, chunk_bytes=4096) as rawFile:
+        block = next(iter(rawFile), None)
+        if block is None or len(block.columns[rawFile.names[0]]) < 2:
+            raise ValueError ("At least 2 stripes are needed to measure the sample time")
+        times = block.columns[rawFile.names[0]]
+        return float(times[1] - times[0])
+
 
 if __name__=="__main__":
     main()
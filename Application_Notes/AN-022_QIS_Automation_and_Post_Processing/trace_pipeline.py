@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+"""
+Single pass post processing pipeline for CSV traces, running several calculations on one read of the trace.
+
+Resampling, statistics and window averaging each read the whole trace when run on their own, so a report of N
+calculations reads (and parses) the trace N times.  TracePipeline reads the trace once with TraceReader
+(trace_reader.py), reading only the columns the stages need, and passes each block to every stage registered with
+add().  The stages provided are:
+
+1- ResampleStage: combines stripes by count or by time period into a new CSV file, with a STATISTICS footer, as
+   post_process_resample() in PowerExamples.py does (which runs this stage on its own)
+2- StatisticsStage: count, min, max, mean and RMS of each column
+3- WindowStage: worst case (largest) and best case (smallest) average over windows of each length
+4- EnergyStage: energy of each power column, integrated over the time column, in joules
+5- ThresholdStage: times a column crosses a threshold (with optional hysteresis), and the time spent above it
+
+A stage is any object with the methods of PipelineStage, so other calculations can be added the same way.
+
+Example:
+    pipeline = TracePipeline("RawData100us.csv")
+    pipeline.add(ResampleStage("PostData1ms.csv", resample_count=10))
+    pipeline.add(StatisticsStage())
+    pipeline.add(WindowStage([1000, 100000], column="Tot uW"))
+    results = pipeline.run()
+    print(results["statistics"]["Tot uW"].rms)
+"""
+import math
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import BLOCK_ROWS, CHUNK_BYTES, TraceReader, unit_scale
+from window_sums import WindowSums, combine
+
+# Statistics of one column.  Empty cells are not counted
+ColumnStatistics = namedtuple("ColumnStatistics", ("count", "min", "max", "mean", "rms"))
+
+# Result of ResampleStage: the number of output stripes, and the MAX, MIN and AVE written to the footer as dicts of
+# column name to value (None if there were no complete stripes)
+ResampleResult = namedtuple("ResampleResult", ("stripes", "max", "min", "ave"))
+
+# Worst and best case window averages for one window length (None if the column is shorter than the window)
+WindowExtremes = namedtuple("WindowExtremes", ("window", "window_samples", "worst_case", "best_case", "windows"))
+
+# Energy of one power column.  'integral' is the integral of the column over time, in the column units x the time
+# units, and 'joules' the same in joules (None if the units are not known).  'average' is integral / duration
+ColumnEnergy = namedtuple("ColumnEnergy", ("joules", "integral", "duration", "average"))
+
+# Crossings of a threshold.  'rising_times' and 'falling_times' are arrays of the sample times where the column goes
+# above the threshold, and back below it (less the hysteresis).  'time_above' is the time from each sample above the
+# threshold to the next sample
+ThresholdCrossings = namedtuple("ThresholdCrossings", ("threshold", "hysteresis", "rising_times", "falling_times",
+                                                       "samples_above", "time_above"))
+
+
+class TracePipeline:
+    '''
+    Runs every stage added to it on one read of a CSV trace.  The first column is the time column.
+
+    source          = Path of the CSV file, or an open file object
+    delimiter       = Delimiter character used in the CSV file
+    block_rows      = Number of rows passed to the stages at once
+    '''
+    def __init__(self, source, delimiter=",", block_rows=BLOCK_ROWS):
+        self.source = source
+        self.delimiter = delimiter
+        self.block_rows = block_rows
+        self.stages = []
+        self.rows = 0
+
+    # Adds a stage, returning it.  Each stage must have a different name
+    def add(self, stage):
+        if any(existing.name == stage.name for existing in self.stages):
+            raise ValueError ("The pipeline already has a stage named: " + stage.name)
+        self.stages.append(stage)
+        return stage
+
+    # Reads the trace, passing each block to every stage.  Returns a dict of stage name to the result of the stage
+    def run(self):
+        if len(self.stages) == 0:
+            raise ValueError ("The pipeline has no stages")
+        is_path = isinstance(self.source, (str, bytes, os.PathLike))
+        with TraceReader(self.source, delimiter=self.delimiter, block_rows=self.block_rows,
+                         chunk_bytes=4096 if is_path else CHUNK_BYTES) as header:
+            if len(header.names) == 0:
+                raise ValueError ("File does not contain any named columns")
+            time_name = header.names[0]
+            needed = {time_name}
+            for stage in self.stages:
+                needed.update(stage.start(header, time_name))
+            if not is_path:
+                # An open file can only be read once, so every column is read
+                self.__read(header, time_name)
+                return {stage.name: stage.finish() for stage in self.stages}
+
+        # Only the columns a stage needs are parsed
+        with TraceReader(self.source, columns=[name for name in header.names if name in needed],
+                         delimiter=self.delimiter, block_rows=self.block_rows) as reader:
+            self.__read(reader, time_name)
+        return {stage.name: stage.finish() for stage in self.stages}
+
+    # Passes each block of the trace to every stage
+    def __read(self, reader, time_name):
+        for block in reader:
+            for stage in self.stages:
+                stage.add(block, block.columns[time_name])
+        self.rows = reader.rows
+
+
+class PipelineStage:
+    '''
+    Base of the pipeline stages.  start() is called with the reader once the header has been read, add() with each
+    block of rows in order, then finish() once at the end of the trace.
+
+    name            = Name of the result of the stage
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+
+    # Returns the names of the columns the stage needs, from the header in 'reader'
+    def start(self, reader, time_name):
+        return []
+
+    # Processes a TraceBlock.  'times' holds the time of each row
+    def add(self, block, times):
+        pass
+
+    # Returns the result of the stage, also kept in 'result'
+    def finish(self):
+        return self.result
+
+
+class ResampleStage(PipelineStage):
+    '''
+    Combines stripes into a new CSV file, in groups of 'resample_count' stripes, or every stripe in each
+    'resample_time' period (from the time of the first stripe).  Each output stripe has the time of the last stripe
+    combined into it, and the average of each column (empty cells count as 0).  A last group of fewer than
+    'resample_count' stripes is not output.  The MAX, MIN and AVE of the output are written in a STATISTICS footer,
+    with the averages summed with compensated (Neumaier) summation.
+
+    output_file_path    = Path of the CSV file to write
+    resample_count      = Number of stripes to combine into one (a whole number)
+    resample_time       = Time period to combine stripes over, in the units of the time column, instead of a count
+    delimiter           = Delimiter character to write
+    '''
+    def __init__(self, output_file_path, resample_count=None, resample_time=None, delimiter=",", name="resample"):
+        super().__init__(name)
+        if resample_time is None:
+            if resample_count is None or resample_count != int(resample_count) or resample_count < 1:
+                raise ValueError ("Resample count must be a whole number of at least 1")
+        elif resample_time <= 0:
+            raise ValueError ("Resample time must be greater than 0")
+        self.output_file_path = output_file_path
+        self.resample_count = None if resample_count is None else int(resample_count)
+        self.resample_time = resample_time
+        self.delimiter = delimiter
+        self.__file = None
+
+    def start(self, reader, time_name):
+        self.__time_name = time_name
+        self.__data_names = reader.names[1:]
+        self.__stripes = 0
+        self.__first_time = None
+        # Stripes left over from the last block, that may be part of the next output stripe
+        self.__left = None
+        self.__max = None
+        self.__min = None
+        self.__ave = [_CompensatedSum() for _ in self.__data_names]
+        # Each block of output is formatted into one string, and written through a large buffer
+        self.__file = open(self.output_file_path, 'w', buffering=1024 * 1024)
+        self.__file.write(self.delimiter.join(reader.names) + "\n\n")
+        return reader.names
+
+    def add(self, block, times):
+        # Data columns as one array of (stripes, columns), with empty cells as 0
+        data = np.column_stack([block.columns[name] if block.missing[name] is None else
+                                np.where(block.missing[name], 0, block.columns[name])
+                                for name in self.__data_names])
+        # Output stripe that each stripe is combined into
+        if self.resample_time is None:
+            ids = (block.first_row + np.arange(len(times))) // self.resample_count
+        else:
+            if self.__first_time is None:
+                self.__first_time = times[0]
+            ids = np.floor((times - self.__first_time) / self.resample_time).astype(np.int64)
+        if self.__left is not None:
+            times = np.concatenate((self.__left[0], times))
+            data = np.concatenate((self.__left[1], data))
+            ids = np.concatenate((self.__left[2], ids))
+        self.__combine(times, data, ids, False)
+
+    def finish(self):
+        if self.__file is None:
+            return self.result
+        try:
+            if self.__left is not None and len(self.__left[0]) > 0:
+                self.__combine(*self.__left, True)
+            if self.__stripes == 0:
+                self.result = ResampleResult(0, None, None, None)
+                return self.result
+            # Add the stats data to the bottom of the output file
+            averages = [total.value / self.__stripes for total in self.__ave]
+            self.__file.write("\n\nSTATISTICS\n")
+            self.__file.write("MAX," + self.delimiter.join(str(x) for x in self.__max.tolist()) + "\n")
+            self.__file.write("MIN," + self.delimiter.join(str(x) for x in self.__min.tolist()) + "\n")
+            self.__file.write("AVE," + self.delimiter.join(str(x) for x in averages) + "\n")
+            self.result = ResampleResult(self.__stripes, dict(zip(self.__data_names, self.__max.tolist())),
+                                         dict(zip(self.__data_names, self.__min.tolist())),
+                                         dict(zip(self.__data_names, averages)))
+            return self.result
+        finally:
+            self.__file.close()
+            self.__file = None
+
+    # Combines the stripes of each output stripe, the last one may continue in the next block unless 'at_end'
+    def __combine(self, times, data, ids, at_end):
+        starts = np.flatnonzero(np.diff(ids) != 0) + 1
+        starts = np.concatenate(([0], starts)) if len(ids) > 0 else starts
+        ends = np.append(starts[1:], len(ids))
+        complete = len(starts) if at_end else len(starts) - 1
+        if complete < len(starts):
+            self.__left = (times[starts[complete]:], data[starts[complete]:], ids[starts[complete]:])
+        else:
+            self.__left = (times[:0], data[:0], ids[:0])
+        starts = starts[:complete]
+        ends = ends[:complete]
+        if at_end and self.resample_time is None and len(starts) > 0 and ends[-1] - starts[-1] < self.resample_count:
+            # A last group of fewer stripes is not output
+            starts = starts[:-1]
+            ends = ends[:-1]
+        if len(starts) == 0:
+            return
+        counts = (ends - starts)[:, None]
+        proc_data = np.add.reduceat(data[:ends[-1]], starts, axis=0) / counts
+        proc_times = times[ends - 1]
+
+        # Generate the lines for the output file, formatting one column at a time
+        fields = [[str(x) for x in proc_times.tolist()]]
+        fields += [[str(x) for x in proc_data[:, i].tolist()] for i in range(len(self.__data_names))]
+        self.__file.write("\n".join(self.delimiter.join(line) for line in zip(*fields)) + "\n")
+        self.__stripes += len(starts)
+
+        # Track maximums, minimums and averages
+        block_max = proc_data.max(axis=0)
+        block_min = proc_data.min(axis=0)
+        self.__max = block_max if self.__max is None else np.maximum(self.__max, block_max)
+        self.__min = block_min if self.__min is None else np.minimum(self.__min, block_min)
+        for i, total in enumerate(self.__ave):
+            total.add(math.fsum(proc_data[:, i].tolist()))
+
+
+class StatisticsStage(PipelineStage):
+    '''
+    Count, min, max, mean and RMS of each column, with empty cells not counted.  The result is a dict of column name
+    to ColumnStatistics.
+
+    columns         = Names of the columns, every column after the time column if None
+    '''
+    def __init__(self, columns=None, name="statistics"):
+        super().__init__(name)
+        self.columns = columns
+
+    def start(self, reader, time_name):
+        names = [name for name in reader.names if name != time_name] if self.columns is None else self.columns
+        self.__names = [_column(reader, name) for name in names]
+        self.__counts = dict.fromkeys(self.__names, 0)
+        self.__mins = dict.fromkeys(self.__names)
+        self.__maxs = dict.fromkeys(self.__names)
+        self.__sums = {name: _CompensatedSum() for name in self.__names}
+        self.__squares = {name: _CompensatedSum() for name in self.__names}
+        return self.__names
+
+    def add(self, block, times):
+        for name in self.__names:
+            values = _present(block, name)
+            if len(values) == 0:
+                continue
+            self.__counts[name] += len(values)
+            self.__mins[name] = combine(min, self.__mins[name], values.min().item())
+            self.__maxs[name] = combine(max, self.__maxs[name], values.max().item())
+            values = values.astype(np.float64)
+            self.__sums[name].add(math.fsum(values.tolist()))
+            self.__squares[name].add(math.fsum((values * values).tolist()))
+
+    def finish(self):
+        self.result = {}
+        for name in self.__names:
+            count = self.__counts[name]
+            self.result[name] = ColumnStatistics(count, self.__mins[name], self.__maxs[name],
+                                                 self.__sums[name].value / count if count > 0 else None,
+                                                 math.sqrt(self.__squares[name].value / count) if count > 0 else None)
+        return self.result
+
+
+class WindowStage(PipelineStage):
+    '''
+    Worst case (largest) and best case (smallest) average over every run of consecutive values covering each window
+    length, with empty cells skipped.  The result is a list of WindowExtremes, in the order of 'windows'.
+
+    windows         = List of window time spans, in the units of the time column
+    column          = Name of the column, the last power column (units ending in W) if None
+    sample_time     = Sample time of the trace, measured from the first 2 rows if None
+    '''
+    def __init__(self, windows, column=None, sample_time=None, name="windows"):
+        super().__init__(name)
+        self.windows = list(windows)
+        self.column = column
+        self.sample_time = sample_time
+
+    def start(self, reader, time_name):
+        self.__name = _column(reader, self.column) if self.column is not None else _power_columns(reader)[-1]
+        self.__samples = None
+        self.__first_times = []
+        self.__pending = []
+        return [self.__name]
+
+    def add(self, block, times):
+        values = _present(block, self.__name)
+        if self.__samples is None:
+            # Values are held until the sample time is known from the first 2 rows
+            self.__first_times += times[:2 - len(self.__first_times)].tolist()
+            self.__pending.append(values)
+            if self.sample_time is None and len(self.__first_times) < 2:
+                return
+            self.__set_windows()
+            values = np.concatenate(self.__pending)
+            self.__pending = None
+        for sums, extremes in zip(self.__sums, self.__extremes):
+            window_sums = sums.add(values)
+            if len(window_sums) > 0:
+                extremes[0] = combine(max, extremes[0], window_sums.max().item())
+                extremes[1] = combine(min, extremes[1], window_sums.min().item())
+                extremes[2] += len(window_sums)
+
+    def finish(self):
+        if self.__samples is None:
+            if self.sample_time is None and len(self.__first_times) < 2:
+                raise ValueError ("At least 2 rows are needed to measure the sample time")
+            self.__set_windows()
+        self.result = [WindowExtremes(window, samples, None if worst is None else worst / samples,
+                                      None if best is None else best / samples, windows)
+                       for window, samples, (worst, best, windows) in zip(self.windows, self.__samples,
+                                                                          self.__extremes)]
+        return self.result
+
+    # Sets the number of samples in each window, from the sample time
+    def __set_windows(self):
+        sample_time = self.sample_time
+        if sample_time is None:
+            sample_time = self.__first_times[1] - self.__first_times[0]
+        self.__samples = []
+        for window in self.windows:
+            samples = int(window / sample_time) if sample_time > 0 else 0
+            if samples == 0:
+                raise ValueError ("Window size of 0 stripes calculated, check your window parameter")
+            self.__samples.append(samples)
+        self.__sums = [WindowSums(samples) for samples in self.__samples]
+        self.__extremes = [[None, None, 0] for _ in self.__samples]
+
+
+class EnergyStage(PipelineStage):
+    '''
+    Energy of each power column, integrating the column over the time column with the trapezoidal rule (empty cells
+    are skipped).  The result is a dict of column name to ColumnEnergy.  The joules are calculated from the units in
+    the header, such as "uW" and "us".
+
+    columns         = Names of the power columns, every column with units ending in W if None
+    '''
+    def __init__(self, columns=None, name="energy"):
+        super().__init__(name)
+        self.columns = columns
+
+    def start(self, reader, time_name):
+        self.__names = _power_columns(reader) if self.columns is None else [_column(reader, name)
+                                                                            for name in self.columns]
+        time_scale = unit_scale(reader.units.get(time_name), "s")
+        self.__scales = {}
+        for name in self.__names:
+            power_scale = unit_scale(reader.units.get(name), "W")
+            self.__scales[name] = None if time_scale is None or power_scale is None else time_scale * power_scale
+        # Last value and time of each column, and the sum of (value + last value) x interval
+        self.__last = dict.fromkeys(self.__names)
+        self.__first_times = dict.fromkeys(self.__names)
+        self.__sums = {name: 0.0 for name in self.__names}
+        return self.__names
+
+    def add(self, block, times):
+        for name in self.__names:
+            values = block.columns[name]
+            block_times = times
+            if block.missing[name] is not None:
+                values = values[~block.missing[name]]
+                block_times = times[~block.missing[name]]
+            if len(values) == 0:
+                continue
+            if self.__last[name] is not None:
+                values = np.concatenate(([self.__last[name][1]], values))
+                block_times = np.concatenate(([self.__last[name][0]], block_times))
+            else:
+                self.__first_times[name] = block_times[0]
+            self.__last[name] = (block_times[-1], values[-1])
+            # Float64 so that (value + last value) x interval cannot overflow for integer columns, such as uW
+            # over ns timestamps
+            values = values.astype(np.float64)
+            block_times = block_times.astype(np.float64)
+            self.__sums[name] += math.fsum(((values[1:] + values[:-1]) * np.diff(block_times)).tolist())
+
+    def finish(self):
+        self.result = {}
+        for name in self.__names:
+            integral = self.__sums[name] / 2
+            duration = 0 if self.__last[name] is None else (self.__last[name][0] - self.__first_times[name]).item()
+            self.result[name] = ColumnEnergy(None if self.__scales[name] is None else integral * self.__scales[name],
+                                             integral, duration, integral / duration if duration > 0 else None)
+        return self.result
+
+
+class ThresholdStage(PipelineStage):
+    '''
+    Times a column goes above a threshold and back below it, with optional hysteresis: the column is above the
+    threshold from a value over 'threshold', until a value under 'threshold - hysteresis'.  Empty cells are skipped.
+    The result is a ThresholdCrossings.
+
+    threshold       = Threshold, in the units of the column
+    column          = Name of the column, the last power column (units ending in W) if None
+    hysteresis      = Amount the column must fall below the threshold to go back below it
+    '''
+    def __init__(self, threshold, column=None, hysteresis=0, name="threshold"):
+        super().__init__(name)
+        if hysteresis < 0:
+            raise ValueError ("Hysteresis must not be negative")
+        self.threshold = threshold
+        self.column = column
+        self.hysteresis = hysteresis
+
+    def start(self, reader, time_name):
+        self.__name = _column(reader, self.column) if self.column is not None else _power_columns(reader)[-1]
+        # State (True if above) and time of the last value
+        self.__state = None
+        self.__last_time = None
+        self.__rising = []
+        self.__falling = []
+        self.__samples_above = 0
+        self.__time_above = 0
+        return [self.__name]
+
+    def add(self, block, times):
+        values = block.columns[self.__name]
+        if block.missing[self.__name] is not None:
+            values = values[~block.missing[self.__name]]
+            times = times[~block.missing[self.__name]]
+        if len(values) == 0:
+            return
+        # Values between the two levels keep the state of the value before them
+        above = values > self.threshold
+        decided = above | (values < self.threshold - self.hysteresis)
+        last_decided = np.maximum.accumulate(np.where(decided, np.arange(len(values)), -1))
+        previous = self.__state if self.__state is not None else bool(above[np.argmax(decided)]) if \
+            decided.any() else False
+        states = np.where(last_decided >= 0, above[np.maximum(last_decided, 0)], previous)
+
+        changes = np.flatnonzero(np.diff(states.astype(np.int8), prepend=np.int8(previous)))
+        self.__rising.append(times[changes[states[changes]]])
+        self.__falling.append(times[changes[~states[changes]]])
+        self.__samples_above += int(np.count_nonzero(states))
+        # Each interval is above the threshold if the value at its start is
+        if self.__last_time is not None:
+            intervals = np.diff(times, prepend=self.__last_time)
+            starts_above = np.concatenate(([previous], states[:-1]))
+        else:
+            intervals = np.diff(times)
+            starts_above = states[:-1]
+        self.__time_above += intervals[starts_above].sum().item()
+        self.__state = bool(states[-1])
+        self.__last_time = times[-1]
+
+    def finish(self):
+        self.result = ThresholdCrossings(self.threshold, self.hysteresis, _join(self.__rising),
+                                         _join(self.__falling), self.__samples_above, self.__time_above)
+        return self.result
+
+
+class _CompensatedSum:
+    '''
+    Running sum of floats with Neumaier compensation, so adding many values does not lose precision
+    '''
+    def __init__(self):
+        self.total = 0.0
+        self.compensation = 0.0
+
+    def add(self, value):
+        total = self.total + value
+        if abs(self.total) >= abs(value):
+            self.compensation += (self.total - total) + value
+        else:
+            self.compensation += (value - total) + self.total
+        self.total = total
+
+    @property
+    def value(self):
+        return self.total + self.compensation
+
+
+# Returns the name of a column as found in the header, or raises ValueError if it is not there
+def _column (reader, name):
+    name = name.strip().strip("\"").strip()
+    if name not in reader.names:
+        raise ValueError ("File does not contain the specified column name: " + name)
+    return name
+
+
+# Returns the power columns of a trace (with units ending in W), or raises ValueError if there are none
+def _power_columns (reader):
+    names = [name for name in reader.names[1:] if unit_scale(reader.units.get(name), "W") is not None]
+    if len(names) == 0:
+        raise ValueError ("File does not contain any power columns")
+    return names
+
+
+# Returns the values of a column in a block that are not empty
+def _present (block, name):
+    values = block.columns[name]
+    return values if block.missing[name] is None else values[~block.missing[name]]
+
+
+# Returns the arrays in 'parts' joined into one
+def _join (parts):
+    return np.concatenate(parts) if len(parts) > 0 else np.zeros(0)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+'''
+AN-023 - Stress test of the HdStreamer capture loop and capture storage
+
+This script replays synthetic HD Plus stream blocks through an in-process socket at the full HD data rate, and
+runs a complete HdStreamer capture against it.  No module is required.
+
+At the end of the capture it reports the allocations and copies made per block by the capture storage.  These are
+compared with the original capture loop, which grew a bytearray with slice assignment on every block.
+
+With --save-mode streaming the blocks go through the bounded chunk queue to the decoder thread instead, and the
+number of times the receive loop had to wait for the decoder is also reported.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the capture time and data rate:
+    python CaptureStressTest.py --seconds 3 --rate-mb 3.0
+2- Use --unpaced to send data as fast as the capture loop can receive it
+3- Use --save-mode streaming to test the streaming save mode
+
+####################################
+'''
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from hd_decode import SYNC_REPLY
+from hd_replay import BLOCK_SIZE, generate_hdplus_data, make_hdplus_header
+from intel_custom import HdStreamer
+
+# Full HD data rate: 250k stripes per second, with 12 bytes per stripe (all channels enabled)
+FULL_RATE_BYTES = 250000 * 12
+
+# Number of data blocks between each sync request from the module
+SYNC_INTERVAL = 64
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress test the HdStreamer capture loop")
+    parser.add_argument("--seconds", type=float, default=3, help="Capture time in seconds")
+    parser.add_argument("--rate-mb", type=float, default=FULL_RATE_BYTES / 1e6, help="Data rate in MB/s")
+    parser.add_argument("--unpaced", action="store_true", help="Send data as fast as possible")
+    parser.add_argument("--save-mode", default="post_process", choices=("post_process", "streaming"),
+                        help="HdStreamer save mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 capture stress test")
+    print("----------------------------------------------------------\n")
+
+    rate = None if args.unpaced else args.rate_mb * 1e6
+    device = SimulatedHdPlusDevice(generate_hdplus_data(32 * 1024 * 1024), rate)
+    streamer = HdStreamer(device)
+
+    print("-Capturing for " + str(args.seconds) + " seconds")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        capture_start = time.perf_counter()
+        streamer.start_stream(args.seconds, os.path.join(temp_dir, "stress.csv"), logger, save_mode=args.save_mode)
+        total_time = time.perf_counter() - capture_start
+
+    storage = streamer.capture_storage
+    socket = device.connectionObj.connection.Connection
+    blocks = max(storage.blocks, 1)
+
+    # Replay the same block sizes through the original capture storage, to compare the cost
+    original = original_append_costs(socket.block_sizes)
+
+    print("\n####Results####")
+    print("Blocks received: " + str(storage.blocks) + " (" + str(len(storage)) + " bytes, " +
+          str(socket.syncs) + " syncs)")
+    print("Stream time: {:.2f} s, {:.2f} MB/s".format(socket.stream_time, len(storage) / socket.stream_time / 1e6))
+    print("Total time (including CSV decode): {:.2f} s".format(total_time))
+    print("Capture storage:")
+    print("\tAllocations: {} ({:.4f} per block, {} bytes)".format(
+        storage.allocations, storage.allocations / blocks, storage.bytes_allocated))
+    print("\tCopies:      {} ({:.4f} per block, {} bytes)".format(
+        storage.copies, storage.copies / blocks, storage.bytes_copied))
+    if args.save_mode == "streaming":
+        print("\tReceive stalls waiting for the decoder: " + str(storage.stalls))
+    print("Original bytearray growth:")
+    print("\tAllocations: {} ({:.4f} per block)".format(original.allocations, original.allocations / blocks))
+    print("\tCopies:      {} ({:.4f} per block, {} bytes)".format(
+        original.copies, original.copies / blocks, original.bytes_copied))
+    print("##############\n")
+
+
+# Replays block sizes through the original capture loop storage (bytearray(0) grown by slice assignment), counting
+# the allocations and the copies made.  A resize is counted as an allocation, and as a copy of the existing data
+def original_append_costs(block_sizes):
+    costs = SimpleNamespace(allocations=0, copies=0, bytes_copied=0)
+    mega_buffer = bytearray(0)
+    data = bytearray(1024)
+    store_pos = 0
+    for len_bytes in block_sizes:
+        old_size = sys.getsizeof(mega_buffer)
+        # data[0:len_bytes] creates a new copy of the block, which is then copied into the mega buffer
+        mega_buffer[store_pos:store_pos + len_bytes] = data[0:len_bytes]
+        costs.allocations += 1
+        costs.copies += 2
+        costs.bytes_copied += len_bytes * 2
+        if sys.getsizeof(mega_buffer) != old_size:
+            costs.allocations += 1
+            costs.copies += 1
+            costs.bytes_copied += store_pos
+        store_pos += len_bytes
+    return costs
+
+
+class SimulatedHdPlusDevice:
+    '''
+    Stand-in for a quarchpy HD Plus device, answering the commands HdStreamer sends, with a simulated stream socket
+    '''
+    def __init__(self, stream_data, rate):
+        self.connectionObj = SimpleNamespace(connection=SimpleNamespace(Connection=SimulatedStreamSocket(stream_data, rate)))
+
+    def sendCommand(self, command):
+        socket = self.connectionObj.connection.Connection
+        if command == "*serial?":
+            return "QTL1944-01-001"
+        if command == "hello?":
+            return "Simulated HD PLUS Power Module"
+        if command == "rec:ave?":
+            return "0"
+        if command.endswith("enable?"):
+            return "ON"
+        if command == "rec stream":
+            socket.start()
+        elif command == "rec stop":
+            socket.stop()
+        return "OK"
+
+
+class SimulatedStreamSocket:
+    '''
+    Serves HD Plus stream blocks in the same framing as the module: a 2 byte length, then the block.  The header fills
+    the first block, a sync status byte is added every SYNC_INTERVAL blocks, and a stream end status is sent after
+    'rec stop'.  If 'rate' is set (bytes per second) blocks are paced to that rate.
+    '''
+    def __init__(self, stream_data, rate):
+        self.__stream_data = memoryview(stream_data)
+        self.__rate = rate
+        self.__data_pos = 0
+        self.__pending = memoryview(b"")
+        self.__stopping = False
+        self.__ended = False
+        self.__start_time = None
+        self.stream_time = None
+        self.__bytes_sent = 0
+        self.block_sizes = []
+        self.syncs = 0
+
+    # Starts the stream, queueing the header block
+    def start(self):
+        self.__start_time = time.perf_counter()
+        self.__queue_block(make_hdplus_header(average_rate=0))
+
+    # Requests the end of the stream
+    def stop(self):
+        self.__stopping = True
+
+    # Socket receive, copying up to 'nbytes' of the stream into 'buffer'
+    def recv_into(self, buffer, nbytes=0):
+        if len(self.__pending) == 0:
+            self.__next_block()
+        if nbytes == 0:
+            nbytes = len(buffer)
+        count = min(nbytes, len(self.__pending))
+        buffer[:count] = self.__pending[:count]
+        self.__pending = self.__pending[count:]
+        return count
+
+    # Socket send, the ACK and sync replies from the host are counted
+    def send(self, data):
+        if bytes(data) == SYNC_REPLY:
+            self.syncs += 1
+        return len(data)
+
+    # Queues the next block of the stream
+    def __next_block(self):
+        if self.__ended:
+            raise Exception("Stream has ended")
+        if self.__stopping:
+            self.__queue_block(b"\x00")
+            self.__ended = True
+            self.stream_time = time.perf_counter() - self.__start_time
+            return
+
+        # Wait until this block is due, if pacing to a data rate
+        if self.__rate is not None:
+            due_time = self.__start_time + self.__bytes_sent / self.__rate
+            delay = due_time - time.perf_counter()
+            if delay > 0.001:
+                time.sleep(delay)
+
+        if self.__data_pos + BLOCK_SIZE > len(self.__stream_data):
+            self.__data_pos = 0
+        block = self.__stream_data[self.__data_pos:self.__data_pos + BLOCK_SIZE]
+        self.__data_pos += BLOCK_SIZE
+        self.block_sizes.append(BLOCK_SIZE)
+        if len(self.block_sizes) % SYNC_INTERVAL == 0:
+            block = bytes(block) + b"\x07"
+        self.__queue_block(block)
+
+    # Adds the length framing to a block and queues it for receive
+    def __queue_block(self, block):
+        self.__pending = memoryview(len(block).to_bytes(2, "little") + bytes(block))
+        self.__bytes_sent += len(block)
+
+
+if __name__ == "__main__":
+    main()
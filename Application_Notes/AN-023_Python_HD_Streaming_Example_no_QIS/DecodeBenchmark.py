@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+AN-023 - Benchmark of the HD / HD PPM Plus stream decoders in HdStreamer
+
+This script generates a synthetic HD Plus (or original HD) capture and times the original per-byte (or
+per-word) decoder against the NumPy batch decoder (hd_decode.py).  No module is required.
+
+The original decoder is slow, so it is timed on a small sample of the capture, and its time for the full
+capture is extrapolated from that.  The CSV output of both decoders on the sample is compared to check
+that they are bit-identical.  The sample is also written with the binary column sink (hd_sinks.py) and
+checked against the CSV.  The batch decoder is then run over the full capture.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the capture size:
+    python DecodeBenchmark.py --size-mb 1024 --sample-mb 4
+2- Use --module hd to benchmark the original HD decode
+
+####################################
+'''
+import argparse
+import filecmp
+import logging
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from hd_decode import HdPlusDecoder, HdStripeDecoder
+from hd_replay import generate_hd_data, generate_hdplus_data, make_hd_header, make_hdplus_header
+from hd_sinks import NpyColumnSink, load_columns
+from intel_custom import HdStreamer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HD / HD Plus stream decoders")
+    parser.add_argument("--module", default="hdplus", choices=("hd", "hdplus"), help="Module type")
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of the synthetic capture to decode")
+    parser.add_argument("--sample-mb", type=int, default=4, help="Size of the sample decoded by both decoders")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 decode benchmark")
+    print("-------------------------------------------------------\n")
+
+    hd_plus = args.module == "hdplus"
+    print("-Generating " + str(args.size_mb) + "MB synthetic " + ("HD Plus" if hd_plus else "HD") + " capture")
+    if hd_plus:
+        header = make_hdplus_header(average_rate=0)
+        data = generate_hdplus_data(args.size_mb * 1024 * 1024)
+    else:
+        header = make_hd_header(average_rate=0)
+        data = generate_hd_data(args.size_mb * 1024 * 1024)
+    sample = data[:args.sample_mb * 1024 * 1024]
+
+    # Decode the sample with both decoders, to CSV, and check the outputs match
+    with tempfile.TemporaryDirectory() as temp_dir:
+        legacy_path = os.path.join(temp_dir, "legacy.csv")
+        batch_path = os.path.join(temp_dir, "batch.csv")
+
+        print("-Decoding " + str(args.sample_mb) + "MB sample with the original decoder")
+        legacy_time = decode_to_csv(header, sample, legacy_path, logger, use_vectorised_decode=False, hd_plus=hd_plus)
+        print("-Decoding " + str(args.sample_mb) + "MB sample with the batch decoder")
+        batch_time = decode_to_csv(header, sample, batch_path, logger, use_vectorised_decode=True, hd_plus=hd_plus)
+
+        if filecmp.cmp(legacy_path, batch_path, shallow=False):
+            print("\tCSV output is identical")
+        else:
+            raise ValueError("CSV output of the batch decoder does not match the original decoder")
+
+        # Decode the sample to binary columns, and check they hold the same values as the CSV
+        print("-Decoding " + str(args.sample_mb) + "MB sample with the batch decoder to binary columns")
+        npy_path = os.path.join(temp_dir, "batch_npy")
+        npy_time = decode_to_csv(header, sample, batch_path, logger, use_vectorised_decode=True,
+                                 hd_plus=hd_plus, sink=NpyColumnSink(npy_path))
+        check_columns_match_csv(load_columns(npy_path), legacy_path)
+        print("\tBinary columns match the CSV")
+
+    # Decode the full capture to columns
+    print("-Decoding full capture with the batch decoder")
+    if hd_plus:
+        decoder = HdPlusDecoder(time_step=4)
+    else:
+        decoder = HdStripeDecoder(channels=0x0F, time_step=4)
+    rows = 0
+    start_time = time.perf_counter()
+    for block in decoder.decode(data):
+        rows += block.shape[1]
+    full_time = time.perf_counter() - start_time
+
+    size_ratio = len(data) / len(sample)
+    print("\n####Results####")
+    print("Sample (" + str(args.sample_mb) + "MB) to CSV:")
+    print("\tOriginal decoder: {:.2f} s".format(legacy_time))
+    print("\tBatch decoder:    {:.2f} s ({:.1f}x faster)".format(batch_time, legacy_time / batch_time))
+    print("Sample (" + str(args.sample_mb) + "MB) to binary columns:")
+    print("\tBatch decoder:    {:.2f} s ({:.1f}x faster)".format(npy_time, legacy_time / npy_time))
+    print("Full capture (" + str(args.size_mb) + "MB, " + str(rows) + " stripes) to columns:")
+    print("\tBatch decoder:    {:.2f} s ({:.1f} MB/s)".format(full_time, args.size_mb / full_time))
+    print("\tOriginal decoder: {:.0f} s (extrapolated)".format(legacy_time * size_ratio))
+    print("##############\n")
+
+
+# Decodes a raw capture to CSV (or the given sink) with HdStreamer, returning the time taken
+def decode_to_csv(header, data, csv_path, logger, use_vectorised_decode, hd_plus=True, sink=None):
+    streamer = HdStreamer(OfflineHdDevice(hd_plus))
+    streamer.use_vectorised_decode = use_vectorised_decode
+    start_time = time.perf_counter()
+    streamer.decode_capture(header, data, csv_path, logger, sink=sink)
+    return time.perf_counter() - start_time
+
+
+# Checks the binary columns hold the same values as the CSV file.  Binary power is in nW, the CSV in uW
+def check_columns_match_csv(columns, csv_path):
+    with open(csv_path, newline="") as csv_file:
+        rows = csv_file.read().split("\r")[1:-1]
+    values = np.array([row.split(",") for row in rows], dtype=np.float64).T
+    for index, name in enumerate(("Time us", "5V voltage mV", "5V current uA", "12V voltage mV", "12V current uA")):
+        if not np.array_equal(columns[name], values[index]):
+            raise ValueError("Binary column does not match the CSV: " + name)
+    for index, name in enumerate(("5V power nW", "12V power nW", "Total power nW"), start=5):
+        if not np.allclose(columns[name] / 1000, values[index]):
+            raise ValueError("Binary column does not match the CSV: " + name)
+
+
+class OfflineHdDevice:
+    '''
+    Minimal stand-in for a quarchpy device, answering the identification commands HdStreamer sends when it
+    is created.  This allows captured data to be decoded without a module attached.
+    '''
+    def __init__(self, hd_plus=True):
+        self.hd_plus = hd_plus
+        self.connectionObj = SimpleNamespace(connection=SimpleNamespace(Connection=None))
+
+    def sendCommand(self, command):
+        if command == "*serial?":
+            return "QTL1944-01-001"
+        if command == "hello?":
+            return "Offline HD PLUS Power Module" if self.hd_plus else "Offline HD Power Module"
+        return "FAIL: offline device"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+'''
+AN-023 - Soak and fault injection test against a local fake HD / HD Plus module
+
+This script serves a fake module on a local TCP port (hd_fake_device.py) and runs repeated HdStreamer captures from
+it, with the stream data and faults set on the command line:
+
+1- The waveform and frequency of the stream data, and the data rate
+2- A module buffer size, so the stream ends with an overrun status if the host falls behind
+3- Stalls in sending (back-pressure from a congested link), partial reads and corrupt packet IDs
+
+For each run it reports the data rate, the time the module waited for sync replies, the largest backlog in the module
+buffer, any overrun, the faults injected and the decode result.  No module is required.
+
+With --serve the fake module is only served (on port 9760 by default), so other scripts can connect to it.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the capture time, number of runs and the waveform:
+    python FakeModuleSoakTest.py --seconds 5 --runs 10 --waveform sine --frequency 1000
+2- Add faults, for example a 256kB module buffer with a 100mS stall every second and 1% of blocks split:
+    python FakeModuleSoakTest.py --buffer-kb 256 --stall-interval 1 --stall-ms 100 --partial-reads 0.01
+3- Use --corrupt-ids to send blocks with invalid packet IDs, HdStreamer stops decoding with an error after a few
+4- Use --serve to serve the fake module until Ctrl-C, on --port
+
+####################################
+'''
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from hd_decode import COMMAND_PORT
+from hd_fake_device import FULL_RATE_BYTES, WAVEFORMS, FakeHdDevice, TcpQuarchDevice
+from hd_sinks import NpyColumnSink, load_columns
+from intel_custom import HdStreamer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak and fault injection test against a fake HD module")
+    parser.add_argument("--seconds", type=float, default=3, help="Capture time of each run in seconds")
+    parser.add_argument("--runs", type=int, default=3, help="Number of captures to run")
+    parser.add_argument("--rate-mb", type=float, default=FULL_RATE_BYTES / 1e6, help="Data rate in MB/s")
+    parser.add_argument("--unpaced", action="store_true", help="Send data as fast as the host reads it")
+    parser.add_argument("--hd", action="store_true", help="Emulate an original HD module instead of HD Plus")
+    parser.add_argument("--waveform", default="random", choices=WAVEFORMS, help="Waveform of the stream data")
+    parser.add_argument("--frequency", type=float, default=1000.0, help="Frequency of the waveform in Hz")
+    parser.add_argument("--buffer-kb", type=int, help="Module buffer size in kB, the stream overruns if this fills")
+    parser.add_argument("--stall-interval", type=float, help="Seconds between stalls in sending")
+    parser.add_argument("--stall-ms", type=float, default=50, help="Length of each stall in mS")
+    parser.add_argument("--partial-reads", type=float, default=0.0, help="Chance of a block being sent in pieces")
+    parser.add_argument("--corrupt-ids", type=float, default=0.0, help="Chance of a block having a corrupt packet ID")
+    parser.add_argument("--save-mode", default="post_process", choices=("post_process", "streaming"),
+                        help="HdStreamer save mode")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the injected faults")
+    parser.add_argument("--serve", action="store_true", help="Only serve the fake module, until Ctrl-C")
+    parser.add_argument("--port", type=int, default=COMMAND_PORT, help="Port to serve on with --serve")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 fake module soak test")
+    print("-------------------------------------------------------------\n")
+
+    device = FakeHdDevice(hd_plus=not args.hd, rate=None if args.unpaced else args.rate_mb * 1e6,
+                          waveform=args.waveform, frequency=args.frequency, port=args.port if args.serve else 0,
+                          buffer_bytes=None if args.buffer_kb is None else args.buffer_kb * 1024,
+                          stall_interval=args.stall_interval, stall_time=args.stall_ms / 1000,
+                          partial_reads=args.partial_reads, corrupt_ids=args.corrupt_ids, seed=args.seed)
+
+    if args.serve:
+        print("-Serving a fake " + ("HD" if args.hd else "HD Plus") + " module on port " + str(args.port) +
+              ", Ctrl-C to stop")
+        try:
+            asyncio.run(serve_forever(device))
+        except KeyboardInterrupt:
+            pass
+        for stats in device.streams:
+            print_stream(stats)
+        return 0
+
+    loop = asyncio.new_event_loop()
+    server_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    server_thread.start()
+    asyncio.run_coroutine_threadsafe(device.start(), loop).result()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for run in range(args.runs):
+            print("-Run " + str(run + 1) + " of " + str(args.runs) + ", capturing for " + str(args.seconds) +
+                  " seconds")
+            columns_dir = os.path.join(temp_dir, str(run))
+            error = capture(device.port, args.seconds, columns_dir, args.save_mode, logger)
+            print_stream(device.streams[-1])
+            if error is not None:
+                failures += 1
+                print("\tCapture failed: " + str(error))
+            else:
+                print_columns(load_columns(columns_dir))
+
+    asyncio.run_coroutine_threadsafe(device.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    server_thread.join()
+
+    print("\n####Results####")
+    print("Runs: {}, failed: {}".format(args.runs, failures))
+    print("Overruns: {}".format(sum(1 for stats in device.streams if stats.overrun)))
+    print("##############\n")
+    return 1 if failures > 0 else 0
+
+
+# Runs one capture from the fake module to binary columns, returning any error
+def capture(port, seconds, columns_dir, save_mode, logger):
+    device = TcpQuarchDevice("127.0.0.1", port)
+    try:
+        streamer = HdStreamer(device)
+        streamer.start_stream(seconds, columns_dir, logger, save_mode=save_mode, sink=NpyColumnSink(columns_dir))
+    except Exception as error:
+        return error
+    finally:
+        device.close()
+    return None
+
+
+# Serves the fake module until interrupted
+async def serve_forever(device):
+    await device.start()
+    try:
+        while True:
+            await asyncio.sleep(1)
+    finally:
+        await device.close()
+
+
+# Prints the statistics of a stream from the module side
+def print_stream(stats):
+    print("\t{:.1f} MB in {:.2f} s ({:.2f} MB/s), {} blocks, {} syncs, {:.3f} s waiting for sync replies".format(
+        stats.bytes / 1e6, stats.seconds, stats.rate / 1e6, stats.blocks, stats.syncs, stats.sync_wait))
+    print("\tLargest module backlog: {:.1f} kB{}".format(
+        stats.max_backlog / 1024, ", OVERRUN" if stats.overrun else ""))
+    print("\tInjected: {} stalls, {} partial blocks, {} corrupt blocks".format(
+        stats.stalls, stats.partial_blocks, stats.corrupt_blocks))
+
+
+# Prints the stripe count and the range of the total power from the decoded columns
+def print_columns(columns):
+    power = np.asarray(columns["Total power nW"]) / 1e9
+    if len(power) == 0:
+        print("\tDecoded 0 stripes")
+        return
+    print("\tDecoded {} stripes, total power {:.3f} W min, {:.3f} W mean, {:.3f} W max".format(
+        len(power), power.min(), power.mean(), power.max()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+AN-023 - Benchmark of multi-module capture, asyncio against one thread per module
+
+This script starts a fake HD Plus (or HD) module on a local TCP port (hd_fake_device.py) in a separate process, then
+captures from N modules at once in two ways:
+
+1- asyncio: one event loop in one thread drives every module (hd_async.py)
+2- threads: an HdStreamer per module, each on its own thread with a blocking socket (the original approach)
+
+Each connection to the fake module is an independent module.  For each method it reports the aggregate data rate
+received, the time the modules spent waiting for sync replies from the host (the back-pressure the host puts on the
+modules) and the CPU time used by the capturing process.  No module is required.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the number of modules, the capture time and the data rate of each module:
+    python MultiModuleBenchmark.py --modules 8 --seconds 3 --rate-mb 3.0
+2- Use --unpaced to have each module send data as fast as the host reads it
+3- Use --hd to emulate original HD modules instead of HD Plus
+
+####################################
+'''
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from hd_async import AsyncHdModule
+from hd_fake_device import FULL_RATE_BYTES, FakeHdDevice, TcpQuarchDevice
+from hd_sinks import NpyColumnSink
+from intel_custom import HdStreamer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark asyncio multi-module capture against one thread per module")
+    parser.add_argument("--modules", type=int, default=4, help="Number of modules to capture from at once")
+    parser.add_argument("--seconds", type=float, default=3, help="Capture time in seconds")
+    parser.add_argument("--rate-mb", type=float, default=FULL_RATE_BYTES / 1e6, help="Data rate of each module in MB/s")
+    parser.add_argument("--unpaced", action="store_true", help="Send data as fast as the host reads it")
+    parser.add_argument("--hd", action="store_true", help="Emulate original HD modules instead of HD Plus")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 multi-module capture benchmark")
+    print("---------------------------------------------------------------------\n")
+
+    rate = None if args.unpaced else args.rate_mb * 1e6
+    results = []
+    for name, capture in (("asyncio", capture_asyncio), ("threads", capture_threads)):
+        print("-Capturing from " + str(args.modules) + " modules for " + str(args.seconds) + " seconds (" + name + ")")
+        with FakeDeviceProcess(not args.hd, rate) as device:
+            cpu_start = time.process_time()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                details = capture(device.port, args.modules, args.seconds, temp_dir, logger)
+            cpu_time = time.process_time() - cpu_start
+        results.append((name, device.streams, cpu_time, details))
+
+    print("\n####Results####")
+    for name, streams, cpu_time, details in results:
+        total_bytes = sum(stream[1] for stream in streams)
+        stream_time = max(stream[4] for stream in streams)
+        print(name + ":")
+        print("\tStreams: {}, {:.1f} MB in {:.2f} s ({:.2f} MB/s total, {:.2f} MB/s per module)".format(
+            len(streams), total_bytes / 1e6, stream_time, total_bytes / stream_time / 1e6,
+            total_bytes / stream_time / 1e6 / len(streams)))
+        print("\tSyncs: {}, module time waiting for sync replies: {:.3f} s mean, {:.3f} s max".format(
+            sum(stream[2] for stream in streams), sum(stream[5] for stream in streams) / len(streams),
+            max(stream[5] for stream in streams)))
+        print("\tCPU time (capture and decode): {:.2f} s".format(cpu_time))
+        if details is not None:
+            print("\t" + details)
+    print("##############\n")
+
+
+# Captures from each module with AsyncHdModule on one event loop, then decodes the captures in a thread pool
+def capture_asyncio(port, modules, seconds, temp_dir, logger):
+    async def run():
+        hd_modules = [AsyncHdModule("127.0.0.1", port) for _ in range(modules)]
+        await asyncio.gather(*(module.connect() for module in hd_modules))
+        await asyncio.gather(*(module.capture(seconds) for module in hd_modules))
+        for module in hd_modules:
+            module.close()
+        await asyncio.gather(*(module.decode(None, logger, sink=NpyColumnSink(os.path.join(temp_dir, str(index))))
+                               for index, module in enumerate(hd_modules)))
+        blocks = sum(module.protocol.blocks for module in hd_modules)
+        receive_calls = sum(module.protocol.receive_calls for module in hd_modules)
+        return "Blocks: {}, socket reads: {} ({:.2f} blocks per read)".format(
+            blocks, receive_calls, blocks / max(receive_calls, 1))
+    return asyncio.run(run())
+
+
+# Captures from each module with an HdStreamer on its own thread
+def capture_threads(port, modules, seconds, temp_dir, logger):
+    errors = []
+
+    def capture(index):
+        device = TcpQuarchDevice("127.0.0.1", port)
+        try:
+            streamer = HdStreamer(device)
+            streamer.start_stream(seconds, None, logger, sink=NpyColumnSink(os.path.join(temp_dir, str(index))))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            device.close()
+
+    threads = [threading.Thread(target=capture, args=(index,)) for index in range(modules)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return None
+
+
+class FakeDeviceProcess:
+    '''
+    Runs a FakeHdDevice in a separate process, so the module side does not share the capturing process.  On exit the
+    statistics of each stream are in 'streams', as (blocks, bytes, syncs, acks, seconds, sync_wait) tuples.
+    '''
+    def __init__(self, hd_plus, rate):
+        self.hd_plus = hd_plus
+        self.rate = rate
+        self.port = None
+        self.streams = []
+        self.__queue = multiprocessing.Queue()
+        self.__stop = multiprocessing.Event()
+        self.__process = None
+
+    def __enter__(self):
+        self.__process = multiprocessing.Process(target=_run_fake_device,
+                                                 args=(self.hd_plus, self.rate, self.__queue, self.__stop))
+        self.__process.start()
+        self.port = self.__queue.get(timeout=60)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__stop.set()
+        self.streams = self.__queue.get(timeout=60)
+        self.__process.join()
+
+
+# Serves a fake module until 'stop' is set, sending the port and then the stream statistics on 'queue'
+def _run_fake_device(hd_plus, rate, queue, stop):
+    async def run():
+        device = FakeHdDevice(hd_plus=hd_plus, rate=rate)
+        await device.start()
+        queue.put(device.port)
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        await device.close()
+        queue.put([(stream.blocks, stream.bytes, stream.syncs, stream.acks, stream.seconds, stream.sync_wait)
+                   for stream in device.streams])
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
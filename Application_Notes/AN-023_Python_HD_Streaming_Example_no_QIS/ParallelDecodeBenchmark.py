@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+AN-023 - Benchmark of the parallel (multi-process) HD Plus decoder
+
+This script generates a synthetic HD Plus capture and decodes it with the serial batch decoder (HdPlusDecoder) and
+the parallel decoder (hd_parallel.py) for a range of worker counts, reporting the time and speed up of each.  No module
+is required.
+
+The output of the parallel decoder is checked against the serial decoder, and a sample is decoded to CSV through
+HdStreamer with and without decode workers to check the files are identical.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the capture size and the largest number of workers:
+    python ParallelDecodeBenchmark.py --size-mb 512 --workers 8
+2- Use --segment-mb to set the size of the segment given to each worker
+
+####################################
+'''
+import argparse
+import filecmp
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from DecodeBenchmark import OfflineHdDevice
+from hd_decode import HdPlusDecoder
+from hd_parallel import DEFAULT_SEGMENT_BYTES, ParallelHdPlusDecoder
+from hd_replay import generate_hdplus_data, make_hdplus_header
+from intel_custom import HdStreamer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parallel HD Plus decoder")
+    parser.add_argument("--size-mb", type=int, default=256, help="Size of the synthetic capture to decode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Largest number of worker processes")
+    parser.add_argument("--segment-mb", type=float, default=DEFAULT_SEGMENT_BYTES / (1024 * 1024),
+                        help="Size of the segment given to each worker")
+    parser.add_argument("--sample-mb", type=int, default=32, help="Size of the sample decoded to CSV through HdStreamer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 parallel decode benchmark")
+    print("----------------------------------------------------------------\n")
+
+    print("-Generating " + str(args.size_mb) + "MB synthetic HD Plus capture")
+    data = generate_hdplus_data(args.size_mb * 1024 * 1024)
+    segment_bytes = int(args.segment_mb * 1024 * 1024)
+
+    # Worker counts to time: powers of two up to the largest
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= args.workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != args.workers:
+        worker_counts.append(args.workers)
+
+    print("-Decoding with the serial decoder")
+    serial_time, serial_rows = time_decode(HdPlusDecoder(time_step=4), data)
+    serial_digest = decode_digest(HdPlusDecoder(time_step=4), data)
+
+    parallel_times = []
+    for workers in worker_counts:
+        print("-Decoding with " + str(workers) + " worker(s)")
+        with ParallelHdPlusDecoder(time_step=4, workers=workers, segment_bytes=segment_bytes) as decoder:
+            # The first decode starts the worker processes, so is not timed
+            time_decode(decoder, data[:2 * segment_bytes])
+            decoder.time_pos = 0
+            parallel_time, rows = time_decode(decoder, data)
+        parallel_times.append(parallel_time)
+        if rows != serial_rows:
+            raise ValueError("Parallel decoder output " + str(rows) + " stripes, serial decoder " + str(serial_rows))
+
+    print("-Checking the parallel output matches the serial decoder")
+    with ParallelHdPlusDecoder(time_step=4, workers=worker_counts[-1], segment_bytes=segment_bytes) as decoder:
+        if decode_digest(decoder, data) != serial_digest:
+            raise ValueError("Parallel decoder output does not match the serial decoder")
+    print("\tOutput is identical")
+
+    # Decode a sample to CSV through HdStreamer, with and without workers
+    sample = data[:args.sample_mb * 1024 * 1024]
+    print("-Decoding " + str(args.sample_mb) + "MB sample to CSV with HdStreamer")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        serial_path = os.path.join(temp_dir, "serial.csv")
+        parallel_path = os.path.join(temp_dir, "parallel.csv")
+        csv_serial_time = decode_to_csv(sample, serial_path, logger, decode_workers=1)
+        csv_parallel_time = decode_to_csv(sample, parallel_path, logger, decode_workers=worker_counts[-1])
+        if not filecmp.cmp(serial_path, parallel_path, shallow=False):
+            raise ValueError("CSV output with decode workers does not match the serial decode")
+    print("\tCSV output is identical")
+
+    print("\n####Results####")
+    print("Full capture (" + str(args.size_mb) + "MB, " + str(serial_rows) + " stripes) to columns:")
+    print("\tSerial decoder:   {:.2f} s ({:.1f} MB/s)".format(serial_time, args.size_mb / serial_time))
+    for workers, parallel_time in zip(worker_counts, parallel_times):
+        print("\t{:3d} worker(s):    {:.2f} s ({:.1f} MB/s, {:.2f}x)".format(
+            workers, parallel_time, args.size_mb / parallel_time, serial_time / parallel_time))
+    print("Sample (" + str(args.sample_mb) + "MB) to CSV through HdStreamer:")
+    print("\tSerial decoder:   {:.2f} s".format(csv_serial_time))
+    print("\t{:3d} worker(s):    {:.2f} s (CSV formatting is not shared between the workers)".format(
+        worker_counts[-1], csv_parallel_time))
+    print("##############\n")
+
+
+# Decodes a buffer, returning the time taken and the number of stripes
+def time_decode(decoder, data):
+    rows = 0
+    start_time = time.perf_counter()
+    for block in decoder.decode(data):
+        rows += block.shape[1]
+    return time.perf_counter() - start_time, rows
+
+
+# Returns a digest of the decoded rows, which does not depend on how the output is split into blocks
+def decode_digest(decoder, data):
+    digest = hashlib.sha256()
+    for block in decoder.decode(data):
+        digest.update(block.T.tobytes())
+    return digest.hexdigest()
+
+
+# Decodes a raw capture to CSV with HdStreamer, returning the time taken
+def decode_to_csv(data, csv_path, logger, decode_workers):
+    streamer = HdStreamer(OfflineHdDevice(hd_plus=True))
+    streamer.decode_workers = decode_workers
+    start_time = time.perf_counter()
+    streamer.decode_capture(make_hdplus_header(average_rate=0), data, csv_path, logger)
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    main()
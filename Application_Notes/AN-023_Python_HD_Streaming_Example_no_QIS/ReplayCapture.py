@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+AN-023 - Replay of raw HD stream captures through HdStreamer
+
+This script replays a raw .dat capture (written by HdStreamer with debug_data_dump=True) through the same header
+parse, capture and decode code as a live module, and reports the decode throughput.  No module is required, so it
+can be used to benchmark and regression test the decoder on a CI host.
+
+It can also generate synthetic HD and HD Plus captures to replay.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Generate a synthetic capture (or use a .dat file from a real capture):
+    python ReplayCapture.py generate synthetic.dat --module hdplus --blocks 20000
+2- Replay it to CSV, optionally at the original wire rate:
+    python ReplayCapture.py replay synthetic.dat --output synthetic.csv [--wire-rate]
+3- For regression tests, compare the output to a reference CSV and/or set a minimum throughput.  The script exits
+   with an error if either check fails:
+    python ReplayCapture.py replay synthetic.dat --output synthetic.csv --expect reference.csv --min-mbps 1.0
+4- Use --npy to write binary columns (hd_sinks.py) to a directory instead of CSV
+
+####################################
+'''
+import argparse
+import filecmp
+import logging
+import os
+import sys
+import time
+
+from hd_replay import replay_capture, write_synthetic_capture
+from hd_sinks import NpyColumnSink
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay raw HD stream captures through HdStreamer")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="Generate a synthetic capture")
+    generate_parser.add_argument("dat_path", help="Capture file to write")
+    generate_parser.add_argument("--module", default="hdplus", choices=("hd", "hdplus"), help="Module type")
+    generate_parser.add_argument("--blocks", type=int, default=20000, help="Number of 512 byte data blocks")
+    generate_parser.add_argument("--seed", type=int, default=1, help="Random seed")
+
+    replay_parser = commands.add_parser("replay", help="Replay a capture through HdStreamer")
+    replay_parser.add_argument("dat_path", help="Capture file to replay")
+    replay_parser.add_argument("--output", required=True, help="CSV file (or directory with --npy) to write")
+    replay_parser.add_argument("--npy", action="store_true", help="Write binary .npy columns instead of CSV")
+    replay_parser.add_argument("--wire-rate", action="store_true", help="Send blocks at the recorded times")
+    replay_parser.add_argument("--save-mode", default="post_process", choices=("post_process", "streaming"),
+                               help="HdStreamer save mode")
+    replay_parser.add_argument("--expect", help="Reference CSV the output must match")
+    replay_parser.add_argument("--min-mbps", type=float, help="Minimum decode throughput in MB/s")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 capture replay")
+    print("-----------------------------------------------------\n")
+
+    if args.command == "generate":
+        print("-Generating " + args.module + " capture: " + args.dat_path)
+        write_synthetic_capture(args.dat_path, args.module, args.blocks, args.seed)
+        print("\tWritten " + str(os.path.getsize(args.dat_path)) + " bytes")
+        return 0
+
+    print("-Replaying " + args.dat_path)
+    sink = NpyColumnSink(args.output) if args.npy else None
+    start_time = time.perf_counter()
+    streamer = replay_capture(args.dat_path, args.output, logger, wire_rate=args.wire_rate, save_mode=args.save_mode,
+                              sink=sink)
+    total_time = time.perf_counter() - start_time
+
+    data_bytes = len(streamer.capture_storage)
+    throughput = data_bytes / total_time / 1e6
+
+    print("\n####Results####")
+    print("Blocks: " + str(streamer.capture_storage.blocks) + " (" + str(data_bytes) + " bytes of stream data)")
+    print("Stream end time: " + str(streamer.stream_time_pos) + " uS")
+    print("Total time: {:.2f} s ({:.2f} MB/s)".format(total_time, throughput))
+    print("##############\n")
+
+    failed = False
+    if args.expect is not None:
+        if args.npy:
+            print("--expect compares CSV output only")
+            failed = True
+        elif filecmp.cmp(args.output, args.expect, shallow=False):
+            print("Output matches " + args.expect)
+        else:
+            print("Output does NOT match " + args.expect)
+            failed = True
+    if args.min_mbps is not None and throughput < args.min_mbps:
+        print("Throughput {:.2f} MB/s is below the minimum of {:.2f} MB/s".format(throughput, args.min_mbps))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+AN-023 - Live telemetry tap and power limit trigger example
+
+This script runs an HdStreamer capture in the "streaming" save mode with a telemetry tap (hd_telemetry.py) added.
+Window statistics (min/max/mean of each channel) are read from an asyncio queue while the capture runs, and a
+threshold trigger on the total power sends "run:power down" to the device when the limit is exceeded.
+
+By default the capture is made from a simulated HD Plus module streaming synthetic data at the full HD data rate, so
+no module is required.  Use --ip to capture from a real HD Plus module over LAN instead (quarchpy is then required).
+
+At the end it reports the latency from receiving data to publishing it, and the time from the trigger to the command
+being sent to the device.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+3- Quarchpy python package (only with --ip)
+    https://quarch.com/products/quarchpy-python-package/
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the capture time, the window length and the power limit:
+    python TelemetryTapExample.py --seconds 3 --window-us 1000 --limit-w 9.1
+   The simulated data rate can be set with --rate-mb.  The latency is only bounded while the decoder keeps up with
+   the data rate
+2- Use --stop-on-trigger to stop the stream when the trigger fires
+3- Use --ip to capture from a module, note this will send "run:power down" to it if the limit is exceeded
+
+####################################
+'''
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from CaptureStressTest import FULL_RATE_BYTES, SimulatedHdPlusDevice
+from hd_replay import generate_hdplus_data
+from hd_sinks import NpyColumnSink
+from hd_telemetry import TelemetryTap, ThresholdTrigger
+from intel_custom import HdStreamer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live telemetry tap and power limit trigger example")
+    parser.add_argument("--seconds", type=float, default=3, help="Capture time in seconds")
+    parser.add_argument("--window-us", type=int, default=1000, help="Statistics window length in uS")
+    parser.add_argument("--limit-w", type=float, default=9.1, help="Total power limit in W")
+    parser.add_argument("--rate-mb", type=float, default=FULL_RATE_BYTES / 1e6, help="Simulated data rate in MB/s")
+    parser.add_argument("--stop-on-trigger", action="store_true", help="Stop the stream when the trigger fires")
+    parser.add_argument("--ip", help="IP address of an HD Plus module to capture from, instead of the simulation")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    print("\n\nQuarch application note example: AN-023 live telemetry tap")
+    print("---------------------------------------------------------\n")
+
+    if args.ip is not None:
+        from quarchpy.device import getQuarchDevice
+        device = getQuarchDevice("TCP:" + args.ip)
+    else:
+        device = CommandLogDevice(generate_hdplus_data(32 * 1024 * 1024), args.rate_mb * 1e6)
+    streamer = HdStreamer(device)
+
+    # Record the time the trigger was handled, and how long after the data was received
+    trigger_times = []
+
+    def on_trigger(event):
+        trigger_times.append((event, event.handled_time - tap.received_time))
+        print("\tTrigger: total power {:.3f} W at {} uS".format(event.value / 1e6, event.time_us))
+
+    tap = TelemetryTap(window_us=args.window_us)
+    tap.add_trigger(ThresholdTrigger("Total power uW", above=args.limit_w * 1e6, callback=on_trigger,
+                                     command="run:power down", stop_stream=args.stop_on_trigger))
+    streamer.add_tap(tap)
+
+    print("-Capturing for " + str(args.seconds) + " seconds")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sink = NpyColumnSink(os.path.join(temp_dir, "columns"))
+        windows = asyncio.run(capture_with_monitor(streamer, args.seconds, logger, tap, sink))
+
+    print("\n####Results####")
+    print("Stripes published: " + str(tap.samples))
+    print("Windows received: " + str(len(windows)) + " (" + str(tap.dropped) + " dropped)")
+    if len(windows) > 0:
+        peak = max(window.maximum[6] for window in windows)
+        print("Peak total power: {:.3f} W".format(peak / 1e6))
+    print("Receive to publish latency: {:.2f} ms mean, {:.2f} ms max".format(
+        tap.latency_mean * 1000, tap.latency_max * 1000))
+    if len(trigger_times) > 0:
+        event, latency = trigger_times[0]
+        print("Trigger at {} uS, handled {:.2f} ms after the data was received".format(event.time_us, latency * 1000))
+        if isinstance(device, CommandLogDevice) and "run:power down" in device.command_times:
+            sent = device.command_times["run:power down"] - event.handled_time
+            print("\"run:power down\" sent {:.2f} ms after the trigger".format(sent * 1000))
+    else:
+        print("Trigger did not fire")
+    print("##############\n")
+
+
+# Runs the capture in a worker thread, reading window statistics from the tap while it runs
+async def capture_with_monitor(streamer, seconds, logger, tap, sink):
+    queue = asyncio.Queue(maxsize=10000)
+    tap.subscribe_queue(queue)
+    capture = asyncio.get_running_loop().run_in_executor(
+        None, lambda: streamer.start_stream(seconds, sink.directory, logger, save_mode="streaming", sink=sink))
+
+    windows = []
+    last_print = time.perf_counter()
+    while not capture.done() or not queue.empty():
+        try:
+            window = await asyncio.wait_for(queue.get(), timeout=0.1)
+        except asyncio.TimeoutError:
+            continue
+        windows.append(window)
+        if time.perf_counter() - last_print > 0.5:
+            last_print = time.perf_counter()
+            print("\t{:.3f} s: total power {:.3f} W mean, {:.3f} W max".format(
+                window.start_us / 1e6, window.mean[6] / 1e6, window.maximum[6] / 1e6))
+    await capture
+    return windows
+
+
+class CommandLogDevice(SimulatedHdPlusDevice):
+    '''
+    Simulated HD Plus module that records the time each command is received
+    '''
+    def __init__(self, stream_data, rate):
+        super().__init__(stream_data, rate)
+        self.command_times = {}
+
+    def sendCommand(self, command):
+        self.command_times.setdefault(command, time.perf_counter())
+        return super().sendCommand(command)
+
+
+if __name__ == "__main__":
+    main()
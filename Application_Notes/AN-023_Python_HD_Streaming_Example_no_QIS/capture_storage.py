@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+Capture storage for raw HD stream data.
+
+Stream blocks are received from the socket straight into the storage, so no block is copied after it arrives.  The
+storage is made of one or more segments:
+
+1- When the capture length is known, the first segment is preallocated to the full stripe budget
+2- When it is not known (or the budget is used up) further fixed size segments are added as needed
+
+A block is never split across two segments, so each segment holds whole blocks and can be decoded in turn.  The
+counters on the storage record each allocation and copy, so the cost per block can be checked.
+
+StreamChunkQueue has the same interface, but hands each filled chunk to a decoder thread through a bounded queue
+instead of keeping it, so memory use depends on the chunk size rather than the capture length.  A flush interval can
+be set so that part filled chunks are passed on, bounding the time from receive to decode for live data.
+'''
+import queue
+import time
+
+# Size of each segment added when the capture length is unknown, or the preallocated segment is full
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Size of each chunk passed to the decoder in streaming mode, and the number that can wait in the queue
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_QUEUE_CHUNKS = 8
+
+
+class CaptureStorage:
+    '''
+    Append-only store for raw stream data.  Data is added by reserving space, receiving into the returned memoryview,
+    then committing the number of bytes that are valid.
+
+    capacity        = Size of the first (preallocated) segment, 0 if the capture length is unknown
+    segment_size    = Size of each additional segment
+    '''
+    def __init__(self, capacity=0, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.segment_size = segment_size
+        # Stored segments, and the number of valid bytes in each
+        self.__segments = []
+        self.__segment_used = []
+        self.__segment_offsets = []
+        self.__length = 0
+        # Counters for the stress test and debug
+        self.allocations = 0
+        self.bytes_allocated = 0
+        self.copies = 0
+        self.bytes_copied = 0
+        self.blocks = 0
+
+        if capacity > 0:
+            self.__add_segment(capacity)
+
+    # Creates storage around an existing buffer of captured data, without copying it
+    @classmethod
+    def wrap(cls, buffer):
+        storage = cls()
+        storage.__segments.append(memoryview(buffer).cast("B"))
+        storage.__segment_used.append(len(storage.__segments[0]))
+        storage.__segment_offsets.append(0)
+        storage.__length = storage.__segment_used[0]
+        return storage
+
+    # Number of bytes of data stored
+    def __len__(self):
+        return self.__length
+
+    # Total size of all segments
+    @property
+    def capacity(self):
+        return sum(len(segment) for segment in self.__segments)
+
+    # Returns a writable memoryview of 'length' bytes at the end of the stored data, adding a segment if the current one
+    # does not have space.  Nothing is stored until commit() is called
+    def reserve(self, length):
+        if len(self.__segments) == 0 or len(self.__segments[-1]) - self.__segment_used[-1] < length:
+            self.__add_segment(max(length, self.segment_size))
+        used = self.__segment_used[-1]
+        return self.__segments[-1][used:used + length]
+
+    # Marks 'length' bytes of the last reserved space as valid data
+    def commit(self, length):
+        self.__segment_used[-1] += length
+        self.__length += length
+        self.blocks += 1
+
+    # Copies a block of data into the storage, for data that could not be received in place
+    def append(self, data):
+        length = len(data)
+        self.reserve(length)[:] = data
+        self.copies += 1
+        self.bytes_copied += length
+        self.commit(length)
+
+    # Returns memoryviews of the data in each segment, in order.  No data is copied
+    def segments(self):
+        return [segment[:used] for segment, used in zip(self.__segments, self.__segment_used) if used > 0]
+
+    # Returns the data from 'start' to 'end'.  This is a memoryview when the range is inside one segment, otherwise the
+    # data is copied to join the segments
+    def view(self, start=0, end=None):
+        if end is None or end > self.__length:
+            end = self.__length
+        if start >= end:
+            return memoryview(b"")
+
+        parts = []
+        for segment, used, offset in zip(self.__segments, self.__segment_used, self.__segment_offsets):
+            if offset + used <= start:
+                continue
+            if offset >= end:
+                break
+            parts.append(segment[max(start - offset, 0):min(end - offset, used)])
+
+        if len(parts) == 1:
+            return parts[0]
+        self.copies += 1
+        self.bytes_copied += end - start
+        return memoryview(b"".join(parts))
+
+    # Allocates a new segment, which starts at the end of the current data
+    def __add_segment(self, size):
+        self.__segments.append(memoryview(bytearray(size)))
+        self.__segment_used.append(0)
+        self.__segment_offsets.append(self.__length)
+        self.allocations += 1
+        self.bytes_allocated += size
+
+
+class StreamChunkQueue:
+    '''
+    Bounded producer/consumer queue of raw stream data, with the same reserve()/commit() interface as CaptureStorage.
+    Blocks are received into a fixed size chunk.  When the next block does not fit, the chunk is queued for the decoder
+    and another is taken from the free pool.  The decoder gets chunks with get() and returns them with release(), so no
+    more than max_chunks + 2 chunks are ever allocated.  If the queue is full the receiving thread waits for the
+    decoder (counted in 'stalls').
+
+    chunk_size      = Size of each chunk
+    max_chunks      = Number of filled chunks that can wait in the queue
+    flush_interval  = If set, a chunk is queued once this many seconds have passed since its first block, even if it
+                      is not full
+    '''
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=DEFAULT_QUEUE_CHUNKS, flush_interval=None):
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        # Time (time.perf_counter()) the first block of the current chunk was committed, and of the last chunk returned
+        # by get()
+        self.__chunk_time = None
+        self.chunk_time = None
+        self.__queue = queue.Queue(maxsize=max_chunks)
+        self.__free_chunks = queue.Queue()
+        self.__chunk = None
+        self.__used = 0
+        self.__length = 0
+        # Counters for the stress test and debug
+        self.allocations = 0
+        self.bytes_allocated = 0
+        self.copies = 0
+        self.bytes_copied = 0
+        self.blocks = 0
+        self.stalls = 0
+
+    # Number of bytes of data stored (including data already decoded)
+    def __len__(self):
+        return self.__length
+
+    # Returns a writable memoryview of 'length' bytes in the current chunk, queueing the chunk and starting another if
+    # it does not have space.  Nothing is stored until commit() is called
+    def reserve(self, length):
+        if self.__chunk is None or len(self.__chunk) - self.__used < length:
+            self.__queue_chunk()
+            self.__chunk = self.__get_free_chunk(length)
+        return self.__chunk[self.__used:self.__used + length]
+
+    # Marks 'length' bytes of the last reserved space as valid data, queueing the chunk if the flush interval has passed
+    def commit(self, length):
+        if self.__used == 0:
+            self.__chunk_time = time.perf_counter()
+        self.__used += length
+        self.__length += length
+        self.blocks += 1
+        if self.flush_interval is not None and time.perf_counter() - self.__chunk_time >= self.flush_interval:
+            self.__queue_chunk()
+
+    # Copies a block of data into the queue, for data that could not be received in place
+    def append(self, data):
+        length = len(data)
+        self.reserve(length)[:] = data
+        self.copies += 1
+        self.bytes_copied += length
+        self.commit(length)
+
+    # Queues the last partly filled chunk and marks the end of the stream for the decoder
+    def close(self):
+        self.__queue_chunk()
+        self.__queue.put((None, None))
+
+    # Returns the next chunk of data (a memoryview) for the decoder, waiting if needed.  None marks the end of the stream
+    def get(self):
+        chunk, self.chunk_time = self.__queue.get()
+        return chunk
+
+    # Returns a chunk from get() to the free pool once it has been decoded
+    def release(self, chunk):
+        if len(chunk.obj) == self.chunk_size:
+            self.__free_chunks.put(chunk.obj)
+
+    # Queues the current chunk if it holds any data, waiting for space in the queue
+    def __queue_chunk(self):
+        if self.__chunk is not None and self.__used > 0:
+            if self.__queue.full():
+                self.stalls += 1
+            self.__queue.put((self.__chunk[:self.__used], self.__chunk_time))
+        elif self.__chunk is not None:
+            self.release(self.__chunk)
+        self.__chunk = None
+        self.__used = 0
+
+    # Takes a chunk from the free pool, or allocates one if none are free.  Blocks larger than the chunk size get their
+    # own chunk, which is not reused
+    def __get_free_chunk(self, length):
+        if length <= self.chunk_size:
+            try:
+                return memoryview(self.__free_chunks.get_nowait())
+            except queue.Empty:
+                length = self.chunk_size
+        self.allocations += 1
+        self.bytes_allocated += length
+        return memoryview(bytearray(length))
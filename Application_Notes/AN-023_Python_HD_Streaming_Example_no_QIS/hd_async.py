@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+'''
+asyncio capture of HD stream data, so one event loop (and one thread) can capture from many modules at once.
+
+HdStreamer receives the stream with a blocking loop on its socket, so each module needs its own thread.
+HdStreamProtocol implements the same command and stream protocol as an asyncio BufferedProtocol instead:
+
+1- Commands are sent as text lines, and the response is read up to the "\\r\\n>" prompt
+2- After "rec stream" the data is parsed as length prefixed blocks, with an ACK stub (02 00 FF FF) sent for each block
+3- The status byte on odd length blocks is handled as HdStreamer does: 0-2 end the stream, 3 is no data, and 7 is a
+   sync request, answered with 02 00 FF 01 (after "rec stop" if a stop has been requested)
+
+Data is received into a large buffer, so many blocks are handled for each wake up of the event loop, and then copied
+into the module's CaptureStorage (one copy per block).  AsyncHdModule wraps the protocol for one module, with its own
+storage and an HdStreamer to decode the capture once the stream ends.
+'''
+import asyncio
+import logging
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from capture_storage import CaptureStorage
+from hd_decode import ACK_STUB, COMMAND_PORT, RESPONSE_END, SYNC_REPLY
+from intel_custom import HdStreamer
+
+# Size of the buffer data is received into, large enough for the longest block (65535 bytes) and its length
+RECEIVE_BUFFER_SIZE = 256 * 1024
+
+# Size of the original HD stream header, HD Plus headers fill the first block
+HD_HEADER_SIZE = 4
+
+
+class HdStreamProtocol(asyncio.BufferedProtocol):
+    '''
+    asyncio protocol for the command connection of one module.  Commands are sent with command(), and once the stream
+    has been started the blocks are stored in 'capture_storage' until an end status is received ('stream_done' is set).
+
+    hd_plus         = True for an HD Plus module, where the header fills the first block
+    receive_size    = Size of the receive buffer
+    '''
+    def __init__(self, hd_plus=True, receive_size=RECEIVE_BUFFER_SIZE):
+        self.hd_plus = hd_plus
+        self.transport = None
+        self.__buffer = memoryview(bytearray(receive_size))
+        self.__used = 0
+        self.__response_future = None
+        self.__stream_starting = False
+        self.__streaming = False
+        self.__queued_commands = []
+        self.request_stop = False
+        # Stream header, data and end status
+        self.header = None
+        self.capture_storage = CaptureStorage()
+        self.stream_done = None
+        self.stream_end_status = -1
+        # Counters
+        self.blocks = 0
+        self.syncs = 0
+        self.receive_calls = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        error = exc if exc is not None else ConnectionError("Module connection closed")
+        for future in (self.__response_future, self.stream_done):
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    def get_buffer(self, sizehint):
+        return self.__buffer[self.__used:]
+
+    def buffer_updated(self, nbytes):
+        self.__used += nbytes
+        self.receive_calls += 1
+        if not self.__streaming:
+            self.__parse_response()
+        if self.__streaming:
+            self.__parse_stream()
+
+    # Sends a command and returns its response.  Once the stream is running commands are not answered, so they are
+    # queued and sent at the next sync instead
+    async def command(self, command):
+        if self.__streaming:
+            self.__queued_commands.append(command)
+            return ""
+        self.__response_future = asyncio.get_running_loop().create_future()
+        if command == "rec stream":
+            self.__stream_starting = True
+            self.stream_done = asyncio.get_running_loop().create_future()
+        self.transport.write(command.encode("latin1") + b"\r\n")
+        return await self.__response_future
+
+    # Completes the pending command when its whole response has been received.  After "rec stream", the data that
+    # follows the response is the start of the stream
+    def __parse_response(self):
+        received = self.__buffer[:self.__used]
+        end = bytes(received).find(RESPONSE_END)
+        if end < 0:
+            return
+        response = bytes(received[:end]).decode("latin1").strip()
+        self.__consume(end + len(RESPONSE_END))
+        if self.__stream_starting:
+            self.__stream_starting = False
+            self.__streaming = True
+        if self.__response_future is not None and not self.__response_future.done():
+            self.__response_future.set_result(response)
+
+    # Handles all the complete blocks in the receive buffer, then sends the ACKs and any sync reply in one write
+    def __parse_stream(self):
+        buffer = self.__buffer
+        used = self.__used
+        pos = 0
+        reply = bytearray()
+        while used - pos >= 2 and self.__streaming:
+            len_bytes = buffer[pos] + (buffer[pos + 1] << 8)
+            if used - pos - 2 < len_bytes:
+                break
+            reply += ACK_STUB
+            self.__handle_block(buffer[pos + 2:pos + 2 + len_bytes], reply)
+            pos += 2 + len_bytes
+        self.__consume(pos)
+        if len(reply) > 0:
+            self.transport.write(reply)
+
+    # Stores a block and handles its status byte, adding any sync reply to 'reply'
+    def __handle_block(self, block, reply):
+        self.blocks += 1
+        status = None
+        if (len(block) & 1) != 0:
+            status = block[-1]
+            block = block[:-1]
+
+        if self.header is None:
+            header_size = len(block) if self.hd_plus else HD_HEADER_SIZE
+            self.header = bytes(block[:header_size])
+            block = block[header_size:]
+        if len(block) > 0:
+            self.capture_storage.append(block)
+
+        if status is None or status == 3:
+            return
+        if status < 3:
+            self.stream_end_status = status
+            self.__streaming = False
+            if not self.stream_done.done():
+                self.stream_done.set_result(status)
+        elif status == 7:
+            self.syncs += 1
+            for command in self.__queued_commands:
+                reply += command.encode("latin1") + b"\r\n"
+            self.__queued_commands = []
+            if self.request_stop:
+                reply += b"rec stop\r\n"
+            reply += SYNC_REPLY
+        else:
+            logging.debug(datetime.now().isoformat() + "\t: Status byte - unexpected: " + str(status))
+
+    # Removes 'count' bytes from the start of the receive buffer, moving any part block to the start
+    def __consume(self, count):
+        remaining = self.__used - count
+        if count > 0 and remaining > 0:
+            self.__buffer[:remaining] = self.__buffer[count:self.__used]
+        self.__used = remaining
+
+
+class AsyncHdModule:
+    '''
+    Captures from one HD or HD Plus module on an asyncio event loop.  Any number of modules can be captured at once,
+    for example with asyncio.gather(*(module.capture(10) for module in modules)).
+
+    host            = IP address of the module
+    port            = Command port
+    '''
+    def __init__(self, host, port=COMMAND_PORT):
+        self.host = host
+        self.port = port
+        self.protocol = None
+        self.serial = None
+        self.identity = None
+        self.stream_time = None
+
+    # Opens the connection and identifies the module
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        transport, self.protocol = await loop.create_connection(HdStreamProtocol, self.host, self.port)
+        self.serial = await self.protocol.command("*serial?")
+        if "1944" not in self.serial:
+            raise ValueError("Attached device not supported.  This code only supports HD power modules (QTL1999 / QTL1995)")
+        self.identity = await self.protocol.command("hello?")
+        self.protocol.hd_plus = "HD PLUS" in self.identity.upper()
+
+    # Sends a command and returns the response
+    async def send_command(self, command):
+        return await self.protocol.command(command)
+
+    # Streams for 'seconds' (or until stop() if None), returning when the module has ended the stream
+    async def capture(self, seconds=None):
+        if self.protocol is None:
+            await self.connect()
+        await self.protocol.command("conf stream enable on")
+        start_time = time.perf_counter()
+        await self.protocol.command("rec stream")
+        if seconds is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.protocol.stream_done), seconds)
+            except asyncio.TimeoutError:
+                self.stop()
+        await self.protocol.stream_done
+        self.stream_time = time.perf_counter() - start_time
+
+    # Requests the stream to stop at the next sync
+    def stop(self):
+        self.protocol.request_stop = True
+
+    # Captured stream data
+    @property
+    def capture_storage(self):
+        return self.protocol.capture_storage
+
+    # Decodes the capture to CSV (or the given sink) with HdStreamer.  This is CPU bound, so runs in 'executor' (the
+    # default thread pool if None) to keep the event loop free
+    async def decode(self, csv_file_path, logger, sink=None, executor=None):
+        streamer = HdStreamer(_IdentifiedDevice(self.serial, self.identity))
+        await asyncio.get_running_loop().run_in_executor(
+            executor, streamer.decode_capture, self.protocol.header, self.capture_storage, csv_file_path, logger, sink)
+        return streamer
+
+    # Closes the connection
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+
+
+class _IdentifiedDevice:
+    '''
+    Answers the identification commands HdStreamer sends when it is created, from the responses already read
+    '''
+    def __init__(self, serial, identity):
+        self.__serial = serial
+        self.__identity = identity
+        self.connectionObj = SimpleNamespace(connection=SimpleNamespace(Connection=None))
+
+    def sendCommand(self, command):
+        if command == "*serial?":
+            return self.__serial
+        if command == "hello?":
+            return self.__identity
+        return "OK"
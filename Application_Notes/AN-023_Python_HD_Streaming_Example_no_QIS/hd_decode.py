@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+'''
+Batch (NumPy) decode engines for HD PPM Plus and original HD stream data.
+
+The HD Plus stream is made up of variable length packets, stored with the bytes of each 16 bit word swapped.  Decoding
+one byte at a time in Python is slow for long captures, so the work is split into two steps:
+
+1- A fast pass over the byte-swapped buffer that walks the packet chain to find the start of every packet
+2- NumPy bit operations that decode all absolute and delta fields at once, with a cumulative sum to apply the deltas
+
+Original HD data is a fixed sequence of 16 bit words for each stripe, set by the channels enabled in the stream header.
+HdStripeDecoder compiles this into a NumPy structured dtype once, so whole stripes are read with a single frombuffer()
+instead of stepping a state machine for every word.
+
+The output is a columnar int64 array (one row per column in DECODE_COLUMNS) that matches the values and time stamps
+written by the original per-byte decoder in HdStreamer.
+
+The constants of the command and stream protocol (port, response terminator, status bytes and the stubs sent back to
+the module) are also defined here, for HdStreamer, hd_async.py and the fake and replay modules.
+'''
+import operator
+
+import numpy as np
+
+# Command port of the module
+COMMAND_PORT = 9760
+
+# Text sent by the module after each command response
+RESPONSE_END = b"\r\n>"
+
+# Stub sent by the host after each stream block, to force a TCP ACK
+ACK_STUB = b"\x02\x00\xff\xff"
+
+# Stub sent by the host to reply to a sync request
+SYNC_REPLY = b"\x02\x00\xff\x01"
+
+# Status bytes sent at the end of a block: 0 (to 2) ends the stream, 7 is a sync request
+STATUS_END = 0
+STATUS_SYNC = 7
+
+# HD Plus packet IDs
+PACKET_ABSOLUTE = 4
+PACKET_BLANK = 8
+PACKET_TRIGGER = 10
+PACKET_DELTA = 12
+PACKET_REPEAT = 14
+
+# Fixed packet lengths in bytes (blank packets carry their own length)
+PACKET_LENGTHS = {PACKET_ABSOLUTE: 12, PACKET_TRIGGER: 2, PACKET_DELTA: 8, PACKET_REPEAT: 3}
+
+# Length nibble expected on every delta packet
+DELTA_LENGTH_CODE = 10
+
+# Rows of the decoded output array
+DECODE_COLUMNS = ("Time us", "5V voltage mV", "5V current uA", "12V voltage mV", "12V current uA")
+COL_TIME = 0
+COL_5V_V = 1
+COL_5V_I = 2
+COL_12V_V = 3
+COL_12V_I = 4
+
+# Lookup table from packet ID to packet length, 0 marks an invalid ID
+_packet_length_lookup = np.zeros(256, dtype=np.int64)
+for _packet_id, _packet_len in PACKET_LENGTHS.items():
+    _packet_length_lookup[_packet_id] = _packet_len
+_packet_length_lookup[PACKET_BLANK] = 2
+
+# Segment size and overlap used when walking the packet chain in parallel
+_SEGMENT_BYTES = 4096
+_SEGMENT_OVERLAP = 512
+
+# Below this many bytes the chain is walked one packet at a time, as each parallel step has a fixed cost
+_SERIAL_WALK_BYTES = 32 * _SEGMENT_BYTES
+
+
+# Swaps the bytes of each 16 bit word, giving the logical byte order of the stream.  The buffer length must be even
+def swap_stream_bytes(buffer):
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    return raw.reshape(-1, 2)[:, ::-1].reshape(-1)
+
+
+# Returns True if the data from 'pos' to the end of the (byte-swapped) buffer is the start of a valid packet that
+# continues in the next buffer, rather than a bad packet
+def is_partial_packet(buffer, pos):
+    buffer_len = len(buffer)
+    if pos >= buffer_len:
+        return False
+    packet_id = buffer[pos ^ 1]
+    if packet_id == PACKET_BLANK:
+        return pos + 1 >= buffer_len or pos + 2 + buffer[(pos + 1) ^ 1] > buffer_len
+    if packet_id in PACKET_LENGTHS:
+        return pos + PACKET_LENGTHS[packet_id] > buffer_len
+    return False
+
+
+# Generator that expands runs from HdPlusDecoder.decode_runs() into time stamped blocks of at most 'max_rows' rows
+# (a single repeat packet can produce 255 rows), with the first stripe at 'time_pos'
+def expand_runs(values, counts, time_pos, time_step, max_rows=1 << 20):
+    row_ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        last = int(np.searchsorted(row_ends, row_ends[first] - counts[first] + max_rows, side='right'))
+        last = max(last, first + 1)
+        block_counts = counts[first:last]
+        rows = int(block_counts.sum())
+        block = np.empty((len(DECODE_COLUMNS), rows), dtype=np.int64)
+        block[COL_TIME] = time_pos + np.arange(rows, dtype=np.int64) * time_step
+        block[COL_5V_V:] = np.repeat(values[:, first:last], block_counts, axis=1)
+        time_pos += rows * time_step
+        yield block
+        first = last
+
+
+# Returns the position of the next packet for every position in a (logical order) buffer, assuming a packet starts
+# there.  Blank packets hold their length in the following byte.  Bad IDs and packets running past the data point back
+# to themselves, as does the extra entry for the end of the buffer
+def next_packet_positions(logical):
+    available = len(logical)
+    index = np.arange(available, dtype=np.int64)
+    next_pos = index + _packet_length_lookup[logical]
+    blank_pos = np.flatnonzero(logical[:-1] == PACKET_BLANK)
+    next_pos[blank_pos] += logical[blank_pos + 1]
+    stuck = (next_pos == index) | (next_pos > available)
+    next_pos[stuck] = index[stuck]
+    return np.append(next_pos, available)
+
+
+# Sign extends an array of raw values of the given bit width
+def _sign_extend(values, bits):
+    sign_bit = 1 << (bits - 1)
+    return np.where((values & sign_bit) != 0, values - (sign_bit << 1), values)
+
+
+class HdPlusDecoder:
+    '''
+    Decodes HD Plus packet data into columnar arrays.  The delta/repeat state and the stream time are held between
+    calls, so sequential buffers can be decoded with multiple calls to decode().
+
+    time_step       = Time between stripes in uS (the HdStreamer 'ave_multiplier')
+    time_pos        = Time of the next stripe to be output
+    window_bytes    = Number of stream bytes scanned per pass, which bounds the memory used
+    max_rows        = Maximum number of rows in each decoded block returned
+    '''
+    def __init__(self, time_step, time_pos=0, window_bytes=1 << 22, max_rows=1 << 20):
+        self.time_step = time_step
+        self.time_pos = time_pos
+        self.window_bytes = window_bytes
+        self.max_rows = max_rows
+        # Last absolute values (5V V, 5V I, 12V V, 12V I), needed for deltas and repeats
+        self.last_values = [0, 0, 0, 0]
+        self.last_valid = False
+        # Number of bytes of the last buffer that were decoded.  Less than the buffer length if a bad or incomplete
+        # packet was found, in which case the remaining bytes were not processed
+        self.consumed = 0
+        self.packets_decoded = 0
+
+    # Generator that decodes a buffer of stream data (header and transport bytes removed), yielding int64 arrays of
+    # shape (len(DECODE_COLUMNS), rows).  Decoding starts at byte 'start' and stops at the first bad or incomplete
+    # packet, see 'consumed'.  If 'stop' is given, no packet starting at or after it is decoded
+    def decode(self, buffer, start=0, stop=None):
+        for values, counts in self.decode_runs(buffer, start, stop):
+            time_pos = self.time_pos - int(counts.sum()) * self.time_step
+            for block in expand_runs(values, counts, time_pos, self.time_step, self.max_rows):
+                yield block
+
+    # Generator that decodes as decode(), but yields the output in run length form without time stamps: an int64 array
+    # of shape (4, runs) holding the 5V V, 5V I, 12V V and 12V I values, and the number of stripes in each run.  The
+    # stream time is still advanced
+    def decode_runs(self, buffer, start=0, stop=None):
+        buffer_len = len(buffer) & ~1
+        if stop is None or stop > buffer_len:
+            stop = buffer_len
+        self.consumed = start
+        pos = start
+
+        while pos < stop:
+            # Swap a window of the buffer to logical byte order, with enough extra for any packet that starts in it
+            base = pos & ~1
+            end = min(buffer_len, base + self.window_bytes + 512)
+            logical = swap_stream_bytes(buffer[base:end])
+            window_stop = min(stop, base + self.window_bytes) if end < buffer_len else min(stop, end)
+
+            starts, next_pos, complete = self._find_packet_starts(logical, pos - base, window_stop - base)
+            if len(starts) > 0:
+                values, counts = self._decode_packets(logical, starts)
+                if len(counts) > 0:
+                    self.time_pos += int(counts.sum()) * self.time_step
+                    yield values, counts
+            pos = next_pos + base
+            self.consumed = pos
+            if not complete:
+                break
+
+    # Finds the packet start offsets from 'pos' until 'stop', returning them with the position after the last packet
+    # and a flag that is False if a bad or incomplete packet ended the search early
+    def _find_packet_starts(self, logical, pos, stop):
+        next_pos = next_packet_positions(logical)
+        result = self._walk_segments(next_pos, pos, stop) if stop - pos >= _SERIAL_WALK_BYTES else None
+        if result is None:
+            result = self._walk_packet_chain(next_pos, pos, stop)
+        starts, pos, complete = result
+
+        # Delta packets with an unexpected length field are treated as the end of the good data
+        if len(starts) > 0:
+            delta_starts = starts[logical[starts] == PACKET_DELTA]
+            bad_delta = delta_starts[(logical[delta_starts + 2] >> 4) != DELTA_LENGTH_CODE]
+            if len(bad_delta) > 0:
+                pos = int(bad_delta[0])
+                starts = starts[starts < pos]
+                complete = False
+
+        return starts, pos, complete
+
+    # Walks the packet chain one packet at a time
+    def _walk_packet_chain(self, next_pos, pos, stop):
+        next_list = next_pos.tolist()
+        starts = []
+        add_start = starts.append
+        complete = True
+        while pos < stop:
+            packet_end = next_list[pos]
+            if packet_end == pos:
+                complete = False
+                break
+            add_start(pos)
+            pos = packet_end
+        return np.array(starts, dtype=np.int64), pos, complete
+
+    # Walks the packet chain in parallel.  The data is split into segments and a walker is started at the beginning of
+    # each one, as if a packet started there.  Each walker runs a little way into the next segment, and once its path
+    # meets the path of the next walker the two are identical from then on.  Joining the walkers at these meeting points
+    # gives the true chain.  Returns None if any pair of walkers did not meet, so the chain must be walked serially
+    def _walk_segments(self, next_pos, pos, stop):
+        if pos >= stop:
+            return np.zeros(0, dtype=np.int64), pos, True
+        segment_starts = np.arange(pos, stop, _SEGMENT_BYTES, dtype=np.int64)
+        limits = np.minimum(segment_starts + _SEGMENT_BYTES + _SEGMENT_OVERLAP, stop)
+        limits[-1] = stop
+
+        # Step all walkers together, recording their positions, until each passes its limit or reaches a bad packet
+        walker_pos = segment_starts.copy()
+        path = []
+        while True:
+            path.append(walker_pos)
+            step_pos = next_pos[walker_pos]
+            active = (walker_pos < limits) & (step_pos != walker_pos)
+            if not active.any():
+                break
+            walker_pos = np.where(active, step_pos, walker_pos)
+        path = np.array(path)
+        new_pos = np.ones(path.shape, dtype=bool)
+        new_pos[1:] = path[1:] != path[:-1]
+
+        # Mark where each walker went in the overlap with the following segment, then find the first point where the
+        # next walker arrives at one of these
+        overlap = new_pos & (path >= segment_starts + _SEGMENT_BYTES) & (path < segment_starts + _SEGMENT_BYTES + _SEGMENT_OVERLAP)
+        visited = np.zeros(len(next_pos), dtype=bool)
+        visited[path[overlap]] = True
+        meets = new_pos & (path < segment_starts + _SEGMENT_OVERLAP) & visited[path]
+        meets[:, 0] = path[:, 0] == pos
+        if not meets.any(axis=0).all():
+            return None
+        join_pos = path[meets.argmax(axis=0), np.arange(path.shape[1])]
+        join_end = np.append(join_pos[1:], stop)
+
+        # Each walker contributes its packets from its join point up to the join point of the next walker
+        keep = new_pos & (path >= join_pos) & (path < join_end) & (next_pos[path] != path)
+        starts = path.T[keep.T]
+
+        # The final walker gives the position after the last packet, or stops on a bad packet
+        final_pos = int(walker_pos[-1])
+        return starts, final_pos, final_pos >= stop
+
+    # Decodes the packets at the given start offsets, returning the values and stripe count of each run of output rows
+    def _decode_packets(self, logical, starts):
+        packet_ids = logical[starts]
+        is_absolute = packet_ids == PACKET_ABSOLUTE
+        is_delta = packet_ids == PACKET_DELTA
+        is_value = is_absolute | is_delta
+        self.packets_decoded += len(starts)
+
+        # Absolute packets: 15 bit signed voltages and 25 bit signed currents
+        b = [logical[starts[is_absolute] + offset].astype(np.int64) for offset in range(2, 12)]
+        absolute = (_sign_extend(((b[0] << 8) + b[1]) >> 1, 15),
+                    _sign_extend(((b[1] & 0x01) << 24) + (b[2] << 16) + (b[3] << 8) + b[4], 25),
+                    _sign_extend(((b[5] << 8) + b[6]) >> 1, 15),
+                    _sign_extend(((b[6] & 0x01) << 24) + (b[7] << 16) + (b[8] << 8) + b[9], 25))
+
+        # Delta packets: 10 bit signed values (12V current keeps the original field alignment)
+        b = [logical[starts[is_delta] + offset].astype(np.int64) for offset in range(2, 8)]
+        delta = (_sign_extend(((b[0] & 0x0F) << 6) + (b[1] >> 2), 10),
+                 _sign_extend(((b[1] & 0x03) << 8) + b[2], 10),
+                 _sign_extend((b[3] << 2) + ((b[4] >> 6) & 0x03), 10),
+                 _sign_extend(((b[4] & 0x3F) << 2) + ((b[5] >> 4) & 0x0F), 10))
+
+        # Running values, with the sum restarting on every absolute packet.  Entry 0 holds the last values carried
+        # in from the previous buffer
+        value_abs = is_absolute[is_value]
+        run_start = np.zeros(len(value_abs) + 1, dtype=np.int64)
+        run_start[1:][value_abs] = np.flatnonzero(value_abs) + 1
+        run_start = np.maximum.accumulate(run_start)
+        values = np.empty((4, len(value_abs) + 1), dtype=np.int64)
+        for channel in range(4):
+            steps = np.empty(len(value_abs) + 1, dtype=np.int64)
+            steps[0] = self.last_values[channel]
+            steps[1:][value_abs] = absolute[channel]
+            steps[1:][~value_abs] = delta[channel]
+            running = np.cumsum(steps)
+            values[channel] = running - (running[run_start] - steps[run_start])
+
+        # Last values are only valid once an absolute packet has been seen
+        abs_seen = np.cumsum(is_absolute)
+        valid_before = (abs_seen - is_absolute) > 0
+        if self.last_valid:
+            valid_before[:] = True
+
+        # Number of stripes output for each packet
+        counts = np.zeros(len(starts), dtype=np.int64)
+        counts[is_absolute] = 1
+        counts[is_delta & valid_before] = 1
+        is_repeat = (packet_ids == PACKET_REPEAT) & valid_before
+        counts[is_repeat] = logical[starts[is_repeat] + 2]
+
+        # Each packet outputs the values of the latest absolute or delta packet at or before it
+        value_index = np.cumsum(is_value)
+
+        # Update the carried state to the end of this buffer
+        if self.last_valid or abs_seen[-1] > 0:
+            self.last_values = values[:, -1].tolist()
+            self.last_valid = True
+
+        # Keep only the packets that output stripes
+        output = counts > 0
+        return values[:, value_index[output]], counts[output]
+
+
+class HdStripeDecoder:
+    '''
+    Decodes original HD stream data into columnar arrays.  The stripe layout is compiled from the channel enable mask in
+    the stream header: each enabled channel in order 5V V, 5V I, 12V V, 12V I, with voltages in one 14 bit word and
+    currents in a high then low word (value = high * 4096 + low).  Any part stripe at the end of a buffer is held and
+    completed by the next call, and disabled channels are output as 'last_values'.
+
+    channels        = Channel enable mask from the stream header (5V V = 0x8, 5V I = 0x4, 12V V = 0x2, 12V I = 0x1)
+    time_step       = Time between stripes in uS (the HdStreamer 'ave_multiplier')
+    time_pos        = Time of the next stripe to be output
+    max_rows        = Maximum number of rows in each decoded block returned
+    '''
+    def __init__(self, channels, time_step, time_pos=0, max_rows=1 << 20):
+        self.time_step = time_step
+        self.time_pos = time_pos
+        self.max_rows = max_rows
+        # Values output for disabled channels (5V V, 5V I, 12V V, 12V I)
+        self.last_values = [0, 0, 0, 0]
+        self.__pending = b""
+
+        # Compile the stripe layout: one little-endian word field per voltage, two per current
+        fields = []
+        self.__channel_fields = []
+        for column, bit, name, words in ((COL_5V_V, 0x8, "5v_v", 1), (COL_5V_I, 0x4, "5v_i", 2),
+                                         (COL_12V_V, 0x2, "12v_v", 1), (COL_12V_I, 0x1, "12v_i", 2)):
+            if (channels & bit) != 0:
+                names = (name,) if words == 1 else (name + "_high", name + "_low")
+                fields += [(field_name, "<u2") for field_name in names]
+                self.__channel_fields.append((column, names))
+        if len(fields) == 0:
+            raise ValueError('Device header indicates that no channels are enabled for streaming')
+        self.stripe_dtype = np.dtype(fields)
+        self.stride = self.stripe_dtype.itemsize
+
+    # Generator that decodes a buffer of stream data (header and transport bytes removed), yielding int64 arrays of
+    # shape (len(DECODE_COLUMNS), rows)
+    def decode(self, buffer):
+        offset = 0
+        # Complete the part stripe left from the last buffer
+        if len(self.__pending) > 0:
+            offset = min(self.stride - len(self.__pending), len(buffer))
+            self.__pending += bytes(buffer[:offset])
+            if len(self.__pending) < self.stride:
+                return
+            yield self.__decode_stripes(np.frombuffer(self.__pending, dtype=self.stripe_dtype))
+            self.__pending = b""
+
+        # Decode all whole stripes, a window at a time, then hold any part stripe at the end
+        stripe_count = (len(buffer) - offset) // self.stride
+        for first in range(0, stripe_count, self.max_rows):
+            count = min(self.max_rows, stripe_count - first)
+            yield self.__decode_stripes(np.frombuffer(buffer, dtype=self.stripe_dtype, count=count,
+                                                      offset=offset + first * self.stride))
+        self.__pending = bytes(buffer[offset + stripe_count * self.stride:])
+
+    # Converts an array of stripes to a decoded block
+    def __decode_stripes(self, stripes):
+        rows = len(stripes)
+        block = np.empty((len(DECODE_COLUMNS), rows), dtype=np.int64)
+        block[COL_TIME] = self.time_pos + np.arange(rows, dtype=np.int64) * self.time_step
+        block[COL_5V_V:] = np.array(self.last_values, dtype=np.int64)[:, None]
+        for column, names in self.__channel_fields:
+            if len(names) == 1:
+                block[column] = stripes[names[0]] & 0x3FFF
+            else:
+                block[column] = (stripes[names[0]] & 0x3FFF).astype(np.int64) * 4096 + (stripes[names[1]] & 0x3FFF)
+        self.time_pos += rows * self.time_step
+        return block
+
+
+# Calculates the derived power columns (5V, 12V and total power in uW) for a decoded block, using the same
+# floating point calculation as the CSV output
+def calculate_power(block):
+    power_5v = (block[COL_5V_V] * block[COL_5V_I]) / 1000
+    power_12v = (block[COL_12V_V] * block[COL_12V_I]) / 1000
+    return power_5v, power_12v, power_5v + power_12v
+
+
+# Formats a decoded block as CSV text, in the same format as the original per-stripe file writes.  Stripes from repeat
+# packets share the same values, so the value text is formatted once for each run of identical stripes
+def format_csv_rows(block):
+    values = block[COL_5V_V:]
+    changed = np.ones(block.shape[1], dtype=bool)
+    changed[1:] = np.any(values[:, 1:] != values[:, :-1], axis=0)
+    run_starts = np.flatnonzero(changed)
+    run_lengths = np.diff(np.append(run_starts, block.shape[1]))
+
+    run_block = block[:, run_starts]
+    columns = [map(str, column.tolist()) for column in run_block[COL_5V_V:]]
+    columns += [map(str, power.tolist()) for power in calculate_power(run_block)]
+    row_ends = np.empty(len(run_starts), dtype=object)
+    row_ends[:] = ["," + ",".join(row) + "\r" for row in zip(*columns)]
+
+    times = map(str, block[COL_TIME].tolist())
+    return "".join(map(operator.add, times, np.repeat(row_ends, run_lengths).tolist()))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+'''
+Local fake HD / HD Plus module, served over TCP.
+
+FakeHdDevice is an asyncio TCP server that answers the commands HdStreamer sends, and streams synthetic data in the
+same framing as the module after "rec stream":
+
+1- Commands are text lines, answered with the response text followed by "\\r\\n>"
+2- Each stream block is sent as a 2 byte little-endian length, then the block.  The stream header is the first block
+3- Every 'sync_interval' data blocks a sync status byte (7) is added to the block, and no more data is sent until the
+   host replies with 02 00 FF 01
+4- After "rec stop" (sent by the host before a sync reply) the stream ends with an end status byte (0)
+
+The host sends an ACK stub (02 00 FF FF) after each block, which is counted.  Commands sent during the stream are not
+answered, as the stream data would be out of step.
+
+The stream data is a synthetic random walk, or a waveform (make_waveform_data()) at a given frequency.  Faults can be
+injected to load test the host:
+
+1- Buffer overrun: with a paced rate and 'buffer_bytes' set, the module holds data not yet sent in a buffer of that
+   size (as the module does).  If the host falls behind far enough to fill it, the stream ends with STATUS_OVERRUN
+2- Back-pressure: 'stall_interval' / 'stall_time' pause sending at intervals, as a congested link would, while data
+   keeps building up in the module buffer
+3- Partial reads: 'partial_reads' is the chance of a block (with its length) being sent in several small pieces
+4- Corrupt packet IDs: 'corrupt_ids' is the chance of a data block having an invalid ID in its first HD Plus packet
+   (or a corrupt first word for an original HD module)
+
+TcpQuarchDevice is a minimal blocking client with the quarchpy device interface used by HdStreamer, so HdStreamer can
+capture from the fake module (or a real module) without quarchpy.
+'''
+import asyncio
+import math
+import random
+import socket
+import time
+
+from hd_decode import ACK_STUB, COMMAND_PORT, RESPONSE_END, STATUS_END, STATUS_SYNC, SYNC_REPLY
+from hd_replay import (BLOCK_SIZE, SYNC_INTERVAL, encode_hd_data, encode_hdplus_data, generate_hd_data,
+                       generate_hdplus_data, make_hd_header, make_hdplus_header)
+
+# Full HD data rate: 250k stripes per second, with 12 bytes per stripe (all channels enabled)
+FULL_RATE_BYTES = 250000 * 12
+
+# End status byte sent by the fake module when its buffer overruns (any of 0-2 end the stream)
+STATUS_OVERRUN = 1
+
+# Packet ID written over the first packet of a block to corrupt it, this is not a valid HD Plus packet ID
+CORRUPT_PACKET_ID = 0x0F
+
+# Number of pieces a block is split into for an injected partial read, and the gap in seconds between them
+_PARTIAL_PIECES = 3
+_PARTIAL_GAP = 0.0002
+
+# Waveforms available from make_waveform_data(), "random" is the synthetic random walk from hd_replay
+WAVEFORMS = ("random", "constant", "sine", "square", "ramp")
+
+# Response to "rec:ave?" for each averaging rate in the stream header
+_AVERAGE_RATE_NAMES = ("0", "2", "4", "8", "16", "32", "64", "128", "256", "1k", "2k", "4k", "8k", "16k", "32k")
+
+
+class StreamStats:
+    '''
+    Counters for one stream served by FakeHdDevice
+    '''
+    def __init__(self):
+        self.blocks = 0
+        self.bytes = 0
+        self.syncs = 0
+        self.acks = 0
+        self.start_time = None
+        self.end_time = None
+        # Total time spent waiting for sync replies from the host
+        self.sync_wait = 0.0
+        # Largest amount of data held in the module buffer, waiting to be sent
+        self.max_backlog = 0
+        self.overrun = False
+        # Injected faults
+        self.stalls = 0
+        self.partial_blocks = 0
+        self.corrupt_blocks = 0
+
+    # Length of the stream in seconds
+    @property
+    def seconds(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    # Data rate of the stream in bytes per second
+    @property
+    def rate(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class FakeHdDevice:
+    '''
+    asyncio TCP server emulating an HD or HD Plus module.  Each connection is an independent module, so one server can
+    stand in for many modules.  Call start() (in a running event loop) then connect to 'port'.
+
+    hd_plus         = True for an HD Plus module, False for an original HD module (all channels enabled)
+    rate            = Data rate in bytes per second, None to send as fast as the host reads
+    stream_data     = Stream data to send (repeated as needed), generated from 'waveform' if None
+    average_rate    = Averaging rate in the stream header (0 = no averaging)
+    sync_interval   = Number of data blocks between each sync request
+    host / port     = Address to listen on, port 0 picks a free port
+    waveform        = Waveform of the generated stream data, from WAVEFORMS
+    frequency       = Frequency of the waveform in Hz
+    buffer_bytes    = Size of the module buffer for data not yet sent, None for no overrun (only with a paced rate)
+    stall_interval  = Seconds between injected stalls in sending, None for no stalls
+    stall_time      = Length of each stall in seconds
+    partial_reads   = Chance (0 to 1) of a block being sent in several pieces
+    corrupt_ids     = Chance (0 to 1) of a data block being sent with a corrupt packet ID
+    seed            = Seed for the injected faults, so a run can be repeated
+    '''
+    def __init__(self, hd_plus=True, rate=FULL_RATE_BYTES, stream_data=None, average_rate=0,
+                 sync_interval=SYNC_INTERVAL, host="127.0.0.1", port=0, waveform="random", frequency=1000.0,
+                 buffer_bytes=None, stall_interval=None, stall_time=0.0, partial_reads=0.0, corrupt_ids=0.0, seed=1):
+        self.hd_plus = hd_plus
+        self.rate = rate
+        self.average_rate = average_rate
+        self.sync_interval = sync_interval
+        self.host = host
+        self.port = port
+        if stream_data is None:
+            stream_data = make_waveform_data(hd_plus, waveform, frequency, average_rate)
+        self.stream_data = memoryview(stream_data)
+        # Injected faults
+        self.buffer_bytes = buffer_bytes
+        self.stall_interval = stall_interval
+        self.stall_time = stall_time
+        self.partial_reads = partial_reads
+        self.corrupt_ids = corrupt_ids
+        self.seed = seed
+        # Statistics of each stream served
+        self.streams = []
+        self.__server = None
+        self.__connections = {}
+
+    # Starts listening for connections
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle_connection, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    # Stops listening, ends any open connections and waits for the server to close
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            # Closing the connections ends their handlers, through the end of file on the reader
+            tasks = []
+            for task, writer in self.__connections.items():
+                writer.close()
+                tasks.append(task)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.__server.wait_closed()
+            self.__server = None
+
+    # Returns the response to a command sent outside a stream
+    def response(self, command):
+        if command == "*serial?":
+            return "QTL1944-01-001"
+        if command == "hello?":
+            return "Fake HD PLUS Power Module" if self.hd_plus else "Fake HD Power Module"
+        if command == "rec:ave?":
+            return _AVERAGE_RATE_NAMES[self.average_rate]
+        if command.startswith("rec:") and command.endswith("enable?"):
+            return "ON"
+        return "OK"
+
+    # Returns the stream header block
+    def header_block(self):
+        if self.hd_plus:
+            return make_hdplus_header(self.average_rate)
+        return make_hd_header(self.average_rate)
+
+    # Handles one host connection: commands, then streams when requested
+    async def __handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.__connections[task] = writer
+        try:
+            while True:
+                # ACK stubs for the last blocks of a stream can arrive after it ends, and are ignored
+                stub, command = await self.__read_host(reader)
+                if stub is not None or command == "":
+                    continue
+                writer.write(self.response(command).encode("latin1") + RESPONSE_END)
+                await writer.drain()
+                if command == "rec stream":
+                    await self.__stream(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.__connections.pop(task, None)
+            writer.close()
+
+    # Streams blocks to the host until "rec stop", reading the ACKs, sync replies and commands from the host alongside
+    async def __stream(self, reader, writer):
+        stats = StreamStats()
+        self.streams.append(stats)
+        stopping = asyncio.Event()
+        sync_replied = asyncio.Event()
+        host_task = asyncio.ensure_future(self.__read_stream_host(reader, stats, stopping, sync_replied))
+        rng = random.Random(self.seed)
+        try:
+            stats.start_time = time.perf_counter()
+            await self.__send_block(writer, self.header_block(), stats, rng)
+
+            data_pos = 0
+            data_blocks = 0
+            next_stall = self.stall_interval
+            end_status = STATUS_END
+            while not stopping.is_set():
+                if data_pos + BLOCK_SIZE > len(self.stream_data):
+                    data_pos = 0
+                block = self.stream_data[data_pos:data_pos + BLOCK_SIZE]
+                data_pos += BLOCK_SIZE
+                data_blocks += 1
+
+                # Injected stall, the module keeps filling its buffer while nothing is sent
+                if next_stall is not None and time.perf_counter() - stats.start_time >= next_stall:
+                    next_stall += self.stall_interval
+                    stats.stalls += 1
+                    await writer.drain()
+                    await asyncio.sleep(self.stall_time)
+
+                # Wait until this block is due, if pacing to a data rate
+                if self.rate is not None:
+                    delay = stats.start_time + stats.bytes / self.rate - time.perf_counter()
+                    if delay > 0.001:
+                        await writer.drain()
+                        await asyncio.sleep(delay)
+                    # Data measured but not yet sent to the host (including any waiting in the socket) is held in the
+                    # module buffer, which overruns if the host falls too far behind
+                    backlog = (int((time.perf_counter() - stats.start_time) * self.rate) - stats.bytes +
+                               writer.transport.get_write_buffer_size())
+                    stats.max_backlog = max(stats.max_backlog, backlog)
+                    if self.buffer_bytes is not None and backlog > self.buffer_bytes:
+                        stats.overrun = True
+                        end_status = STATUS_OVERRUN
+                        break
+
+                if self.corrupt_ids > 0 and rng.random() < self.corrupt_ids:
+                    block = self.__corrupt_block(block)
+                    stats.corrupt_blocks += 1
+
+                if data_blocks % self.sync_interval != 0:
+                    await self.__send_block(writer, block, stats, rng)
+                    continue
+
+                # Sync request, no more data is sent until the host replies
+                sync_replied.clear()
+                await self.__send_block(writer, bytes(block) + bytes((STATUS_SYNC,)), stats, rng)
+                await writer.drain()
+                wait_start = time.perf_counter()
+                await sync_replied.wait()
+                stats.sync_wait += time.perf_counter() - wait_start
+
+            await self.__send_block(writer, bytes((end_status,)), stats, rng)
+            await writer.drain()
+            stats.end_time = time.perf_counter()
+        finally:
+            host_task.cancel()
+            try:
+                await host_task
+            except asyncio.CancelledError:
+                pass
+
+    # Reads the host side of the stream: ACK stubs, sync replies and command lines
+    async def __read_stream_host(self, reader, stats, stopping, sync_replied):
+        while True:
+            stub, command = await self.__read_host(reader)
+            if stub == SYNC_REPLY:
+                stats.syncs += 1
+                sync_replied.set()
+            elif stub is not None:
+                stats.acks += 1
+            elif command == "rec stop":
+                stopping.set()
+
+    # Reads the next item from the host, returning (stub, None) for a 4 byte stub starting 02, otherwise (None, command)
+    @staticmethod
+    async def __read_host(reader):
+        first = await reader.readexactly(1)
+        if first == ACK_STUB[:1]:
+            return first + await reader.readexactly(3), None
+        line = first + await reader.readuntil(b"\n")
+        return None, line.decode("latin1").strip()
+
+    # Writes a block with its length prefix.  For an injected partial read, the block and its length are split at
+    # random points and each piece sent on its own, with a short gap so the host receives them separately.  The gap
+    # blocks the event loop, as an asyncio sleep cannot be shorter than the loop's timer resolution (around 1mS)
+    async def __send_block(self, writer, block, stats, rng):
+        stats.blocks += 1
+        stats.bytes += len(block)
+        if self.partial_reads == 0 or rng.random() >= self.partial_reads:
+            writer.write(len(block).to_bytes(2, "little"))
+            writer.write(block)
+            return
+        stats.partial_blocks += 1
+        message = len(block).to_bytes(2, "little") + bytes(block)
+        cuts = sorted(rng.sample(range(1, len(message)), min(_PARTIAL_PIECES - 1, len(message) - 1)))
+        for start, end in zip([0] + cuts, cuts + [len(message)]):
+            writer.write(message[start:end])
+            await writer.drain()
+            time.sleep(_PARTIAL_GAP)
+
+    # Returns a copy of a data block with an invalid ID in place of its first packet ID (byte 1, as the bytes of each
+    # 16 bit word are swapped), or the first word set to all ones for an original HD module
+    def __corrupt_block(self, block):
+        block = bytearray(block)
+        if self.hd_plus:
+            block[1] = CORRUPT_PACKET_ID
+        else:
+            block[0:2] = b"\xff\xff"
+        return block
+
+
+# Returns stream data for a waveform from WAVEFORMS, as HD Plus data if 'hd_plus' else as original HD data.  The
+# currents follow the waveform around 'values' (5V mV, 5V uA, 12V mV, 12V uA), varying by +/- 'depth' of their value,
+# and the voltages are fixed.  One period is generated, which the device repeats
+def make_waveform_data(hd_plus=True, waveform="random", frequency=1000.0, average_rate=0, depth=0.5,
+                       values=(5000, 250000, 12000, 500000)):
+    if waveform == "random":
+        return generate_hdplus_data(8 * 1024 * 1024) if hd_plus else generate_hd_data(8 * 1024 * 1024)
+    if waveform not in WAVEFORMS:
+        raise ValueError("Unknown waveform: " + str(waveform))
+
+    time_step_us = max(average_rate * average_rate * 4, 4)
+    period = max(1, int(round(1e6 / (frequency * time_step_us))))
+    v5, i5, v12, i12 = values
+    stripes = []
+    for index in range(period):
+        phase = index / period
+        if waveform == "sine":
+            level = math.sin(2 * math.pi * phase)
+        elif waveform == "square":
+            level = 1.0 if phase < 0.5 else -1.0
+        elif waveform == "ramp":
+            level = 2 * phase - 1
+        else:
+            level = 0.0
+        scale = 1 + depth * level
+        stripes.append((v5, int(round(i5 * scale)), v12, int(round(i12 * scale))))
+    return encode_hdplus_data(stripes) if hd_plus else encode_hd_data(stripes)
+
+
+class TcpQuarchDevice:
+    '''
+    Minimal blocking TCP client for a module (or FakeHdDevice), with the sendCommand() and connectionObj interface that
+    HdStreamer uses from a quarchpy device.  Once "rec stream" has been sent, commands are not answered until the
+    stream ends, so "rec stop" is sent without waiting for a response.
+
+    host            = IP address of the module
+    port            = Command port
+    timeout         = Socket timeout in seconds
+    '''
+    def __init__(self, host, port=COMMAND_PORT, timeout=10.0):
+        self.__socket = socket.create_connection((host, port), timeout=timeout)
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__streaming = False
+        self.connectionObj = _Connection(self.__socket)
+
+    # Sends a command, returning the response text
+    def sendCommand(self, command):
+        self.__socket.sendall(command.encode("latin1") + b"\r\n")
+        if self.__streaming:
+            if command == "rec stop":
+                self.__streaming = False
+            return ""
+        if command == "rec stream":
+            self.__streaming = True
+        return self.__read_response()
+
+    # Closes the connection
+    def close(self):
+        self.__socket.close()
+
+    # Reads a response one byte at a time, so no stream data that follows it is taken from the socket
+    def __read_response(self):
+        response = bytearray()
+        while not response.endswith(RESPONSE_END):
+            byte = self.__socket.recv(1)
+            if len(byte) == 0:
+                raise ConnectionError("Connection closed while reading a response")
+            response += byte
+        return response[:-len(RESPONSE_END)].decode("latin1").strip()
+
+
+class _Connection:
+    '''
+    Matches the device.connectionObj.connection.Connection path HdStreamer uses to find the stream socket
+    '''
+    def __init__(self, socket):
+        self.connection = self
+        self.Connection = socket
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+'''
+Parallel (multi-process) decode of long HD Plus captures.
+
+Every absolute packet in an HD Plus stream holds the full value of all four channels, so the decode state can be
+rebuilt at any absolute packet without the data before it.  ParallelHdPlusDecoder uses this to share the decode of a
+long capture between worker processes:
+
+1- The capture is copied once into shared memory, which each worker maps instead of being sent a copy
+2- The capture is split into segments of about 'segment_bytes', each starting at an absolute packet on the packet
+   chain (see find_split_points())
+3- Each worker decodes its segment with HdPlusDecoder.decode_runs() into a shared memory output slot, in run length form
+4- The segments are collected in order and expanded with the running stream time, so the output is identical to the
+   serial decoder
+
+ParallelHdPlusDecoder has the same interface as HdPlusDecoder (decode(), consumed, last_values, last_valid, time_pos),
+so it can be used in its place.  Only the decode is shared between the workers: the expanded blocks are produced in the
+calling process, so a slow output sink (such as CSV) still limits the total time.
+'''
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from hd_decode import PACKET_ABSOLUTE, HdPlusDecoder, expand_runs, next_packet_positions, swap_stream_bytes
+
+# Default size of the segment given to each worker
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+# Any packet that covers a given byte starts no more than this many bytes before the next packet (the longest packet is
+# a blank packet of 2 + 255 bytes), so the packet chain must pass through one of this many walkers
+_SPLIT_WALKERS = 258
+
+# Number of bytes searched for a split point after each nominal split position
+_SPLIT_WINDOW = 64 * 1024
+
+# Each run in a segment comes from an absolute, delta or repeat packet, the shortest of which is 3 bytes
+_MIN_RUN_BYTES = 3
+
+
+# Returns the split points for a buffer of stream data (header and transport bytes removed), about 'segment_bytes'
+# apart from 'start'.  Each split is the start of an absolute packet on the packet chain.  Walkers are started at every
+# position a packet could start near the nominal split, and stepped along their packet chains until all of them (other
+# than those that reach a bad packet) meet.  One of the walkers is on the true chain, so the meeting point is too, and
+# the split is the first absolute packet from there.  A split is skipped if no meeting point is found
+def find_split_points(buffer, segment_bytes=DEFAULT_SEGMENT_BYTES, start=0):
+    buffer_len = len(buffer) & ~1
+    splits = []
+    nominal = (start + segment_bytes) & ~1
+    while nominal + segment_bytes // 2 < buffer_len:
+        split = _find_split(buffer, nominal, buffer_len)
+        if split is not None:
+            splits.append(split)
+            nominal = max(nominal, split)
+        nominal = (nominal + segment_bytes) & ~1
+    return splits
+
+
+# Returns the first absolute packet on the packet chain at or after 'pos' (which must be even), or None if it cannot be
+# found within _SPLIT_WINDOW bytes
+def _find_split(buffer, pos, buffer_len):
+    end = min(buffer_len, pos + _SPLIT_WINDOW)
+    logical = swap_stream_bytes(buffer[pos:end])
+    next_pos = next_packet_positions(logical)
+
+    # Step every walker that is behind the leader, until all are at the same position.  Walkers that reach a bad packet
+    # are dropped.  If the leader gets near the end of the window before they meet, no split is found here
+    walkers = np.arange(min(_SPLIT_WALKERS, len(logical)), dtype=np.int64)
+    while True:
+        lead = walkers.max()
+        if lead >= len(logical) - _SPLIT_WALKERS:
+            return None
+        behind = walkers < lead
+        if not behind.any():
+            break
+        step_pos = next_pos[walkers]
+        stuck = behind & (step_pos == walkers)
+        walkers = np.where(behind, step_pos, walkers)[~stuck]
+
+    # Follow the chain to the next absolute packet
+    chain_pos = int(walkers[0])
+    while chain_pos < len(logical):
+        if logical[chain_pos] == PACKET_ABSOLUTE and next_pos[chain_pos] != chain_pos:
+            return pos + chain_pos
+        if next_pos[chain_pos] == chain_pos:
+            return None
+        chain_pos = int(next_pos[chain_pos])
+    return None
+
+
+# Worker process function, decoding the segment from 'start' to 'stop' of the shared input into the runs of an output
+# slot.  Returns the number of runs and the decoder state at the end of the segment
+def _decode_segment(input_name, input_len, slot_name, slot_runs, start, stop, last_values, last_valid):
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    slot_memory = shared_memory.SharedMemory(name=slot_name)
+    try:
+        # The stream time is added when the segments are joined, so the time step here is not used
+        decoder = HdPlusDecoder(0)
+        decoder.last_values = last_values
+        decoder.last_valid = last_valid
+        output = np.ndarray((5, slot_runs), dtype=np.int64, buffer=slot_memory.buf)
+        runs = 0
+        buffer = input_memory.buf[:input_len]
+        for values, counts in decoder.decode_runs(buffer, start, stop):
+            output[:4, runs:runs + len(counts)] = values
+            output[4, runs:runs + len(counts)] = counts
+            runs += len(counts)
+        # Release all views of the shared memory, so it can be closed
+        del output, buffer
+        return runs, decoder.consumed, decoder.last_values, decoder.last_valid, decoder.packets_decoded
+    finally:
+        input_memory.close()
+        slot_memory.close()
+
+
+class ParallelHdPlusDecoder:
+    '''
+    Decodes HD Plus packet data into columnar arrays using a pool of worker processes.  The output, stream time and
+    carried state are the same as HdPlusDecoder.  The pool and shared memory are kept between calls to decode(), and
+    are freed by close() (or by using the decoder in a 'with' statement).
+
+    time_step       = Time between stripes in uS (the HdStreamer 'ave_multiplier')
+    time_pos        = Time of the next stripe to be output
+    workers         = Number of worker processes, the CPU count if None
+    segment_bytes   = Nominal size of the segment of stream data given to each worker
+    max_rows        = Maximum number of rows in each decoded block returned
+    '''
+    def __init__(self, time_step, time_pos=0, workers=None, segment_bytes=DEFAULT_SEGMENT_BYTES, max_rows=1 << 20):
+        self.time_step = time_step
+        self.time_pos = time_pos
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.segment_bytes = segment_bytes
+        self.max_rows = max_rows
+        # Decode state, as HdPlusDecoder
+        self.last_values = [0, 0, 0, 0]
+        self.last_valid = False
+        self.consumed = 0
+        self.packets_decoded = 0
+        # Number of segments decoded by the workers, and by the calling process
+        self.segments_parallel = 0
+        self.segments_serial = 0
+        self.__pool = None
+        self.__input_memory = None
+        self.__slots = []
+        self.__slot_runs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Generator that decodes a buffer of stream data (header and transport bytes removed), yielding int64 arrays of
+    # shape (len(DECODE_COLUMNS), rows).  Decoding starts at byte 'start' and stops at the first bad or incomplete
+    # packet, see 'consumed'.  Buffers of less than two segments are decoded in the calling process
+    def decode(self, buffer, start=0):
+        buffer_len = len(buffer) & ~1
+        splits = find_split_points(buffer, self.segment_bytes, start) if buffer_len - start >= 2 * self.segment_bytes else []
+        if len(splits) == 0:
+            for block in self.__decode_serial(buffer, start):
+                yield block
+            return
+
+        bounds = list(zip([start] + splits, splits + [None]))
+        segment_lengths = np.diff([start] + splits + [buffer_len])
+        self.__prepare(buffer, buffer_len, int(segment_lengths.max()))
+
+        # Keep every slot busy, collecting the segments in order.  The first segment carries in the current state, the
+        # others start at an absolute packet so need none
+        pending = deque()
+        free_slots = deque(range(len(self.__slots)))
+        next_segment = 0
+        self.consumed = start
+        try:
+            while next_segment < len(bounds) or len(pending) > 0:
+                while next_segment < len(bounds) and len(free_slots) > 0:
+                    slot = free_slots.popleft()
+                    segment_start, segment_stop = bounds[next_segment]
+                    state = (self.last_values, self.last_valid) if next_segment == 0 else ([0, 0, 0, 0], False)
+                    future = self.__pool.submit(_decode_segment, self.__input_memory.name, buffer_len,
+                                                self.__slots[slot].name, self.__slot_runs, segment_start, segment_stop,
+                                                *state)
+                    pending.append((future, slot, segment_stop))
+                    next_segment += 1
+
+                future, slot, segment_stop = pending.popleft()
+                runs, consumed, last_values, last_valid, packets = future.result()
+                self.segments_parallel += 1
+                for block in self.__expand_slot(slot, runs):
+                    yield block
+                free_slots.append(slot)
+                self.consumed = consumed
+                self.last_values = last_values
+                self.last_valid = last_valid
+                self.packets_decoded += packets
+
+                # The segment must end exactly at the next split.  If it stopped early (a bad or incomplete packet) the
+                # decode ends there, as it would for the serial decoder.  If the last packet ran past the split, the
+                # split was not on the chain, so the rest is decoded serially
+                if segment_stop is not None and consumed != segment_stop:
+                    if consumed > segment_stop:
+                        for block in self.__decode_serial(buffer, consumed):
+                            yield block
+                    break
+        finally:
+            for future, slot, segment_stop in pending:
+                future.cancel()
+            # Wait for any segments still running, so their slots are not reused while being written
+            for future, slot, segment_stop in pending:
+                if not future.cancelled():
+                    future.exception()
+
+    # Shuts down the worker processes and frees the shared memory
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+        self.__free_memory([self.__input_memory] + self.__slots)
+        self.__input_memory = None
+        self.__slots = []
+        self.__slot_runs = 0
+
+    # Decodes from 'start' in the calling process, carrying the state in and out
+    def __decode_serial(self, buffer, start):
+        decoder = HdPlusDecoder(self.time_step, self.time_pos, max_rows=self.max_rows)
+        decoder.last_values = self.last_values
+        decoder.last_valid = self.last_valid
+        for block in decoder.decode(buffer, start):
+            yield block
+        self.time_pos = decoder.time_pos
+        self.last_values = decoder.last_values
+        self.last_valid = decoder.last_valid
+        self.consumed = decoder.consumed
+        self.packets_decoded += decoder.packets_decoded
+        self.segments_serial += 1
+
+    # Yields the time stamped blocks for the runs in an output slot
+    def __expand_slot(self, slot, runs):
+        if runs == 0:
+            return
+        output = np.ndarray((5, self.__slot_runs), dtype=np.int64, buffer=self.__slots[slot].buf)
+        counts = output[4, :runs]
+        for block in expand_runs(output[:4, :runs], counts, self.time_pos, self.time_step, self.max_rows):
+            yield block
+        self.time_pos += int(counts.sum()) * self.time_step
+
+    # Starts the pool if needed, and copies the buffer to shared memory, with an output slot for each segment that can
+    # be in progress.  The shared memory is reused if it is already large enough
+    def __prepare(self, buffer, buffer_len, max_segment_len):
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        if self.__input_memory is None or self.__input_memory.size < buffer_len:
+            self.__free_memory([self.__input_memory])
+            self.__input_memory = shared_memory.SharedMemory(create=True, size=buffer_len)
+        self.__input_memory.buf[:buffer_len] = buffer[:buffer_len]
+
+        slot_runs = max_segment_len // _MIN_RUN_BYTES + 2
+        if slot_runs > self.__slot_runs:
+            self.__free_memory(self.__slots)
+            self.__slots = [shared_memory.SharedMemory(create=True, size=5 * 8 * slot_runs)
+                            for slot in range(self.workers * 2)]
+            self.__slot_runs = slot_runs
+
+    # Closes and removes shared memory blocks
+    @staticmethod
+    def __free_memory(memory_blocks):
+        for memory in memory_blocks:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+'''
+Replay of raw HD stream captures (.dat files), and a generator for synthetic captures.
+
+HdStreamer writes a .dat file next to the CSV when started with debug_data_dump=True.  The file starts with 2 fixed
+bytes (00 02), then holds every block received from the module as:
+
+1- An 8 byte big-endian time, in nS since the previous block
+2- A 4 byte big-endian block length
+3- The block itself, exactly as received (the stream header is the first block, and any status byte is included)
+
+ReplayDevice stands in for the module, serving the blocks of a .dat file through a simulated stream socket in the same
+framing as the module.  HdStreamer then runs its normal header parse, capture and decode code against it, so decode
+throughput can be measured (and output checked) without a module attached.  Blocks can be sent as fast as possible or
+at the original wire rate, using the recorded times.
+
+The generator functions create synthetic HD and HD Plus captures in the same format, and the encoder functions build
+stream data from given stripe values (for example a waveform).
+'''
+import random
+import struct
+import time
+
+from hd_decode import (PACKET_ABSOLUTE, PACKET_BLANK, PACKET_DELTA, PACKET_REPEAT, PACKET_TRIGGER, STATUS_END,
+                       STATUS_SYNC, SYNC_REPLY)
+
+# Fixed bytes at the start of every .dat file
+DAT_FILE_HEADER = b"\x00\x02"
+
+# Bytes of stream data in each block sent by the module
+BLOCK_SIZE = 512
+
+# Number of data blocks between each sync request in a synthetic capture
+SYNC_INTERVAL = 64
+
+
+# Generator that reads a .dat capture file, yielding (time in nS since the previous block, block) for each block
+def read_dat_blocks(path):
+    with open(path, 'rb') as dat_file:
+        if dat_file.read(len(DAT_FILE_HEADER)) != DAT_FILE_HEADER:
+            raise ValueError("Not a raw HD stream capture file: " + str(path))
+        while True:
+            block_header = dat_file.read(12)
+            if len(block_header) == 0:
+                break
+            if len(block_header) != 12:
+                raise ValueError("Capture file ends part way through a block header: " + str(path))
+            time_ns, len_bytes = struct.unpack(">QI", block_header)
+            block = dat_file.read(len_bytes)
+            if len(block) != len_bytes:
+                raise ValueError("Capture file ends part way through a block: " + str(path))
+            yield time_ns, block
+
+
+# Writes a .dat capture file from an iterable of (time in nS since the previous block, block)
+def write_dat_file(path, blocks):
+    with open(path, 'wb') as dat_file:
+        dat_file.write(DAT_FILE_HEADER)
+        for time_ns, block in blocks:
+            dat_file.write(struct.pack(">QI", time_ns, len(block)))
+            dat_file.write(block)
+
+
+# Returns True if the first block of a capture is an HD Plus stream header (version 2, one group of 4 channels)
+def is_hdplus_header(block):
+    return len(block) >= 20 and block[0] == 2 and block[10] == 1 and block[12] == 4
+
+
+class ReplayDevice:
+    '''
+    Stand-in for a quarchpy HD / HD Plus device that replays a .dat capture.  It answers the commands HdStreamer sends,
+    and provides a ReplaySocket as the stream socket.  The module type is found from the stream header unless 'hd_plus'
+    is given.
+
+    dat_path        = Capture file to replay
+    wire_rate       = If True, blocks are sent at the times recorded in the file
+    rate            = If set, blocks are sent at this rate in bytes per second instead
+    '''
+    def __init__(self, dat_path, wire_rate=False, rate=None, hd_plus=None):
+        if hd_plus is None:
+            first_block = next(read_dat_blocks(dat_path), (0, b""))[1]
+            hd_plus = is_hdplus_header(first_block)
+        self.hd_plus = hd_plus
+        self.connectionObj = _Connection(ReplaySocket(read_dat_blocks(dat_path), wire_rate, rate))
+
+    def sendCommand(self, command):
+        socket = self.connectionObj.connection.Connection
+        if command == "*serial?":
+            return "QTL1944-01-001"
+        if command == "hello?":
+            return "Replay HD PLUS Power Module" if self.hd_plus else "Replay HD Power Module"
+        if command == "rec:ave?":
+            return "0"
+        if command.endswith("enable?"):
+            return "ON"
+        if command == "rec stream":
+            socket.start()
+        elif command == "rec stop":
+            socket.stop()
+        return "OK"
+
+
+class _Connection:
+    '''
+    Matches the device.connectionObj.connection.Connection path HdStreamer uses to find the stream socket
+    '''
+    def __init__(self, socket):
+        self.connection = self
+        self.Connection = socket
+
+
+class ReplaySocket:
+    '''
+    Socket stand-in serving blocks in the module framing: a 2 byte little-endian length, then the block.  If the blocks
+    run out before an end status byte was sent, one is added so the stream always finishes.
+    '''
+    def __init__(self, blocks, wire_rate=False, rate=None):
+        self.__blocks = iter(blocks)
+        self.__wire_rate = wire_rate
+        self.__rate = rate
+        self.__pending = memoryview(b"")
+        self.__ended = False
+        self.__stopping = False
+        self.__start_time = None
+        self.__due_time = 0.0
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self.syncs = 0
+        self.acks = 0
+        self.stream_time = None
+
+    # Starts the stream
+    def start(self):
+        self.__start_time = time.perf_counter()
+
+    # Ends the stream after the current block
+    def stop(self):
+        self.__stopping = True
+
+    # Socket receive, copying up to 'nbytes' of the stream into 'buffer'
+    def recv_into(self, buffer, nbytes=0):
+        if len(self.__pending) == 0:
+            self.__next_block()
+        if nbytes == 0:
+            nbytes = len(buffer)
+        count = min(nbytes, len(self.__pending))
+        buffer[:count] = self.__pending[:count]
+        self.__pending = self.__pending[count:]
+        return count
+
+    # Socket send, the ACK stubs and sync replies from the host are counted
+    def send(self, data):
+        if bytes(data) == SYNC_REPLY:
+            self.syncs += 1
+        else:
+            self.acks += 1
+        return len(data)
+
+    # Queues the next block of the capture, waiting until it is due if pacing
+    def __next_block(self):
+        if self.__ended:
+            raise ConnectionError("Replay stream has ended")
+        if self.__start_time is None:
+            self.start()
+
+        block = None
+        if not self.__stopping:
+            time_ns, block = next(self.__blocks, (0, None))
+        if block is None:
+            block = bytes((STATUS_END,))
+            time_ns = 0
+
+        # Pace to the recorded block times, or to the given data rate
+        if self.__wire_rate:
+            self.__due_time += time_ns / 1e9
+        elif self.__rate is not None:
+            self.__due_time = self.bytes_sent / self.__rate
+        delay = self.__start_time + self.__due_time - time.perf_counter()
+        if delay > 0.001:
+            time.sleep(delay)
+
+        # An odd length block with a status byte of 0-2 ends the stream
+        if (len(block) & 1) != 0 and block[-1] < 3:
+            self.__ended = True
+            self.stream_time = time.perf_counter() - self.__start_time
+        self.__pending = memoryview(struct.pack("<H", len(block)) + block)
+        self.blocks_sent += 1
+        self.bytes_sent += len(block)
+
+
+# Replays a .dat capture through HdStreamer, decoding it to 'csv_file_path' (or the given sink).  Returns the
+# HdStreamer, whose capture_storage and stream socket hold the replay statistics
+def replay_capture(dat_path, csv_file_path, logger, wire_rate=False, rate=None, save_mode="post_process", sink=None,
+                   hd_plus=None):
+    from intel_custom import HdStreamer
+
+    device = ReplayDevice(dat_path, wire_rate, rate, hd_plus)
+    streamer = HdStreamer(device)
+    streamer.start_stream(None, csv_file_path, logger, save_mode=save_mode, sink=sink)
+    return streamer
+
+
+# Creates an original HD stream header, 4 bytes: version, reserved, channel enables and averaging rate
+def make_hd_header(average_rate=0, channels=0x0F):
+    return bytes((1, 0, channels, average_rate))
+
+
+# Creates a version 2 HD Plus stream header, with all 4 channels enabled
+def make_hdplus_header(average_rate=0):
+    header = bytearray(20)
+    header[0] = 2               # Header version
+    header[10] = 1              # Hardware group count
+    header[12] = 4              # Channel count
+    header[18] = average_rate
+    return bytes(header)
+
+
+# Generator of synthetic HD Plus blocks, yielding (block in the byte-swapped form sent by the module, stripes in block).
+# Each block starts with an absolute packet, followed by a mix of delta, repeat and trigger packets, with a blank packet
+# filling the end of the block
+def generate_hdplus_blocks(block_count, seed=1):
+    rng = random.Random(seed)
+    values = [5000, 250000, 12000, 500000]
+
+    for block_index in range(block_count):
+        block = bytearray()
+        stripes = 0
+        while True:
+            packet_stripes = 1
+            if len(block) == 0:
+                packet = _absolute_packet(values)
+            else:
+                selector = rng.random()
+                if selector < 0.7:
+                    deltas = [rng.randint(-20, 20) for _ in range(4)]
+                    values = [value + delta for value, delta in zip(values, deltas)]
+                    packet = _delta_packet(deltas)
+                elif selector < 0.995:
+                    packet_stripes = rng.randint(1, 16)
+                    packet = bytes((PACKET_REPEAT, 0, packet_stripes))
+                else:
+                    packet_stripes = 0
+                    packet = bytes((PACKET_TRIGGER, 0))
+
+            # Fill the end of the block with a blank packet if this one does not fit
+            space = BLOCK_SIZE - len(block)
+            if len(packet) == space or len(packet) <= space - 2:
+                block += packet
+                stripes += packet_stripes
+            else:
+                block += bytes((PACKET_BLANK, space - 2)) + bytes(space - 2)
+            if len(block) == BLOCK_SIZE:
+                break
+
+        # Swap to the byte order of the stream
+        block[0::2], block[1::2] = block[1::2], block[0::2]
+        yield bytes(block), stripes
+
+
+# Generates synthetic HD Plus stream data (as held in the capture storage) of the requested size.  A set of unique
+# blocks is generated then repeated, to keep generation time low for large captures
+def generate_hdplus_data(size_bytes, unique_blocks=2048, seed=1):
+    blocks = b"".join(block for block, stripes in generate_hdplus_blocks(unique_blocks, seed))
+    repeats = max(1, size_bytes // len(blocks))
+    return blocks * repeats
+
+
+# Generator of synthetic original HD stream blocks (all 4 channels enabled), yielding (block, stripes completed in
+# block).  Each stripe is 6 little-endian 14 bit words: 5V V, 5V I high/low, 12V V, 12V I high/low.  Stripes run on
+# from one block to the next, so current words are split across blocks
+def generate_hd_blocks(block_count, seed=1):
+    rng = random.Random(seed)
+    values = [5000, 250000, 12000, 500000]
+    pending = bytearray()
+    stripe_bytes = 12
+
+    for block_index in range(block_count):
+        while len(pending) < BLOCK_SIZE:
+            values = [max(0, value + rng.randint(-20, 20)) for value in values]
+            v5, i5, v12, i12 = values
+            words = (v5 & 0x3FFF, (i5 >> 12) & 0x3FFF, i5 & 0xFFF, v12 & 0x3FFF, (i12 >> 12) & 0x3FFF, i12 & 0xFFF)
+            pending += struct.pack("<6H", *words)
+        block = bytes(pending[:BLOCK_SIZE])
+        del pending[:BLOCK_SIZE]
+        start = block_index * BLOCK_SIZE
+        yield block, (start + BLOCK_SIZE) // stripe_bytes - start // stripe_bytes
+
+
+# Generates synthetic original HD stream data (as held in the capture storage) of the requested size.  A set of unique
+# blocks is generated then repeated, rounded to a multiple of 3 blocks so the repeats stay aligned to whole stripes
+def generate_hd_data(size_bytes, unique_blocks=2048, seed=1):
+    unique_blocks = max(3, unique_blocks - unique_blocks % 3)
+    blocks = b"".join(block for block, stripes in generate_hd_blocks(unique_blocks, seed))
+    repeats = max(1, size_bytes // len(blocks))
+    return blocks * repeats
+
+
+# Encodes stripes, a sequence of (5V mV, 5V uA, 12V mV, 12V uA) values, as HD Plus stream data of whole blocks.  Each
+# block starts with an absolute packet, then unchanged stripes use a repeat packet, changes that a delta packet holds
+# exactly use a delta packet and any other change an absolute packet
+def encode_hdplus_data(stripes):
+    data = bytearray()
+    block = bytearray()
+    last = None
+    repeats = 0
+
+    # Fills the end of the block with blank packets (up to 257 bytes each) and adds it to the data, in the byte order
+    # of the stream
+    def close_block():
+        space = BLOCK_SIZE - len(block)
+        while space > 0:
+            fill = min(space, 257)
+            if space - fill == 1:
+                fill -= 2
+            block.extend(bytes((PACKET_BLANK, fill - 2)) + bytes(fill - 2))
+            space -= fill
+        block[0::2], block[1::2] = block[1::2], block[0::2]
+        data.extend(block)
+        block.clear()
+
+    # Adds a packet to the block, returning False (with the block closed) if it does not fit
+    def add_packet(packet):
+        space = BLOCK_SIZE - len(block)
+        if len(packet) == space or len(packet) <= space - 2:
+            block.extend(packet)
+            if len(block) == BLOCK_SIZE:
+                close_block()
+            return True
+        close_block()
+        return False
+
+    # Adds the pending repeats of the last stripe, restarting from an absolute packet if a new block is needed
+    def add_repeats(count):
+        if count > 0 and not add_packet(bytes((PACKET_REPEAT, 0, count))):
+            add_packet(_absolute_packet(last))
+            if count > 1:
+                add_packet(bytes((PACKET_REPEAT, 0, count - 1)))
+
+    for values in stripes:
+        values = tuple(int(value) for value in values)
+        if values == last and len(block) > 0 and repeats < 255:
+            repeats += 1
+            continue
+        add_repeats(repeats)
+        repeats = 0
+
+        if last is None or len(block) == 0:
+            add_packet(_absolute_packet(values))
+        else:
+            deltas = [value - last_value for value, last_value in zip(values, last)]
+            packet = _delta_packet(deltas) if _is_exact_delta(deltas) else _absolute_packet(values)
+            if not add_packet(packet):
+                add_packet(_absolute_packet(values))
+        last = values
+
+    add_repeats(repeats)
+    if len(block) > 0:
+        close_block()
+    return bytes(data)
+
+
+# Encodes stripes, a sequence of (5V mV, 5V uA, 12V mV, 12V uA) values, as original HD stream data (all 4 channels
+# enabled).  The stripes are repeated from the start to fill a whole number of blocks, so the data can be looped
+def encode_hd_data(stripes):
+    stripes = list(stripes)
+    stripe_bytes = 12
+    # Blocks and stripes line up every 128 stripes (3 blocks)
+    stripes_per_repeat = 3 * BLOCK_SIZE // stripe_bytes
+    total = -(-len(stripes) // stripes_per_repeat) * stripes_per_repeat
+    data = bytearray()
+    for index in range(total):
+        v5, i5, v12, i12 = (int(value) for value in stripes[index % len(stripes)])
+        data += struct.pack("<6H", v5 & 0x3FFF, (i5 >> 12) & 0x3FFF, i5 & 0xFFF, v12 & 0x3FFF, (i12 >> 12) & 0x3FFF,
+                            i12 & 0xFFF)
+    return bytes(data)
+
+
+# Writes a synthetic .dat capture of 'block_count' data blocks, for an HD ('hd') or HD Plus ('hdplus') module.  Block
+# times are set from the stripes in each block at the averaging rate, so the capture can be replayed at wire rate.  A
+# sync request is added every SYNC_INTERVAL blocks and the stream ends with an end status
+def write_synthetic_capture(path, module_type="hdplus", block_count=2048, seed=1, average_rate=0):
+    time_step_ns = max(average_rate * average_rate * 4, 4) * 1000
+
+    def capture_blocks():
+        if module_type == "hdplus":
+            # The HD Plus header fills the first block
+            yield 0, make_hdplus_header(average_rate)
+            data_blocks = generate_hdplus_blocks(block_count, seed)
+        elif module_type == "hd":
+            # The HD header is followed by data in the first block
+            data_blocks = generate_hd_blocks(block_count, seed)
+            block, stripes = next(data_blocks)
+            yield stripes * time_step_ns, make_hd_header(average_rate) + block[:BLOCK_SIZE - 4]
+            data_blocks = _prepend_block(block[BLOCK_SIZE - 4:], data_blocks)
+        else:
+            raise ValueError("Unknown module type: " + str(module_type))
+
+        for block_index, (block, stripes) in enumerate(data_blocks):
+            if (block_index + 1) % SYNC_INTERVAL == 0:
+                block += bytes((STATUS_SYNC,))
+            yield stripes * time_step_ns, block
+        yield 0, bytes((STATUS_END,))
+
+    write_dat_file(path, capture_blocks())
+
+
+# Moves 'carry' bytes onto the front of each following HD block, keeping the block size fixed.  Used when the first
+# block also holds the header
+def _prepend_block(carry, blocks):
+    for block, stripes in blocks:
+        joined = carry + block
+        yield joined[:BLOCK_SIZE], stripes
+        carry = joined[BLOCK_SIZE:]
+    if len(carry) > 0:
+        yield carry, 0
+
+
+# Builds an absolute packet (logical byte order) from voltage and current values
+def _absolute_packet(values):
+    v5, i5, v12, i12 = [value & mask for value, mask in zip(values, (0x7FFF, 0x1FFFFFF, 0x7FFF, 0x1FFFFFF))]
+    return bytes((PACKET_ABSOLUTE, 0,
+                  (v5 >> 7) & 0xFF, ((v5 << 1) & 0xFE) | (i5 >> 24), (i5 >> 16) & 0xFF, (i5 >> 8) & 0xFF, i5 & 0xFF,
+                  (v12 >> 7) & 0xFF, ((v12 << 1) & 0xFE) | (i12 >> 24), (i12 >> 16) & 0xFF, (i12 >> 8) & 0xFF,
+                  i12 & 0xFF))
+
+
+# Returns True if the decoders read back exactly these deltas from a delta packet.  The 12V current field is read with
+# the original decoder's alignment, so only changes of 0 to 15 uA are held exactly
+def _is_exact_delta(deltas):
+    d5v, d5i, d12v, d12i = deltas
+    return all(-512 <= delta <= 511 for delta in (d5v, d5i, d12v)) and 0 <= d12i <= 15
+
+
+# Builds a delta packet (logical byte order) from 10 bit signed deltas
+def _delta_packet(deltas):
+    d5v, d5i, d12v, d12i = [delta & 0x3FF for delta in deltas]
+    return bytes((PACKET_DELTA, 0,
+                  0xA0 | (d5v >> 6), ((d5v << 2) & 0xFC) | (d5i >> 8), d5i & 0xFF,
+                  d12v >> 2, ((d12v << 6) & 0xC0) | (d12i >> 4), (d12i << 4) & 0xF0))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+'''
+Output sinks for decoded HD stream data.
+
+HdStreamer passes every decoded stripe to a sink, which writes it out in its own format:
+
+1- CsvSink writes the original CSV text format
+2- NpyColumnSink writes each column as a typed binary .npy file, in large blocks.  These can be memory-mapped with
+   load_columns() (or numpy.load(mmap_mode="r")) instead of parsing text
+
+Other formats can be added by subclassing StreamSink, and TeeSink passes the data to several sinks at once.
+'''
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from hd_decode import COL_12V_I, COL_12V_V, COL_5V_I, COL_5V_V, COL_TIME, format_csv_rows
+
+# The .npy header writer is shared with the trace modules in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from npy_files import npy_header
+
+# Channel enable bits from the stream header
+CHANNEL_5V_V = 0x0008
+CHANNEL_5V_I = 0x0004
+CHANNEL_12V_V = 0x0002
+CHANNEL_12V_I = 0x0001
+
+# Name of the manifest file written by NpyColumnSink
+MANIFEST_NAME = "columns.json"
+
+
+class StreamSink(ABC):
+    '''
+    Abstract base class for decoded stream outputs, each subclass implements all four methods.  open() is called once
+    the stream header has been read, then rows are written with write_rows() (per-stripe decode) or write_block()
+    (batch decode), and close() is called at the end.
+    '''
+    # Prepares the output for the channels enabled in the stream header
+    @abstractmethod
+    def open(self, channels):
+        pass
+
+    # Writes 'count' stripes with the same values, starting at 'time_pos' and 'time_step' uS apart
+    @abstractmethod
+    def write_rows(self, time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i):
+        pass
+
+    # Writes a block from HdPlusDecoder, an int64 array with a row for each column in hd_decode.DECODE_COLUMNS
+    @abstractmethod
+    def write_block(self, block):
+        pass
+
+    # Completes and closes the output
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class CsvSink(StreamSink):
+    '''
+    Writes the CSV format that HdStreamer has always produced, with power in uW
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.__file_stream = None
+
+    def open(self, channels):
+        self.__file_stream = open(self.path, 'w')
+
+        # Write header (based on active channels)
+        self.__file_stream.write("Time us,")
+        if (channels & CHANNEL_5V_V) != 0:
+            self.__file_stream.write("5V voltage mV,")
+        if (channels & CHANNEL_5V_I) != 0:
+            self.__file_stream.write("5V current uA,")
+        if (channels & CHANNEL_12V_V) != 0:
+            self.__file_stream.write("12V voltage mV,")
+        if (channels & CHANNEL_12V_I) != 0:
+            self.__file_stream.write("12V current uA,")
+        if (channels & CHANNEL_5V_V) != 0 and (channels & CHANNEL_5V_I) != 0:
+            self.__file_stream.write("5V power uW,")
+        if (channels & CHANNEL_12V_V) != 0 and (channels & CHANNEL_12V_I) != 0:
+            self.__file_stream.write("12V power uW,")
+        if (channels & 0x000F) == 0x000F:
+            self.__file_stream.write("Total power uW")
+        self.__file_stream.write("\r")
+
+    def write_rows(self, time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i):
+        value_5p = (value_5v * value_5i) / 1000
+        value_12p = (value_12v * value_12i) / 1000
+        value_totp = value_5p + value_12p
+
+        # The values are the same for every row, so only the time needs to be formatted each time
+        row_end = "," + str(value_5v) + "," + str(value_5i) + "," + str(value_12v) + "," + str(value_12i) + "," + str(value_5p) + "," + str(value_12p) + "," + str(value_totp) + "\r"
+        for x in range(count):
+            self.__file_stream.write(str(time_pos) + row_end)
+            time_pos = time_pos + time_step
+
+    def write_block(self, block):
+        self.__file_stream.write(format_csv_rows(block))
+
+    def close(self):
+        if self.__file_stream is not None:
+            self.__file_stream.close()
+            self.__file_stream = None
+
+
+class TeeSink(StreamSink):
+    '''
+    Passes everything written to each of a list of sinks, in order
+    '''
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def open(self, channels):
+        for sink in self.sinks:
+            sink.open(channels)
+
+    def write_rows(self, time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i):
+        for sink in self.sinks:
+            sink.write_rows(time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i)
+
+    def write_block(self, block):
+        for sink in self.sinks:
+            sink.write_block(block)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class NpyColumnSink(StreamSink):
+    '''
+    Writes each enabled column to its own .npy file in 'directory', with a columns.json manifest.  Time is int64 uS,
+    voltages and currents are int32 mV/uA, and powers are exact int64 nW (voltage * current, without the /1000 and
+    float rounding of the CSV uW values).  Rows are buffered and written 'block_rows' at a time.
+    '''
+    def __init__(self, directory, block_rows=1 << 20):
+        self.directory = directory
+        self.block_rows = block_rows
+        self.rows = 0
+        self.__columns = []
+        self.__files = []
+        self.__buffer = None
+        self.__buffered = 0
+
+    def open(self, channels):
+        os.makedirs(self.directory, exist_ok=True)
+        self.__columns = _select_columns(channels)
+        self.__files = [open(os.path.join(self.directory, column["file"]), 'wb') for column in self.__columns]
+        for column, file_stream in zip(self.__columns, self.__files):
+            file_stream.write(npy_header(column["dtype"], 0))
+        # Rows are time, the 4 channel values then the 3 powers, see _FULL_COLUMNS
+        self.__buffer = np.zeros((len(_FULL_COLUMNS), self.block_rows), dtype=np.int64)
+        self.__buffered = 0
+
+    def write_rows(self, time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i):
+        value_5p = value_5v * value_5i
+        value_12p = value_12v * value_12i
+        row = (time_pos, value_5v, value_5i, value_12v, value_12i, value_5p, value_12p, value_5p + value_12p)
+
+        # Single stripes are the common case for the per-stripe decode, so are stored directly
+        if count == 1 and self.__buffered < self.block_rows:
+            self.__buffer[:, self.__buffered] = row
+            self.__buffered += 1
+            return
+
+        while count > 0:
+            if self.__buffered == self.block_rows:
+                self.__flush()
+            take = min(count, self.block_rows - self.__buffered)
+            rows = self.__buffer[:, self.__buffered:self.__buffered + take]
+            rows[1:] = np.array(row[1:], dtype=np.int64)[:, None]
+            rows[0] = time_pos + np.arange(take, dtype=np.int64) * time_step
+            self.__buffered += take
+            time_pos += take * time_step
+            count -= take
+        if self.__buffered == self.block_rows:
+            self.__flush()
+
+    def write_block(self, block):
+        self.__flush()
+        power_5v = block[COL_5V_V] * block[COL_5V_I]
+        power_12v = block[COL_12V_V] * block[COL_12V_I]
+        full = (block[COL_TIME], block[COL_5V_V], block[COL_5V_I], block[COL_12V_V], block[COL_12V_I],
+                power_5v, power_12v, power_5v + power_12v)
+        self.__write_columns(full, block.shape[1])
+
+    def close(self):
+        if self.__buffer is None:
+            return
+        self.__flush()
+        # Fill in the final row count, then write the manifest
+        for column, file_stream in zip(self.__columns, self.__files):
+            file_stream.seek(0)
+            file_stream.write(npy_header(column["dtype"], self.rows))
+            file_stream.close()
+        manifest = {"rows": self.rows, "columns": self.__columns}
+        with open(os.path.join(self.directory, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        self.__buffer = None
+
+    # Writes out the buffered rows
+    def __flush(self):
+        if self.__buffered > 0:
+            self.__write_columns(self.__buffer[:, :self.__buffered], self.__buffered)
+            self.__buffered = 0
+
+    # Writes the selected columns from a full set of rows
+    def __write_columns(self, full, rows):
+        for column, file_stream in zip(self.__columns, self.__files):
+            np.ascontiguousarray(full[column["source"]], dtype=column["dtype"]).tofile(file_stream)
+        self.rows += rows
+
+
+# Loads the columns written by NpyColumnSink, returning a dict of column name to array.  By default the arrays are
+# memory-mapped, so only the data used is read from disk
+def load_columns(directory, mmap_mode="r"):
+    with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+        manifest = json.load(manifest_file)
+    columns = {}
+    for column in manifest["columns"]:
+        columns[column["name"]] = np.load(os.path.join(directory, column["file"]), mmap_mode=mmap_mode)
+    return columns
+
+
+# All columns that NpyColumnSink can write: name, file, dtype, and the channels that must be enabled
+_FULL_COLUMNS = (
+    ("Time us", "time_us.npy", "int64", 0),
+    ("5V voltage mV", "5v_voltage_mv.npy", "int32", CHANNEL_5V_V),
+    ("5V current uA", "5v_current_ua.npy", "int32", CHANNEL_5V_I),
+    ("12V voltage mV", "12v_voltage_mv.npy", "int32", CHANNEL_12V_V),
+    ("12V current uA", "12v_current_ua.npy", "int32", CHANNEL_12V_I),
+    ("5V power nW", "5v_power_nw.npy", "int64", CHANNEL_5V_V | CHANNEL_5V_I),
+    ("12V power nW", "12v_power_nw.npy", "int64", CHANNEL_12V_V | CHANNEL_12V_I),
+    ("Total power nW", "total_power_nw.npy", "int64", 0x000F),
+)
+
+
+# Returns the column descriptions for the enabled channels
+def _select_columns(channels):
+    columns = []
+    for source, (name, file_name, dtype, required) in enumerate(_FULL_COLUMNS):
+        if (channels & required) == required:
+            columns.append({"name": name, "file": file_name, "dtype": dtype, "source": source})
+    return columns
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+'''
+Live telemetry tap for HdStreamer.
+
+A TelemetryTap is added to a streamer with HdStreamer.add_tap().  It receives every decoded stripe as it is decoded,
+and publishes either:
+
+1- Blocks of samples: a float64 array with a row for each column in TAP_COLUMNS
+2- Window statistics: the min, max and mean of each channel over each 'window_us' of stream time (WindowStats)
+
+to any number of callbacks and asyncio queues.  Threshold triggers are checked on every sample, and can call a function
+and/or send a command to the device (for example "run:power down") when a channel goes outside its limit.
+
+Data is only decoded during the capture in the "streaming" save mode, so this mode must be used for live data.  The
+latency from socket to callback is then bounded by HdStreamer.stream_flush_interval, which queues part filled chunks
+for the decoder.  Device commands are sent at the next stream sync, as the stream shares the command connection.
+'''
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from hd_decode import COL_5V_I, COL_5V_V, COL_12V_I, COL_12V_V, COL_TIME
+from hd_sinks import StreamSink
+
+# Rows of the published sample arrays
+TAP_COLUMNS = ("Time us", "5V voltage mV", "5V current uA", "12V voltage mV", "12V current uA", "5V power uW",
+               "12V power uW", "Total power uW")
+
+# Statistics of one window of stream time.  'minimum', 'maximum' and 'mean' hold a value for each column in
+# TAP_COLUMNS after the time
+WindowStats = namedtuple("WindowStats", ("start_us", "end_us", "count", "minimum", "maximum", "mean"))
+
+# A threshold trigger firing: the trigger, the stream time and value of the first stripe outside the limit, and the
+# time (time.perf_counter()) the trigger was handled
+TriggerEvent = namedtuple("TriggerEvent", ("trigger", "time_us", "value", "handled_time"))
+
+
+class ThresholdTrigger:
+    '''
+    Fires when a channel goes above or below a limit.  By default a trigger fires once, set 'repeat' to fire again each
+    time the channel returns inside its limits and then leaves them.
+
+    column          = Name of the column to check, from TAP_COLUMNS
+    above           = Fire when the value is greater than this (None to not check)
+    below           = Fire when the value is less than this (None to not check)
+    callback        = Function called with a TriggerEvent, from the decode thread
+    command         = Device command to send when fired, for example "run:power down"
+    stop_stream     = Stop the stream when fired
+    repeat          = Fire again after the value returns inside the limits
+    '''
+    def __init__(self, column, above=None, below=None, callback=None, command=None, stop_stream=False, repeat=False):
+        if above is None and below is None:
+            raise ValueError("A threshold trigger needs an 'above' or 'below' limit")
+        self.column = column
+        self.column_index = TAP_COLUMNS.index(column)
+        self.above = above
+        self.below = below
+        self.callback = callback
+        self.command = command
+        self.stop_stream = stop_stream
+        self.repeat = repeat
+        self.armed = True
+        self.events = []
+
+    # Returns a boolean array, True where the values are outside the limits
+    def outside(self, values):
+        outside = np.zeros(len(values), dtype=bool)
+        if self.above is not None:
+            outside |= values > self.above
+        if self.below is not None:
+            outside |= values < self.below
+        return outside
+
+
+class TelemetryTap(StreamSink):
+    '''
+    Publishes decoded stream data to callbacks and asyncio queues while the capture runs.
+
+    window_us       = Window length in uS of stream time for WindowStats, or None to publish blocks of samples
+    device          = Device to send trigger commands to, if the tap is not added to an HdStreamer
+    '''
+    def __init__(self, window_us=None, device=None):
+        self.window_us = window_us
+        self.device = device
+        # Set by HdStreamer.add_tap(), which sends trigger commands at the next stream sync
+        self.streamer = None
+        # Time (time.perf_counter()) the data being decoded was received, set by HdStreamer for the latency counters
+        self.received_time = None
+        self.__callbacks = []
+        self.__queues = []
+        self.__triggers = []
+        # Running statistics of the current window: window number, count, min, max and sum
+        self.__window = None
+        # Counters
+        self.samples = 0
+        self.published = 0
+        self.dropped = 0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+
+    # Registers a function to be called with each published item, from the decode thread
+    def subscribe(self, callback):
+        self.__callbacks.append(callback)
+
+    # Registers an asyncio queue to receive each published item.  Items are passed to the event loop thread safely, and
+    # dropped (counted in 'dropped') if the queue is full, so a slow consumer cannot stall the decoder
+    def subscribe_queue(self, queue, loop=None):
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self.__queues.append((queue, loop))
+
+    # Adds a ThresholdTrigger, checked against every sample
+    def add_trigger(self, trigger):
+        self.__triggers.append(trigger)
+
+    # Mean latency in seconds from receiving data to publishing it
+    @property
+    def latency_mean(self):
+        return self.latency_total / self.published if self.published > 0 else 0.0
+
+    def open(self, channels):
+        self.__window = None
+
+    def write_rows(self, time_pos, time_step, count, value_5v, value_5i, value_12v, value_12i):
+        block = np.empty((5, count), dtype=np.int64)
+        block[COL_TIME] = time_pos + np.arange(count, dtype=np.int64) * time_step
+        block[COL_5V_V:] = np.array((value_5v, value_5i, value_12v, value_12i), dtype=np.int64)[:, None]
+        self.write_block(block)
+
+    def write_block(self, block):
+        if block.shape[1] == 0:
+            return
+        samples = np.empty((len(TAP_COLUMNS), block.shape[1]), dtype=np.float64)
+        samples[:5] = block
+        samples[5] = (block[COL_5V_V] * block[COL_5V_I]) / 1000
+        samples[6] = (block[COL_12V_V] * block[COL_12V_I]) / 1000
+        samples[7] = samples[5] + samples[6]
+        self.samples += block.shape[1]
+
+        for trigger in self.__triggers:
+            self.__check_trigger(trigger, samples)
+
+        if self.window_us is None:
+            self.__publish(samples)
+        else:
+            self.__add_to_windows(samples)
+
+    # Publishes the last part window
+    def close(self):
+        if self.__window is not None:
+            self.__publish(self.__window_stats(self.__window))
+            self.__window = None
+
+    # Finds the points where the trigger fires in a block of samples, and handles each one
+    def __check_trigger(self, trigger, samples):
+        outside = trigger.outside(samples[trigger.column_index])
+        pos = 0
+        while pos < len(outside):
+            if trigger.armed:
+                hits = np.flatnonzero(outside[pos:])
+                if len(hits) == 0:
+                    return
+                pos += int(hits[0])
+                trigger.armed = False
+                self.__fire(trigger, samples[COL_TIME, pos], samples[trigger.column_index, pos])
+            if not trigger.repeat:
+                return
+            # Re-arm once the value is back inside the limits
+            inside = np.flatnonzero(~outside[pos:])
+            if len(inside) == 0:
+                return
+            pos += int(inside[0])
+            trigger.armed = True
+
+    # Calls the trigger callback and sends its device command
+    def __fire(self, trigger, time_us, value):
+        event = TriggerEvent(trigger, int(time_us), float(value), time.perf_counter())
+        trigger.events.append(event)
+        logging.info(datetime.now().isoformat() + "\t: Telemetry trigger on " + trigger.column + " at " +
+                     str(event.time_us) + " uS, value " + str(event.value))
+        if trigger.command is not None:
+            if self.streamer is not None:
+                self.streamer.queue_command(trigger.command)
+            elif self.device is not None:
+                self.device.sendCommand(trigger.command)
+            else:
+                logging.warning(datetime.now().isoformat() + "\t: Telemetry trigger has no device for command: " +
+                                trigger.command)
+        if trigger.stop_stream and self.streamer is not None:
+            self.streamer.stop_stream()
+        if trigger.callback is not None:
+            trigger.callback(event)
+
+    # Adds samples to the running window statistics, publishing each window that is complete
+    def __add_to_windows(self, samples):
+        window_ids = samples[COL_TIME].astype(np.int64) // self.window_us
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(window_ids)) + 1))
+        values = samples[1:]
+        minimum = np.minimum.reduceat(values, starts, axis=1)
+        maximum = np.maximum.reduceat(values, starts, axis=1)
+        total = np.add.reduceat(values, starts, axis=1)
+        counts = np.diff(np.append(starts, len(window_ids)))
+
+        for index, start in enumerate(starts):
+            window_id = int(window_ids[start])
+            window = self.__window
+            if window is not None and window[0] == window_id:
+                window[1] += int(counts[index])
+                np.minimum(window[2], minimum[:, index], out=window[2])
+                np.maximum(window[3], maximum[:, index], out=window[3])
+                window[4] += total[:, index]
+                continue
+            if window is not None:
+                self.__publish(self.__window_stats(window))
+            self.__window = [window_id, int(counts[index]), minimum[:, index].copy(), maximum[:, index].copy(),
+                             total[:, index].copy()]
+
+    # Returns the WindowStats for a running window
+    def __window_stats(self, window):
+        window_id, count, minimum, maximum, total = window
+        return WindowStats(window_id * self.window_us, (window_id + 1) * self.window_us, count, minimum, maximum,
+                           total / count)
+
+    # Passes an item to every callback and queue, and updates the latency counters
+    def __publish(self, item):
+        for callback in self.__callbacks:
+            callback(item)
+        for queue, loop in self.__queues:
+            loop.call_soon_threadsafe(self.__put_queue, queue, item)
+        self.published += 1
+        if self.received_time is not None:
+            latency = time.perf_counter() - self.received_time
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_total += latency
+
+    # Adds an item to a queue, on the event loop thread
+    def __put_queue(self, queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 import logging
 import subprocess
+from collections import deque
 import threading
 import time
 from datetime import datetime
 from timeit import default_timer as timer
 import struct
 
+from capture_storage import DEFAULT_CHUNK_SIZE, DEFAULT_QUEUE_CHUNKS, CaptureStorage, StreamChunkQueue
+from hd_decode import ACK_STUB, SYNC_REPLY, HdPlusDecoder, HdStripeDecoder, is_partial_packet
+from hd_parallel import ParallelHdPlusDecoder
+from hd_sinks import CsvSink, TeeSink
+
+# Flush interval in seconds used in the "streaming" save mode when a telemetry tap is added, bounding the time from
+# receiving data to publishing it
+DEFAULT_TAP_FLUSH_INTERVAL = 0.002
+
+
 class HdStreamer:
     def __init__(self, quarch_device):
         self.__my_device = quarch_device
@@ -20,20 +31,41 @@ class HdStreamer:
         self.__stream_end_status = -1  # -1 = not status set
         self.__old_socket_timeout = None
         self.__request_stop = False
-        self.__mega_buffer = None
-        self.__data_store_pos = 0
+        # Raw stream data is received directly into the capture storage (see capture_storage.py)
+        self.capture_storage = None
         self.__next_data_pos = 0
+        # Chunk size and queue length for the "streaming" save mode, which bound the memory used
+        self.stream_chunk_size = DEFAULT_CHUNK_SIZE
+        self.stream_queue_chunks = DEFAULT_QUEUE_CHUNKS
+        # Longest time in seconds received data waits before it is passed to the decoder in the "streaming" save mode.
+        # If None, chunks are only passed on when full, unless a telemetry tap is added
+        self.stream_flush_interval = None
+        # Telemetry taps (see hd_telemetry.py) given the decoded data, and device commands waiting for the next sync
+        self.__taps = []
+        self.__queued_commands = deque()
+        self.__stream_decode_thread = None
+        self.__stream_decode_error = None
         self.__stream_decode_state = None
         self.__stream_decode_prev_state = None
         self.__stream_stop_ordered = False
         self.calculate_power = False
+        # Use the NumPy batch decoders (set False to use the original per-byte / per-word decode)
+        self.use_vectorised_decode = True
+        # Number of worker processes for the post-process decode of HD Plus data (see hd_parallel.py), 1 to decode in
+        # this process only
+        self.decode_workers = 1
+        self.__parallel_decoder = None
+        # Batch decoder for original HD data, compiled from the stream header
+        self.__stripe_decoder = None
         self.__real_time_thread_running = False
         self.dump_complete = False
         self.__save_mode = "post_process"
         self.__csv_file_path = None
         # Members used to buffer and then write to file during the CSV creating process
         self.__write_buffer = ""
-        self.__file_stream = None        
+        # Output sink for the decoded data (see hd_sinks.py), a CsvSink on the CSV file path unless one is given
+        self.__sink = None
+        self.__sink_open = False
         # Decode flags to persist across buffers to track cases where words are split
         self.__flag_word_low = False
         self.__val_word_high = 0
@@ -54,6 +86,9 @@ class HdStreamer:
         self.__value_totp = 0
         self.__isHdPlus = False
         self.__LastValid = False
+        # Incomplete HD Plus packet from the end of the last buffer decoded, and the offset it starts at
+        self.__partial_packet = b""
+        self.__partial_start = 0
         self.__Last5V_V = 0
         self.__Last5V_I = 0
         self.__Last12V_V = 0
@@ -61,7 +96,7 @@ class HdStreamer:
         self.__logger = None
         # Members used for debug logging to .dat file during implementation testing
         self.__debug_file_stream = None
-        self.__debug_time_structure = bytearray(8)
+        self.__debug_last_block_time = None
         self.__debug_bad_packets = 0
 
         # State machine setup for the streaming decode.  Provides the state transitions needed for any given channel selection
@@ -119,10 +154,11 @@ class HdStreamer:
         }
         return average_rates
 
-    def start_stream(self, seconds, csv_file_path, logger, fio_command=None, save_mode="post_process", debug_data_dump=False):
+    def start_stream(self, seconds, csv_file_path, logger, fio_command=None, save_mode="post_process", debug_data_dump=False, sink=None):
 
         self.__save_mode = save_mode
         self.__csv_file_path = csv_file_path
+        self.__sink = self.__add_taps_to_sink(sink if sink is not None else CsvSink(csv_file_path))
         self.__logger = logger
         self.__debug_data_dump = debug_data_dump
 
@@ -138,8 +174,12 @@ class HdStreamer:
         # Get the averaging rate
         stripes_per_second = self._get_average_rate()
 
-        # Allocate the full buffer now, with 5% additional
-        mega_buffer_len = int(seconds * stripes_per_second * bytes_per_stripe * 1.05)
+        # Allocate the full buffer now, with 5% additional.  If the stream time is not given (stopped by stop_stream())
+        # the storage grows in segments instead
+        if seconds is None:
+            mega_buffer_len = 0
+        else:
+            mega_buffer_len = int(seconds * stripes_per_second * bytes_per_stripe * 1.05)
 
         # Create initial receive buffers, avoiding repeat allocation                
         data, data_buffer_len, len_data = self._create_initial_receive_buffers(logger, mega_buffer_len)
@@ -160,9 +200,44 @@ class HdStreamer:
 
         elif save_mode == "real_time":
             self._real_time_monitoring(logger)
+        elif save_mode == "streaming":
+            self._streaming_complete(logger)
         else:
             raise ValueError("Invalid save mode: " + save_mode)
 
+    # Decodes a previously captured raw stream to CSV (or the given sink) without a device stream.  'header' is the
+    # stream header block and 'data' is the measurement data that followed it (as held in the mega buffer at the end
+    # of a capture), either a buffer or a CaptureStorage
+    def decode_capture(self, header, data, csv_file_path, logger, sink=None):
+        self.__csv_file_path = csv_file_path
+        self.__sink = self.__add_taps_to_sink(sink if sink is not None else CsvSink(csv_file_path))
+        self.__logger = logger
+        self.__process_stream_header(header, len(header))
+        self.__header_valid = True
+        self.capture_storage = data if isinstance(data, CaptureStorage) else CaptureStorage.wrap(data)
+        self._post_processing(csv_file_path, logger)
+
+    # Requests the stream to stop at the next sync, for streams started without a fixed time
+    def stop_stream(self):
+        self.__request_stop = True
+
+    # Adds a telemetry tap (hd_telemetry.TelemetryTap), which is given the decoded data along with the output sink.
+    # Taps must be added before the stream is started
+    def add_tap(self, tap):
+        tap.streamer = self
+        self.__taps.append(tap)
+
+    # Queues a device command to be sent at the next stream sync, as the stream uses the command connection.  This can
+    # be called from any thread while the stream runs
+    def queue_command(self, command):
+        self.__queued_commands.append(command)
+
+    # Returns the sink to write to, with any telemetry taps added
+    def __add_taps_to_sink(self, sink):
+        if len(self.__taps) == 0:
+            return sink
+        return TeeSink([sink] + self.__taps)
+
     def _start_stream_and_start_processing_thread(self, fio_command, logger, save_mode):
         myproc = None
         # Tell the PPM we are stream capable, to unlock the stream function
@@ -179,6 +254,11 @@ class HdStreamer:
         if save_mode == "real_time":
             proc_thread = threading.Thread(name='save_worker', target=self.__decode_stream_section_worker)
             proc_thread.start()
+        # Start the decoder thread for the streaming save mode, this is a daemon so it cannot hold the process open if
+        # the stream fails
+        elif save_mode == "streaming":
+            self.__stream_decode_thread = threading.Thread(name='stream_decode_worker', target=self.__decode_stream_chunk_worker, daemon=True)
+            self.__stream_decode_thread.start()
         return myproc
 
     def _real_time_monitoring(self, logger):
@@ -192,16 +272,42 @@ class HdStreamer:
         wait_time = real_time_end_time - real_time_start_time
         logger.info("Process complete! Waited {} seconds for thread based save to complete".format(wait_time))
 
+    def _streaming_complete(self, logger):
+        # Mark the end of the data and wait for the decoder thread to finish the queued chunks
+        wait_start_time = time.time()
+        logger.info(datetime.now().isoformat() + "\t: Waiting for streaming decode to complete")
+        self.capture_storage.close()
+        self.__stream_decode_thread.join()
+        self.__discard_partial_packet()
+        self.__sink.close()
+        if (self.__debug_file_stream is not None):
+            self.__debug_file_stream.close()
+        if self.__stream_decode_error is not None:
+            raise Exception("Streaming decode failed: " + str(self.__stream_decode_error)) from self.__stream_decode_error
+        wait_time = time.time() - wait_start_time
+        logger.info("Process complete! Waited {} seconds for streaming decode to complete, {} receive stalls".format(
+            wait_time, self.capture_storage.stalls))
+
     def _post_processing(self, csv_file_path, logger):
         csv_start_time = time.time()
         print("Post-processing data to CSV")
         logger.info(datetime.now().isoformat() + "\t: Started CSV post-processing")
         # Stream has now fully completed, write the data to csv, as required
-        self.__prepare_csv_file(csv_file_path)
-        # Process the buffered data
-        self.__decode_stream_data_buffer(memoryview(self.__mega_buffer))
+        self.__open_sink()
+        # Share the HD Plus decode between worker processes if requested
+        if self.decode_workers > 1 and self.__isHdPlus and self.use_vectorised_decode:
+            self.__parallel_decoder = ParallelHdPlusDecoder(self.__get_stripe_time(), workers=self.decode_workers)
+        # Process the buffered data, one storage segment at a time (segments always hold whole blocks)
+        try:
+            for segment in self.capture_storage.segments():
+                self.__decode_stream_data_buffer(segment)
+        finally:
+            if self.__parallel_decoder is not None:
+                self.__parallel_decoder.close()
+                self.__parallel_decoder = None
+        self.__discard_partial_packet()
         logger.info(datetime.now().isoformat() + "\t: Closing file stream")
-        self.__file_stream.close()
+        self.__sink.close()
         if (self.__debug_file_stream is not None):
             self.__debug_file_stream.close()
         logger.info(datetime.now().isoformat() + "\t: Completed CSV post-processing, exiting")
@@ -212,91 +318,126 @@ class HdStreamer:
     def _process_stream_data(self, data, data_buffer_len, len_data, seconds):
         # Loop to get all data in the stream, not returning until done
         stream_start = timer()
+        len_view = memoryview(len_data)
         while self.__stream_end_status == -1:
-            # Read packet size first
-            got_bytes = self.__stream_socket.recv_into(memoryview(len_data), 2)
+            # Read packet size first, the 2 bytes can arrive in separate reads
+            got_bytes = self.__stream_socket.recv_into(len_view, 2)
+            if (got_bytes == 1):
+                got_bytes += self.__stream_socket.recv_into(len_view[1:], 1)
             if (got_bytes != 2):
                 raise Exception ("Unable to read data block length")
 
             if not len_data:
                 break
-            data, len_bytes = self._send_and_receive_data(data, data_buffer_len, len_data)
-
-            # If packet capture debug is enabled, process it here
-            if (self.__debug_file_stream is not None):
-                # Write the 8 byte time in nS since the last packet.  Unused for now, so set to 0
-                self.__debug_file_stream.write(self.__debug_time_structure)
-                # Write the 4 byte Int32 form packet length
-                byte_string = struct.pack(">I", len_bytes)
-                self.__debug_file_stream.write(byte_string)
-                # Finally the data block is written
-                self.__debug_file_stream.write(data[:len_bytes])
 
             # If header is not valid, assume this is the stream header and process it (one time operation at start)
             if not self.__header_valid:
+                data, len_bytes = self._send_and_receive_data(data, data_buffer_len, len_data)
+                self._write_debug_block(data, len_bytes)
                 # Ensure we pass only the valid data to the processing function as the buffer can be sized larger
                 self.__process_stream_header(data, len_bytes)
                 self.__header_valid = True
                 # HD has a 4 byte header, HD Plus is dynamic and fills the first block returned
                 if (self.__header_size > 0):
-                    len_bytes -= self.__header_size
+                    header_size = self.__header_size
                 else:
-                    len_bytes -= len_bytes
+                    header_size = len_bytes
+                len_bytes -= header_size
 
                 # If we're done after the header bytes, continue and skip processing
                 if len_bytes == 0:
                     continue
 
-            self._process_data_and_send_ack(data, len_bytes)
+                # Any data after the header is copied into the capture storage, this only happens once
+                block = self.capture_storage.reserve(len_bytes)
+                block[:] = data[header_size:header_size + len_bytes]
+                self.capture_storage.copies += 1
+                self.capture_storage.bytes_copied += len_bytes
+            else:
+                # Receive the block straight into the capture storage, so it is never copied
+                len_bytes = int(len_data[0] + (len_data[1] << 8))
+                block = self.capture_storage.reserve(len_bytes)
+                self._receive_block(block, len_bytes)
+                self._write_debug_block(block, len_bytes)
+
+            self._process_data_and_send_ack(block, len_bytes)
 
             # calculate end time
-            if timer() - stream_start > seconds:
+            if seconds is not None and timer() - stream_start > seconds:
                 if not self.__request_stop:
                     logging.debug(datetime.now().isoformat() + "\t: Stream time complete, halting")
                     self.__request_stop = True
 
-    def _process_data_and_send_ack(self, data, len_bytes):
-        # Odd byte count means a status byte at the end which must be processed
+    # Writes a received block to the debug raw dump file, if packet capture debug is enabled
+    def _write_debug_block(self, data, len_bytes):
+        if (self.__debug_file_stream is not None):
+            # Write the 8 byte time in nS since the last packet (0 for the first), used for wire rate replay
+            block_time = time.perf_counter_ns()
+            if self.__debug_last_block_time is None:
+                self.__debug_last_block_time = block_time
+            self.__debug_file_stream.write(struct.pack(">Q", block_time - self.__debug_last_block_time))
+            self.__debug_last_block_time = block_time
+            # Write the 4 byte Int32 form packet length
+            byte_string = struct.pack(">I", len_bytes)
+            self.__debug_file_stream.write(byte_string)
+            # Finally the data block is written
+            self.__debug_file_stream.write(data[:len_bytes])
+
+    # Processes a block that has been received into the capture storage
+    def _process_data_and_send_ack(self, block, len_bytes):
+        # Odd byte count means a status byte at the end which must be processed.  The status byte is not committed,
+        # so it is overwritten by the next block
         if (len_bytes & 1) != 0:
-            self.__handle_status_byte(data[len_bytes - 1])
+            self.__handle_status_byte(block[len_bytes - 1])
             len_bytes -= 1
         if len_bytes > 0:
-            # Store data into the stream mega buffer, at the end of current data (no processing during the stream,
-            # to avoid any performance hit)
-            self.__mega_buffer[self.__data_store_pos:self.__data_store_pos + len_bytes] = data[0:len_bytes]
-            self.__data_store_pos += len_bytes
+            # Commit the data into the capture storage (no processing during the stream, to avoid any performance hit)
+            self.capture_storage.commit(len_bytes)
         # Perform ACK sequence as required by the current status
         if self.__sync_packet_active:
             self.__send_sync()
             self.__sync_packet_active = False
 
-            # End after set time
-
     # Handles the receipt of a single 'block' of data.   2 bytes are passed in from the previous read, to
     # tell us how big the block is.  Outside of a timeout, we cannot leave here until the full block is read
     # as otherwise we would be out of step for the next block
     def _send_and_receive_data(self, data, data_buffer_len, len_data):
-        read_bytes = 0
         len_bytes = int(len_data[0] + (len_data[1] << 8))
 
         # If the current buffer is not large enough, re-allocate with a bit of headroom
         if len_bytes > data_buffer_len:
             data = bytearray(len_bytes + 10)
 
+        self._receive_block(memoryview(data), len_bytes)
+        return data, len_bytes
+
+    # Receives 'len_bytes' of a stream block into the given memoryview, then sends the ACK
+    def _receive_block(self, block, len_bytes):
+        read_bytes = 0
+
         # Loop until the entire stream block is read
         while (read_bytes < len_bytes):
             # Receive from the socket into the end of the current data
-            received = self.__stream_socket.recv_into(memoryview(data)[read_bytes:], (len_bytes - read_bytes))
-            read_bytes += received               
-        
+            received = self.__stream_socket.recv_into(block[read_bytes:], (len_bytes - read_bytes))
+            if received == 0:
+                raise Exception ("Stream connection closed during a data block")
+            read_bytes += received
+
         # Force an TCP ACK by sending a stub packet, used to speed up the data flow on devices with low TCP RAM
-        self.__stream_socket.send(bytearray(b'\x02\x00\xff\xff'))
-        return data, len_bytes
+        self.__stream_socket.send(ACK_STUB)
 
     def _create_initial_receive_buffers(self, logger, mega_buffer_len):
-        self.__mega_buffer = bytearray(0)  # mega_buffer_len)
-        logger.info(datetime.now().isoformat() + "\t: Init megabuffer as length: " + str(mega_buffer_len))
-        self.__data_store_pos = 0
+        # Streaming mode passes fixed size chunks to the decoder thread, rather than keeping the whole capture
+        if self.__save_mode == "streaming":
+            flush_interval = self.stream_flush_interval
+            if flush_interval is None and len(self.__taps) > 0:
+                flush_interval = DEFAULT_TAP_FLUSH_INTERVAL
+            self.capture_storage = StreamChunkQueue(self.stream_chunk_size, self.stream_queue_chunks, flush_interval)
+            logger.info(datetime.now().isoformat() + "\t: Init stream chunk queue: " + str(self.stream_queue_chunks) +
+                        " x " + str(self.stream_chunk_size))
+        else:
+            self.capture_storage = CaptureStorage(mega_buffer_len)
+            logger.info(datetime.now().isoformat() + "\t: Init megabuffer as length: " + str(mega_buffer_len))
         data_buffer_len = 1024
         data = bytearray(data_buffer_len)
         len_data = bytearray(2)
@@ -323,28 +464,11 @@ class HdStreamer:
             bytes_per_stripe += 4
         return bytes_per_stripe
 
-    def __prepare_csv_file(self, path):
-        self.__file_stream = open(path, 'w')
-        self.__logger.info(datetime.now().isoformat() + "\t: Preparing CSV file headers")
-
-        # Write header (based on active channels)
-        self.__file_stream.write("Time us,")
-        if (self.__stream_header_channels & 0x0008) != 0:  # 5V V
-            self.__file_stream.write("5V voltage mV,")
-        if (self.__stream_header_channels & 0x0004) != 0:  # 5V I
-            self.__file_stream.write("5V current uA,")
-        if (self.__stream_header_channels & 0x0002) != 0:  # 12V V
-            self.__file_stream.write("12V voltage mV,")
-        if (self.__stream_header_channels & 0x0001) != 0:  # 12V I
-            self.__file_stream.write("12V current uA,")
-        if (self.__stream_header_channels & 0x0008 != 0 and self.__stream_header_channels & 0x0004 != 0):
-            self.__file_stream.write("5V power uW,")
-        if (self.__stream_header_channels & 0x0002 != 0 and self.__stream_header_channels & 0x0001 != 0):
-            self.__file_stream.write("12V power uW,")
-        if (
-                self.__stream_header_channels & 0x0008 != 0 and self.__stream_header_channels & 0x0004 != 0 and self.__stream_header_channels & 0x0002 != 0 and self.__stream_header_channels & 0x0001 != 0):
-            self.__file_stream.write("Total power uW")
-        self.__file_stream.write("\r")
+    # Opens the output sink, which writes the file headers based on the active channels
+    def __open_sink(self):
+        self.__logger.info(datetime.now().isoformat() + "\t: Preparing output file headers")
+        self.__sink.open(self.__stream_header_channels)
+        self.__sink_open = True
 
     # Processes each packet coming in
     def __process_packet(self, data, data_len):
@@ -391,11 +515,8 @@ class HdStreamer:
             data_len -= 1
 
         if (data_len > 0):
-            # Store data into the stream mega buffer, at the end of current data (no processing during the stream, to avoid any performance hit)
-            # mem_view = memoryview(self.__mega_buffer)[self.__data_store_pos:]
-            self.__mega_buffer[self.__data_store_pos:self.__data_store_pos + data_len] = data[0:data_len]
-            # mem_view[:] = bytes(b'hello')#data[0:data_len]
-            self.__data_store_pos += data_len
+            # Store data into the capture storage, at the end of current data (no processing during the stream, to avoid any performance hit)
+            self.capture_storage.append(data[0:data_len])
 
         # Perform ACK sequence as required by the current status
         if (self.__sync_packet_active):
@@ -404,12 +525,17 @@ class HdStreamer:
 
     # Send an ACK packet to the SYNC request, allowing streaming to continue
     def __send_sync(self):
+        # Commands queued by telemetry taps are sent first
+        while len(self.__queued_commands) > 0:
+            command = self.__queued_commands.popleft()
+            logging.debug(datetime.now().isoformat() + "\t: Sending queued command: " + command)
+            self.__my_device.sendCommand(command)
         if (self.__request_stop == True):
             self.__my_device.sendCommand("rec stop")
             if (self.__stream_stop_ordered == False):
                 self.__stream_stop_ordered = True
                 print ("Stopping stream, recording time is complete")
-        self.__stream_socket.send(bytearray(b'\x02\x00\xff\x01'))
+        self.__stream_socket.send(SYNC_REPLY)
 
     # Processing for stream header
     def __process_stream_header(self, data, len_bytes):
@@ -459,14 +585,17 @@ class HdStreamer:
             # data[1] is a reserved padding byte
             self.__stream_header_channels = data[2]
             self.__stream_average_rate = data[3]
+            # The stripe layout is fixed by the enabled channels, so compile it once for the batch decoder
+            if self.use_vectorised_decode:
+                self.__stripe_decoder = HdStripeDecoder(self.__stream_header_channels & 0x0F, self.__get_stripe_time())
 
         # Calculate the initial stream state given the available channels
         self.__init_stream_state(self.__stream_header_channels & 0x0F)
 
         # Prepare the output file for real time write if required
-        if (self.__file_stream is None and self.__save_mode == "real_time"):
+        if (not self.__sink_open and self.__save_mode in ("real_time", "streaming")):
             logging.debug(datetime.now().isoformat() + "\t: Opened CSV for real-time processing")
-            self.__prepare_csv_file(self.__csv_file_path)
+            self.__open_sink()
 
     # Set the initial decode state, given the channels that will be returned.  This comes from the stream header
     def __init_stream_state(self, channel_enable):
@@ -513,14 +642,14 @@ class HdStreamer:
         logging.debug(datetime.now().isoformat() + "\t: Real-time save worker: Started")
 
         # While there is data to process
-        while (self.__data_store_pos >= self.__next_data_pos and self.dump_complete == False):
+        while (len(self.capture_storage) >= self.__next_data_pos and self.dump_complete == False):
 
             # If there are more than x bytes to process, process a block
             next_data = self.__next_data_pos
-            store_pos = self.__data_store_pos
+            store_pos = len(self.capture_storage)
             if (store_pos - next_data > buffer_needed):
                 # logging.debug(datetime.now().isoformat() + "\t: Real-time save worker: Decode " + str(next_data) + "-" + str(next_data+process_size))
-                self.__decode_stream_data_buffer(self.__mega_buffer[next_data:next_data + process_size])
+                self.__decode_stream_data_buffer(self.capture_storage.view(next_data, next_data + process_size))
                 self.__next_data_pos = (next_data + process_size)
             # Else wait a little for more to come along
             else:
@@ -530,12 +659,42 @@ class HdStreamer:
 
         # Process all remaining bytes
         next_data = self.__next_data_pos
-        self.__decode_stream_data_buffer(self.__mega_buffer[next_data:])
+        self.__decode_stream_data_buffer(self.capture_storage.view(next_data))
 
         logging.debug(datetime.now().isoformat() + "\t: Real-time save worker: Closing")
 
         self.__real_time_thread_running = False
 
+    # Thread worker function for the "streaming" save mode.  Each chunk of raw data is decoded as it arrives from the
+    # chunk queue, then returned to the free pool.  The decode state (split words, delta/repeat values and any
+    # incomplete HD Plus packet) carries from one chunk to the next
+    def __decode_stream_chunk_worker(self):
+        logging.debug(datetime.now().isoformat() + "\t: Streaming save worker: Started")
+
+        while True:
+            chunk = self.capture_storage.get()
+            if chunk is None:
+                break
+            for tap in self.__taps:
+                tap.received_time = self.capture_storage.chunk_time
+            # After a decode error, keep taking chunks so the receive loop is never blocked
+            if self.__stream_decode_error is None:
+                try:
+                    self.__decode_stream_data_buffer(chunk)
+                except Exception as err:
+                    logging.error(datetime.now().isoformat() + "\t: Streaming save worker: Decode failed: " + str(err))
+                    self.__stream_decode_error = err
+            self.capture_storage.release(chunk)
+
+        logging.debug(datetime.now().isoformat() + "\t: Streaming save worker: Closing")
+
+    # Drops any incomplete packet left at the end of the data, as the rest of it was never received
+    def __discard_partial_packet(self):
+        if len(self.__partial_packet) > 0:
+            logging.warning(datetime.now().isoformat() + "\t: Stream ended part way through a packet, " +
+                            str(len(self.__partial_packet) - self.__partial_start) + " bytes discarded")
+            self.__partial_packet = b""
+
     # Decodes a buffer of streaming data measurements.  The header and and additional transport bytes must have been
     # removed by this point, leaving only pure measurement data.  The decode uses a state machine (PPM), initialised by the
     # header bytes at the start of streaming.  Multiple calls can be made provided sequential buffers of valid data
@@ -544,14 +703,17 @@ class HdStreamer:
         i = 0
         buffer_len = len(buffer)
 
-        # Note: Fixed HD 4uS per stripe base measurement rate
-        ave_multiplier = (pow(self.__stream_average_rate, 2) * 4)
-        if (ave_multiplier == 0):
-            ave_multiplier = 4        
+        ave_multiplier = self.__get_stripe_time()
         
         # HD Plus format requires alternate processing, as the format is different
         if (self.__isHdPlus == True):            
             self.__decode_hdplus_stream_data_buffer(buffer, ave_multiplier)
+        # Original HD format with the batch decoder, whole stripes at a time
+        elif self.__stripe_decoder is not None:
+            self.__stripe_decoder.time_pos = self.stream_time_pos
+            for block in self.__stripe_decoder.decode(buffer):
+                self.__sink.write_block(block)
+            self.stream_time_pos = self.__stripe_decoder.time_pos
         else:
             while i < buffer_len:
                 to_buffer = False
@@ -566,11 +728,40 @@ class HdStreamer:
                     if self.__stream_decode_state <= self.__stream_decode_prev_state:
                         self._calculate_time_and_power_values(ave_multiplier)
                     
+    # Returns the time between stripes in uS, from the averaging rate in the stream header
+    def __get_stripe_time(self):
+        # Note: Fixed HD 4uS per stripe base measurement rate
+        ave_multiplier = (pow(self.__stream_average_rate, 2) * 4)
+        if (ave_multiplier == 0):
+            ave_multiplier = 4
+        return ave_multiplier
+
     # HD Plus decode section, intended to take 1 512 byte block at a time but other sizes should work provided
     # the data is packed with no additional bytes
     def __decode_hdplus_stream_data_buffer(self, buffer, ave_multiplier):
+        start = 0
+        # Join any incomplete packet from the end of the last buffer onto this one.  It is held from the start of its
+        # 16 bit word, so the byte order is kept
+        if len(self.__partial_packet) > 0:
+            start = self.__partial_start
+            buffer = self.__partial_packet + bytes(buffer)
+            self.__partial_packet = b""
+
+        # Batch decode as much of the buffer as possible, any bad packet is left to the per-byte decode below, so
+        # error handling is unchanged.  An incomplete packet at the end is held for the next buffer
+        if self.use_vectorised_decode:
+            consumed = self.__decode_hdplus_stream_data_vectorised(buffer, ave_multiplier, start)
+            if consumed == len(buffer):
+                return
+            if is_partial_packet(buffer, consumed):
+                self.__partial_start = consumed & 1
+                self.__partial_packet = bytes(buffer[consumed & ~1:])
+                return
+            start = consumed & 1
+            buffer = buffer[consumed & ~1:]
+
         buffer_len = len(buffer)
-        access_byte = 0
+        access_byte = start
         repeat_count = 0
         packet_id = 0
         self.__value_5v = 0
@@ -785,16 +976,26 @@ class HdStreamer:
                     self.__debug_bad_packets += 1
             # Process if data is ready
             if (repeat_count > 0):
-                # Calculate time and power values
-                value_5p = (self.__value_5v * self.__value_5i) / 1000
-                value_12p = (self.__value_12v * self.__value_12i) / 1000
-                value_totp = value_5p + value_12p
-
-                # Write the line(s) to file
-                for x in range (repeat_count):
-                    file_string = str(self.stream_time_pos) + "," + str(self.__value_5v) + "," + str(self.__value_5i) + "," + str(self.__value_12v) + "," + str(self.__value_12i) + "," + str(value_5p) + "," + str(value_12p) + "," + str(value_totp) + "\r"
-                    self.__file_stream.write(file_string)
-                    self.stream_time_pos = self.stream_time_pos + ave_multiplier
+                # Write the line(s) to the output, the sink calculates the power values
+                self.__sink.write_rows(self.stream_time_pos, ave_multiplier, repeat_count, self.__value_5v, self.__value_5i, self.__value_12v, self.__value_12i)
+                self.stream_time_pos = self.stream_time_pos + ave_multiplier * repeat_count
+
+    # Decodes HD Plus data from byte 'start' with the NumPy batch decoder, carrying the repeat/delta state and stream
+    # time in and out.  The parallel decoder is used in place of HdPlusDecoder when it has been started.  Returns the
+    # position after the last packet that was decoded
+    def __decode_hdplus_stream_data_vectorised(self, buffer, ave_multiplier, start):
+        decoder = self.__parallel_decoder if self.__parallel_decoder is not None else HdPlusDecoder(ave_multiplier)
+        decoder.time_pos = self.stream_time_pos
+        decoder.last_values = [self.__Last5V_V, self.__Last5V_I, self.__Last12V_V, self.__Last12V_I]
+        decoder.last_valid = self.__LastValid
+
+        for block in decoder.decode(buffer, start):
+            self.__sink.write_block(block)
+
+        self.__Last5V_V, self.__Last5V_I, self.__Last12V_V, self.__Last12V_I = decoder.last_values
+        self.__LastValid = decoder.last_valid
+        self.stream_time_pos = decoder.time_pos
+        return decoder.consumed
 
     def _process_stream_decode_state(self, buffer, i, to_buffer):
         if self.__stream_decode_state == 0:
@@ -842,14 +1043,7 @@ class HdStreamer:
         return to_buffer
 
     def _calculate_time_and_power_values(self, ave_multiplier):
-        # Calculate time and power values
-        value_time = self.stream_time_pos
-        value_5p = (self.__value_5v * self.__value_5i) / 1000
-        value_12p = (self.__value_12v * self.__value_12i) / 1000
-        value_totp = value_5p + value_12p
-        self.__file_stream.write(
-            str(value_time) + "," + str(self.__value_5v) + "," + str(self.__value_5i) + "," + str(
-                self.__value_12v) + "," + str(self.__value_12i) + "," + str(value_5p) + "," + str(
-                value_12p) + "," + str(value_totp) + "\r")
+        # Write the stripe to the output, the sink calculates the power values
+        self.__sink.write_rows(self.stream_time_pos, ave_multiplier, 1, self.__value_5v, self.__value_5i, self.__value_12v, self.__value_12i)
         # Next stripe
         self.stream_time_pos = self.stream_time_pos + ave_multiplier
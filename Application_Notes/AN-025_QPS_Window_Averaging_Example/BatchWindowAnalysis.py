@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+AN-025 - Batch window analysis of a directory of QPS / QIS traces
+
+WindowAveragingExample.py processes one trace with a fixed path, and appends the results to a text file.  This script
+finds every trace in a set of files and directories, processes them in parallel over a pool of processes, and writes
+one results table with a row for each trace and window:
+
+1- The worst case and best case window average of each window (window_power.py), and optionally the percentiles of
+   the window averages (power_stats.py) and the time weighted worst case with the gaps found (time_windows.py)
+2- The size of each trace, and the time taken to load and to process it
+3- The status of each trace: a trace that cannot be processed gets a row with the error, and the run carries on
+
+The table is written as CSV, JSON or Parquet (chosen by the file extension), and the throughput of the run in MB/s is
+reported at the end.  No module is required.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- NumPy python package
+    pip install numpy
+3- PyArrow python package, only to write Parquet results
+    pip install pyarrow
+
+########### INSTRUCTIONS ###########
+
+1- Run the script with the directories (or files) holding the traces, and the results file to write:
+    python BatchWindowAnalysis.py captures/ --output results.csv
+2- Set the windows (in uS) and the other calculations to run on each trace:
+    python BatchWindowAnalysis.py captures/ --windows 100 1000 1000000 --percentiles --time-aware
+3- Use --pattern and --recursive to choose the traces, for example every test_data.csv under the directory:
+    python BatchWindowAnalysis.py captures/ --pattern "test_data*.csv" --recursive --output results.parquet
+4- Use --workers to set the number of processes, which is the number of CPUs by default
+
+####################################
+"""
+import argparse
+import concurrent.futures
+import csv
+import fnmatch
+import json
+import os
+import sys
+import time
+import traceback
+
+from power_stats import PERCENTILES, window_statistics
+from time_windows import time_window_extremes
+from window_power import load_column, window_extremes
+
+# Formats the results table can be written in, by file extension
+RESULT_FORMATS = {".csv": "csv", ".json": "json", ".parquet": "parquet"}
+
+# Columns of the results table, before the percentile columns
+RESULT_COLUMNS = ["file", "size_mb", "status", "error", "window", "window_samples", "worst_case", "best_case",
+                  "samples_processed", "time_weighted_worst_case", "gaps", "missing_samples", "load_seconds",
+                  "process_seconds", "total_seconds", "mb_per_second"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Window analysis of a directory of traces, in parallel")
+    parser.add_argument("paths", nargs="+", help="Trace files, or directories holding the traces")
+    parser.add_argument("--output", default="window_results.csv", help="Results file (.csv, .json or .parquet)")
+    parser.add_argument("--pattern", default="*.csv", help="File name pattern of the traces in each directory")
+    parser.add_argument("--recursive", action="store_true", help="Also search the subdirectories")
+    parser.add_argument("--windows", type=float, nargs="+", default=[100, 1000000], help="Window lengths in uS")
+    parser.add_argument("--column", default="Tot uW", help="Name of the column to process")
+    parser.add_argument("--delimiter", default=",", help="Delimiter character used in the traces")
+    parser.add_argument("--sample-time", type=float, default=-1,
+                        help="Sample time of the traces in uS, otherwise measured from each trace")
+    parser.add_argument("--percentiles", action="store_true", help="Add the percentiles of the window averages")
+    parser.add_argument("--time-aware", action="store_true",
+                        help="Add the time weighted worst case and the gaps found in each trace")
+    parser.add_argument("--cache", action="store_true", help="Cache the parsed column next to each trace")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of processes")
+    args = parser.parse_args()
+
+    print("\n\nQuarch application note example: AN-025 batch window analysis")
+    print("---------------------------------------------------------------\n")
+
+    result_format = RESULT_FORMATS.get(os.path.splitext(args.output)[1].lower())
+    if result_format is None:
+        raise ValueError ("Results file must end in " + ", ".join(RESULT_FORMATS))
+    if result_format == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("'pyarrow' module required to write Parquet results, please install this")
+
+    traces = find_traces(args.paths, args.pattern, args.recursive, exclude=[args.output])
+    if len(traces) == 0:
+        print("No traces found")
+        return 1
+    windows = [int(window) if window == int(window) else window for window in args.windows]
+    sample_time = -1 if args.sample_time == -1 else (
+        int(args.sample_time) if args.sample_time == int(args.sample_time) else args.sample_time)
+    settings = {"windows": windows, "column": args.column, "delimiter": args.delimiter, "sample_time": sample_time,
+                "percentiles": args.percentiles, "time_aware": args.time_aware, "cache": args.cache}
+
+    print("-Processing " + str(len(traces)) + " traces with " + str(args.workers) + " processes")
+    start_time = time.perf_counter()
+    rows = []
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(analyse_trace, path, settings): path for path in traces}
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            path = futures[future]
+            try:
+                trace_rows = future.result()
+            except Exception as error:
+                # The worker process failed, rather than the analysis
+                trace_rows = [_error_row(path, error)]
+            if trace_rows[0]["status"] != "ok":
+                failures += 1
+            rows.extend(trace_rows)
+            print("\t[{}/{}] {}: {}".format(done + 1, len(traces), path, trace_rows[0]["status"] if
+                                            trace_rows[0]["status"] == "ok" else trace_rows[0]["error"]))
+    run_time = time.perf_counter() - start_time
+
+    # Rows in the order of the traces, then of the windows
+    order = {path: position for position, path in enumerate(traces)}
+    rows.sort(key=lambda row: order[row["file"]])
+    columns = RESULT_COLUMNS + (["p" + str(percent) for percent in PERCENTILES] if args.percentiles else [])
+    write_results(args.output, result_format, rows, columns)
+
+    total_mb = sum(size for size in {row["file"]: row["size_mb"] or 0 for row in rows}.values())
+    print("\n####Results####")
+    print("Traces: {}, failed: {}".format(len(traces), failures))
+    print("Processed {:.1f} MB in {:.2f} s ({:.1f} MB/s)".format(total_mb, run_time, total_mb / run_time))
+    print("Results written to " + args.output)
+    print("##############\n")
+    return 1 if failures > 0 else 0
+
+
+# Returns the paths of the traces in 'paths' (files, or directories searched for 'pattern'), sorted, without the
+# files in 'exclude'
+def find_traces(paths, pattern, recursive=False, exclude=()):
+    excluded = {os.path.abspath(path) for path in exclude}
+    traces = []
+    for path in paths:
+        if os.path.isfile(path):
+            traces.append(path)
+            continue
+        if not os.path.isdir(path):
+            raise ValueError ("Path not found: " + path)
+        for directory, subdirectories, files in os.walk(path):
+            traces.extend(os.path.join(directory, name) for name in fnmatch.filter(files, pattern))
+            if not recursive:
+                break
+    return sorted(set(trace for trace in traces if os.path.abspath(trace) not in excluded))
+
+
+# Runs the window analysis of one trace, in a worker process.  Returns a result row for each window, or one row with
+# the error if the trace cannot be processed
+def analyse_trace(path, settings):
+    start_time = time.perf_counter()
+    try:
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        column = load_column(path, settings["column"], settings["delimiter"], cache=settings["cache"])
+        load_time = time.perf_counter() - start_time
+        results = window_extremes(column, settings["windows"], expected_sample_time=settings["sample_time"])
+        statistics = None
+        if settings["percentiles"]:
+            statistics = window_statistics(column, settings["windows"], expected_sample_time=settings["sample_time"])
+        report = None
+        if settings["time_aware"]:
+            report = time_window_extremes(path, settings["windows"], settings["column"], settings["delimiter"],
+                                          expected_sample_time=settings["sample_time"])
+    except Exception as error:
+        row = _error_row(path, error)
+        row["total_seconds"] = time.perf_counter() - start_time
+        return [row]
+    total_time = time.perf_counter() - start_time
+
+    rows = []
+    for index, result in enumerate(results):
+        row = {"file": path, "size_mb": size_mb, "status": "ok", "error": None, "window": result.window,
+               "window_samples": result.window_samples, "worst_case": result.worst_case,
+               "best_case": result.best_case, "samples_processed": result.samples_processed,
+               "load_seconds": load_time, "process_seconds": total_time - load_time, "total_seconds": total_time,
+               "mb_per_second": size_mb / total_time if total_time > 0 else None}
+        if statistics is not None:
+            for percent, value in zip(PERCENTILES, statistics[index].digest.percentiles(PERCENTILES)):
+                row["p" + str(percent)] = value
+        if report is not None:
+            row["time_weighted_worst_case"] = report.results[index].worst_case
+            row["gaps"] = len(report.gaps)
+            row["missing_samples"] = sum(gap.missing_samples for gap in report.gaps)
+        rows.append(row)
+    return rows
+
+
+# Writes the result rows as a table with 'columns', in 'result_format' (csv, json or parquet)
+def write_results(path, result_format, rows, columns):
+    table = [{name: row.get(name) for name in columns} for row in rows]
+    if result_format == "csv":
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(table)
+    elif result_format == "json":
+        with open(path, "w") as file:
+            json.dump(table, file, indent=1)
+    else:
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(table), path)
+
+
+# Returns the result row of a trace that could not be processed
+def _error_row(path, error):
+    message = "".join(traceback.format_exception_only(type(error), error)).strip()
+    size_mb = os.path.getsize(path) / (1024 * 1024) if os.path.exists(path) else None
+    return {"file": path, "size_mb": size_mb, "status": "error", "error": message}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
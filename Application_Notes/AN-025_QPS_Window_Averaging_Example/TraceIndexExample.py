@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+AN-025 - Reading time ranges and test sections of a large trace with a time-range index
+
+This script builds the time-range index of a CSV trace (trace_index.py), then reads a set of time ranges and the test
+sections between annotations from it, checking each against a full read of the trace and timing both.  Reading a range
+from the index parses only about one index interval of rows outside the range, however far into the trace it is.
+Without --data a synthetic trace is written, with a section every quarter of the trace.  No module is required.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- Quarchpy python package (imported by WindowAveragingExample.py, for the synthetic trace)
+    https://quarch.com/products/quarchpy-python-package/
+3- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the size of the synthetic trace and the length of each range read (in uS):
+    python TraceIndexExample.py --size-mb 200 --range 10000
+2- Use --data to index an existing trace instead, with --column for the column to read, and --annotations to mark the
+   start of each test section as TIME=LABEL pairs:
+    python TraceIndexExample.py --data RawData.csv --annotations 0=Idle 2000000=Write 5000000=Read
+3- The index is saved next to the trace as <trace>.index.npz, and built again if the trace changes
+
+####################################
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_index import INDEX_ROWS, index_path, open_index
+from trace_reader import TraceReader
+from WindowEngineBenchmark import write_synthetic_trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read time ranges of a trace with a time-range index")
+    parser.add_argument("--size-mb", type=int, default=50, help="Size of the synthetic trace to generate")
+    parser.add_argument("--data", help="Existing CSV trace to index instead of a synthetic trace")
+    parser.add_argument("--column", default="Tot uW", help="Name of the column to read")
+    parser.add_argument("--range", type=float, default=10000, help="Length of each range read, in uS")
+    parser.add_argument("--reads", type=int, default=20, help="Number of ranges to read")
+    parser.add_argument("--every-rows", type=int, default=INDEX_ROWS, help="Data lines between index entries")
+    parser.add_argument("--annotations", nargs="*", default=None, help="TIME=LABEL start of each test section")
+    args = parser.parse_args()
+
+    print("\n\nQuarch application note example: AN-025 time-range index")
+    print("----------------------------------------------------------\n")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_path = args.data
+        if data_path is None:
+            data_path = os.path.join(temp_dir, "trace.csv")
+            print("-Writing " + str(args.size_mb) + "MB synthetic trace")
+            write_synthetic_trace(data_path, args.size_mb * 1024 * 1024)
+        size_mb = os.path.getsize(data_path) / (1024 * 1024)
+
+        print("-Reading the whole trace, for comparison")
+        start_time = time.perf_counter()
+        with TraceReader(data_path, columns=[args.column]) as reader:
+            reader_names = reader.names
+            full = reader.read()
+        full_time = time.perf_counter() - start_time
+        with TraceReader(data_path, columns=[reader_names[0]]) as reader:
+            times = reader.read().columns[reader_names[0]]
+        column = reader_names[reader_names.index(args.column.strip("\""))]
+        values = full.columns[column]
+
+        annotations = None
+        if args.annotations is not None:
+            annotations = [(float(pair.split("=", 1)[0]), pair.split("=", 1)[1]) for pair in args.annotations]
+        elif args.data is None and len(times) > 0:
+            annotations = [(times[len(times) * quarter // 4], "Section " + str(quarter + 1)) for quarter in range(4)]
+
+        print("-Building the index")
+        start_time = time.perf_counter()
+        index = open_index(data_path, every_rows=args.every_rows, annotations=annotations)
+        build_time = time.perf_counter() - start_time
+        index_kb = os.path.getsize(index_path(data_path)) / 1024
+
+        print("-Reading " + str(args.reads) + " ranges of " + str(args.range) + " uS")
+        rng = np.random.default_rng(1)
+        mismatches = 0
+        range_time = 0.0
+        for start in rng.uniform(times[0], max(times[-1] - args.range, times[0]), args.reads):
+            read_start = time.perf_counter()
+            block = index.read(start, start + args.range, columns=[column])
+            range_time += time.perf_counter() - read_start
+            expected = (times >= start) & (times < start + args.range)
+            if not np.array_equal(block.columns[column], values[expected]):
+                mismatches += 1
+
+        section_results = []
+        for section in index.sections:
+            read_start = time.perf_counter()
+            rows = 0
+            present = 0
+            total = 0
+            for block in index.read_section(section.label, columns=[column]):
+                block_values = block.columns[column]
+                if block.missing[column] is not None:
+                    block_values = block_values[~block.missing[column]]
+                rows += len(block.columns[column])
+                present += len(block_values)
+                total += block_values.sum()
+            section_results.append((section, rows, total / max(present, 1), time.perf_counter() - read_start))
+
+    print("\n####Results####")
+    print("Trace: {} rows, {:.1f} MB, column read in {:.2f} s".format(len(times), size_mb, full_time))
+    print("Index: {} entries, {:.1f} kB, built in {:.2f} s".format(len(index.rows), index_kb, build_time))
+    print("Range reads: {:.2f} mS each, {} mismatches".format(range_time / max(args.reads, 1) * 1000, mismatches))
+    for section, rows, mean, seconds in section_results:
+        print("Section '{}' from {:.0f} uS: {} rows, {:.1f} {} mean, read in {:.3f} s".format(
+            section.label, section.start_time, rows, mean, column, seconds))
+    print("##############\n")
+    if mismatches > 0:
+        raise ValueError("Ranges read with the index do not match the whole trace")
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,9 @@ from collections import deque
 from datetime import datetime
 from quarchpy.qis import *
 from quarchpy import qisInterface
+from window_power import load_column, window_extremes
+from power_stats import PERCENTILES, window_statistics
+from time_windows import time_window_extremes
 
 '''
 Main function, containing the example code to execute.
@@ -170,14 +173,35 @@ def main():
         out_file.write("Test Time=" + current_time + "\n")
         # Request the worst case average across the trace.  Time specified in same units as the CSV recording (uS in this case)
         print ("Processing CSV file")
-        # 100mS window
-        worst_case = active_power_calc (data_path, col_name, window=100, expected_sample_time=sample_time_us)
-        out_file.write("Active power over 100 uS: " + str(worst_case) + "uW\n")
-        print ("Active power over 100 uS: " + str(worst_case) + "uW")
-        # 1 Second window
-        worst_case = active_power_calc (data_path, col_name, window=1000000, expected_sample_time=sample_time_us)
-        out_file.write("Active power over 1 Second: " + str(worst_case) + "uW\n")
-        print ("Active power over 1 Second: " + str(worst_case) + "uW")
+        # The column is loaded once, then the worst case for all the windows is calculated in one pass (this gives
+        # the same results as calling active_power_calc() for each window, much faster on large files)
+        column = load_column (data_path, col_name)
+        # 100uS and 1 Second windows
+        results = window_extremes (column, [100, 1000000], expected_sample_time=sample_time_us)
+        print ("Samples Processed: " + str(results[0].samples_processed))
+        for window_name, result in zip (["100 uS", "1 Second"], results):
+            out_file.write("Active power over " + window_name + ": " + str(result.worst_case) + "uW\n")
+            print ("Active power over " + window_name + ": " + str(result.worst_case) + "uW" +
+                   " (best case " + str(result.best_case) + "uW)")
+        # Percentiles of the power over all the windows, for power budgeting
+        statistics = window_statistics (column, [100, 1000000], expected_sample_time=sample_time_us)
+        for window_name, window_stats in zip (["100 uS", "1 Second"], statistics):
+            percentiles = ", ".join ("p" + str(percent) + "=" + str(round(value, 1)) + "uW" for percent, value in
+                                     zip (PERCENTILES, window_stats.digest.percentiles(PERCENTILES))
+                                     if value is not None)
+            out_file.write("Power percentiles over " + window_name + ": " + percentiles + "\n")
+            print ("Power percentiles over " + window_name + ": " + percentiles)
+        # Time weighted worst case, using the time of every sample, so dropped samples and timing jitter do not
+        # change the time each window covers
+        report = time_window_extremes (data_path, [100, 1000000], col_name, expected_sample_time=sample_time_us)
+        for window_name, result in zip (["100 uS", "1 Second"], report.results):
+            out_file.write("Time weighted active power over " + window_name + ": " + str(result.worst_case) + "uW\n")
+            print ("Time weighted active power over " + window_name + ": " + str(result.worst_case) + "uW")
+        if len(report.gaps) > 0:
+            out_file.write("Gaps in the trace: " + str(len(report.gaps)) + ", " +
+                           str(sum(gap.missing_samples for gap in report.gaps)) + " samples missing\n")
+            print ("Gaps in the trace: " + str(len(report.gaps)) + ", first at " + str(report.gaps[0].start_time) +
+                   "uS")
         # Spacing between results
         out_file.write("\n\n")
     
@@ -192,6 +216,7 @@ Reads the CSV and calculates a single worst case value for any window of the spe
 Return value is in the same units as the column data.
 Window time is in the same units as the time column.
 Assumes the first column is the time data.
+window_power.window_extremes() gives the same results for a list of windows in one pass, and is much faster.
 
 data_path               = The path of the CSV file to read.
 col_name                = The name of the column containing the data to process.
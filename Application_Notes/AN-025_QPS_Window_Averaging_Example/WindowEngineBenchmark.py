@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+AN-025 - Benchmark of the vectorised window averaging engine against active_power_calc()
+
+This script writes a synthetic trace in the QIS CSV format (with some empty values in the power column), then finds
+the worst case average power for a list of windows with active_power_calc() (once per window, as
+WindowAveragingExample.py did) and with window_power.py (the column loaded once, all windows in one pass).  The
+results must be identical, and the time of each method is reported.  No module is required.
+
+########### REQUIREMENTS ###########
+
+1- Python (3.x recommended)
+    https://www.python.org/downloads/
+2- Quarchpy python package (imported by WindowAveragingExample.py)
+    https://quarch.com/products/quarchpy-python-package/
+3- NumPy python package
+    pip install numpy
+
+########### INSTRUCTIONS ###########
+
+1- Run the script, optionally setting the trace size and the windows (in uS):
+    python WindowEngineBenchmark.py --size-mb 200 --windows 100 1000 100000 1000000
+2- Use --data to process an existing trace instead, with --column for the column name
+3- Use --skip-legacy on large files, to only time the engine
+4- Use --cache to also time a second run, with the column memory-mapped from the .npy cache
+
+####################################
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+
+from WindowAveragingExample import active_power_calc
+from window_power import load_column, window_extremes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorised window averaging engine")
+    parser.add_argument("--size-mb", type=int, default=50, help="Size of the synthetic trace to generate")
+    parser.add_argument("--windows", type=int, nargs="+", default=[100, 1000, 100000, 1000000],
+                        help="Window lengths in uS")
+    parser.add_argument("--data", help="Existing CSV trace to process instead of a synthetic trace")
+    parser.add_argument("--column", default="Tot uW", help="Name of the column to process")
+    parser.add_argument("--skip-legacy", action="store_true", help="Do not run active_power_calc()")
+    parser.add_argument("--cache", action="store_true", help="Cache the column, and time a run from the cache")
+    args = parser.parse_args()
+
+    print("\n\nQuarch application note example: AN-025 window engine benchmark")
+    print("-----------------------------------------------------------------\n")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_path = args.data
+        if data_path is None:
+            data_path = os.path.join(temp_dir, "trace.csv")
+            print("-Writing " + str(args.size_mb) + "MB synthetic trace")
+            write_synthetic_trace(data_path, args.size_mb * 1024 * 1024)
+        size_mb = os.path.getsize(data_path) / (1024 * 1024)
+
+        print("-Calculating with the vectorised engine")
+        start_time = time.perf_counter()
+        column = load_column(data_path, args.column, cache=args.cache)
+        load_time = time.perf_counter() - start_time
+        results = window_extremes(column, args.windows)
+        engine_time = time.perf_counter() - start_time
+
+        if args.cache:
+            print("-Calculating with the vectorised engine, from the cache")
+            start_time = time.perf_counter()
+            cached = window_extremes(load_column(data_path, args.column, cache=True), args.windows)
+            cached_time = time.perf_counter() - start_time
+            if cached != results:
+                raise ValueError("Results from the cached column do not match")
+
+        legacy = None
+        if not args.skip_legacy:
+            legacy = []
+            print("-Calculating with active_power_calc(), once per window")
+            start_time = time.perf_counter()
+            for window in args.windows:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    legacy.append(active_power_calc(data_path, args.column, window=window))
+            legacy_time = time.perf_counter() - start_time
+
+    print("\n####Results####")
+    print("Trace: {:.1f}MB, {} samples processed".format(size_mb, results[0].samples_processed))
+    for index, result in enumerate(results):
+        line = "Window {} uS ({} samples): worst case {}, best case {}".format(
+            result.window, result.window_samples, result.worst_case, result.best_case)
+        if legacy is not None:
+            line += ", active_power_calc() " + ("matches" if legacy[index] == result.worst_case else
+                                                "DIFFERS: " + str(legacy[index]))
+        print(line)
+    print("Engine: {:.2f} s ({:.2f} s loading the column, {:.1f} MB/s)".format(
+        engine_time, load_time, size_mb / engine_time))
+    if args.cache:
+        print("Engine from the cache: {:.3f} s".format(cached_time))
+    if legacy is not None:
+        print("active_power_calc(): {:.2f} s ({:.1f} MB/s), {:.0f}x slower".format(
+            legacy_time, size_mb * len(args.windows) / legacy_time, legacy_time / engine_time))
+    print("##############\n")
+    if legacy is not None and any(value != result.worst_case for value, result in zip(legacy, results)):
+        raise ValueError("Engine results do not match active_power_calc()")
+
+
+# Writes a synthetic trace in the QIS CSV format (each line ending with a delimiter), sampled every 4uS, with about 1
+# in 1000 power values empty
+def write_synthetic_trace(path, size_bytes):
+    rng = random.Random(1)
+    power = 8000000
+    line_time = 0
+    with open(path, "w") as file:
+        file.write("Time us,5V Voltage mV,5V Current uA,5V Power uW,12V Voltage mV,12V Current uA,12V Power uW,"
+                   "Tot uW,\n\n")
+        while file.tell() < size_bytes:
+            lines = []
+            for index in range(10000):
+                power = max(0, power + rng.randint(-20000, 20000))
+                total = "" if rng.random() < 0.001 else str(power)
+                lines.append("{},5000,{},{},12000,{},{},{},\n".format(
+                    line_time, power // 20000, power // 4, power // 16000, power * 3 // 4, total))
+                line_time += 4
+            file.write("".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Streaming percentile and histogram statistics of windowed power, for power budgeting from long traces.
+
+window_extremes() in window_power.py gives the single worst (and best) window average.  This module gives the
+distribution of the window averages instead, such as the p50, p95, p99 and p99.9 power over 100uS windows, in one
+pass over the trace and in bounded memory:
+
+1- PowerDigest is a histogram with logarithmically spaced bins, so any percentile is returned within a fixed relative
+   accuracy (0.1% by default) using a few thousand bins, however many values are added
+2- FixedHistogram counts values in bins with edges chosen up front, for plotting a power histogram
+3- window_statistics() reads a trace in blocks with TraceReader (or takes a column from load_column()), and adds the
+   average of every window of each length to a PowerDigest
+
+Both kinds of histogram are mergeable: digests of parts of a trace (or of traces processed in separate processes)
+can be combined with merge(), giving the same result as one digest of all the values.
+
+The windows are every run of 'window_samples' consecutive values, with empty values skipped as active_power_calc()
+skips them.  Unlike window_extremes(), the windows active_power_calc() does not check (such as the one ending on the
+value after an empty one) are included.
+"""
+import math
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import BLOCK_ROWS, TraceReader
+from window_sums import WindowSums
+from window_power import TraceColumn, read_first_times
+
+# Percentiles reported by default
+PERCENTILES = (50, 95, 99, 99.9)
+
+# Default relative accuracy of the percentiles from a PowerDigest
+RELATIVE_ACCURACY = 0.001
+
+# Statistics for one window length.  'digest' holds the window averages, 'histogram' is a FixedHistogram of them (or
+# None if no histogram edges were given)
+WindowStatistics = namedtuple("WindowStatistics", ("window", "window_samples", "digest", "histogram"))
+
+
+class PowerDigest:
+    '''
+    Mergeable histogram of values for percentiles, with logarithmically spaced bins.  Each bin covers values from
+    gamma^(k-1) to gamma^k, where gamma = (1 + relative_accuracy) / (1 - relative_accuracy), so the centre of the bin
+    holding a percentile is within relative_accuracy of the true value.  Negative values are held in a second set of
+    bins, and zero values are counted on their own.
+
+    relative_accuracy   = Relative accuracy of the percentiles, 0.001 for 0.1%
+    '''
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError ("Relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.__log_gamma = math.log(self.gamma)
+        self.__positive = _BinCounts()
+        self.__negative = _BinCounts()
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    # Adds an array of values
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        negative = values[values < 0]
+        self.__positive.add(self.__bin_indexes(positive))
+        self.__negative.add(self.__bin_indexes(-negative))
+        self.zero_count += len(values) - len(positive) - len(negative)
+        self.count += len(values)
+        self.total += float(values.sum())
+        block_min = float(values.min())
+        block_max = float(values.max())
+        self.min = block_min if self.min is None else min(self.min, block_min)
+        self.max = block_max if self.max is None else max(self.max, block_max)
+
+    # Adds the values of another digest, which must have the same relative accuracy
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError ("Digests with different relative accuracy cannot be merged")
+        self.__positive.merge(other.__positive)
+        self.__negative.merge(other.__negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    # Mean of the values added, or None if there are none
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else None
+
+    # Returns the value at percentile 'percent' (0 to 100), or None if no values have been added
+    def percentile(self, percent):
+        return self.percentiles([percent])[0]
+
+    # Returns the values at each percentile in 'percents', using the nearest rank
+    def percentiles(self, percents=PERCENTILES):
+        if self.count == 0:
+            return [None for _ in percents]
+        # Bins in order of value: negative bins from the largest magnitude, the zero count, then positive bins
+        negative_counts = self.__negative.counts[::-1]
+        counts = np.concatenate((negative_counts, [self.zero_count], self.__positive.counts))
+        cumulative = np.cumsum(counts)
+        results = []
+        for percent in percents:
+            if not 0 <= percent <= 100:
+                raise ValueError ("Percentiles must be from 0 to 100")
+            rank = min(max(math.ceil(percent / 100 * self.count), 1), self.count)
+            position = int(np.searchsorted(cumulative, rank))
+            if position < len(negative_counts):
+                index = self.__negative.offset + len(negative_counts) - 1 - position
+                value = -self.__bin_value(index)
+            elif position == len(negative_counts):
+                value = 0.0
+            else:
+                value = self.__bin_value(self.__positive.offset + position - len(negative_counts) - 1)
+            results.append(min(max(value, self.min), self.max))
+        return results
+
+    # Returns the counts of the values in the bins of 'edges' (numpy.histogram style), estimated from the digest bins.
+    # Each digest bin is counted at its centre value
+    def histogram(self, edges):
+        edges = np.asarray(edges, dtype=np.float64)
+        values = [self.__bin_value(self.__positive.offset + np.arange(len(self.__positive.counts))),
+                  -self.__bin_value(self.__negative.offset + np.arange(len(self.__negative.counts))), [0.0]]
+        weights = [self.__positive.counts, self.__negative.counts, [self.zero_count]]
+        counts, _ = np.histogram(np.concatenate(values), bins=edges, weights=np.concatenate(weights))
+        return counts.astype(np.int64)
+
+    # Returns the bin index of each positive value
+    def __bin_indexes(self, values):
+        return np.ceil(np.log(values) / self.__log_gamma).astype(np.int64)
+
+    # Returns the value at the centre of bin 'index', within relative_accuracy of every value in the bin
+    def __bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class FixedHistogram:
+    '''
+    Mergeable histogram with fixed bins, counting values as numpy.histogram() does.  Values outside the edges are
+    counted in 'below' and 'above'.
+
+    edges               = Bin edges, in increasing order
+    '''
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if len(self.edges) < 2 or np.any(np.diff(self.edges) <= 0):
+            raise ValueError ("Histogram edges must be at least 2 increasing values")
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    # Adds an array of values
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        counts, _ = np.histogram(values, bins=self.edges)
+        self.counts += counts
+        self.below += int(np.count_nonzero(values < self.edges[0]))
+        self.above += int(np.count_nonzero(values > self.edges[-1]))
+
+    # Adds the counts of another histogram with the same edges
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError ("Histograms with different edges cannot be merged")
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+        return self
+
+
+'''
+Calculates the distribution of the window averages of a column, for each window length in 'windows', in one pass.
+Returns a WindowStatistics for each window length, in the order given.
+
+source                  = The path of the CSV file to read, or a TraceColumn from load_column().
+windows                 = List of window time spans, in the same units as the CSV time column.
+col_name                = The name of the column containing the data to process, if 'source' is a path.
+csv_delimiter           = The delimiter character used in the CSV file.
+expected_sample_time    = Optional value for the sample time of the file, otherwise measured from the first 2 lines.
+relative_accuracy       = Relative accuracy of the percentiles.
+histogram_edges         = Optional bin edges, to also count the window averages in a FixedHistogram.
+block_rows              = Number of values processed at once.
+'''
+def window_statistics (source, windows, col_name="Tot uW", csv_delimiter=",", expected_sample_time=-1,
+                       relative_accuracy=RELATIVE_ACCURACY, histogram_edges=None, block_rows=BLOCK_ROWS):
+    if isinstance(source, TraceColumn):
+        first_times = source.first_times
+        blocks = (source.values[start:start + block_rows] for start in range(0, len(source.values), block_rows))
+    else:
+        first_times = read_first_times(source, csv_delimiter) if expected_sample_time == -1 else None
+        blocks = _column_values(source, col_name, csv_delimiter, block_rows)
+
+    if expected_sample_time == -1:
+        if len(first_times) < 2:
+            raise ValueError ("At least 2 data lines are needed to measure the sample time")
+        time_step = first_times[1] - first_times[0]
+    else:
+        time_step = expected_sample_time
+
+    statistics = []
+    for window in windows:
+        samples = int(window / time_step)
+        if samples == 0:
+            raise ValueError ("Window size of 0 stripes calculated, check your window parameter")
+        statistics.append(WindowStatistics(window, samples, PowerDigest(relative_accuracy),
+                                           None if histogram_edges is None else FixedHistogram(histogram_edges)))
+
+    # The windows that span two blocks are carried over by WindowSums
+    window_sums = [WindowSums(window_stats.window_samples) for window_stats in statistics]
+    for values in blocks:
+        for window_stats, sums in zip(statistics, window_sums):
+            averages = sums.add(values) / window_stats.window_samples
+            if len(averages) > 0:
+                window_stats.digest.add(averages)
+                if window_stats.histogram is not None:
+                    window_stats.histogram.add(averages)
+    return statistics
+
+
+# Yields the values of one column of a trace that are not empty, in blocks
+def _column_values (data_path, col_name, csv_delimiter, block_rows):
+    with TraceReader(data_path, columns=[col_name], delimiter=csv_delimiter, block_rows=block_rows) as reader:
+        col_name = reader.columns[0]
+        for block in reader:
+            values = block.columns[col_name]
+            if block.missing[col_name] is not None:
+                values = values[~block.missing[col_name]]
+            yield values
+
+
+class _BinCounts:
+    '''
+    Counts of values in consecutive bins, from bin 'offset', grown as values are added to new bins
+    '''
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    # Adds one count to each bin in 'indexes'
+    def add(self, indexes):
+        if len(indexes) == 0:
+            return
+        self.__add_counts(int(indexes.min()), np.bincount(indexes - indexes.min()))
+
+    # Adds the counts of another set of bins
+    def merge(self, other):
+        if len(other.counts) > 0:
+            self.__add_counts(other.offset, other.counts)
+
+    def __add_counts(self, offset, counts):
+        if len(self.counts) == 0:
+            self.offset = offset
+            self.counts = np.array(counts, dtype=np.int64)
+            return
+        start = min(self.offset, offset)
+        end = max(self.offset + len(self.counts), offset + len(counts))
+        if start != self.offset or end != self.offset + len(self.counts):
+            grown = np.zeros(end - start, dtype=np.int64)
+            grown[self.offset - start:self.offset - start + len(self.counts)] = self.counts
+            self.offset = start
+            self.counts = grown
+        self.counts[offset - self.offset:offset - self.offset + len(counts)] += counts
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Time-aware window averaging of a QPS / QIS CSV trace, using the time column of every sample.
+
+active_power_calc() and window_extremes() size each window as a number of samples, from the time between the first
+two lines (or the expected sample time), and skip empty values.  If samples are dropped, or the time column has
+jitter, a window of N samples no longer covers the window time.  This module weights each sample by the time it
+covers instead:
+
+1- Each sample covers the time since the sample before it, so with a regular time column a window of N sample times
+   holds exactly N samples, and the results match the sample count based functions
+2- An interval longer than 'gap_factor' sample times is a gap: the sample after it only covers one sample time, and
+   the rest of the interval is not covered.  An empty value covers no time.  Each gap is reported
+3- The average of a window is the integral of the power over the time covered in the window, divided by that time,
+   including the part of the sample that crosses the start of the window.  Windows covering less than
+   'min_coverage' of the window time (such as one spanning a long gap) are not checked
+
+time_window_extremes() processes a trace file in blocks, with running cumulative sums of power x time and of the time
+covered, so each window is the difference of two sums, found with a binary search on the time column.
+TimeWindowTracker gives the same window averages one sample at a time (for a live stream), with running sums and a
+monotonic deque for the largest sample in the window, in constant amortised time per sample.
+"""
+import os
+import sys
+from collections import deque, namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import BLOCK_ROWS, TraceReader
+from window_sums import combine
+
+# Intervals longer than this many sample times are gaps
+GAP_FACTOR = 1.5
+
+# Least part of the window time a window must cover to be checked
+MIN_COVERAGE = 0.5
+
+# Result for one window time.  'worst_case' and 'best_case' are the largest and smallest time weighted window average
+# (None if no window was checked), and the end times of those windows
+TimeWindowResult = namedtuple("TimeWindowResult", ("window", "worst_case", "worst_end_time", "best_case",
+                                                   "best_end_time", "windows_checked"))
+
+# Time not covered by the trace, from 'start_time' to 'end_time', holding about 'missing_samples' samples
+TraceGap = namedtuple("TraceGap", ("start_time", "end_time", "missing_samples"))
+
+# Results of time_window_extremes().  'sample_time' is the nominal time between samples, and 'min_interval' and
+# 'max_interval' the range of the intervals that are not gaps, showing any jitter
+TimeWindowReport = namedtuple("TimeWindowReport", ("results", "gaps", "samples", "sample_time", "min_interval",
+                                                   "max_interval"))
+
+
+'''
+Calculates the worst case (largest) and best case (smallest) time weighted average over any window ending on a
+sample, for each window time in 'windows', in one pass over a trace.  Returns a TimeWindowReport.
+
+data_path               = The path of the CSV file to read.
+windows                 = List of window time spans, in the same units as the CSV time column.
+col_name                = The name of the column containing the data to process.
+csv_delimiter           = The delimiter character used in the CSV file.
+expected_sample_time    = Optional value for the nominal sample time, otherwise the median interval of the first block.
+gap_factor              = Intervals longer than this many sample times are gaps.
+min_coverage            = Least part of the window time (0 to 1) a window must cover to be checked.
+block_rows              = Number of lines processed at once.
+'''
+def time_window_extremes (data_path, windows, col_name="Tot uW", csv_delimiter=",", expected_sample_time=-1,
+                          gap_factor=GAP_FACTOR, min_coverage=MIN_COVERAGE, block_rows=BLOCK_ROWS):
+    with TraceReader(data_path, delimiter=csv_delimiter) as header:
+        if len(header.names) == 0:
+            raise ValueError ("File does not contain any named columns")
+        time_column = header.names[0]
+
+    engine = None
+    with TraceReader(data_path, columns=[time_column, col_name], delimiter=csv_delimiter,
+                     block_rows=block_rows) as reader:
+        col_name = reader.columns[1]
+        for block in reader:
+            times = block.columns[time_column]
+            if block.missing[time_column] is not None:
+                raise ValueError ("Time column has an empty value on data row " +
+                                  str(block.first_row + int(np.flatnonzero(block.missing[time_column])[0])))
+            if engine is None:
+                if expected_sample_time == -1:
+                    if len(times) < 2:
+                        raise ValueError ("At least 2 data lines are needed to measure the sample time")
+                    sample_time = np.median(np.diff(times))
+                    sample_time = int(sample_time) if sample_time == int(sample_time) else float(sample_time)
+                else:
+                    sample_time = expected_sample_time
+                engine = _TimeWindows(windows, sample_time, gap_factor, min_coverage)
+            engine.add(block.first_row, times, block.columns[col_name], block.missing[col_name])
+
+    if engine is None:
+        return TimeWindowReport([TimeWindowResult(window, None, None, None, None, 0) for window in windows], [], 0,
+                                None if expected_sample_time == -1 else expected_sample_time, None, None)
+    return engine.report()
+
+
+class TimeWindowTracker:
+    '''
+    Time weighted average over one window time ending on the latest sample, updated one sample at a time, for a live
+    stream.  The samples are weighted as in time_window_extremes(), which returns the same averages for a file.
+
+    window          = Window time span, in the units of the sample times
+    sample_time     = Nominal time between samples
+    gap_factor      = Intervals longer than this many sample times are gaps
+    min_coverage    = Least part of the window time (0 to 1) the window must cover for an average
+    '''
+    def __init__(self, window, sample_time, gap_factor=GAP_FACTOR, min_coverage=MIN_COVERAGE):
+        if window <= 0 or sample_time <= 0:
+            raise ValueError ("Window and sample time must be greater than 0")
+        self.window = window
+        self.sample_time = sample_time
+        self.gap_limit = sample_time * gap_factor
+        self.min_coverage = min_coverage
+        # Number of samples after a gap, or with an empty value
+        self.gaps = 0
+        self.samples = 0
+        # Samples covering the window as (time, covered time, value), and the sums of covered time x value and of
+        # covered time over them
+        self.__segments = deque()
+        self.__integral = 0
+        self.__covered = 0
+        # Samples that may be the largest in the window, as (time, value) with decreasing values
+        self.__peaks = deque()
+        self.__last_time = None
+        self.__start_time = None
+
+    # Adds the next sample (the value is None if empty), returning the window average or None if the window does not
+    # cover enough of the window time
+    def push(self, time, value):
+        if self.__last_time is None:
+            interval = self.sample_time
+            self.__start_time = time - interval
+        else:
+            interval = time - self.__last_time
+            if interval < 0:
+                raise ValueError ("Sample times must not decrease")
+        self.__last_time = time
+        self.samples += 1
+        if interval > self.gap_limit:
+            interval = self.sample_time
+            self.gaps += 1
+        if value is None:
+            self.gaps += 1
+            covered = 0
+            value = 0
+        else:
+            covered = interval
+            while len(self.__peaks) > 0 and self.__peaks[-1][1] <= value:
+                self.__peaks.pop()
+            self.__peaks.append((time, value))
+        self.__segments.append((time, covered, value))
+        self.__integral += covered * value
+        self.__covered += covered
+
+        # Remove the samples that end before the window starts
+        start = time - self.window
+        while self.__segments[0][0] <= start:
+            old_time, old_covered, old_value = self.__segments.popleft()
+            self.__integral -= old_covered * old_value
+            self.__covered -= old_covered
+        while len(self.__peaks) > 0 and self.__peaks[0][0] <= start:
+            self.__peaks.popleft()
+        if start < self.__start_time:
+            return None
+
+        # Less the part of the first sample before the window starts
+        first_time, first_covered, first_value = self.__segments[0]
+        outside = first_covered - min(first_covered, first_time - start)
+        covered = self.__covered - outside
+        if covered <= 0 or covered < self.min_coverage * self.window:
+            return None
+        return (self.__integral - outside * first_value) / covered
+
+    # Largest sample value in the window, or None if there is none
+    @property
+    def peak(self):
+        return self.__peaks[0][1] if len(self.__peaks) > 0 else None
+
+
+class _TimeWindows:
+    '''
+    Running state of time_window_extremes(), with blocks of samples added in order
+    '''
+    def __init__(self, windows, sample_time, gap_factor, min_coverage):
+        if sample_time <= 0:
+            raise ValueError ("Sample time must be greater than 0")
+        self.windows = list(windows)
+        for window in self.windows:
+            if window <= 0:
+                raise ValueError ("Window size must be greater than 0")
+        self.sample_time = sample_time
+        self.gap_limit = sample_time * gap_factor
+        self.min_coverage = min_coverage
+        self.extremes = [[None, None, None, None, 0] for _ in self.windows]
+        self.samples = 0
+        self.min_interval = None
+        self.max_interval = None
+        # Sample rows with a gap before them or an empty value: (row, time before, time, time not covered)
+        self.gap_rows = []
+        self.start_time = None
+        self.last_time = None
+        # Samples that windows ending in later blocks can start in: times, covered time, values, and cumulative sums
+        # of covered time x value and of covered time
+        self.carry = None
+
+    # Adds a block of samples.  'missing' is True where the value is empty, or None
+    def add(self, first_row, times, values, missing):
+        if len(times) == 0:
+            return
+        exact = times.dtype.kind == "i" and values.dtype.kind == "i" and all(
+            float(window) == int(window) for window in self.windows) and float(self.sample_time) == int(
+            self.sample_time)
+        dtype = np.int64 if exact else np.float64
+
+        if self.start_time is None:
+            self.start_time = times[0] - self.sample_time
+            previous = times[0] - self.sample_time
+        else:
+            previous = self.last_time
+        intervals = np.diff(times, prepend=previous).astype(dtype)
+        if np.any(intervals < 0):
+            raise ValueError ("Time column decreases on data row " +
+                              str(first_row + int(np.flatnonzero(intervals < 0)[0])))
+        gaps = intervals > self.gap_limit
+        covered = np.where(gaps, dtype(self.sample_time), intervals)
+        regular = intervals[~gaps]
+        if len(regular) > 0:
+            self.min_interval = combine(min, self.min_interval, regular.min().item())
+            self.max_interval = combine(max, self.max_interval, regular.max().item())
+        if missing is not None:
+            covered[missing] = 0
+            values = np.where(missing, 0, values)
+            gaps |= missing
+        gap_rows = np.flatnonzero(gaps)
+        if len(gap_rows) > 0:
+            before = np.concatenate(([previous], times[:-1]))
+            self.gap_rows.append((gap_rows + first_row, before[gap_rows], times[gap_rows],
+                                  intervals[gap_rows] - covered[gap_rows]))
+
+        values = values.astype(dtype)
+        integral = np.cumsum(covered * values)
+        total = np.cumsum(covered)
+        if self.carry is not None and len(self.carry[0]) > 0:
+            carry_times, carry_covered, carry_values, carry_integral, carry_total = self.carry
+            integral += carry_integral[-1].astype(dtype)
+            total += carry_total[-1].astype(dtype)
+            new_start = len(carry_times)
+            times = np.concatenate((carry_times, times))
+            covered = np.concatenate((carry_covered.astype(dtype), covered))
+            values = np.concatenate((carry_values.astype(dtype), values))
+            integral = np.concatenate((carry_integral.astype(dtype), integral))
+            total = np.concatenate((carry_total.astype(dtype), total))
+        else:
+            new_start = 0
+        self.samples += len(times) - new_start
+
+        for index, window in enumerate(self.windows):
+            ends = np.arange(new_start, len(times))
+            starts = times[ends] - (dtype(window) if exact else window)
+            checked = starts >= self.start_time
+            ends = ends[checked]
+            starts = starts[checked]
+            if len(ends) == 0:
+                continue
+            # First sample ending after the window starts, and the part of it inside the window
+            firsts = np.searchsorted(times, starts, side="right")
+            inside = np.minimum(covered[firsts], times[firsts] - starts)
+            window_covered = total[ends] - total[firsts] + inside
+            window_integral = integral[ends] - integral[firsts] + inside * values[firsts]
+            checked = (window_covered > 0) & (window_covered >= self.min_coverage * window)
+            if not checked.any():
+                continue
+            averages = window_integral[checked] / window_covered[checked]
+            end_times = times[ends[checked]]
+            worst = int(np.argmax(averages))
+            best = int(np.argmin(averages))
+            extremes = self.extremes[index]
+            if extremes[0] is None or averages[worst] > extremes[0]:
+                extremes[0], extremes[1] = float(averages[worst]), end_times[worst].item()
+            if extremes[2] is None or averages[best] < extremes[2]:
+                extremes[2], extremes[3] = float(averages[best]), end_times[best].item()
+            extremes[4] += len(averages)
+
+        # Windows ending after this block start after (last time - longest window)
+        self.last_time = times[-1]
+        keep = int(np.searchsorted(times, times[-1] - max(self.windows), side="right"))
+        self.carry = (times[keep:], covered[keep:], values[keep:], integral[keep:], total[keep:])
+
+    def report(self):
+        results = [TimeWindowResult(window, worst_case, worst_end, best_case, best_end, checked)
+                   for window, (worst_case, worst_end, best_case, best_end, checked) in zip(self.windows,
+                                                                                            self.extremes)]
+        return TimeWindowReport(results, self.__gaps(), self.samples, self.sample_time, self.min_interval,
+                                self.max_interval)
+
+    # Returns the gaps, joining the gaps of consecutive rows
+    def __gaps(self):
+        if len(self.gap_rows) == 0:
+            return []
+        rows, before, times, missing = (np.concatenate(part) for part in zip(*self.gap_rows))
+        # Each run of consecutive rows is one gap, from the time before its first row to the start of the time covered
+        # by its last row
+        run_starts = np.flatnonzero(np.diff(rows, prepend=rows[0] - 2) != 1)
+        run_ends = np.append(run_starts[1:], len(rows)) - 1
+        missing_time = np.add.reduceat(missing, run_starts)
+        end_times = before[run_ends] + missing[run_ends]
+        return [TraceGap(before[start].item(), end_time.item(), int(round(float(lost) / self.sample_time)))
+                for start, end_time, lost in zip(run_starts, end_times, missing_time)]
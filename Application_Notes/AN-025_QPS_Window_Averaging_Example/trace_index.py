@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Time-range index of a QPS / QIS CSV trace, for reading part of a large trace without parsing the data before it.
+
+A CSV line has no fixed length, so finding the data at a given time normally means reading every line before it.
+build_index() reads the trace once and saves a small sidecar file next to it ('<trace>.index.npz'), holding the byte
+offset and time of every N'th data line.  TraceIndex then finds the lines either side of any time with a binary
+search, and TraceReader starts reading from the nearest offset:
+
+1- read_range() returns the rows from time t0 up to time t1, reading only about N rows outside the range
+2- read_section() returns the rows of a test section, where each section runs from one annotation (a time and a label,
+   such as the times a test script logged the start of each workload) to the next
+3- The index records the size and modification time of the trace, and open_index() builds it again if the trace has
+   changed since
+
+The time column must not decrease from one line to the next, as in every QPS and QIS trace.
+
+Example:
+    index = open_index("RawData.csv", annotations=[(0, "Idle"), (2000000, "Write"), (5000000, "Read")])
+    block = index.read(2000000, 3000000, columns=["Tot uW"])
+    for block in index.read_section("Read", columns=["Tot uW"]):
+        ...
+"""
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import BLOCK_ROWS, CHUNK_BYTES, TraceBlock, TraceReader
+
+# Default number of data lines between index entries.  The sidecar file uses 16 bytes per entry
+INDEX_ROWS = 4096
+
+# Smallest chunk read when a range is read from the trace
+MIN_CHUNK_BYTES = 64 * 1024
+
+# Test section of a trace, from the time of one annotation up to the next ('end_time' is None for the last section)
+TraceSection = namedtuple("TraceSection", ("label", "start_time", "end_time"))
+
+
+'''
+Reads a CSV trace once and saves its time-range index next to it, as '<data_path>.index.npz'.  Returns the TraceIndex.
+
+data_path               = The path of the CSV file to index.
+every_rows              = Number of data lines between index entries.  Fewer rows give faster seeking with a larger
+                          index.
+csv_delimiter           = The delimiter character used in the CSV file.
+annotations             = Optional list of (time, label) pairs marking the start of each test section.
+time_column             = Name of the time column, the first column if None.
+'''
+def build_index (data_path, every_rows=INDEX_ROWS, csv_delimiter=",", annotations=None, time_column=None):
+    source = os.stat(data_path)
+    if time_column is None:
+        with TraceReader(data_path, delimiter=csv_delimiter) as header:
+            if len(header.names) == 0:
+                raise ValueError ("File does not contain any named columns")
+            time_column = header.names[0]
+
+    rows = []
+    offsets = []
+    times = []
+    last_time = None
+    monotonic = True
+    with TraceReader(data_path, columns=[time_column], delimiter=csv_delimiter, block_rows=every_rows,
+                     row_offsets=True) as reader:
+        time_column = reader.columns[0]
+        for block in reader:
+            block_times = block.columns[time_column]
+            if block.missing[time_column] is not None:
+                raise ValueError ("Time column has an empty value on data row " +
+                                  str(block.first_row + int(np.flatnonzero(block.missing[time_column])[0])))
+            if monotonic and ((last_time is not None and block_times[0] < last_time) or
+                              np.any(np.diff(block_times) < 0)):
+                monotonic = False
+            rows.append(block.first_row)
+            offsets.append(int(block.offsets[0]))
+            times.append(block_times[0])
+            last_time = block_times[-1]
+        total_rows = reader.rows
+
+    annotations = sorted(annotations or [], key=lambda annotation: annotation[0])
+    np.savez(index_path(data_path), rows=np.array(rows, dtype=np.int64), offsets=np.array(offsets, dtype=np.int64),
+             times=np.array(times, dtype=np.float64), total_rows=total_rows,
+             last_time=np.nan if last_time is None else float(last_time),
+             monotonic=monotonic, every_rows=every_rows, time_column=time_column, delimiter=csv_delimiter,
+             source_size=source.st_size, source_mtime=source.st_mtime_ns,
+             annotation_times=np.array([annotation[0] for annotation in annotations], dtype=np.float64),
+             annotation_labels=np.array([str(annotation[1]) for annotation in annotations], dtype=np.str_))
+    return TraceIndex(data_path)
+
+
+'''
+Returns the TraceIndex of a CSV trace, building it first if there is no index, or the trace has changed since it was
+built.  The index is also built again if different settings or annotations are given, keeping the saved annotations
+if 'annotations' is None.
+
+data_path               = The path of the CSV file.
+every_rows              = Number of data lines between index entries, if the index is built.
+csv_delimiter           = The delimiter character used in the CSV file.
+annotations             = Optional list of (time, label) pairs marking the start of each test section.  The
+                          annotations saved in the index are used if None.
+time_column             = Name of the time column, the first column if None.
+'''
+def open_index (data_path, every_rows=INDEX_ROWS, csv_delimiter=",", annotations=None, time_column=None):
+    if os.path.exists(index_path(data_path)):
+        index = TraceIndex(data_path)
+        if annotations is None:
+            annotations = [(section.start_time, section.label) for section in index.sections]
+        if (not index.is_stale() and index.every_rows == every_rows and index.delimiter == csv_delimiter and
+                (time_column is None or index.time_column == time_column) and
+                index.sections == _sections(sorted(annotations, key=lambda annotation: annotation[0]))):
+            return index
+    return build_index(data_path, every_rows, csv_delimiter, annotations, time_column)
+
+
+'''
+Returns the saved TraceIndex of a CSV trace, or None if there is no index or the trace has changed since it was built.
+
+data_path               = The path of the CSV file.
+'''
+def load_index (data_path):
+    if not os.path.exists(index_path(data_path)):
+        return None
+    index = TraceIndex(data_path)
+    return None if index.is_stale() else index
+
+
+# Returns the path of the index file of a trace
+def index_path (data_path):
+    return data_path + ".index.npz"
+
+
+class TraceIndex:
+    '''
+    Time-range index of a CSV trace, loaded from the file saved by build_index().  Use open_index() to check the index
+    is up to date, or is_stale() if the trace may have changed since.
+
+    data_path       = Path of the CSV file
+    '''
+    def __init__(self, data_path):
+        self.data_path = data_path
+        with np.load(index_path(data_path)) as saved:
+            self.rows = saved["rows"]
+            self.offsets = saved["offsets"]
+            self.times = saved["times"]
+            self.total_rows = int(saved["total_rows"])
+            self.last_time = float(saved["last_time"])
+            self.monotonic = bool(saved["monotonic"])
+            self.every_rows = int(saved["every_rows"])
+            self.time_column = str(saved["time_column"])
+            self.delimiter = str(saved["delimiter"])
+            self.__source_size = int(saved["source_size"])
+            self.__source_mtime = int(saved["source_mtime"])
+            self.sections = _sections(list(zip(saved["annotation_times"].tolist(),
+                                               saved["annotation_labels"].tolist())))
+
+    # True if the trace has changed (or been removed) since the index was built
+    def is_stale(self):
+        try:
+            source = os.stat(self.data_path)
+        except OSError:
+            return True
+        return source.st_size != self.__source_size or source.st_mtime_ns != self.__source_mtime
+
+    # Returns (row, offset) of the index entry to start reading from for the rows at or after 'time': the last entry
+    # before 'time', so no row at 'time' comes before it
+    def locate(self, time):
+        entry = max(int(np.searchsorted(self.times, time, side="left")) - 1, 0)
+        if len(self.rows) == 0:
+            return 0, self.__source_size
+        return int(self.rows[entry]), int(self.offsets[entry])
+
+    # Yields the blocks of rows with a time from 't0' up to (not including) 't1'.  The time column is always read,
+    # before any other 'columns' (every column if None).  't0' or 't1' may be None for the start or end of the trace
+    def read_range(self, t0=None, t1=None, columns=None, block_rows=BLOCK_ROWS):
+        if not self.monotonic:
+            raise ValueError ("The time column of the trace decreases, so it cannot be read by time")
+        if self.is_stale():
+            raise ValueError ("The trace has changed since the index was built, open the index again")
+        if t0 is not None and t1 is not None and t1 <= t0:
+            return
+        start_row, start_offset = self.locate(-np.inf if t0 is None else t0)
+        # Every row from the first index entry at or after 't1' is past the range.  Blocks and chunks no larger than
+        # the rows and bytes before that entry are read, so a short range reads little more than its own rows
+        end_entry = len(self.offsets) if t1 is None else int(np.searchsorted(self.times, t1, side="left"))
+        if end_entry < len(self.offsets):
+            end_row, end_offset = int(self.rows[end_entry]), int(self.offsets[end_entry])
+        else:
+            end_row, end_offset = self.total_rows, self.__source_size
+        chunk_bytes = min(CHUNK_BYTES, max(end_offset - start_offset, MIN_CHUNK_BYTES))
+        block_rows = min(block_rows, max(end_row - start_row, 1))
+
+        if columns is None:
+            with TraceReader(self.data_path, delimiter=self.delimiter) as header:
+                columns = header.names
+        columns = [self.time_column] + [name for name in columns if name.strip().strip("\"") != self.time_column]
+        with TraceReader(self.data_path, columns=columns, delimiter=self.delimiter, block_rows=block_rows,
+                         chunk_bytes=chunk_bytes, start_offset=start_offset, start_row=start_row) as reader:
+            for block in reader:
+                times = block.columns[self.time_column]
+                start = 0 if t0 is None else int(np.searchsorted(times, t0, side="left"))
+                end = len(times) if t1 is None else int(np.searchsorted(times, t1, side="left"))
+                if start < end:
+                    yield _slice_block(block, start, end)
+                if end < len(times) or block.first_row + len(times) >= end_row:
+                    break
+
+    # Returns the rows with a time from 't0' up to (not including) 't1' as one TraceBlock
+    def read(self, t0=None, t1=None, columns=None):
+        blocks = list(self.read_range(t0, t1, columns))
+        if len(blocks) == 1:
+            return blocks[0]
+        if len(blocks) == 0:
+            with TraceReader(self.data_path, columns=columns, delimiter=self.delimiter) as reader:
+                names = [self.time_column] + [name for name in reader.columns if name != self.time_column]
+            return TraceBlock(self.total_rows, {name: np.zeros(0, dtype=np.int64) for name in names},
+                              {name: None for name in names})
+        names = list(blocks[0].columns)
+        missing = {}
+        for name in names:
+            if all(block.missing[name] is None for block in blocks):
+                missing[name] = None
+            else:
+                missing[name] = np.concatenate([np.zeros(len(block.columns[name]), dtype=bool)
+                                                if block.missing[name] is None else block.missing[name]
+                                                for block in blocks])
+        return TraceBlock(blocks[0].first_row,
+                          {name: np.concatenate([block.columns[name] for block in blocks]) for name in names},
+                          missing)
+
+    # Yields the blocks of rows in the test section with 'label' (or at position 'label' in 'sections', if a number)
+    def read_section(self, label, columns=None, block_rows=BLOCK_ROWS):
+        section = self.section(label)
+        return self.read_range(section.start_time, section.end_time, columns, block_rows)
+
+    # Returns the TraceSection with 'label', or at position 'label' in 'sections' if a number
+    def section(self, label):
+        if isinstance(label, int):
+            return self.sections[label]
+        for section in self.sections:
+            if section.label == label:
+                return section
+        raise ValueError ("The index does not have a section labelled: " + str(label))
+
+
+# Returns the sections between each of the sorted (time, label) annotations
+def _sections (annotations):
+    sections = []
+    for position, (time, label) in enumerate(annotations):
+        end_time = annotations[position + 1][0] if position + 1 < len(annotations) else None
+        sections.append(TraceSection(str(label), time, end_time))
+    return sections
+
+
+# Returns rows 'start' to 'end' of a block
+def _slice_block (block, start, end):
+    if start == 0 and end == len(next(iter(block.columns.values()))):
+        return block
+    missing = {}
+    for name, empty in block.missing.items():
+        missing[name] = None if empty is None or not empty[start:end].any() else empty[start:end]
+    return TraceBlock(block.first_row + start, {name: values[start:end] for name, values in block.columns.items()},
+                      missing, None if block.offsets is None else block.offsets[start:end])
+
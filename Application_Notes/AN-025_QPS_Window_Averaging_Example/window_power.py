@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Vectorised worst case (and best case) window averaging of a QPS / QIS CSV trace.
+
+active_power_calc() in WindowAveragingExample.py reads and splits every line of the file in Python, once for each
+window length.  This module does the same calculation with NumPy:
+
+1- load_column() reads the chosen column once with TraceReader (trace_reader.py), in large chunks parsed with array
+   operations, into an int64 array (8 bytes per sample, much smaller than the CSV text).  With cache=True the column is also saved next to
+   the CSV as a .npy file, which later calls memory-map instead of parsing the CSV again
+2- window_extremes() takes the column and any list of window lengths, and finds the largest and smallest window sum
+   for every window length from a running cumulative sum, processed in blocks so memory use stays bounded
+
+The results match active_power_calc() exactly, including the windows it checks: the first full window is not
+checked, nor is a window ending on the first value after an empty one.  Windows of 1 or 2 samples include the first
+two samples on their own, as active_power_calc() does.
+"""
+import math
+import os
+import re
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import CHUNK_BYTES, TraceReader
+
+# Number of window end points calculated at once in window_extremes()
+BLOCK_ROWS = 1 << 22
+
+# Column loaded from a trace.  'values' holds every value that is not empty, in file order.  'empty_lines' holds the
+# line number of each empty value, and 'lines' the number of data lines, both counted from the first data line.
+# 'first_times' holds the times of the first two data lines
+TraceColumn = namedtuple("TraceColumn", ("name", "values", "empty_lines", "lines", "first_times"))
+
+# Result for one window length.  'worst_case' and 'best_case' are the largest and smallest window average (None for
+# best_case if no window was checked), in the units of the column
+WindowResult = namedtuple("WindowResult", ("window", "window_samples", "worst_case", "best_case",
+                                           "samples_processed"))
+
+
+'''
+Reads one column of a CSV trace into a TraceColumn.  The file must have a header line containing the column name
+(optionally quoted), which may be followed by blank lines before the data.  The data ends at the end of the file, at
+the first blank line or at a STATISTICS footer.
+
+data_path               = The path of the CSV file to read.
+col_name                = The name of the column containing the data to process.
+csv_delimiter           = The delimiter character used in the CSV file.
+chunk_bytes             = Size of each chunk of the file read at once.
+cache                   = True to save the column next to the CSV, and memory-map it on later calls.  The cache is
+                          not used if the CSV size or modification time has changed.
+'''
+def load_column (data_path, col_name="Tot uW", csv_delimiter=",", chunk_bytes=CHUNK_BYTES, cache=False):
+    cache_base = data_path + "." + re.sub("[^0-9A-Za-z]+", "_", col_name.strip("\"")).strip("_").lower()
+    if cache:
+        column = _load_cache(cache_base, data_path, col_name, csv_delimiter)
+        if column is not None:
+            return column
+
+    # The time of the first 2 data lines gives the sample time
+    first_times = read_first_times(data_path, csv_delimiter)
+
+    value_blocks = []
+    empty_blocks = []
+    with TraceReader(data_path, columns=[col_name], delimiter=csv_delimiter, dtypes={col_name: np.int64},
+                     chunk_bytes=chunk_bytes) as reader:
+        col_name = reader.columns[0]
+        for block in reader:
+            values = block.columns[col_name]
+            empty = block.missing[col_name]
+            if empty is None:
+                value_blocks.append(values)
+            else:
+                value_blocks.append(values[~empty])
+                empty_blocks.append(np.flatnonzero(empty) + block.first_row)
+        lines = reader.rows
+
+    column = TraceColumn(col_name, np.concatenate(value_blocks) if value_blocks else np.zeros(0, dtype=np.int64),
+                         np.concatenate(empty_blocks) if empty_blocks else np.zeros(0, dtype=np.int64), lines,
+                         tuple(first_times))
+    if cache:
+        _save_cache(cache_base, data_path, column, csv_delimiter)
+    return column
+
+
+'''
+Returns the times (first column) of the first 2 data lines of a CSV trace, as integers.  Fewer are returned if the
+trace is shorter.
+
+data_path               = The path of the CSV file to read.
+csv_delimiter           = The delimiter character used in the CSV file.
+'''
+def read_first_times (data_path, csv_delimiter=","):
+    with TraceReader(data_path, delimiter=csv_delimiter, block_rows=2, chunk_bytes=4096) as reader:
+        first_block = next(iter(reader), None)
+        return [] if first_block is None else [int(time) for time in first_block.columns[reader.names[0]]]
+
+
+'''
+Calculates the worst case (largest) and best case (smallest) average over any window of each length in 'windows',
+in one pass over the column.  The parameters match active_power_calc(), and the worst case results are the values it
+returns.  Returns a WindowResult for each window length, in the order given.
+
+column                  = TraceColumn from load_column().
+windows                 = List of window time spans, in the same units as the CSV time column.
+max_calc_time           = Optional value for the end time, if you do not wish to process the whole file.
+expected_sample_time    = Optional value for the sample time of the file, otherwise measured from the first 2 lines.
+block_rows              = Number of window end points calculated at once.
+'''
+def window_extremes (column, windows, max_calc_time=-1, expected_sample_time=-1, block_rows=BLOCK_ROWS):
+    if expected_sample_time == -1:
+        if len(column.first_times) < 2:
+            raise ValueError ("At least 2 data lines are needed to measure the sample time")
+        time_step = column.first_times[1] - column.first_times[0]
+    else:
+        time_step = expected_sample_time
+
+    window_samples = []
+    for window in windows:
+        samples = int(window / time_step)
+        if (samples == 0):
+            raise ValueError ("Window size of 0 stripes calculated, check your window parameter")
+        if (max_calc_time != -1 and max_calc_time < window):
+            raise ValueError ("Window size is greater than the data to process")
+        window_samples.append(samples)
+
+    # Lines processed: the first 2, then up to the stop time, as active_power_calc() stops at the first value that
+    # is not empty once the stop sample is reached
+    lines = column.lines
+    empty_lines = column.empty_lines
+    stop_at_sample = max_calc_time / time_step if max_calc_time != -1 else 0
+    if stop_at_sample != 0:
+        stop_line = max(1, math.ceil(stop_at_sample)) + 1
+        empty_pos = np.searchsorted(empty_lines, stop_line)
+        while empty_pos < len(empty_lines) and empty_lines[empty_pos] == stop_line:
+            stop_line += 1
+            empty_pos += 1
+        lines = min(lines, stop_line + 1)
+    empty_lines = empty_lines[:np.searchsorted(empty_lines, lines)]
+    values = column.values[:lines - len(empty_lines)]
+    samples_processed = max(lines - 2, 0)
+
+    # Number of the first 2 lines that have a value
+    first_values = 2 - int(np.searchsorted(empty_lines, 2))
+
+    extremes = _window_sums(values, empty_lines, first_values, window_samples, block_rows)
+    results = []
+    for window, samples, (worst_case, best_case) in zip(windows, window_samples, extremes):
+        results.append(WindowResult(window, samples, max(worst_case, 0) / samples,
+                                    None if best_case is None else best_case / samples, samples_processed))
+    return results
+
+
+# Returns the largest and smallest window sum for each window length in 'window_samples', over the windows
+# active_power_calc() checks, in one pass over the values.
+#
+# active_power_calc() pushes the values of the first 2 lines into its window (if both have a value and the window is
+# over 2 samples), then the value of each following line that has one.  A window is checked when a value is pushed
+# if the window was already full: at least 'samples' values were pushed before it and the line before also had a
+# value.  Counting values from the start of the column, the value after the i'th empty line is value (line - i), so
+# these are the values that never end a checked window
+def _window_sums (values, empty_lines, first_values, window_samples, block_rows):
+    skipped = np.unique(empty_lines - np.arange(len(empty_lines)))
+
+    # First value that can end a checked window, for each window length
+    first_ends = []
+    extremes = []
+    for samples in window_samples:
+        if samples > 2 and first_values == 2:
+            first_ends.append(samples)
+            extremes.append([None, None])
+            continue
+        # The first 2 values are not pushed, windows of 1 or 2 samples check them on their own
+        first_ends.append(samples + first_values)
+        if first_values == 2:
+            first = [int(value) for value in values[:2]]
+            initial = (first[0] + first[1],) if samples == 2 else tuple(first)
+            extremes.append([max(initial), min(initial)])
+        else:
+            extremes.append([None, None])
+
+    longest = max(window_samples)
+    for block_start in range(min(first_ends), len(values), block_rows):
+        block_end = min(block_start + block_rows, len(values))
+        # Cumulative sum from one value before the longest window ending at the start of the block.  Each window sum
+        # is the difference of two cumulative sums 'samples' apart
+        sums_start = max(block_start - longest - 1, 0)
+        sums = np.concatenate(([0], np.cumsum(values[sums_start:block_end], dtype=np.int64)))
+        ends = np.arange(block_start, block_end) - sums_start + 1
+        checked = np.ones(block_end - block_start, dtype=bool)
+        skip = skipped[(skipped >= block_start) & (skipped < block_end)] - block_start
+        checked[skip] = False
+
+        for index, samples in enumerate(window_samples):
+            first_end = max(first_ends[index] - block_start, 0)
+            window_sums = (sums[ends[first_end:]] - sums[ends[first_end:] - samples])[checked[first_end:]]
+            if len(window_sums) == 0:
+                continue
+            block_worst = int(window_sums.max())
+            block_best = int(window_sums.min())
+            worst_case, best_case = extremes[index]
+            extremes[index] = [block_worst if worst_case is None else max(worst_case, block_worst),
+                               block_best if best_case is None else min(best_case, block_best)]
+
+    return [(0 if worst_case is None else worst_case, best_case) for worst_case, best_case in extremes]
+
+
+# Saves a column as '<cache_base>.npy' (the values) and '<cache_base>.npz' (the rest of the column, and the size and
+# modification time of the CSV it was read from)
+def _save_cache (cache_base, data_path, column, csv_delimiter):
+    source = os.stat(data_path)
+    np.save(cache_base + ".npy", column.values)
+    np.savez(cache_base + ".npz", empty_lines=column.empty_lines, lines=column.lines,
+             first_times=np.array(column.first_times, dtype=np.int64), source_size=source.st_size,
+             source_mtime=source.st_mtime_ns, delimiter=csv_delimiter)
+
+
+# Returns the cached column, with the values memory-mapped, or None if there is no cache for the current CSV
+def _load_cache (cache_base, data_path, col_name, csv_delimiter):
+    if not os.path.exists(cache_base + ".npy") or not os.path.exists(cache_base + ".npz"):
+        return None
+    source = os.stat(data_path)
+    with np.load(cache_base + ".npz") as meta:
+        if (int(meta["source_size"]) != source.st_size or int(meta["source_mtime"]) != source.st_mtime_ns or
+                str(meta["delimiter"]) != csv_delimiter):
+            return None
+        return TraceColumn(col_name, np.load(cache_base + ".npy", mmap_mode="r"), meta["empty_lines"],
+                           int(meta["lines"]), tuple(int(time) for time in meta["first_times"]))
@@ -26,9 +26,11 @@ QIS is distributed as part of the Quarchpy python package and does not require s
     https://quarch.com/support/faqs/java/
 3- Quarchpy python package
     https://quarch.com/products/quarchpy-python-package/
-4- Quarch USB driver (Required for USB connected devices on windows only)
+4- NumPy python package
+    pip install numpy
+5- Quarch USB driver (Required for USB connected devices on windows only)
     https://quarch.com/downloads/driver/
-5- Check USB permissions if using Linux:
+6- Check USB permissions if using Linux:
     https://quarch.com/support/faqs/usb/
 
 ########### INSTRUCTIONS ###########
@@ -38,19 +40,17 @@ QIS is distributed as part of the Quarchpy python package and does not require s
 
 ####################################
 '''
-import csv
 # Import other libraries used in the examples
 import time  # Used for sleep commands
 import logging  # Optionally used to create a log to help with debugging
-import pandas as pd
 import numpy as np
 
 from quarchpy.device import *
 from quarchpy.qis import *
 from quarchpy.user_interface.user_interface import quarchSleep
 
-#import library used to store in-memory csv data
-from io import StringIO
+# In-memory sink parsing the stream into typed NumPy columns as it arrives (column_sink.py)
+from column_sink import ColumnSink
 
 '''
 Select the device you want to connect to here!
@@ -113,8 +113,9 @@ This example streams measurement data to file, by default in the same folder as
 
 
 def simple_stream_example(module):
-    # Define IO data structure used by python startStream() function
-    csv_data_io = StringIO()
+    # Define IO data structure used by python startStream() function.  ColumnSink is a StringIO that keeps the data as
+    # typed columns rather than as CSV text
+    csv_data_io = ColumnSink()
 
     # Prints out connected module information
     print("Running QIS SIMPLE STREAM Example")
@@ -125,7 +126,7 @@ def simple_stream_example(module):
     # Use 1k averaging (around 1 measurement every 4mS)
     print("Set averaging: " + module.sendCommand("record:averaging 1"))
 
-    # In this example we write to a defined StringIO data structure
+    # In this example we write to a defined ColumnSink data structure
     print("\nStarting Recording!")
     module.startStream(inMemoryData=csv_data_io)
 
@@ -152,7 +153,9 @@ def simple_stream_example(module):
     print("\nStopping the stream...")
     module.stopStream()
 
-    # Print the data acquired from the stream that is currently stored in the StringIO object
+    # Print the data acquired from the stream that is currently stored in the ColumnSink object.  Any room allocated
+    # for more rows is freed first, as the stream has stopped
+    csv_data_io.trim()
     process_qis_data(csv_data_io)
 
     print("\nQIS SIMPLE STREAM Example - Complete!\n\n")
@@ -161,37 +164,39 @@ def process_qis_data(csv_data_io):
     # Print Header and CSV Data as a List
     print("\nIn-Memory Data acquired from QIS: \n")
 
-    # Get the entire contents of the buffer as a string
-    csv_data_string = csv_data_io.getvalue()
-
-    # Print all csv data (for debugging)
-    # print(csv_data_string)
-
-    # Convert the CSV-like data in StringIO to a pandas DataFrame
-    csv_data_io = StringIO(csv_data_string)
-    df = pd.read_csv(csv_data_io)
+    # Print all data as a pandas DataFrame (for debugging, needs pandas).  The DataFrame shares memory with the sink
+    # print(csv_data_io.dataframe())
+
+    # The columns are already parsed, so the maximum, minimum and sum of squares of each column bar the first one are
+    # calculated directly on views of the column arrays
+    columns = csv_data_io.columns()
+    missing = csv_data_io.missing()
+    stats = {}
+    for column in csv_data_io.names[1:]:
+        values = columns[column]
+        if missing[column] is not None:
+            values = values[~missing[column]]
+        if len(values) == 0:
+            stats[column] = (None, None, 0.0, 0)
+            continue
+        stats[column] = (values.max(), values.min(), float(np.sum(np.square(values, dtype=np.float64))), len(values))
 
     # Loop through each column bar the first one
-    for column in df.columns[1:]:
-
-        # Attempt to convert the column to numeric, setting non-convertible values to NaN
-        numeric_column = pd.to_numeric(df[column], errors='coerce')
+    for column, (max_value, min_value, sum_of_squares, count) in stats.items():
 
         # Skip the column if it doesn't contain valid numbers
-        if numeric_column.isna().all():
+        if count == 0:
             print(f"Skipping column {column} as it doesn't contain valid numbers.")
             continue
 
-        # Find and print the maximum value
-        max_value = df[column].max()
+        # Print the maximum value
         print(f"Maximum value in {column}: {max_value}")
 
-        # Find and print the minimum value
-        min_value = df[column].min()
+        # Print the minimum value
         print(f"Minimum value in {column}: {min_value}")
 
         # Perform RMS calculation
-        rms_value = np.sqrt(np.mean(df[column] ** 2))
+        rms_value = np.sqrt(sum_of_squares / count)
         print(f"RMS in {column}: {rms_value}")
 
         print()  # Add a newline for better readability
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Typed columnar in-memory sink for a QIS stream, in place of a StringIO of CSV text.
+
+startStream(inMemoryData=...) writes the stream to a StringIO as CSV text, which is then parsed once the stream has
+stopped: the capture is held as text (at 40 to 60 bytes a row), then again as a copy of that text while it is parsed,
+and then as the parsed values.  ColumnSink is a StringIO that can be passed in its place, and parses the text as it
+arrives into growable NumPy columns instead:
+
+1- The first line written is the header, giving the name and units of each column ('names' and 'units')
+2- Text written is held until 'parse_bytes' of it has arrived (or the data is read), then the whole lines are parsed
+   with TraceReader (trace_reader.py) and appended to the columns, so no more than 'parse_bytes' of text is held
+3- Each column is an int64 array, changing to float64 when a value that is not an integer arrives.  The arrays grow by
+   doubling, so appending costs O(1) per row on average
+4- columns() returns views of the rows so far without copying them, and dataframe() a pandas DataFrame built on those
+   views.  Rows already written never change, so a view stays valid as the stream carries on
+
+getvalue() returns an empty string, as the text is not kept.  tell() returns the length of text written, which QIS uses
+to check the size of the stream.
+
+Example:
+    sink = ColumnSink()
+    module.startStream(inMemoryData=sink)
+    ...
+    module.stopStream()
+    power = sink.columns()["Tot uW"]
+"""
+import io
+import os
+import sys
+import threading
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import TraceReader
+
+# Text held before it is parsed
+PARSE_BYTES = 256 * 1024
+
+# Rows allocated for each column at first
+INITIAL_ROWS = 4096
+
+# Number of rows in each block parsed by TraceReader, larger than any one parse
+_PARSE_ROWS = 1 << 62
+
+
+class ColumnSink(io.StringIO):
+    '''
+    StringIO for startStream(inMemoryData=...), parsing the stream into growable typed NumPy columns as it is written.
+    The methods that read the data parse any text still held first, so they include everything written up to the call.
+
+    delimiter       = Delimiter character used by the stream (the 'separator' passed to startStream)
+    parse_bytes     = Amount of text held before it is parsed, on the thread writing the stream
+    '''
+    def __init__(self, delimiter=",", parse_bytes=PARSE_BYTES):
+        super().__init__()
+        if len(delimiter) != 1:
+            raise ValueError ("Delimiter must be a single character")
+        self.delimiter = delimiter
+        self.parse_bytes = parse_bytes
+        # Header, set when the first line has been parsed
+        self.names = None
+        self.units = None
+        # Number of rows parsed, and the footer rows after the data (such as a warning when QIS stops the stream)
+        self.rows = 0
+        self.footer = {}
+        # Column arrays with room for 'capacity' rows, and the empty value masks (None until a value is empty)
+        self.__columns = {}
+        self.__missing = {}
+        self.__capacity = 0
+        # Text written and not parsed yet, and the part line left over from the last parse
+        self.__pending = []
+        self.__pending_size = 0
+        self.__written = 0
+        self.__header = None
+        self.__carry = b""
+        self.__lock = threading.RLock()
+
+    # Holds text written by the QIS stream thread, parsing it once 'parse_bytes' has arrived
+    def write(self, text):
+        with self.__lock:
+            self.__pending.append(text)
+            self.__pending_size += len(text)
+            self.__written += len(text)
+            if self.__pending_size >= self.parse_bytes:
+                self.__parse_pending()
+        return len(text)
+
+    # Length of the text written
+    def tell(self):
+        with self.__lock:
+            return self.__written
+
+    # Parses any text held, so the columns hold every whole line written
+    def flush(self):
+        with self.__lock:
+            self.__parse_pending()
+
+    # Returns a dict of column name to a view of its values so far (empty values are 0 in int64 columns and NaN in
+    # float64 columns), for every column or those in 'names'.  The views share memory with the sink
+    def columns(self, names=None):
+        with self.__lock:
+            self.__parse_pending()
+            return {name: self.__columns[name][:self.rows] for name in self.__names(names)}
+
+    # Returns a dict of column name to a bool view, True where the value is empty, or None if no value is empty
+    def missing(self, names=None):
+        with self.__lock:
+            self.__parse_pending()
+            return {name: None if self.__missing[name] is None else self.__missing[name][:self.rows]
+                    for name in self.__names(names)}
+
+    # Returns the rows so far as a pandas DataFrame built on views of the columns, for every column or those in
+    # 'names'.  pandas is only needed for this method
+    def dataframe(self, names=None):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("'pandas' module required for ColumnSink.dataframe(), please install this")
+        return pd.DataFrame(self.columns(names), copy=False)
+
+    # Frees the room allocated for rows to come, such as once the stream has stopped.  Views returned before keep the
+    # arrays they were taken from
+    def trim(self):
+        with self.__lock:
+            self.__parse_pending()
+            if self.names is None or self.__capacity == self.rows:
+                return
+            self.__capacity = self.rows
+            for name in self.names:
+                self.__columns[name] = _grow(self.__columns[name], self.rows, self.rows)
+                if self.__missing[name] is not None:
+                    self.__missing[name] = _grow(self.__missing[name], self.rows, self.rows)
+
+    # Number of bytes held by the columns, including the room allocated for rows to come
+    @property
+    def nbytes(self):
+        with self.__lock:
+            return sum(values.nbytes for values in self.__columns.values()) + \
+                   sum(empty.nbytes for empty in self.__missing.values() if empty is not None)
+
+    # Returns the column names in 'names' (every column if None), checking each is in the header
+    def __names(self, names):
+        if self.names is None:
+            if names:
+                raise ValueError ("The stream header has not been written yet")
+            return []
+        if names is None:
+            return self.names
+        for name in names:
+            if name not in self.__columns:
+                raise ValueError ("Stream does not contain the specified column name: " + name)
+        return names
+
+    # Parses the whole lines of the text held and appends them to the columns
+    def __parse_pending(self):
+        if self.__pending_size == 0:
+            return
+        data = self.__carry + "".join(self.__pending).encode("utf-8")
+        self.__pending = []
+        self.__pending_size = 0
+        # The header is the first line that is not blank
+        while self.__header is None:
+            end = data.find(b"\n")
+            if end < 0:
+                self.__carry = data
+                return
+            if len(data[:end].strip()) > 0:
+                self.__header = data[:end + 1]
+                self.__read_header()
+            data = data[end + 1:]
+        last_newline = data.rfind(b"\n")
+        self.__carry = data[last_newline + 1:]
+        if last_newline < 0:
+            return
+
+        # Columns that have changed to float are read as float, so their values are not cut to integers
+        dtypes = {name: np.float64 for name, values in self.__columns.items() if values.dtype == np.float64}
+        reader = TraceReader(io.BytesIO(self.__header + data[:last_newline + 1]), delimiter=self.delimiter,
+                             block_rows=_PARSE_ROWS, dtypes=dtypes, start_row=self.rows)
+        block = reader.read()
+        self.footer.update(reader.footer)
+        self.__append(block)
+
+    # Sets 'names' and 'units' from the header, and allocates the columns
+    def __read_header(self):
+        reader = TraceReader(io.BytesIO(self.__header), delimiter=self.delimiter)
+        if len(reader.names) == 0:
+            raise ValueError ("Stream header does not contain any named columns")
+        self.names = reader.names
+        self.units = reader.units
+        self.__capacity = INITIAL_ROWS
+        self.__columns = {name: np.zeros(self.__capacity, dtype=np.int64) for name in self.names}
+        self.__missing = dict.fromkeys(self.names)
+
+    # Appends the rows of a TraceBlock to the columns, growing them first if needed
+    def __append(self, block):
+        rows = len(block.columns[self.names[0]])
+        if rows == 0:
+            return
+        end = self.rows + rows
+        if end > self.__capacity:
+            self.__capacity = max(self.__capacity * 2, end)
+            for name in self.names:
+                self.__columns[name] = _grow(self.__columns[name], self.rows, self.__capacity)
+                if self.__missing[name] is not None:
+                    self.__missing[name] = _grow(self.__missing[name], self.rows, self.__capacity)
+        for name in self.names:
+            values = block.columns[name]
+            if values.dtype == np.float64 and self.__columns[name].dtype == np.int64:
+                # The column changes to float, with its empty values as NaN
+                column = self.__columns[name].astype(np.float64)
+                if self.__missing[name] is not None:
+                    column[:self.rows][self.__missing[name][:self.rows]] = np.nan
+                self.__columns[name] = column
+            if block.missing[name] is not None and self.__missing[name] is None:
+                self.__missing[name] = np.zeros(self.__capacity, dtype=bool)
+            self.__columns[name][self.rows:end] = values
+            if self.__missing[name] is not None:
+                self.__missing[name][self.rows:end] = False if block.missing[name] is None else block.missing[name]
+        self.rows = end
+
+
+# Returns a copy of the first 'rows' of 'values' in a new array with room for 'capacity' rows
+def _grow (values, rows, capacity):
+    grown = np.zeros(capacity, dtype=values.dtype)
+    grown[:rows] = values[:rows]
+    return grown
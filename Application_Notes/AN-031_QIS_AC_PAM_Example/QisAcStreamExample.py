@@ -23,9 +23,11 @@ QIS is distributed as part of the Quarchpy python package and does not require s
     https://quarch.com/support/faqs/java/
 3- Quarchpy python package
     https://quarch.com/products/quarchpy-python-package/
-4- Quarch USB driver (Required for USB connected devices on windows only)
+4- NumPy python package
+    pip install numpy
+5- Quarch USB driver (Required for USB connected devices on windows only)
     https://quarch.com/downloads/driver/
-5- Check USB permissions if using Linux:
+6- Check USB permissions if using Linux:
     https://quarch.com/support/faqs/usb/
 
 ########### INSTRUCTIONS ###########
@@ -44,11 +46,13 @@ import logging  # Optionally used to create a log to help with debugging
 from quarchpy.device import *
 from quarchpy.qis import *
 
-from io import StringIO
 from threading import Thread
 
+# In-memory stream sink, parsing only the data added since it was last read (stream_sink.py)
+from stream_sink import StreamSink
+
 # Global variables to store last values and stream status
-csv_data_io = StringIO()  # Store stream data in memory
+csv_data_io = StreamSink()  # Store stream data in memory, a StringIO that is safe to read while QIS writes to it
 last_values = {}  # Cache last values for each channel
 stream_running = False
 
@@ -134,14 +138,9 @@ def simple_stream_example(module):
 
 # Function to cache the last sample for each column
 def process_stream_data():
-    csv_data_io.seek(0)  # Rewind to the start of the CSV data
-    lines = csv_data_io.readlines()  # Read all lines
-    if lines:
-        headers = lines[0].strip().split(',')  # Extract headers from first line
-        last_line = lines[-1].strip().split(',')  # Extract the last line of data
-        for i, header in enumerate(headers):
-            if header != "" and header is not None:  # Only process non-empty headers
-                last_values[header] = last_line[i]  # Cache the last sample for each valid column
+    # The sink parses only the lines written since the last call, so this costs the same however long the stream has
+    # been running.  Each named column is set to its value in the last line, or None if that value is empty
+    last_values.update(csv_data_io.latest())
 
 
 # API to request the last value by channel name
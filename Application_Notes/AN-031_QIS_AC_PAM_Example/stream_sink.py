@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Thread-safe in-memory sink for a QIS stream, parsing only the data added since it was last read.
+
+startStream(inMemoryData=...) writes the stream to a StringIO from the QIS stream thread.  Reading the latest values
+by rewinding the StringIO and reading every line has a cost that grows with the length of the capture, and moves the
+position the stream thread writes at.  StreamSink is a StringIO that can be passed in its place:
+
+1- Every write is added to the end of the text under a lock, whatever position readers have left it at, and is queued
+   for parsing
+2- poll() parses only the whole lines queued since the last poll (with TraceReader, trace_reader.py) into a block of
+   typed NumPy columns, keeping any part line for the next poll, so live monitoring costs O(new data)
+3- latest() returns the values of the newest row, since(t) the rows from time t on, and chunks(cursor) each block
+   parsed after a cursor, so several consumers can each read the new blocks at their own pace
+
+getvalue() still returns all the text written, for saving the stream to a file once it has stopped.  Set
+keep_text=False to keep only the parsed blocks, and max_rows to drop the oldest blocks during a long capture.
+
+Example:
+    sink = StreamSink()
+    module.startStream(inMemoryData=sink, fileName=None)
+    while streaming:
+        print(sink.latest().get("L1_RMS mV"))
+        time.sleep(1)
+"""
+import io
+import os
+import sys
+import threading
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import TraceBlock, TraceReader
+
+# Number of rows in each block parsed by TraceReader, larger than any one poll
+_POLL_ROWS = 1 << 62
+
+
+class StreamSink(io.StringIO):
+    '''
+    StringIO for startStream(inMemoryData=...), parsing the stream into typed blocks as it is written.  The first line
+    written is the header, naming the columns.  Each method that reads the data polls first, so the results include
+    everything written up to the call.
+
+    delimiter       = Delimiter character used by the stream (the 'separator' passed to startStream)
+    keep_text       = True to keep the text written, for getvalue().  tell() returns the length written either way,
+                      which QIS uses to check the size of the stream
+    max_rows        = Number of parsed rows to keep, dropping the oldest blocks as new ones are added, or None for
+                      every row
+    '''
+    def __init__(self, delimiter=",", keep_text=True, max_rows=None):
+        super().__init__()
+        if len(delimiter) != 1:
+            raise ValueError ("Delimiter must be a single character")
+        self.delimiter = delimiter
+        self.keep_text = keep_text
+        self.max_rows = max_rows
+        # Header, set when the first line has been written
+        self.names = None
+        self.units = None
+        # Rows parsed, the footer rows after the data (such as a warning when QIS stops the stream) and the parsed
+        # blocks, with the number of blocks dropped before them
+        self.rows = 0
+        self.footer = {}
+        self.__blocks = []
+        self.__last_times = []
+        self.__dropped = 0
+        self.__kept_rows = 0
+        self.__latest = {}
+        self.__float_columns = set()
+        # Text written and not parsed yet, and the part line left over from the last poll
+        self.__pending = []
+        self.__written = 0
+        self.__header = None
+        self.__carry = b""
+        self.__write_lock = threading.Lock()
+        self.__parse_lock = threading.RLock()
+
+    # Adds text to the end of the stream, called by the QIS stream thread
+    def write(self, text):
+        with self.__write_lock:
+            if self.keep_text:
+                super().seek(0, io.SEEK_END)
+                super().write(text)
+            self.__pending.append(text)
+            self.__written += len(text)
+        return len(text)
+
+    # Length of the text written
+    def tell(self):
+        with self.__write_lock:
+            return self.__written
+
+    # All the text written (empty if keep_text is False)
+    def getvalue(self):
+        with self.__write_lock:
+            return super().getvalue()
+
+    # Parses the whole lines written since the last poll.  Returns the number of new rows
+    def poll(self):
+        with self.__parse_lock:
+            with self.__write_lock:
+                text = "".join(self.__pending)
+                self.__pending = []
+            data = self.__carry + text.encode("utf-8")
+            # The header is the first line that is not blank
+            while self.__header is None:
+                end = data.find(b"\n")
+                if end < 0:
+                    self.__carry = data
+                    return 0
+                if len(data[:end].strip()) > 0:
+                    self.__header = data[:end + 1]
+                    self.__read_header()
+                data = data[end + 1:]
+            last_newline = data.rfind(b"\n")
+            self.__carry = data[last_newline + 1:]
+            if last_newline < 0:
+                return 0
+            return self.__parse(data[:last_newline + 1])
+
+    # Returns a dict of each column name to its value in the newest row (None if that cell is empty), or an empty dict
+    # before the first row, polling first.  A value is never carried forward from an older row
+    def latest(self):
+        with self.__parse_lock:
+            self.poll()
+            return dict(self.__latest)
+
+    # Returns the rows with a time at or after 't' as one TraceBlock (None if there is no header yet), polling first.
+    # Only the rows kept (see max_rows) are returned
+    def since(self, t):
+        with self.__parse_lock:
+            self.poll()
+            if self.names is None:
+                return None
+            first = int(np.searchsorted(self.__last_times, t, side="left"))
+            blocks = self.__blocks[first:]
+            if len(blocks) > 0:
+                times = blocks[0].columns[self.names[0]]
+                start = int(np.searchsorted(times, t, side="left"))
+                blocks[0] = _slice_block(blocks[0], start)
+            return _join_blocks(blocks, self.names, self.rows)
+
+    # Returns (blocks, cursor): the blocks parsed after 'cursor', and the cursor to pass next time for the blocks after
+    # those.  Start with a cursor of 0.  Blocks dropped (see max_rows) before they were read are skipped
+    def chunks(self, cursor=0):
+        with self.__parse_lock:
+            self.poll()
+            first = max(cursor - self.__dropped, 0)
+            return list(self.__blocks[first:]), self.__dropped + len(self.__blocks)
+
+    # Parses the header line on its own, setting 'names' and 'units'
+    def __read_header(self):
+        reader = TraceReader(io.BytesIO(self.__header), delimiter=self.delimiter)
+        if len(reader.names) == 0:
+            raise ValueError ("Stream header does not contain any named columns")
+        self.names = reader.names
+        self.units = reader.units
+
+    # Parses the whole lines in 'data' into a new block
+    def __parse(self, data):
+        dtypes = {name: np.float64 for name in self.__float_columns}
+        reader = TraceReader(io.BytesIO(self.__header + data), delimiter=self.delimiter, block_rows=_POLL_ROWS,
+                             dtypes=dtypes, start_row=self.rows)
+        block = reader.read()
+        self.footer.update(reader.footer)
+        rows = len(block.columns[self.names[0]]) if self.names else 0
+        if rows == 0:
+            return 0
+        if block.missing[self.names[0]] is not None:
+            raise ValueError ("Time column has an empty value on data row " +
+                              str(block.first_row + int(np.flatnonzero(block.missing[self.names[0]])[0])))
+        # Columns that have changed to float stay float, so every block of a column has the same type
+        self.__float_columns.update(name for name, dtype in reader.dtypes.items() if dtype == np.float64)
+
+        self.__latest = {name: None if block.missing[name] is not None and block.missing[name][-1]
+                         else block.columns[name][-1].item() for name in self.names}
+
+        self.__blocks.append(block)
+        self.__last_times.append(block.columns[self.names[0]][-1])
+        self.rows += rows
+        self.__kept_rows += rows
+        if self.max_rows is not None:
+            while (len(self.__blocks) > 1 and
+                   self.__kept_rows - len(self.__blocks[0].columns[self.names[0]]) >= self.max_rows):
+                self.__kept_rows -= len(self.__blocks.pop(0).columns[self.names[0]])
+                self.__last_times.pop(0)
+                self.__dropped += 1
+        return rows
+
+
+# Returns the rows of a block from 'start' on
+def _slice_block (block, start):
+    if start == 0:
+        return block
+    missing = {}
+    for name, empty in block.missing.items():
+        missing[name] = None if empty is None or not empty[start:].any() else empty[start:]
+    return TraceBlock(block.first_row + start, {name: values[start:] for name, values in block.columns.items()},
+                      missing)
+
+
+# Returns the blocks joined into one TraceBlock, or an empty block at row 'first_row' if there are none
+def _join_blocks (blocks, names, first_row):
+    if len(blocks) == 0:
+        return TraceBlock(first_row, {name: np.zeros(0, dtype=np.int64) for name in names},
+                          {name: None for name in names})
+    if len(blocks) == 1:
+        return blocks[0]
+    missing = {}
+    for name in names:
+        if all(block.missing[name] is None for block in blocks):
+            missing[name] = None
+        else:
+            missing[name] = np.concatenate([np.zeros(len(block.columns[name]), dtype=bool)
+                                            if block.missing[name] is None else block.missing[name]
+                                            for block in blocks])
+    return TraceBlock(blocks[0].first_row, {name: np.concatenate([block.columns[name] for block in blocks])
+                                            for name in names}, missing)
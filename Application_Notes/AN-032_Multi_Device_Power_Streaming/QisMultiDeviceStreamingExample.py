@@ -5,7 +5,8 @@ Automated capture allows data from multiple instruments to be gathered at the sa
 This example uses quarchpy functions to connect and pull data from a list of instruments on the network.
 
 We demonstrate two capture modes:
-simple_multi_stream_example() - This example streams each modules stream data to a CSV file for post-processing
+simple_multi_stream_example() - This example starts every module's stream together, streaming each to a CSV file, and
+                                merges the files into one time aligned CSV file for post-processing
 multi_device_live_monitoring_example() - This example showcases live monitoring for select stream data
 
 QIS is distributed as part of the Quarchpy python package and does not require separate install
@@ -38,8 +39,6 @@ import os
 
 # Import other libraries used in the examples
 import time  # Used for sleep commands
-import xml.etree.ElementTree as ET
-from dataclasses import dataclass
 from io import StringIO
 from threading import Thread
 # import logging  # Optionally used to create a log to help with debugging
@@ -48,9 +47,16 @@ from quarchpy.device import *
 from quarchpy.qis import *
 from quarchpy.user_interface import displayTable, visual_sleep
 
+# Polls the latest sample of every module in parallel (device_poller.py)
+from device_poller import DevicePoller
+# Stream schema from the XML stream header, compiling the channels to monitor (stream_schema.py)
+from stream_schema import StreamSchema
+# Starts the streams of every module together, and merges their files on a common time base (multi_capture.py)
+from multi_capture import CaptureCoordinator
+
 # Global variables to store last values and stream status
 csv_data_io = []  # Store stream data in memory
-last_values = {}  # Cache last values for each channel
+last_values = {}  # Cache last values for each channel, replaced as a whole on each refresh
 stream_running = False
 
 # Hardcoded list to hold all module ID's you'd like to stream with.
@@ -64,17 +70,8 @@ myDeviceIDs = [
     # 'TCP:QTL2751-01-001'
 ]
 
-channels = []
-
-
-# Define a Channel object using a dataclass
-@dataclass
-class Channel:
-    name: str
-    group: str
-    units: str
-    max_t_value: int
-    data_position: int
+# Positions of the channels to monitor in the stream of each module, compiled once from its stream header
+projections = {}
 
 
 # List of channels to monitor.
@@ -140,12 +137,13 @@ def main():
 # Setup each power module and start streaming
 def simple_multi_stream_example(modules):
     """
-    Starts streaming measurement data from multiple devices to separate files.
+    Starts streaming measurement data from multiple devices to separate files, on a common time base, and merges the
+    files into one time aligned file.
 
-    1. Sets the resampling rate for each module.
-    2. Starts recording and streams data to a file for 30 seconds.
-    3. Starts a separate thread to check the stream status once a second
-    4. Stops the stream.
+    1. Sets the resampling rate for each module, and arms a thread to start each module's stream.
+    2. Starts every stream at once, recording when each one started, and reports the alignment error.
+    3. Starts a separate thread to check the stream status once a second, for 30 seconds.
+    4. Stops the streams together, and merges the files.
 
     :param modules: dict[int, quarchPPM]
     :return: None
@@ -154,19 +152,23 @@ def simple_multi_stream_example(modules):
 
     print("\nSimple Multi Device Streaming Example\n")
 
-    # Loop through all set devices in hard-coded list
-    for i in range(len(myDeviceIDs)):
-        print(f"\nSetting QIS resampling to 1mS on module: {myDeviceIDs[i]}")
-        modules[i].streamResampleMode("1mS")
+    # The coordinator starts and stops the modules together, streaming each one to a file named by its device id
+    coordinator = CaptureCoordinator({get_device_id(myDeviceIDs[i]): modules[i] for i in range(len(myDeviceIDs))})
 
-        # Start the recording and set the stream duration to 30 seconds to ensure all modules stream for the same amount of time.
-        # Setting the fileName allows the API call to stream directly to the file.
-        print(f"Started Recording on module: {myDeviceIDs[i]}\n")
-        # Create file name using the device id
-        file_name = f'{get_device_id(myDeviceIDs[i])}.csv'
-        # Start the stream
-        # Note: You can optionally add the parameter "streamDuration" for finer control.
-        modules[i].startStream(fileName=file_name)
+    # Set the resampling on every module, and arm the start, so nothing else is sent to the modules when they start
+    print("Setting QIS resampling to 1mS and arming all modules")
+    for device_id, reply in coordinator.arm(resampling="1mS").items():
+        if reply != "OK":
+            print(f"Failed to set trigger mode on module {device_id}: {reply}")
+
+    # Start every stream at once.  Each module's start is timed, giving its offset from the first module to start
+    starts = coordinator.start()
+    offsets = coordinator.offsets()
+    for device_id, start in starts.items():
+        print(f"Started Recording on module: {device_id} to {start.file_name}, "
+              f"offset {offsets[device_id] * 1000:.3f} mS +/- {start.uncertainty * 1000:.3f} mS")
+    print(f"\nModules started within {coordinator.start_spread * 1000:.3f} mS, "
+          f"aligned to within {coordinator.alignment_error * 1000:.3f} mS")
 
     stream_running = True
 
@@ -180,11 +182,16 @@ def simple_multi_stream_example(modules):
     # Ensure global variable is set too false to stop the live data coming through.
     stream_running = False
 
-    # Loop through the devices and stop each device stream
-    for i in range(len(myDeviceIDs)):
-        # Stop the stream
-        print(f"\nStopping the stream on module: {myDeviceIDs[i]}")
-        modules[i].stopStream()
+    # Stop every stream at once, returning when each file has been saved
+    print("\nStopping the stream on all modules")
+    coordinator.stop()
+
+    # Merge the files into one, on the time base of the first module to start.  Each row holds the latest sample of
+    # every module, so the age of those samples adds to the alignment error
+    result = coordinator.merge("merged.csv")
+    print(f"\nMerged {result.rows} rows into: {result.file_name}")
+    for device_id, rows in result.device_rows.items():
+        print(f"{device_id}: {rows} rows, samples up to {result.max_age[device_id] / 1000:.3f} mS old")
 
 
 def multi_device_live_monitoring_example(modules):
@@ -211,8 +218,8 @@ def multi_device_live_monitoring_example(modules):
         print(f"Started Recording on module: {myDeviceIDs[i]}\n")
         modules[i].sendAndVerifyCommand("rec stream")
 
-        # Check stream header contains channels you'd like to monitor
-        check_header_contains_channels_to_monitor(modules[i])
+        # Check stream header contains channels you'd like to monitor, and compile their positions in the stream
+        projections[get_device_id(myDeviceIDs[i])] = check_header_contains_channels_to_monitor(modules[i])
 
     stream_running = True
 
@@ -232,23 +239,19 @@ def multi_device_live_monitoring_example(modules):
         modules[i].sendCommand("rec stop")
 
 
-def process_stream_data(modules: dict[int, quarchPPM]):
+def process_stream_data(poller: DevicePoller, timeout=None):
     """
-    Function to cache the stream data for each module.
-    :param modules: dict[int, quarchPPM]
-    :return:
+    Function to cache the stream data for each module.  The poller sends "stream text 1" to every module at once, so
+    the refresh takes about as long as the slowest module rather than the sum of them all.
+    :param poller: DevicePoller
+    :param timeout: float, seconds to wait for the modules, or None to wait for all of them
+    :return: None
     """
-    # Iterate through each module in the provided list of modules.
-    for i in range(len(modules)):
-        # Send a command to get the streaming data in text format.
-        line = modules[i].sendCommand("stream text 1")
-
-        # Split the returned line into parts, removing leading/trailing whitespace.
-        # Skip the first part (assumed to be the timestamp) using slicing.
-        parts = line.strip().split()[1:]
+    global last_values
+    # The poller returns a new dict with the values of every module, replacing the cache in one step.  Each value is
+    # the tuple of the monitored channels of the latest sample, in the order of the module's projection
+    last_values = poller.poll(timeout)
 
-        # Convert the remaining parts to integers and store them as a sublist in last_values.
-        last_values[f'{get_device_id(myDeviceIDs[i])}'] = [int(x) for x in parts]
 
 def read_and_print_last_values(modules: dict[int, quarchPPM], sleep_interval=0.4):
     """
@@ -257,36 +260,55 @@ def read_and_print_last_values(modules: dict[int, quarchPPM], sleep_interval=0.4
     :param sleep_interval: int
     :return: None
     """
+    # Create the poller, with the modules keyed by their device id.  Each reply is parsed with the module's projection,
+    # which converts only the monitored values
+    poller = DevicePoller({get_device_id(myDeviceIDs[i]): modules[i] for i in range(len(myDeviceIDs))},
+                          parse=lambda device_id, reply: projections[device_id].extract(reply))
+
     # Loop continuously while the stream is active.
     while stream_running:
-        # Update the cache with the most recent stream data for all modules.
-        process_stream_data(modules)
+        # Update the cache with the most recent stream data for all modules.  Modules that take longer than the
+        # interval to reply keep their last values, and are collected on a later refresh
+        process_stream_data(poller, timeout=sleep_interval)
 
-        # Initialize an index to track the position in the channels list.
-        index = 0
         # Iterate through each device in the list of device IDs.
         for device_id in myDeviceIDs:
             # Ensure the device ID is in the correct format or retrieve the actual ID.
             device_id = get_device_id(device_id)
-            if len(last_values[device_id]) != 0:
+            # Check if there is any data to process
+            values = last_values.get(device_id)
+            if values:
                 print(f'\n{device_id}')
-                # Loop through each channel to monitor and its descriptor.
-                for channel_key, channel_descriptor in channelsToMonitor.items():
-                    # Retrieve the corresponding channel object using the current index and channel key.
-                    channel = channels[index].get(channel_key)
-                    # Check if there is any data to process
-                    # Print the channel descriptor and the most recent value for this device and channel.
-                    print(f'{channel_descriptor}: {last_values[device_id][channel.data_position - 1]}', end=' ')
+                # Print the descriptor and the most recent value of each monitored channel found on this device.
+                for channel_key, value in zip(projections[device_id].keys, values):
+                    print(f'{channelsToMonitor[channel_key]}: {value}', end=' ')
 
-            # Move to the next device's channels.
-            index += 1
-
-        # Print a blank line to separate outputs.
-        print('\n')
+        # Print a blank line to separate outputs, and the time taken to refresh every module.
+        print(f'\nRefreshed {len(myDeviceIDs)} modules in {poller.last_poll_time * 1000:.1f} mS\n')
 
         # Pause execution for the specified interval before the next iteration.
         time.sleep(sleep_interval)
 
+    # Stop the poller threads and print the query round trip times of each module
+    poller.close()
+    print_poll_latency(poller)
+
+
+def print_poll_latency(poller: DevicePoller):
+    """
+    Prints the round trip times of the "stream text 1" queries sent to each module.
+    :param poller: DevicePoller
+    :return: None
+    """
+    print("\nQuery round trip times (mS):")
+    for device_id, latency in poller.latency.items():
+        if latency.mean is None:
+            print(f"{device_id}: no replies, {latency.errors} errors")
+            continue
+        print(f"{device_id}: last {latency.last * 1000:.1f}, mean {latency.mean * 1000:.1f}, "
+              f"p95 {latency.percentile(95) * 1000:.1f}, max {latency.max * 1000:.1f}, "
+              f"{latency.queries} queries, {latency.errors} errors, {latency.skipped} skipped")
+
 
 def check_stream_status(modules):
     """
@@ -295,7 +317,7 @@ def check_stream_status(modules):
     :return: None
     """
     while stream_running:
-        for module in modules:
+        for module in modules.values():
             stream_status = module.streamRunningStatus()
             if "Stopped" in stream_status:
                 if "Overrun" in stream_status:
@@ -309,43 +331,24 @@ def check_stream_status(modules):
 
 def check_header_contains_channels_to_monitor(module: quarchPPM):
     """
-    Checks if the stream header returned from the module contains the set of channels you wish to monitor.
+    Checks if the stream header returned from the module contains the set of channels you wish to monitor, and
+    compiles the positions of those channels in the stream.
     Note: List of channels to monitor is currently defined as a global variable in the script.
     :param module: quarchPPM
-    :return: None
+    :return: StreamProjection
     """
-    # Get the stream header as XML.
-    xml_response = module.sendCommand("stream text header")
-    while "Header Not Available" in xml_response:
-        xml_response = module.sendCommand("stream text header")
-
-    # Parse the XML
-    root = ET.fromstring(xml_response)
-
-    # Extract channels and store them as Channel objects in a dict
-    extracted_channels = {}
-    # List of Channel Keys to check against
-    for channel in root.findall(".//channel"):
-        channel_obj = Channel(
-            name=channel.find("name").text,
-            group=channel.find("group").text,
-            units=channel.find("units").text,
-            max_t_value=int(channel.find("maxTValue").text),
-            data_position=int(channel.find("dataPosition").text),
-        )
-        # Add extracted Channel object to a dict
-        extracted_channels[f"{channel_obj.name} {channel_obj.units}"] = channel_obj
-
-    # Append extracted channels from header into global channels list of dicts
-    channels.append(extracted_channels)
+    # Get the stream header as XML, waiting (with a growing delay between queries) until the stream has started, and
+    # extract the channels from it
+    schema = StreamSchema.from_module(module)
 
     # Debug - output all channels.
-    # print(str(extracted_channels))
+    # print(str(schema.channels))
 
     # Check if all channels to monitor are present in the stream
-    for key, value in channelsToMonitor.items():
-        if extracted_channels.get(key) is None:
-            print(f"Channel: {key} not found.")
+    projection = schema.projection(channelsToMonitor)
+    for key in projection.missing:
+        print(f"Channel: {key} not found.")
+    return projection
 
 
 def process_qis_data(device_id, csv_data_io_data):
@@ -0,0 +1,161 @@
+'''
+Concurrent polling of the latest stream sample from many Quarch modules, for live monitoring.
+
+Sending "stream text 1" to each module in turn means one refresh takes the sum of every module's round trip, so the
+refresh time grows with the number of modules.  DevicePoller sends the query to every module at once from a pool of
+threads (each module connected through QIS has its own socket), so a refresh takes about as long as the slowest module:
+
+1- poll() queries every module in parallel and waits for the replies, up to an optional timeout.  A module that has not
+   replied yet is not queried again until it does, so no socket ever has two queries in flight
+2- The new values are published as a new dict, replacing 'last_values' in one step, so a reader always sees the values
+   of one complete refresh, and never a dict part way through an update
+3- The round trip time of every query is recorded per module in a DeviceLatency (last, mean, max and recent
+   percentiles), along with the number of failed and skipped queries
+
+A module that fails or times out keeps its values from the refresh before.
+'''
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+# Number of recent round trip times kept for the percentiles of each module
+RECENT_QUERIES = 100
+
+
+@dataclass
+class DeviceLatency:
+    """
+    Round trip times of the queries sent to one module, in seconds.
+    """
+    queries: int = 0
+    errors: int = 0
+    skipped: int = 0
+    last: float = None
+    max: float = None
+    total: float = 0.0
+    recent: deque = field(default_factory=lambda: deque(maxlen=RECENT_QUERIES))
+
+    @property
+    def mean(self):
+        """ Mean round trip time of the successful queries, or None before the first """
+        successful = self.queries - self.errors
+        return self.total / successful if successful > 0 else None
+
+    def percentile(self, percent):
+        """
+        Returns the round trip time below which 'percent' of the recent queries fall, or None before the first.
+        :param percent: float, 0 to 100
+        :return: float
+        """
+        if len(self.recent) == 0:
+            return None
+        recent = sorted(self.recent)
+        return recent[min(int(len(recent) * percent / 100), len(recent) - 1)]
+
+    def add(self, seconds):
+        """ Records the round trip time of a successful query """
+        self.queries += 1
+        self.last = seconds
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.total += seconds
+        self.recent.append(seconds)
+
+
+def parse_stream_line(line: str):
+    """
+    Parses the reply to "stream text 1" into the list of values of the latest sample, after its time stamp, or None if
+    the reply holds no sample.
+    :param line: str
+    :return: list[int] or None
+    """
+    for text in reversed(line.strip().splitlines()):
+        parts = text.split()
+        if len(parts) > 1 and parts[0].isdigit():
+            return [int(x) for x in parts[1:]]
+    return None
+
+
+class DevicePoller:
+    """
+    Polls the latest sample of every module in parallel, keeping the latest values of each module in 'last_values'.
+
+    :param modules: dict[str, quarchPPM] of device id to module, each with a running stream
+    :param parse: Function converting the reply of a module into the values to keep, or None if the reply holds no
+                  sample.  It is called as parse(device_id, reply), parse_stream_line(reply) by default
+    :param command: The query sent to each module
+    :param max_workers: Number of threads, one per module by default
+    """
+    def __init__(self, modules, parse=None, command="stream text 1", max_workers=None):
+        self.modules = dict(modules)
+        self.parse = parse if parse is not None else (lambda device_id, reply: parse_stream_line(reply))
+        self.command = command
+        self.latency = {device_id: DeviceLatency() for device_id in self.modules}
+        # Time taken by the last call to poll(), in seconds
+        self.last_poll_time = None
+        self.__values = {}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers or max(len(self.modules), 1),
+                                             thread_name_prefix="DevicePoller")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def last_values(self):
+        """ dict of device id to the latest values of that module.  The dict is never changed once published """
+        return self.__values
+
+    def poll(self, timeout=None):
+        """
+        Queries every module in parallel and publishes the new values.  Modules that have not replied within 'timeout'
+        seconds keep their values from before, and are collected on a later poll.
+        :param timeout: float or None to wait for every module
+        :return: dict of device id to the latest values
+        """
+        start_time = time.perf_counter()
+        futures = {}
+        for device_id, module in self.modules.items():
+            pending = self.__pending.get(device_id)
+            if pending is not None and not pending.done():
+                # The module is still answering the last query
+                self.latency[device_id].skipped += 1
+                continue
+            futures[device_id] = self.__executor.submit(self.__query, device_id, module)
+            self.__pending[device_id] = futures[device_id]
+        wait(futures.values(), timeout=timeout)
+
+        with self.__lock:
+            values = dict(self.__values)
+            for device_id, future in self.__pending.items():
+                if future.done() and future.exception() is None and future.result() is not None:
+                    values[device_id] = future.result()
+            self.__pending = {device_id: future for device_id, future in self.__pending.items() if not future.done()}
+            # Replacing the dict is one step, so readers see either the old or the new values of every module
+            self.__values = values
+        self.last_poll_time = time.perf_counter() - start_time
+        return values
+
+    def close(self):
+        """ Stops the threads, after any queries in flight """
+        self.__executor.shutdown(wait=True)
+
+    def __query(self, device_id, module):
+        """ Sends the query to one module, on a pool thread, recording the round trip time """
+        latency = self.latency[device_id]
+        start_time = time.perf_counter()
+        try:
+            reply = module.sendCommand(self.command)
+            seconds = time.perf_counter() - start_time
+            values = self.parse(device_id, reply)
+        except Exception:
+            latency.queries += 1
+            latency.errors += 1
+            raise
+        latency.add(seconds)
+        return values
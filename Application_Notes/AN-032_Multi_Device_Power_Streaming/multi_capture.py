@@ -0,0 +1,389 @@
+'''
+Synchronised capture from many Quarch modules, on a common time base, merged into one time aligned CSV file.
+
+Starting each module's stream in turn with startStream() gives every file a different start offset, and the time
+column of each file counts from the start of its own stream, so the files cannot be lined up.  CaptureCoordinator
+starts the streams together, and records when each one started:
+
+1- arm() sets up every module (manual record trigger and resampling), and parks a thread for each module that is ready
+   to call startStream().  Nothing is sent to the modules after this until the start
+2- start() releases every thread at once, so the "rec stream" commands go out together.  Each thread records the time
+   just before calling startStream(), and the time the module first reports its stream as running, so the stream
+   started somewhere in that window.  The middle of the window is taken as the start time, and half its width as the
+   uncertainty of that time
+3- merge() merges the files into one, adding each module's start offset to its time column.  The merge is a streaming
+   k-way merge: the files are read in blocks with TraceReader (trace_reader.py), and only the rows before the earliest
+   last time buffered from any file are merged and written, so memory is bounded by the block size whatever the length
+   of the capture.  Each row holds the latest sample of every module at or before its time, and the age of those
+   samples is reported in MergeResult
+
+The alignment error is reported from the start windows: 'alignment_error' is the largest error there can be between
+the time bases of any two modules, and 'start_spread' the offset there would have been between them without it.
+
+The modules are started from the host, as the examples here do not use a hardware start trigger.  The windows measure
+how close together the starts were, so the error reported holds whatever the host and network add.
+'''
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# The trace modules shared by the application notes are in Application_Notes/libs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "libs"))
+from trace_reader import TraceReader, unit_scale
+
+# Delay between the queries while waiting for a stream to run, in seconds
+RUNNING_POLL_DELAY = 0.001
+
+# Number of rows read from each file at once while merging, the size of each chunk of a file parsed at once, and the
+# number of merged rows formatted as text at once
+MERGE_BLOCK_ROWS = 16 * 1024
+MERGE_CHUNK_BYTES = 1024 * 1024
+WRITE_ROWS = 16 * 1024
+
+@dataclass
+class DeviceStart:
+    """
+    Window in which the stream of one module started, as Unix times in seconds.
+    """
+    device_id: str
+    file_name: str
+    before: float = None
+    after: float = None
+
+    @property
+    def time(self):
+        """ Estimated start time of the stream, the middle of the window """
+        return (self.before + self.after) / 2
+
+    @property
+    def uncertainty(self):
+        """ Largest error of the estimated start time, half the width of the window """
+        return (self.after - self.before) / 2
+
+
+@dataclass
+class MergeResult:
+    """
+    Summary of a merged capture.  'rows' is the number of merged rows, one for each distinct time.  'max_age' is the
+    largest time (in microseconds) between a row and the latest sample of each module it holds, the most the merge adds
+    to the alignment error of that module's values.
+    """
+    file_name: str
+    rows: int = 0
+    device_rows: dict = field(default_factory=dict)
+    max_age: dict = field(default_factory=dict)
+
+
+class CaptureCoordinator:
+    """
+    Arms, starts, and stops the streams of several modules together, and merges their files onto one time base.
+
+    :param modules: dict[str, quarchPPM] of device id to module
+    :param file_names: dict[str, str] of device id to the file each stream is saved to, "<device id>.csv" by default
+    :param separator: Delimiter character of the stream files
+    """
+    def __init__(self, modules, file_names=None, separator=","):
+        self.modules = dict(modules)
+        file_names = file_names or {}
+        self.starts = {device_id: DeviceStart(device_id, file_names.get(device_id, f"{device_id}.csv"))
+                       for device_id in self.modules}
+        self.separator = separator
+        self.__barrier = None
+        self.__threads = []
+        self.__errors = {}
+
+    def arm(self, resampling=None, timeout=10.0):
+        """
+        Sets up every module, and parks a thread for each one, ready to start its stream.  Returns the reply of each
+        module to "record:trigger:mode manual", so any failure can be reported.
+        :param resampling: str, QIS resampling mode to set on every module (such as "1mS"), or None to leave it
+        :param timeout: float, seconds each module has to report its stream running once started
+        :return: dict[str, str]
+        """
+        if self.__barrier is not None:
+            raise RuntimeError("The capture is already armed")
+        replies = {}
+        for device_id, module in self.modules.items():
+            replies[device_id] = module.sendCommand("record:trigger:mode manual")
+            if resampling is not None:
+                module.streamResampleMode(resampling)
+
+        # The threads and the caller of start() all wait on the barrier, which releases them together
+        self.__errors = {}
+        self.__barrier = threading.Barrier(len(self.modules) + 1)
+        self.__threads = [threading.Thread(target=self.__start_stream, args=(device_id, module, timeout),
+                                           name=f"CaptureStart-{device_id}", daemon=True)
+                          for device_id, module in self.modules.items()]
+        for thread in self.__threads:
+            thread.start()
+        return replies
+
+    def start(self):
+        """
+        Starts every armed stream at once, and waits until each one is running.  Raises RuntimeError naming any module
+        whose stream did not start.
+        :return: dict[str, DeviceStart]
+        """
+        if self.__barrier is None:
+            raise RuntimeError("The capture must be armed before it is started")
+        self.__barrier.wait()
+        for thread in self.__threads:
+            thread.join()
+        self.__barrier = None
+        if self.__errors:
+            raise RuntimeError("Stream did not start on: " +
+                               ", ".join(f"{device_id} ({error})" for device_id, error in self.__errors.items()))
+        return self.starts
+
+    def stop(self):
+        """ Stops every stream at once, returning when each stream's data has been saved to its file """
+        threads = [threading.Thread(target=module.stopStream, name=f"CaptureStop-{device_id}")
+                   for device_id, module in self.modules.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def offsets(self):
+        """
+        Returns the time from the earliest start to the start of each stream, in seconds.
+        :return: dict[str, float]
+        """
+        first = min(start.time for start in self.starts.values())
+        return {device_id: start.time - first for device_id, start in self.starts.items()}
+
+    @property
+    def start_spread(self):
+        """ Time between the first and last stream starting, in seconds """
+        times = [start.time for start in self.starts.values()]
+        return max(times) - min(times)
+
+    @property
+    def alignment_error(self):
+        """ Largest error between the time bases of any two modules, the sum of the two largest uncertainties """
+        uncertainties = sorted((start.uncertainty for start in self.starts.values()), reverse=True)
+        return sum(uncertainties[:2])
+
+    def merge(self, file_name, block_rows=MERGE_BLOCK_ROWS):
+        """
+        Merges the files of the capture into one file, on the time base of the earliest start.
+        :param file_name: str, path of the merged file
+        :param block_rows: int, number of rows read from each file at once
+        :return: MergeResult
+        """
+        offsets = self.offsets()
+        sources = {device_id: (start.file_name, offsets[device_id]) for device_id, start in self.starts.items()}
+        return merge_streams(sources, file_name, self.separator, block_rows)
+
+    def __start_stream(self, device_id, module, timeout):
+        """ Waits for the start, then starts the stream of one module and records its start window """
+        start = self.starts[device_id]
+        try:
+            self.__barrier.wait()
+        except threading.BrokenBarrierError as err:
+            self.__errors[device_id] = err
+            return
+        start.before = time.time()
+        try:
+            module.startStream(fileName=start.file_name, separator=self.separator)
+            # startStream() returns before QIS sends "rec stream", so wait until the stream is running
+            end_time = time.monotonic() + timeout
+            while "Running" not in module.streamRunningStatus():
+                if time.monotonic() > end_time:
+                    raise TimeoutError(f"Stream not running after {timeout} seconds")
+                time.sleep(RUNNING_POLL_DELAY)
+            start.after = time.time()
+        except Exception as err:
+            self.__errors[device_id] = err
+
+
+def merge_streams(sources, file_name, separator=",", block_rows=MERGE_BLOCK_ROWS):
+    """
+    Merges stream files into one file, ordered by time.  The time of each row is the time in its file plus the offset
+    of that file, in microseconds.  The merged file has a "Time uS" column, then every column of each file named
+    "<device id> <column>", holding the latest sample of that file at or before the time of the row (empty before its
+    first sample and after its last).
+    :param sources: dict[str, tuple[str, float]] of device id to (path of the file, offset in seconds)
+    :param file_name: str, path of the merged file
+    :param separator: Delimiter character of the files
+    :param block_rows: int, number of rows read from each file at once
+    :return: MergeResult
+    """
+    result = MergeResult(file_name)
+    streams = []
+    try:
+        for device_id, (path, offset) in sources.items():
+            reader = TraceReader(path, delimiter=separator, block_rows=block_rows, chunk_bytes=MERGE_CHUNK_BYTES)
+            try:
+                streams.append(_MergeStream(device_id, reader, offset))
+            except Exception:
+                reader.close()
+                raise
+        header = ["Time uS"] + [f"{stream.device_id} {name}" for stream in streams for name in stream.names]
+        with open(file_name, "w", newline="") as merged:
+            merged.write(separator.join(header) + "\n")
+            while True:
+                for stream in streams:
+                    stream.fill()
+                active = [stream for stream in streams if stream.buffered > 0]
+                if len(active) == 0:
+                    break
+                # A file not read to its end may still hold rows at its last buffered time, so only the rows before the
+                # earliest of those times are merged, until every file has been read
+                reading = [stream.last_time for stream in active if not stream.exhausted]
+                horizon = min(reading) if reading else None
+                result.rows += _merge_rows(streams, horizon, merged, separator)
+    finally:
+        for stream in streams:
+            stream.reader.close()
+    for stream in streams:
+        result.device_rows[stream.device_id] = stream.rows
+        result.max_age[stream.device_id] = stream.max_age
+    return result
+
+
+class _MergeStream:
+    """
+    One file being merged: its rows read and not yet merged, and its latest merged sample.
+
+    :param device_id: str
+    :param reader: TraceReader of the file
+    :param offset: float, seconds added to the time column
+    """
+    def __init__(self, device_id, reader, offset):
+        if len(reader.names) == 0:
+            raise ValueError(f"Stream file of {device_id} does not contain any named columns")
+        self.device_id = device_id
+        self.reader = reader
+        self.time_name = reader.names[0]
+        self.names = reader.names[1:]
+        scale = unit_scale(reader.units.get(self.time_name), "s")
+        if scale is None:
+            raise ValueError(f"Time column of {device_id} does not have units of time: {self.time_name}")
+        # Multiplier from the time column to microseconds
+        self.scale = scale * 1e6
+        self.offset = offset * 1e6
+        self.blocks = iter(reader)
+        self.exhausted = False
+        # Buffered rows, with their times on the common time base, and the empty value masks (None if none is empty)
+        self.times = np.zeros(0, dtype=np.int64)
+        self.values = [np.zeros(0, dtype=np.int64) for _ in self.names]
+        self.empty = [None for _ in self.names]
+        # Latest merged sample, as (time, values, empty) or None before the first, and the totals reported
+        self.latest = None
+        self.rows = 0
+        self.max_age = 0
+
+    @property
+    def buffered(self):
+        return len(self.times)
+
+    @property
+    def last_time(self):
+        return int(self.times[-1])
+
+    def fill(self):
+        """
+        Reads the next block of the file once every buffered row has been merged, or while every buffered row has the
+        same time, so there is always a row before the last buffered time to merge
+        """
+        while not self.exhausted and (self.buffered == 0 or self.times[0] == self.times[-1]):
+            block = next(self.blocks, None)
+            if block is None:
+                self.exhausted = True
+                return
+            if block.missing[self.time_name] is not None:
+                raise ValueError(f"Time column of {self.device_id} has an empty value on data row "
+                                 f"{block.first_row + int(np.flatnonzero(block.missing[self.time_name])[0])}")
+            times = np.rint(block.columns[self.time_name] * self.scale + self.offset).astype(np.int64)
+            if len(times) > 0 and self.buffered > 0 and times[0] < self.times[-1]:
+                raise ValueError(f"Time column of {self.device_id} must not decrease")
+            self.times = np.concatenate((self.times, times))
+            self.values = [np.concatenate((values, block.columns[name]))
+                           for values, name in zip(self.values, self.names)]
+            self.empty = [_join_empty(empty, len(self.times) - len(times), block.missing[name], len(times))
+                          for empty, name in zip(self.empty, self.names)]
+
+    def take(self, horizon):
+        """
+        Removes the buffered rows before 'horizon' (every row if None) from the buffer.
+        :return: tuple of (times, values, empty) of those rows, with values and empty as lists in the order of 'names'
+        """
+        end = len(self.times) if horizon is None else int(np.searchsorted(self.times, horizon, side="left"))
+        taken = (self.times[:end], [values[:end] for values in self.values],
+                 [None if empty is None else empty[:end] for empty in self.empty])
+        self.times = self.times[end:]
+        self.values = [values[end:] for values in self.values]
+        self.empty = [None if empty is None or not empty[end:].any() else empty[end:] for empty in self.empty]
+        self.rows += end
+        return taken
+
+
+def _merge_rows(streams, horizon, merged, separator):
+    """
+    Merges the buffered rows of every stream before 'horizon' (every row if None), writing them to 'merged'.
+    :return: int, the number of rows written
+    """
+    taken = [stream.take(horizon) for stream in streams]
+    # Modules with samples at the same microsecond share one merged row
+    times = np.unique(np.concatenate([rows[0] for rows in taken]))
+    if len(times) == 0:
+        return 0
+
+    # Each column of the merged rows, as the values and the rows left empty (None if there are none)
+    columns = []
+    for stream, (stream_times, values, empty) in zip(streams, taken):
+        # The latest sample merged before is kept in front of the new rows, for the merged rows before the first
+        if stream.latest is not None:
+            stream_times = np.concatenate((stream.latest[0], stream_times))
+            empty = [_join_empty(latest_empty, 1, column_empty, len(column_values))
+                     for latest_empty, column_empty, column_values in zip(stream.latest[2], empty, values)]
+            values = [np.concatenate((latest_values, column_values))
+                      for latest_values, column_values in zip(stream.latest[1], values)]
+        if len(stream_times) == 0:
+            columns.extend((np.zeros(len(times), dtype=column_values.dtype), np.ones(len(times), dtype=bool))
+                           for column_values in values)
+            continue
+
+        # Position of this stream's latest sample at or before each merged row, -1 before its first sample.  Rows
+        # before its first sample, or after its last once the file has been read, leave its columns empty
+        latest = np.searchsorted(stream_times, times, side="right") - 1
+        no_sample = latest < 0
+        if stream.exhausted and stream.buffered == 0:
+            no_sample |= times > stream_times[-1]
+        at = np.maximum(latest, 0)
+        if not no_sample.all():
+            stream.max_age = max(stream.max_age, int((times - stream_times[at])[~no_sample].max()))
+
+        for column_values, column_empty in zip(values, empty):
+            blank = no_sample if column_empty is None else no_sample | column_empty[at]
+            columns.append((column_values[at], blank if blank.any() else None))
+
+        stream.latest = (stream_times[-1:], [column_values[-1:] for column_values in values],
+                         [None if column_empty is None else column_empty[-1:] for column_empty in empty])
+
+    # The rows are formatted a slice at a time, so the text of only one slice is held
+    row_format = separator.join(["%s"] * (len(columns) + 1))
+    for start in range(0, len(times), WRITE_ROWS):
+        rows = slice(start, start + WRITE_ROWS)
+        fields = [times[rows].tolist()]
+        for column_values, blank in columns:
+            text = column_values[rows].tolist()
+            if blank is not None:
+                for row in np.flatnonzero(blank[rows]).tolist():
+                    text[row] = ""
+            fields.append(text)
+        merged.write("\n".join([row_format % row for row in zip(*fields)]) + "\n")
+    return len(times)
+
+
+def _join_empty(empty, rows, block_empty, block_rows):
+    """ Returns the empty value mask of 'rows' buffered rows followed by a block, or None if no value is empty """
+    if empty is None and block_empty is None:
+        return None
+    return np.concatenate((np.zeros(rows, dtype=bool) if empty is None else empty,
+                           np.zeros(block_rows, dtype=bool) if block_empty is None else block_empty))
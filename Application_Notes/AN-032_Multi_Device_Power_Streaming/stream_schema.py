@@ -0,0 +1,138 @@
+'''
+Stream schema of a Quarch module, read once from its XML stream header, for extracting the monitored channels.
+
+Live monitoring looks up each monitored channel by name for every module on every refresh, and converts every value
+of the reply to an integer when only a few are used.  StreamSchema is built once from the reply to
+"stream text header", and compiles the channels to monitor into a StreamProjection:
+
+1- wait_for_header() waits for the header to become available (it is not until the stream has started), retrying with
+   a delay that doubles up to a limit, rather than sending the query again straight away
+2- StreamSchema holds a Channel for each channel in the header, by its "name units" key as used in the CSV header
+3- StreamSchema.projection() maps the channels to monitor to the positions of their values in a "stream text" reply,
+   once, so StreamProjection.extract() splits each reply and converts only those values
+'''
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from operator import itemgetter
+
+# Delays between queries while waiting for the stream header, in seconds
+HEADER_FIRST_DELAY = 0.01
+HEADER_MAX_DELAY = 0.5
+
+
+# Define a Channel object using a dataclass
+@dataclass
+class Channel:
+    name: str
+    group: str
+    units: str
+    max_t_value: int
+    data_position: int
+
+
+def wait_for_header(module, timeout=10.0, first_delay=HEADER_FIRST_DELAY, max_delay=HEADER_MAX_DELAY):
+    """
+    Returns the XML stream header of a module, waiting while it replies "Header Not Available".  The delay between
+    queries starts at 'first_delay' and doubles each time, up to 'max_delay'.
+    :param module: quarchPPM with a started stream
+    :param timeout: float, seconds to wait before raising TimeoutError
+    :param first_delay: float, seconds before the first retry
+    :param max_delay: float, longest delay between retries
+    :return: str
+    """
+    end_time = time.monotonic() + timeout
+    delay = first_delay
+    while True:
+        xml_response = module.sendCommand("stream text header")
+        if "Header Not Available" not in xml_response:
+            return xml_response
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Stream header not available after {timeout} seconds")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+class StreamProjection:
+    """
+    The positions of a set of channels in a "stream text" reply, compiled from a StreamSchema.
+
+    :param keys: list[str] of the "name units" keys of the channels, in the order the values are returned
+    :param positions: list[int] of the data position of each channel (the time stamp is at position 0)
+    :param missing: list[str] of the keys asked for that are not in the stream
+    """
+    def __init__(self, keys, positions, missing=()):
+        self.keys = tuple(keys)
+        self.positions = tuple(positions)
+        self.missing = tuple(missing)
+        # Fields a reply line must hold, and the compiled lookup of the projected fields
+        self.__width = max(self.positions, default=0) + 1
+        self.__getter = itemgetter(*self.positions) if len(self.positions) > 1 else None
+
+    def extract(self, reply: str):
+        """
+        Returns the values of the projected channels from the latest sample in a "stream text" reply, as a tuple in
+        the order of 'keys', or None if the reply holds no sample.
+        :param reply: str
+        :return: tuple[int] or None
+        """
+        for line in reversed(reply.strip().splitlines()):
+            fields = line.split()
+            if len(fields) >= self.__width and fields[0].isdigit():
+                if self.__getter is None:
+                    return tuple(int(fields[position]) for position in self.positions)
+                return tuple(map(int, self.__getter(fields)))
+        return None
+
+
+class StreamSchema:
+    """
+    Channels of a module's stream, from its XML stream header.
+
+    :param channels: dict[str, Channel] of "name units" key to Channel
+    """
+    def __init__(self, channels):
+        self.channels = channels
+
+    @classmethod
+    def from_xml(cls, xml_response: str):
+        """
+        Builds the schema from the reply to "stream text header".
+        :param xml_response: str
+        :return: StreamSchema
+        """
+        root = ET.fromstring(xml_response)
+        channels = {}
+        for channel in root.findall(".//channel"):
+            channel_obj = Channel(
+                name=channel.find("name").text,
+                group=channel.find("group").text,
+                units=channel.find("units").text,
+                max_t_value=int(channel.find("maxTValue").text),
+                data_position=int(channel.find("dataPosition").text),
+            )
+            channels[f"{channel_obj.name} {channel_obj.units}"] = channel_obj
+        return cls(channels)
+
+    @classmethod
+    def from_module(cls, module, timeout=10.0):
+        """
+        Builds the schema of a module with a started stream, waiting for its header with wait_for_header().
+        :param module: quarchPPM
+        :param timeout: float, seconds to wait for the header
+        :return: StreamSchema
+        """
+        return cls.from_xml(wait_for_header(module, timeout))
+
+    def projection(self, keys):
+        """
+        Compiles the channels with the "name units" 'keys' into a StreamProjection.  Keys not in the stream are left
+        out, and listed in its 'missing'.
+        :param keys: iterable of str
+        :return: StreamProjection
+        """
+        keys = list(keys)
+        found = [key for key in keys if key in self.channels]
+        return StreamProjection(found, [self.channels[key].data_position for key in found],
+                                [key for key in keys if key not in self.channels])
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Header of the .npy files written a block at a time by the application notes.
+
+numpy.save() needs the whole array, and the header numpy.lib.format writes changes size with the shape.  A file that is
+written a block of rows at a time (the pyramid levels of trace_pyramid.py, or the decoded columns of AN-023's
+NpyColumnSink) is started with npy_header() for 0 rows, and the header is written again with the row count once the
+rows are all written.  Every header is NPY_HEADER_SIZE bytes, so it can be rewritten in place.
+
+Example:
+    with open("column.npy", "wb") as file_stream:
+        file_stream.write(npy_header(np.int32, 0))
+        for block in blocks:
+            block.astype(np.int32).tofile(file_stream)
+        file_stream.seek(0)
+        file_stream.write(npy_header(np.int32, rows))
+"""
+import struct
+
+import numpy as np
+
+# Fixed size of each .npy header, so the row count can be filled in when the file is closed
+NPY_HEADER_SIZE = 128
+
+
+# Returns a version 1.0 .npy header for an array of 'rows' rows of 'shape' (a 1D array if 'shape' is empty), padded
+# to NPY_HEADER_SIZE bytes
+def npy_header (dtype, rows, shape=()):
+    shape_text = "(%d,)" % rows if len(shape) == 0 else "(%d, %d)" % ((rows,) + tuple(shape))
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %s, }" % (np.dtype(dtype).str, shape_text)
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+Multi-resolution summary (pyramid) of a CSV trace, for fast zoomed-out views of long recordings.
+
+build_pyramid() reads a raw trace once, with TraceReader (trace_reader.py), and writes successive decimated levels.
+Each bin of level 1 summarises 'factor' raw samples, each bin of level 2 summarises 'factor' bins of level 1, and so
+on until a level has a single bin.  Every level holds, for each channel:
+
+1- min and max of the samples in the bin
+2- mean and count of the samples in the bin (empty cells are not counted)
+
+and the time of the first and last sample in each bin.  Each array is a .npy file in the pyramid directory, with a
+pyramid.json manifest, so TracePyramid memory-maps them and a query only reads the part of the level it needs.
+
+PyramidBuilder builds the same pyramid from the blocks of a trace as they are read, so the pyramid can be built in the
+pass that resamples the trace, rather than in a pass of its own.
+
+Example:
+    pyramid = build_pyramid("RawData100us.csv", "RawData100us_pyramid", factor=10)
+    summary = pyramid.query(0, 10000000, points=1000)
+    print(summary.max["Tot uW"])
+"""
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from npy_files import npy_header
+from trace_reader import BLOCK_ROWS, TraceReader
+
+# Name of the manifest in a pyramid directory
+MANIFEST_NAME = "pyramid.json"
+
+# Statistics stored for each level: name and dtype ("time" uses the dtype of the time column)
+_LEVEL_ARRAYS = (("time_start", "time"), ("time_end", "time"), ("min", "float64"), ("max", "float64"),
+                 ("mean", "float64"), ("count", "int64"))
+
+# Result of a query.  'min', 'max', 'mean' and 'count' map each channel name to an array with one value per bin.
+# Bins with no samples for a channel have a count of 0 and NaN min, max and mean
+PyramidSummary = namedtuple("PyramidSummary", ("level", "bin_samples", "time_start", "time_end", "min", "max", "mean",
+                                               "count"))
+
+
+'''
+Reads a raw CSV trace once and writes its pyramid to 'directory'.  Returns the TracePyramid.  To build the pyramid in
+the same pass as other processing of the trace, pass each block to a PyramidBuilder instead.
+
+raw_file_path           = The path of the CSV file to read.
+directory               = Directory to write the pyramid to, created if needed.
+factor                  = Number of bins of each level summarised by one bin of the next level (2, 4 or 10 are
+                          typical).
+columns                 = Names of the channels to summarise, every column after the time column if None.
+delimiter               = The delimiter character used in the CSV file.
+block_rows              = Number of rows of the trace processed at once.
+'''
+def build_pyramid (raw_file_path, directory, factor=10, columns=None, delimiter=",", block_rows=BLOCK_ROWS):
+    builder = PyramidBuilder(directory, factor, columns, source=os.path.basename(raw_file_path))
+
+    # The header gives the time column and the channels
+    with TraceReader(raw_file_path, delimiter=delimiter, chunk_bytes=4096) as header:
+        time_name = header.names[0]
+        needed = builder.start(header, time_name)
+
+    with TraceReader(raw_file_path, columns=needed, delimiter=delimiter, block_rows=block_rows) as reader:
+        for block in reader:
+            builder.add(block, block.columns[time_name])
+    return builder.finish()
+
+
+class PyramidBuilder:
+    '''
+    Builds the pyramid of a trace from its blocks as they are read, so it can be built in the same pass as other
+    processing of the trace.  start() is called with the reader once the header has been read, add() with each block
+    of rows in order, then finish() once at the end of the trace, which writes the manifest and returns the
+    TracePyramid.  These are the methods of a stage of TracePipeline (trace_pipeline.py), where there is one.
+
+    directory           = Directory to write the pyramid to, created if needed
+    factor              = Number of bins of each level summarised by one bin of the next level
+    columns             = Names of the channels to summarise, every column after the time column if None
+    source              = Name of the trace, recorded in the manifest
+    name                = Name of the result, when run as a pipeline stage
+    '''
+    def __init__(self, directory, factor=10, columns=None, source=None, name="pyramid"):
+        if factor < 2 or factor != int(factor):
+            raise ValueError ("Pyramid factor must be a whole number of at least 2")
+        self.directory = directory
+        self.factor = int(factor)
+        self.columns = columns
+        self.source = source
+        self.name = name
+        self.result = None
+
+    # Returns the names of the columns needed, from the header in 'reader'
+    def start(self, reader, time_name):
+        channels = [name for name in (reader.names[1:] if self.columns is None else self.columns)
+                    if name != time_name]
+        for name in channels:
+            if name not in reader.names:
+                raise ValueError ("File does not contain the specified column name: " + name)
+        if len(channels) == 0:
+            raise ValueError ("File does not contain any channels to summarise")
+        os.makedirs(self.directory, exist_ok=True)
+        self.__units = {name: reader.units.get(name) for name in channels}
+        self.__time_name = time_name
+        self.__channels = channels
+        self.__first_level = None
+        self.__first_times = []
+        self.__rows = 0
+        return [time_name] + channels
+
+    # Adds a TraceBlock.  'times' holds the time of each row
+    def add(self, block, times):
+        if len(self.__first_times) < 2:
+            self.__first_times += times[:2 - len(self.__first_times)].tolist()
+        if self.__first_level is None:
+            time_dtype = "int64" if times.dtype.kind == "i" else "float64"
+            self.__first_level = _LevelWriter(self.directory, 1, self.factor, len(self.__channels), time_dtype)
+
+        # Each raw sample is a bin of one sample, or of none where the cell is empty
+        values = np.column_stack([block.columns[name] for name in self.__channels]).astype(np.float64)
+        present = np.column_stack([np.ones(len(times), dtype=bool) if block.missing[name] is None else
+                                   ~block.missing[name] for name in self.__channels])
+        self.__first_level.add(times, times, np.where(present, values, np.inf), np.where(present, values, -np.inf),
+                               np.where(present, values, 0.0), present.astype(np.int64))
+        self.__rows += len(times)
+
+    # Writes the last bins and the manifest, returning the TracePyramid (also kept in 'result')
+    def finish(self):
+        levels = []
+        if self.__first_level is not None:
+            self.__first_level.finish()
+            level = self.__first_level
+            while level is not None:
+                levels.append(level.close())
+                level = level.next_level
+            self.__first_level = None
+
+        first_times = self.__first_times
+        manifest = {"source": self.source, "factor": self.factor, "time_name": self.__time_name,
+                    "channels": self.__channels, "units": self.__units, "rows": self.__rows,
+                    "sample_time": first_times[1] - first_times[0] if len(first_times) == 2 else None,
+                    "levels": levels}
+        with open(os.path.join(self.directory, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        self.result = TracePyramid(self.directory)
+        return self.result
+
+
+class TracePyramid:
+    '''
+    Pyramid written by build_pyramid(), with its levels memory-mapped so only the bins queried are read from disk.
+
+    directory           = Directory the pyramid was written to
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.factor = self.manifest["factor"]
+        self.channels = self.manifest["channels"]
+        self.sample_time = self.manifest["sample_time"]
+        self.__levels = []
+        for level in self.manifest["levels"]:
+            self.__levels.append({name: np.load(os.path.join(directory, file_name), mmap_mode="r")
+                                  for name, file_name in level["files"].items()})
+
+    # Number of levels, level 1 is the finest
+    @property
+    def levels(self):
+        return len(self.__levels)
+
+    # Number of raw samples in each bin of 'level'
+    def bin_samples(self, level):
+        return self.factor ** level
+
+    # Returns the coarsest level with bins no longer than 'resolution' (in the units of the time column), or level 1
+    # if every level is coarser
+    def level_for(self, resolution):
+        if self.levels == 0:
+            raise ValueError ("The pyramid has no levels")
+        if self.sample_time is None or resolution is None:
+            return 1
+        level = 1
+        while level < self.levels and self.bin_samples(level + 1) * self.sample_time <= resolution:
+            level += 1
+        return level
+
+    '''
+    Returns a PyramidSummary of the bins that overlap the time range 'start' to 'end', from one level.  The level is
+    chosen from 'resolution' (the longest bin wanted, in the units of the time column), or from 'points' (the most
+    bins wanted across the range, about), or given directly as 'level'.
+
+    start, end          = Time range, in the units of the time column.
+    resolution          = Longest bin wanted.
+    points              = Most bins wanted across the range, if 'resolution' is not given.
+    level               = Level to read, instead of choosing it from the resolution.
+    channels            = Channels to return, all of them if None.
+    '''
+    def query(self, start, end, resolution=None, points=None, level=None, channels=None):
+        if end < start:
+            raise ValueError ("The end of the range must not be before the start")
+        if level is None:
+            if resolution is None and points is not None:
+                # The finest level with bins at least as long as the range divided by the number of points
+                level = self.level_for((end - start) / max(points, 1))
+                if self.sample_time is not None and self.bin_samples(level) * self.sample_time * points < end - start:
+                    level = min(level + 1, self.levels)
+            else:
+                level = self.level_for(resolution)
+        if not 1 <= level <= self.levels:
+            raise ValueError ("Level must be from 1 to " + str(self.levels))
+        channels = self.channels if channels is None else channels
+        for name in channels:
+            if name not in self.channels:
+                raise ValueError ("Pyramid does not contain the channel: " + name)
+
+        arrays = self.__levels[level - 1]
+        # Bins are in time order, so the range is found with a binary search of the memory-mapped times
+        first = int(np.searchsorted(arrays["time_end"], start, side="left"))
+        last = int(np.searchsorted(arrays["time_start"], end, side="right"))
+        positions = [self.channels.index(name) for name in channels]
+        stats = {}
+        for stat in ("min", "max", "mean", "count"):
+            block = np.asarray(arrays[stat][first:last])
+            stats[stat] = {name: block[:, position] for name, position in zip(channels, positions)}
+        return PyramidSummary(level, self.bin_samples(level), np.asarray(arrays["time_start"][first:last]),
+                              np.asarray(arrays["time_end"][first:last]), stats["min"], stats["max"], stats["mean"],
+                              stats["count"])
+
+
+class _LevelWriter:
+    '''
+    Combines each 'factor' bins added into one bin of this level, writing them to the level's .npy files and passing
+    them on to the next level.  The next level is only created once this level has more than one bin, so the top
+    level has a single bin.
+    '''
+    def __init__(self, directory, level, factor, channels, time_dtype):
+        self.directory = directory
+        self.level = level
+        self.factor = factor
+        self.channels = channels
+        self.time_dtype = time_dtype
+        self.bins = 0
+        self.next_level = None
+        self.__pending = None
+        self.__held = None
+        self.__files = {}
+        for name, dtype in _LEVEL_ARRAYS:
+            dtype = time_dtype if dtype == "time" else dtype
+            shape = () if name.startswith("time") else (channels,)
+            file_name = "level%d_%s.npy" % (level, name)
+            file_stream = open(os.path.join(directory, file_name), 'wb')
+            file_stream.write(npy_header(dtype, 0, shape))
+            self.__files[name] = (file_name, file_stream, dtype, shape)
+
+    # Adds bins of the level below (or raw samples): times of their first and last samples, and (bins, channels)
+    # arrays of their min, max, sum and count
+    def add(self, time_start, time_end, mins, maxs, sums, counts):
+        if self.__pending is not None:
+            time_start, time_end, mins, maxs, sums, counts = (
+                np.concatenate((pending, new)) for pending, new in
+                zip(self.__pending, (time_start, time_end, mins, maxs, sums, counts)))
+        complete = len(time_start) // self.factor * self.factor
+        self.__pending = tuple(array[complete:] for array in (time_start, time_end, mins, maxs, sums, counts))
+        if complete > 0:
+            self.__emit(*(array[:complete] for array in (time_start, time_end, mins, maxs, sums, counts)))
+
+    # Writes the last, part filled bin, and finishes the levels above
+    def finish(self):
+        if self.__pending is not None and len(self.__pending[0]) > 0:
+            self.__emit(*self.__pending)
+        self.__pending = None
+        if self.next_level is not None:
+            self.next_level.finish()
+
+    # Fills in the row counts of the level's files, returning its manifest entry
+    def close(self):
+        files = {}
+        for name, (file_name, file_stream, dtype, shape) in self.__files.items():
+            file_stream.seek(0)
+            file_stream.write(npy_header(dtype, self.bins, shape))
+            file_stream.close()
+            files[name] = file_name
+        return {"level": self.level, "bins": self.bins, "files": files}
+
+    # Combines whole groups of 'factor' bins (the last group may be shorter) into bins of this level
+    def __emit(self, time_start, time_end, mins, maxs, sums, counts):
+        starts = np.arange(0, len(time_start), self.factor)
+        ends = np.append(starts[1:], len(time_start))
+        bins = (time_start[starts], time_end[ends - 1], np.minimum.reduceat(mins, starts, axis=0),
+                np.maximum.reduceat(maxs, starts, axis=0), np.add.reduceat(sums, starts, axis=0),
+                np.add.reduceat(counts, starts, axis=0))
+        self.__write(*bins)
+        self.bins += len(starts)
+
+        if self.next_level is None:
+            if self.__held is None and self.bins == 1:
+                # The next level is only needed once this level has a second bin
+                self.__held = bins
+                return
+            self.next_level = _LevelWriter(self.directory, self.level + 1, self.factor, self.channels,
+                                           self.time_dtype)
+            if self.__held is not None:
+                self.next_level.add(*self.__held)
+                self.__held = None
+        self.next_level.add(*bins)
+
+    def __write(self, time_start, time_end, mins, maxs, sums, counts):
+        empty = counts == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(empty, np.nan, sums / np.maximum(counts, 1))
+        arrays = {"time_start": time_start, "time_end": time_end, "min": np.where(empty, np.nan, mins),
+                  "max": np.where(empty, np.nan, maxs), "mean": means, "count": counts}
+        for name, (file_name, file_stream, dtype, shape) in self.__files.items():
+            np.ascontiguousarray(arrays[name], dtype=dtype).tofile(file_stream)
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+"""
+Chunked reader for the CSV traces saved by QIS and QPS, shared by the post processing examples.  It is kept once,
+in Application_Notes/libs, and each example adds that folder to the path to import it.
+
+The post processing examples each read their traces in their own way, splitting every line in Python or reading the
+whole file into memory first.  TraceReader reads the trace once, in large chunks, and parses each chunk with NumPy
+array operations into blocks of typed columns, so a trace of any size is processed in bounded memory.
+
+The header variants written by QIS and QPS are handled:
+
+1- Column names with units ("Tot uW", "Time (us)", "5V Voltage [mV]"), optionally quoted, with or without a trailing
+   delimiter on each line
+2- Blank lines between the header and the data, and a row of units under the names
+3- A STATISTICS footer after the data ("MAX,..", "MIN,..", "AVE,.."), which is returned in 'footer' rather than being
+   read as data
+
+The data ends at the first blank line, or at the first line that does not start with a number.
+
+Example:
+    with TraceReader("RawData.csv", columns=["Time us", "Tot uW"]) as reader:
+        for block in reader:
+            power = block.columns["Tot uW"]
+"""
+import csv
+import io
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+# Size of each chunk of the file that is read and parsed at once
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# Default number of rows in each block returned by TraceReader
+BLOCK_ROWS = 1 << 20
+
+# Block of rows from a trace.  'first_row' is the row number of the first row in the block, counted from the first
+# data line.  'columns' maps each column name to an int64 or float64 array.  'missing' maps each column name to a bool
+# array, True where the value is empty (0 in int64 columns, NaN in float64 columns), or None if no value is missing.
+# 'offsets' holds the byte offset in the file of each row, if the reader was created with row_offsets=True
+TraceBlock = namedtuple("TraceBlock", ("first_row", "columns", "missing", "offsets"), defaults=(None,))
+
+# Multiplier of each unit prefix
+_PREFIXES = {"p": 1e-12, "n": 1e-9, "u": 1e-6, "µ": 1e-6, "m": 1e-3, "": 1.0, "k": 1e3, "M": 1e6, "G": 1e9}
+
+# Units recognised at the end of a column name, such as "uW" in "Tot uW"
+_UNIT = re.compile(r"^(?:[pnuµmkMG]?(?:V|A|W|VA|VAr|VAR|Wh|J|s|S|Hz|Ohm|C)|%|dB|degC)$")
+
+# Characters a data line can start with
+_DATA_START = np.zeros(256, dtype=bool)
+_DATA_START[[ord(char) for char in "0123456789+-."]] = True
+
+
+class TraceReader:
+    '''
+    Reads a QIS / QPS CSV trace as blocks of typed NumPy columns (TraceBlock), by iterating over the reader.  The
+    header is read when the reader is created, so 'names' and 'units' can be checked before reading the data.
+
+    source          = Path of the CSV file, or an open file object (text or binary) read from its current position
+    columns         = Names of the columns to read, every named column if None
+    delimiter       = Delimiter character used in the CSV file
+    block_rows      = Number of rows in each block, the last block may be shorter
+    dtypes          = Optional dict of column name to np.int64 or np.float64.  Other columns are read as int64 until a
+                      value that is not an integer is found, and as float64 from that block on
+    chunk_bytes     = Size of each chunk of the file read and parsed at once
+    row_offsets     = True to return the byte offset in the file of each row in 'offsets' of each block
+    start_offset    = Optional byte offset of a data line to start reading from, instead of the first data line, such as
+                      an offset returned in 'offsets'.  The header is still read from the start of the file
+    start_row       = Row number of the line at 'start_offset', used for 'first_row' and in error messages
+
+    'row_offsets' and 'start_offset' need a path, or a seekable file opened in binary mode.
+    '''
+    def __init__(self, source, columns=None, delimiter=",", block_rows=BLOCK_ROWS, dtypes=None,
+                 chunk_bytes=CHUNK_BYTES, row_offsets=False, start_offset=None, start_row=0):
+        if len(delimiter) != 1:
+            raise ValueError ("Delimiter must be a single character")
+        if block_rows < 1:
+            raise ValueError ("Block size must be at least 1 row")
+        self.delimiter = delimiter
+        self.block_rows = block_rows
+        self.chunk_bytes = chunk_bytes
+        self.row_offsets = row_offsets
+        if isinstance(source, (str, bytes, os.PathLike)):
+            self.__file = open(source, "rb")
+            self.__owns_file = True
+        else:
+            self.__file = source
+            self.__owns_file = False
+        self.__text = isinstance(self.__file, io.TextIOBase)
+        self.__carry = b""
+        self.__carry_offset = None
+        self.__positions = {}
+        self.__started = False
+        # Header, set when the reader is created
+        self.header_line = None
+        self.names = []
+        self.units = {}
+        self.data_offset = None
+        self.data_line = None
+        # Data, set as the trace is read
+        self.rows = start_row
+        self.__start_row = start_row
+        self.footer = {}
+        self.complete = False
+
+        try:
+            self.__read_header()
+            if columns is None:
+                columns = self.names
+            self.columns = []
+            for name in columns:
+                name = _clean_name(name)
+                if name not in self.__positions:
+                    raise ValueError ("File does not contain the specified column name: " + name)
+                self.columns.append(name)
+            self.__dtypes = {}
+            for name, dtype in (dtypes or {}).items():
+                dtype = np.dtype(dtype)
+                if dtype not in (np.int64, np.float64):
+                    raise ValueError ("Column types must be int64 or float64")
+                self.__dtypes[_clean_name(name)] = dtype
+            self.__forced = set(self.__dtypes)
+            if row_offsets or start_offset is not None:
+                if self.__text or self.data_offset is None:
+                    raise ValueError ("Row offsets need a seekable file opened in binary mode")
+                self.__carry_offset = self.data_offset
+            if start_offset is not None:
+                if start_offset < self.data_offset:
+                    raise ValueError ("Start offset is before the first data line")
+                self.__file.seek(start_offset)
+                self.__carry = b""
+                self.__carry_offset = start_offset
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Closes the file, if the reader opened it
+    def close(self):
+        if self.__owns_file and not self.__file.closed:
+            self.__file.close()
+
+    # Type of each column read so far
+    @property
+    def dtypes(self):
+        return {name: self.__dtypes.get(name, np.dtype(np.int64)) for name in self.columns}
+
+    # Yields the blocks of the trace.  A trace can only be iterated over once
+    def __iter__(self):
+        if self.__started:
+            raise ValueError ("The trace has already been read")
+        self.__started = True
+
+        pending = None
+        for columns, missing, offsets in self.__read_chunks():
+            if pending is not None:
+                columns = {name: np.concatenate((pending[0][name], columns[name])) for name in self.columns}
+                missing = {name: np.concatenate((pending[1][name], missing[name])) for name in self.columns}
+                if offsets is not None:
+                    offsets = np.concatenate((pending[2], offsets))
+            rows = len(missing[self.columns[0]]) if self.columns else 0
+            start = 0
+            while rows - start >= self.block_rows:
+                yield self.__block(columns, missing, offsets, start, start + self.block_rows)
+                start += self.block_rows
+            pending = None
+            if start < rows:
+                pending = ({name: values[start:] for name, values in columns.items()},
+                           {name: empty[start:] for name, empty in missing.items()},
+                           None if offsets is None else offsets[start:])
+        if pending is not None:
+            yield self.__block(pending[0], pending[1], pending[2], 0, len(pending[1][self.columns[0]]))
+        self.complete = True
+
+    # Reads the whole trace into one block
+    def read(self):
+        first_row = self.rows
+        blocks = list(self)
+        if len(blocks) == 0:
+            return TraceBlock(first_row, {name: np.zeros(0, dtype=self.dtypes[name]) for name in self.columns},
+                              {name: None for name in self.columns},
+                              np.zeros(0, dtype=np.int64) if self.row_offsets else None)
+        if len(blocks) == 1:
+            return blocks[0]
+        columns = {name: np.concatenate([block.columns[name] for block in blocks]) for name in self.columns}
+        missing = {}
+        for name in self.columns:
+            if all(block.missing[name] is None for block in blocks):
+                missing[name] = None
+            else:
+                missing[name] = np.concatenate([np.zeros(len(block.columns[name]), dtype=bool)
+                                                if block.missing[name] is None else block.missing[name]
+                                                for block in blocks])
+        offsets = np.concatenate([block.offsets for block in blocks]) if self.row_offsets else None
+        return TraceBlock(first_row, columns, missing, offsets)
+
+    # Returns a TraceBlock of rows 'start' to 'end' of the parsed columns
+    def __block(self, columns, missing, offsets, start, end):
+        block = TraceBlock(self.rows, {name: columns[name][start:end] for name in self.columns},
+                           {name: missing[name][start:end] if missing[name][start:end].any() else None
+                            for name in self.columns}, None if offsets is None else offsets[start:end])
+        self.rows += end - start
+        return block
+
+    # Reads the header line, and any blank lines and row of units after it
+    def __read_header(self):
+        line_number = 0
+        while True:
+            line = self.__file.readline()
+            if len(line) == 0:
+                raise ValueError ("File does not contain a header line")
+            line_number += 1
+            if len(line.strip()) > 0:
+                break
+        self.header_line = _decode(line).rstrip("\r\n")
+        for position, field in enumerate(self.__split_line(self.header_line)):
+            name = _clean_name(field)
+            if len(name) > 0 and name not in self.__positions:
+                self.__positions[name] = position
+                self.names.append(name)
+                self.units[name] = _name_unit(name)
+
+        while True:
+            offset = self.__tell()
+            line = self.__file.readline()
+            if len(line) == 0:
+                break
+            if len(line.strip()) == 0:
+                line_number += 1
+                continue
+            fields = self.__split_line(_decode(line).rstrip("\r\n"))
+            if _is_units_row(fields):
+                line_number += 1
+                for name, position in self.__positions.items():
+                    if position < len(fields) and len(_clean_name(fields[position])) > 0:
+                        self.units[name] = _clean_name(fields[position]).strip("()[]")
+                continue
+            # The first data line is parsed with the rest of the data
+            self.__carry = line.encode("utf-8") if self.__text else line
+            break
+        self.data_offset = offset
+        self.data_line = line_number + 1
+
+    # Yields the parsed columns, missing values and row offsets (or None) of each chunk of the data, then reads the
+    # footer
+    def __read_chunks(self):
+        carry = self.__carry
+        carry_offset = self.__carry_offset
+        self.__carry = b""
+        parsed_rows = self.__start_row
+        while True:
+            chunk = self.__file.read(self.chunk_bytes)
+            if self.__text:
+                chunk = chunk.encode("utf-8")
+            at_end = len(chunk) == 0
+            if at_end:
+                # A last line without a line ending is completed
+                if len(carry) == 0:
+                    break
+                chunk = b"\n"
+            data = carry + chunk
+            last_newline = data.rfind(b"\n")
+            if last_newline < 0:
+                carry = data
+                continue
+            carry = data[last_newline + 1:]
+            data = np.frombuffer(data, dtype=np.uint8, count=last_newline + 1)
+
+            columns, missing, line_starts, data_end = self.__parse_chunk(data, self.data_line + parsed_rows)
+            rows = len(line_starts)
+            parsed_rows += rows
+            offsets = None
+            if self.row_offsets:
+                offsets = line_starts.astype(np.int64) + carry_offset
+                carry_offset += last_newline + 1
+            if rows > 0:
+                yield columns, missing, offsets
+            if data_end is not None:
+                self.__read_footer(bytes(data[data_end:]) + carry)
+                break
+            if at_end:
+                break
+
+    # Parses the chunk of whole lines in 'data'.  Returns (columns, missing, line_starts, data_end), where line_starts
+    # holds the offset of each data line in 'data', and data_end is the offset of the line that ended the data, or None
+    # if every line is data.  'first_line' is the line number of the chunk
+    def __parse_chunk(self, data, first_line):
+        newlines = np.flatnonzero(data == 10)
+        line_starts = np.concatenate(([0], newlines[:-1] + 1))
+        line_ends = newlines.copy()
+        # Remove any carriage return from the line ending
+        has_cr = (line_ends > line_starts) & (data[np.maximum(line_ends - 1, 0)] == 13)
+        line_ends[has_cr] -= 1
+
+        # The data ends at the first blank line, or line that does not start with a number
+        first_chars = data[line_starts]
+        is_data = _DATA_START[first_chars] | (first_chars == ord(self.delimiter))
+        not_data = np.flatnonzero(~is_data)
+        data_end = None
+        if len(not_data) > 0:
+            data_end = int(line_starts[not_data[0]])
+            line_starts = line_starts[:not_data[0]]
+            line_ends = line_ends[:not_data[0]]
+
+        # Find the delimiters either side of each field, fields missing from short lines are empty
+        delimiters = np.flatnonzero(data == ord(self.delimiter))
+        first_delimiter = np.searchsorted(delimiters, line_starts)
+        padded = np.append(delimiters, len(data))
+        columns = {}
+        missing = {}
+        for name in self.columns:
+            position = self.__positions[name]
+            if position == 0:
+                field_starts = line_starts
+            else:
+                field_starts = padded[np.minimum(first_delimiter + position - 1, len(delimiters))] + 1
+                short = field_starts > line_ends
+                field_starts = np.where(short, line_ends, field_starts)
+            field_ends = np.minimum(padded[np.minimum(first_delimiter + position, len(delimiters))], line_ends)
+            columns[name], missing[name] = self.__parse_values(name, data, field_starts, field_ends, first_line)
+        return columns, missing, line_starts, data_end
+
+    # Parses the fields of one column as integers, changing the column to float64 if a field is not an integer
+    def __parse_values(self, name, data, starts, ends, first_line):
+        dtype = self.__dtypes.get(name, np.dtype(np.int64))
+        if dtype == np.int64:
+            values, empty, bad = _parse_integers(data, starts, ends)
+            if not bad.any():
+                return values, empty
+            if name in self.__forced:
+                line = int(np.flatnonzero(bad)[0])
+                raise ValueError ("Invalid value on line " + str(first_line + line) + ": " +
+                                  bytes(data[starts[line]:ends[line]]).decode("latin1"))
+            self.__dtypes[name] = np.dtype(np.float64)
+        return _parse_floats(data, starts, ends, first_line)
+
+    # Reads the lines after the data, keeping each labelled row (such as "MAX,1,2,3") in 'footer'.  'remaining' is the
+    # text already read after the data, which may end part way through a line
+    def __read_footer(self, remaining):
+        rest = self.__file.read()
+        lines = _decode(remaining + (rest.encode("utf-8") if self.__text else rest)).splitlines()
+        for fields in csv.reader(lines, delimiter=self.delimiter):
+            if len(fields) < 2 or len(fields[0].strip()) == 0:
+                continue
+            self.footer[fields[0].strip()] = [_footer_value(field) for field in fields[1:]]
+
+    def __split_line(self, line):
+        return next(csv.reader([line], delimiter=self.delimiter), [])
+
+    # Returns the position in the file, or None if the file cannot report it
+    def __tell(self):
+        try:
+            return self.__file.tell()
+        except (OSError, AttributeError):
+            return None
+
+
+# Returns the multiplier from 'unit' to 'base' (such as 1e-6 for "uW" to "W"), or None if 'unit' is not 'base'.  A
+# time unit may end in "s" or "S", as QIS writes "Time uS" or "Time nS" and QPS "Time mS"
+def unit_scale (unit, base):
+    if unit is None:
+        return None
+    match = re.match(r"^([pnuµmkMG]?)" + ("[sS]" if base == "s" else re.escape(base)) + "$", unit)
+    return None if match is None else _PREFIXES[match.group(1)]
+
+
+# Parses the integer text of each field (from 'starts' to 'ends' in 'data'), one character position at a time across
+# all fields.  Returns (values, empty, bad) arrays, 'bad' is True where a field is not a valid integer
+def _parse_integers (data, starts, ends):
+    lengths = ends - starts
+    empty = lengths == 0
+    last = len(data) - 1
+    negative = ~empty & (data[np.minimum(starts, last)] == ord("-"))
+    digit_starts = starts + negative
+    bad = negative & (digit_starts == ends)
+    values = np.zeros(len(starts), dtype=np.int64)
+    max_length = int(lengths.max()) if len(lengths) > 0 else 0
+    for offset in range(max_length):
+        positions = digit_starts + offset
+        active = positions < ends
+        if not active.any():
+            break
+        digits = data[np.minimum(positions, last)].astype(np.int64) - ord("0")
+        bad |= active & ((digits < 0) | (digits > 9))
+        values = np.where(active, values * 10 + digits, values)
+    values[negative] = -values[negative]
+    return values, empty, bad
+
+
+# Parses the text of each field as a float, by gathering the fields into a fixed width byte string array that NumPy
+# converts in one call.  Returns (values, empty), with NaN for empty fields
+def _parse_floats (data, starts, ends, first_line):
+    lengths = ends - starts
+    empty = lengths == 0
+    values = np.full(len(starts), np.nan)
+    present = np.flatnonzero(~empty)
+    if len(present) == 0:
+        return values, empty
+    width = int(lengths[present].max())
+    offsets = np.arange(width)
+    positions = np.minimum(starts[present, None] + offsets, len(data) - 1)
+    text = np.where(offsets < lengths[present, None], data[positions], 0).astype(np.uint8)
+    strings = np.ascontiguousarray(text).view("S" + str(width)).ravel()
+    try:
+        values[present] = strings.astype(np.float64)
+    except ValueError:
+        for index, string in enumerate(strings):
+            try:
+                float(string)
+            except ValueError:
+                raise ValueError ("Invalid value on line " + str(first_line + int(present[index])) + ": " +
+                                  string.decode("latin1")) from None
+        raise
+    return values, empty
+
+
+# Returns a column name without quotes or surrounding whitespace
+def _clean_name (name):
+    return name.strip().strip("\"").strip()
+
+
+# Returns the unit at the end of a column name, or None
+def _name_unit (name):
+    bracketed = re.match(r"^.*?[\(\[]([^\)\]]*)[\)\]]$", name)
+    if bracketed is not None:
+        return bracketed.group(1).strip()
+    words = name.split()
+    if len(words) > 1 and _UNIT.match(words[-1]) is not None:
+        return words[-1]
+    return None
+
+
+# Returns True if a line under the header is a row of units rather than data
+def _is_units_row (fields):
+    values = [_clean_name(field) for field in fields if len(_clean_name(field)) > 0]
+    if len(values) == 0:
+        return False
+    for value in values:
+        if not isinstance(_footer_value(value), str) or _UNIT.match(value.strip("()[]")) is None:
+            return False
+    return True
+
+
+# Returns a footer field as an int or float, or as text if it is not a number (None if empty)
+def _footer_value (field):
+    field = field.strip()
+    if len(field) == 0:
+        return None
+    for convert in (int, float):
+        try:
+            return convert(field)
+        except ValueError:
+            pass
+    return field
+
+
+def _decode (line):
+    if isinstance(line, str):
+        return line
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("latin1")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Running sums of fixed length windows over values read a block at a time, shared by the window calculations of the
+application notes.
+
+The sum of every run of 'samples' consecutive values is the difference of two cumulative sums, so a block of N values
+gives all of its windows in O(N) whatever the window length.  The last (samples - 1) values of each block are carried
+into the next block, so the windows that span two blocks are included, and the result is the same as for one block
+of all the values.
+
+Example:
+    sums = WindowSums(1000)
+    worst = None
+    for values in blocks:
+        window_sums = sums.add(values)
+        if len(window_sums) > 0:
+            worst = combine(max, worst, window_sums.max().item())
+"""
+import numpy as np
+
+
+class WindowSums:
+    '''
+    Sums of every run of 'samples' consecutive values, for values added a block at a time.
+
+    samples         = Number of values in each window
+    '''
+    def __init__(self, samples):
+        self.samples = samples
+        self.__carry = np.zeros(0, dtype=np.int64)
+
+    # Returns the sums of the windows that end in 'values', in order (empty if fewer than 'samples' values have been
+    # added).  Integer values are summed as int64 and others as float64
+    def add(self, values):
+        samples = self.samples
+        joined = np.concatenate((self.__carry, values)) if len(self.__carry) > 0 else values
+        sums = np.cumsum(joined, dtype=np.float64 if joined.dtype.kind == "f" else np.int64)
+        if len(joined) >= samples:
+            window_sums = sums[samples - 1:].copy()
+            window_sums[1:] -= sums[:-samples]
+        else:
+            window_sums = sums[:0]
+        # The last (samples - 1) values start the windows that end in the next block
+        self.__carry = joined[max(len(joined) - samples + 1, 0):] if samples > 1 else joined[:0]
+        return window_sums
+
+
+# Returns function(current, value), or value if current is None
+def combine (function, current, value):
+    return value if current is None else function(current, value)